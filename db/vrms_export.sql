@@ -22,7 +22,7 @@ CREATE TABLE User (
     Name VARCHAR(100) NOT NULL,
     Email VARCHAR(100) NOT NULL UNIQUE,
     Phone VARCHAR(20),
-    Password VARCHAR(100) NOT NULL,
+    Password VARCHAR(255) NOT NULL,        -- werkzeug hash (plaintext rows are rehashed at login)
     RoleID INT NOT NULL,
     CONSTRAINT fk_user_role
         FOREIGN KEY (RoleID)
@@ -32,8 +32,19 @@ CREATE TABLE User (
 );
 
 -- =========================
--- 3. VEHICLE TABLE
+-- 3. BRANCH & VEHICLE TABLES
 -- =========================
+
+-- Rental locations. Each branch's vehicles, and their rentals and
+-- payments, live in one database shard (web/shards.py); 0 is this
+-- database. Role, Branch and User are copied to every shard.
+CREATE TABLE Branch (
+    BranchID INT AUTO_INCREMENT PRIMARY KEY,
+    Name VARCHAR(100) NOT NULL UNIQUE,
+    City VARCHAR(100),
+    Shard INT NOT NULL DEFAULT 0
+);
+
 CREATE TABLE Vehicle (
     VehicleID INT AUTO_INCREMENT PRIMARY KEY,
     VehicleType VARCHAR(50) NOT NULL,
@@ -41,9 +52,16 @@ CREATE TABLE Vehicle (
     RegistrationNumber VARCHAR(50) NOT NULL UNIQUE,
     RentalPrice DECIMAL(10,2) NOT NULL,
     Status VARCHAR(30) NOT NULL
-        CHECK (Status IN ('Available','Rented','Maintenance'))
+        CHECK (Status IN ('Available','Rented','Maintenance')),
+    BranchID INT NOT NULL DEFAULT 1,
+    CONSTRAINT fk_vehicle_branch
+        FOREIGN KEY (BranchID) REFERENCES Branch(BranchID)
+        ON UPDATE CASCADE ON DELETE RESTRICT
 );
 
+-- vehicle filters: status first, then type, then price range
+CREATE INDEX idx_vehicle_status_type_price ON Vehicle (Status, VehicleType, RentalPrice);
+
 -- =========================
 -- 4. RENTAL TABLE
 -- =========================
@@ -54,8 +72,11 @@ CREATE TABLE Rental (
     RentalDate DATE NOT NULL,
     ReturnDate DATE,
     TotalAmount DECIMAL(10,2) NOT NULL,
+    -- set by the scheduler's overdue sweep / late-fee jobs (web/scheduler.py)
+    LateFee DECIMAL(10,2) NOT NULL DEFAULT 0,
+    OverdueSince DATE,
     Status VARCHAR(30) NOT NULL
-        CHECK (Status IN ('Active','Completed','Cancelled')),
+        CHECK (Status IN ('Reserved','Active','Completed','Cancelled')),
     CONSTRAINT fk_rental_user
         FOREIGN KEY (UserID) REFERENCES User(UserID)
         ON DELETE CASCADE,
@@ -64,6 +85,18 @@ CREATE TABLE Rental (
         ON DELETE CASCADE
 );
 
+-- a customer's active rentals
+CREATE INDEX idx_rental_user_status ON Rental (UserID, Status);
+
+-- admin reports: most recent rentals
+CREATE INDEX idx_rental_date ON Rental (RentalDate);
+
+-- analytics: active rentals and rentals still running in a date range
+CREATE INDEX idx_rental_status_return ON Rental (Status, ReturnDate);
+
+-- booking: a vehicle's active rentals and reservations overlapping a date range
+CREATE INDEX idx_rental_vehicle_status_date ON Rental (VehicleID, Status, RentalDate);
+
 -- =========================
 -- 5. PAYMENT TABLE
 -- =========================
@@ -78,6 +111,9 @@ CREATE TABLE Payment (
         ON DELETE CASCADE
 );
 
+-- admin reports: most recent payments
+CREATE INDEX idx_payment_date ON Payment (PaymentDate);
+
 -- =========================
 -- 6. SAMPLE DATA
 -- =========================
@@ -102,17 +138,21 @@ INSERT INTO User (Name, Email, Phone, Password, RoleID) VALUES
 ('Henry Clark', 'henry@vrms.com', '4564564567', 'pass', 3);
 
 -- Vehicles (10 vehicles)
-INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status) VALUES
-('Car','Toyota Corolla','TX1001',50.00,'Available'),
-('Car','Honda Civic','TX1002',55.00,'Available'),
-('Car','Tesla Model 3','TX1003',120.00,'Available'),
-('Bike','Yamaha MT-15','BK2001',25.00,'Available'),
-('Bike','Royal Enfield Classic','BK2002',30.00,'Available'),
-('SUV','Toyota Highlander','SUV3001',90.00,'Available'),
-('SUV','Ford Explorer','SUV3002',95.00,'Available'),
-('Van','Dodge Caravan','VN4001',80.00,'Available'),
-('Truck','Ford F-150','TR5001',110.00,'Available'),
-('Truck','Ram 1500','TR5002',115.00,'Available');
+INSERT INTO Branch (Name, City) VALUES
+('Downtown', 'Austin'),
+('Airport', 'Austin');
+
+INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status, BranchID) VALUES
+('Car','Toyota Corolla','TX1001',50.00,'Available',1),
+('Car','Honda Civic','TX1002',55.00,'Available',1),
+('Car','Tesla Model 3','TX1003',120.00,'Available',1),
+('Bike','Yamaha MT-15','BK2001',25.00,'Available',1),
+('Bike','Royal Enfield Classic','BK2002',30.00,'Available',1),
+('SUV','Toyota Highlander','SUV3001',90.00,'Available',2),
+('SUV','Ford Explorer','SUV3002',95.00,'Available',2),
+('Van','Dodge Caravan','VN4001',80.00,'Available',2),
+('Truck','Ford F-150','TR5001',110.00,'Available',2),
+('Truck','Ram 1500','TR5002',115.00,'Available',2);
 
 -- =========================
 -- 7. TRIGGERS
@@ -138,10 +178,15 @@ CREATE TRIGGER trg_rental_update_status
 AFTER UPDATE ON Rental
 FOR EACH ROW
 BEGIN
-    IF NEW.Status IN ('Completed','Cancelled') THEN
+    -- a cancelled reservation never had the vehicle
+    IF OLD.Status = 'Active' AND NEW.Status IN ('Completed','Cancelled') THEN
         UPDATE Vehicle
         SET Status = 'Available'
         WHERE VehicleID = NEW.VehicleID;
+    ELSEIF OLD.Status = 'Reserved' AND NEW.Status = 'Active' THEN
+        UPDATE Vehicle
+        SET Status = 'Rented'
+        WHERE VehicleID = NEW.VehicleID;
     END IF;
 END$$
 
@@ -155,33 +200,113 @@ DROP PROCEDURE IF EXISTS sp_book_vehicle;
 
 DELIMITER $$
 
+-- p_Total is the app's quote (web/pricing.py); NULL = RentalPrice * days
 CREATE PROCEDURE sp_book_vehicle(
     IN p_UserID INT,
     IN p_VehicleID INT,
-    IN p_Days INT
+    IN p_Days INT,
+    IN p_Total DECIMAL(10,2)
 )
 BEGIN
     DECLARE v_price DECIMAL(10,2);
     DECLARE v_total DECIMAL(10,2);
+    DECLARE v_slot INT;
 
     IF p_Days IS NULL OR p_Days < 1 THEN
         SET p_Days = 1;
     END IF;
 
+    -- lock the vehicle row: concurrent bookings of the same vehicle queue
+    -- here, and once the first commits the others no longer see it as
+    -- 'Available' and fall through to the SIGNAL below
     SELECT RentalPrice INTO v_price
     FROM Vehicle
     WHERE VehicleID = p_VehicleID
-      AND Status = 'Available';
+      AND Status = 'Available'
+    FOR UPDATE;
 
-    IF v_price IS NULL THEN
+    -- nor may the rental run into a reservation of the vehicle
+    IF v_price IS NULL OR EXISTS (
+        SELECT 1 FROM Rental
+        WHERE VehicleID = p_VehicleID AND Status = 'Reserved'
+          AND RentalDate < DATE_ADD(CURDATE(), INTERVAL p_Days DAY)
+          AND ReturnDate > CURDATE()
+    ) THEN
         SIGNAL SQLSTATE '45000'
             SET MESSAGE_TEXT = 'Vehicle not available for booking';
     END IF;
 
-    SET v_total = v_price * p_Days;
+    SET v_total = COALESCE(p_Total, v_price * p_Days);
 
+    -- trg_rental_insert_status marks the vehicle 'Rented'
     INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status)
     VALUES (p_UserID, p_VehicleID, CURDATE(), DATE_ADD(CURDATE(), INTERVAL p_Days DAY), v_total, 'Active');
+
+    -- one of the metric's slots (web/aggregates.py): a single row here
+    -- would stay locked until COMMIT and queue every booking behind it
+    SET v_slot = FLOOR(RAND() * 16);
+    UPDATE ReportTotals SET Value = Value + 1
+    WHERE Metric = 'total_rentals' AND Slot = v_slot;
+
+    SELECT LAST_INSERT_ID() AS RentalID, v_total AS TotalAmount;
+END$$
+
+DELIMITER ;
+
+DROP PROCEDURE IF EXISTS sp_reserve_vehicle;
+
+DELIMITER $$
+
+-- a 'Reserved' rental over [p_Start, p_Start + p_Days); the vehicle keeps
+-- its status until the reservation is picked up; p_Total as in sp_book_vehicle
+CREATE PROCEDURE sp_reserve_vehicle(
+    IN p_UserID INT,
+    IN p_VehicleID INT,
+    IN p_Start DATE,
+    IN p_Days INT,
+    IN p_Total DECIMAL(10,2)
+)
+BEGIN
+    DECLARE v_price DECIMAL(10,2);
+    DECLARE v_total DECIMAL(10,2);
+    DECLARE v_slot INT;
+    DECLARE v_end DATE;
+
+    IF p_Days IS NULL OR p_Days < 1 THEN
+        SET p_Days = 1;
+    END IF;
+    SET v_end = DATE_ADD(p_Start, INTERVAL p_Days DAY);
+
+    -- the same row lock as sp_book_vehicle: bookings and reservations of
+    -- one vehicle queue here
+    SELECT RentalPrice INTO v_price
+    FROM Vehicle
+    WHERE VehicleID = p_VehicleID
+      AND Status <> 'Maintenance'
+    FOR UPDATE;
+
+    IF v_price IS NULL OR EXISTS (
+        SELECT 1 FROM Rental
+        WHERE VehicleID = p_VehicleID AND Status IN ('Active','Reserved')
+          AND RentalDate < v_end
+          AND COALESCE(ReturnDate, '9999-12-31') > p_Start
+    ) THEN
+        SIGNAL SQLSTATE '45000'
+            SET MESSAGE_TEXT = 'Vehicle not available for these dates';
+    END IF;
+
+    SET v_total = COALESCE(p_Total, v_price * p_Days);
+
+    INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status)
+    VALUES (p_UserID, p_VehicleID, p_Start, v_end, v_total, 'Reserved');
+
+    -- one of the metric's slots (web/aggregates.py): a single row here
+    -- would stay locked until COMMIT and queue every booking behind it
+    SET v_slot = FLOOR(RAND() * 16);
+    UPDATE ReportTotals SET Value = Value + 1
+    WHERE Metric = 'total_rentals' AND Slot = v_slot;
+
+    SELECT LAST_INSERT_ID() AS RentalID, v_total AS TotalAmount;
 END$$
 
 DELIMITER ;
@@ -215,3 +340,140 @@ INSERT INTO Payment (RentalID, PaymentDate, Amount, PaymentMode) VALUES
 (8,'2024-02-18',240.00,'Card'),
 (9,'2024-03-04',330.00,'Cash'),
 (10,'2024-03-06',115.00,'Cash');
+
+-- =========================
+-- 10. REPORT TOTALS
+-- =========================
+
+-- Running totals for the admin reports page, maintained by the app on
+-- every insert/delete (web/aggregates.py) and reconciled periodically.
+-- Each metric is the sum of its 16 slots (aggregates.SLOTS); a write adds
+-- to one at random, so concurrent bookings rarely wait on the same row.
+CREATE TABLE ReportTotals (
+    Metric VARCHAR(50) NOT NULL,
+    Slot TINYINT NOT NULL DEFAULT 0,
+    Value DECIMAL(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (Metric, Slot)
+);
+
+INSERT INTO ReportTotals (Metric, Slot, Value)
+SELECT 'total_users', 0, COUNT(*) FROM User
+UNION ALL SELECT 'total_vehicles', 0, COUNT(*) FROM Vehicle
+UNION ALL SELECT 'total_rentals', 0, COUNT(*) FROM Rental
+UNION ALL SELECT 'total_revenue', 0, IFNULL(SUM(Amount),0) FROM Payment;
+
+INSERT INTO ReportTotals (Metric, Slot, Value)
+SELECT m.Metric, s.Slot, 0
+FROM (SELECT 'total_users' AS Metric UNION ALL SELECT 'total_vehicles'
+      UNION ALL SELECT 'total_rentals' UNION ALL SELECT 'total_revenue') m
+CROSS JOIN (SELECT 1 AS Slot UNION ALL SELECT 2 UNION ALL SELECT 3 UNION ALL SELECT 4
+            UNION ALL SELECT 5 UNION ALL SELECT 6 UNION ALL SELECT 7 UNION ALL SELECT 8
+            UNION ALL SELECT 9 UNION ALL SELECT 10 UNION ALL SELECT 11 UNION ALL SELECT 12
+            UNION ALL SELECT 13 UNION ALL SELECT 14 UNION ALL SELECT 15) s;
+
+-- =========================
+-- 11. PRICING RULES
+-- =========================
+
+-- Rules web/pricing.py turns rental quotes with. VehicleType NULL = every
+-- type (matched case-insensitively). Kinds:
+--   weekend      Multiplier on each Saturday / Sunday of the rental
+--   season       Multiplier on each day from StartDate to EndDate (inclusive)
+--   long_rental  Multiplier on the whole rental from Threshold days on
+--   surge        Multiplier on the whole rental once Threshold (0..1) of the
+--                vehicle type's fleet is rented out
+-- Day rules multiply; of the long_rental / surge rules only the highest
+-- Threshold reached counts.
+CREATE TABLE PricingRule (
+    RuleID INT AUTO_INCREMENT PRIMARY KEY,
+    Kind VARCHAR(20) NOT NULL
+        CHECK (Kind IN ('weekend','season','long_rental','surge')),
+    VehicleType VARCHAR(50),
+    StartDate DATE,
+    EndDate DATE,
+    Threshold DECIMAL(8,3),
+    Multiplier DECIMAL(6,3) NOT NULL CHECK (Multiplier > 0)
+);
+
+INSERT INTO PricingRule (Kind, VehicleType, StartDate, EndDate, Threshold, Multiplier) VALUES
+('weekend', NULL, NULL, NULL, NULL, 1.15),
+('season', NULL, '2026-12-20', '2027-01-05', NULL, 1.25),
+('long_rental', NULL, NULL, NULL, 7, 0.90),
+('long_rental', NULL, NULL, NULL, 14, 0.85),
+('surge', NULL, NULL, NULL, 0.80, 1.20),
+('surge', 'SUV', NULL, NULL, 0.50, 1.10);
+
+-- =========================
+-- 12. SCHEDULED JOBS
+-- =========================
+
+-- One row per background job of web/scheduler.py: when it last ran, how it
+-- went, and the lease of the process running it now (LockedBy /
+-- LockedUntil), so only one app process runs a job at a time. Times are
+-- Unix epoch seconds.
+CREATE TABLE JobState (
+    JobName VARCHAR(50) PRIMARY KEY,
+    LockedBy VARCHAR(100),
+    LockedUntil DOUBLE,
+    LastStarted DOUBLE,
+    LastFinished DOUBLE,
+    LastStatus VARCHAR(10),
+    LastDuration DOUBLE,
+    LastResult TEXT,
+    Runs INT NOT NULL DEFAULT 0,
+    Failures INT NOT NULL DEFAULT 0
+);
+
+-- =========================
+-- 13. ARCHIVE
+-- =========================
+
+-- Completed / Cancelled rentals older than ARCHIVE_AFTER_DAYS, with their
+-- payments, moved out of Rental / Payment in batches by web/archive.py so
+-- the live tables and their indexes only hold recent and open rentals.
+-- Same columns (no foreign keys: a deleted user's or vehicle's archived
+-- rows are deleted by the app); PaymentArchive also carries its rental's
+-- UserID and VehicleID so a customer's archived payments are one index
+-- range. The storage layer reads both tiers where a listing or report
+-- reaches back that far. ArchivedBefore: no row dated before it is left
+-- in the live tables that the archiver would have moved.
+CREATE TABLE RentalArchive (
+    RentalID INT PRIMARY KEY,
+    UserID INT NOT NULL,
+    VehicleID INT NOT NULL,
+    RentalDate DATE NOT NULL,
+    ReturnDate DATE,
+    TotalAmount DECIMAL(10,2) NOT NULL,
+    LateFee DECIMAL(10,2) NOT NULL DEFAULT 0,
+    OverdueSince DATE,
+    Status VARCHAR(30) NOT NULL
+);
+
+CREATE INDEX idx_rental_archive_user ON RentalArchive (UserID);
+CREATE INDEX idx_rental_archive_vehicle ON RentalArchive (VehicleID);
+CREATE INDEX idx_rental_archive_date ON RentalArchive (RentalDate);
+CREATE INDEX idx_rental_archive_return ON RentalArchive (ReturnDate);
+
+CREATE TABLE PaymentArchive (
+    PaymentID INT PRIMARY KEY,
+    RentalID INT NOT NULL,
+    PaymentDate DATE NOT NULL,
+    Amount DECIMAL(10,2) NOT NULL,
+    PaymentMode VARCHAR(20) NOT NULL,
+    UserID INT NOT NULL,
+    VehicleID INT NOT NULL
+);
+
+CREATE INDEX idx_payment_archive_user ON PaymentArchive (UserID, PaymentID);
+CREATE INDEX idx_payment_archive_vehicle ON PaymentArchive (VehicleID);
+CREATE INDEX idx_payment_archive_date ON PaymentArchive (PaymentDate);
+
+CREATE TABLE ArchiveState (
+    Name VARCHAR(30) PRIMARY KEY,
+    ArchivedBefore DATE,
+    Rentals BIGINT NOT NULL DEFAULT 0,
+    Payments BIGINT NOT NULL DEFAULT 0,
+    LastRun DOUBLE
+);
+
+INSERT INTO ArchiveState (Name) VALUES ('rentals');
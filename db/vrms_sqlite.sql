@@ -0,0 +1,358 @@
+-- Vehicle Rental Management System - SQLite version of vrms_export.sql
+-- Used by web/sqlite_compat.py for local runs and load tests without MySQL.
+-- Same tables, constraints, triggers and sample data; SQLite has no stored
+-- procedures, so sp_book_vehicle and sp_reserve_vehicle are not included.
+
+PRAGMA foreign_keys = ON;
+
+DROP TABLE IF EXISTS ArchiveState;
+DROP TABLE IF EXISTS PaymentArchive;
+DROP TABLE IF EXISTS RentalArchive;
+DROP TABLE IF EXISTS JobState;
+DROP TABLE IF EXISTS PricingRule;
+DROP TABLE IF EXISTS ReportTotals;
+DROP TABLE IF EXISTS Payment;
+DROP TABLE IF EXISTS Rental;
+DROP TABLE IF EXISTS Vehicle;
+DROP TABLE IF EXISTS Branch;
+DROP TABLE IF EXISTS User;
+DROP TABLE IF EXISTS Role;
+
+-- =========================
+-- 1. ROLE TABLE
+-- =========================
+CREATE TABLE Role (
+    RoleID INTEGER PRIMARY KEY AUTOINCREMENT,
+    RoleName VARCHAR(50) NOT NULL UNIQUE
+);
+
+-- =========================
+-- 2. USER TABLE
+-- =========================
+CREATE TABLE User (
+    UserID INTEGER PRIMARY KEY AUTOINCREMENT,
+    Name VARCHAR(100) NOT NULL,
+    Email VARCHAR(100) NOT NULL UNIQUE,
+    Phone VARCHAR(20),
+    Password VARCHAR(255) NOT NULL,        -- werkzeug hash (plaintext rows are rehashed at login)
+    RoleID INT NOT NULL
+        REFERENCES Role(RoleID) ON UPDATE CASCADE ON DELETE RESTRICT
+);
+
+-- =========================
+-- 3. BRANCH & VEHICLE TABLES
+-- =========================
+
+-- Rental locations. Each branch's vehicles, and their rentals and
+-- payments, live in one database shard (web/shards.py); 0 is this
+-- database. Role, Branch and User are copied to every shard.
+CREATE TABLE Branch (
+    BranchID INTEGER PRIMARY KEY AUTOINCREMENT,
+    Name VARCHAR(100) NOT NULL UNIQUE,
+    City VARCHAR(100),
+    Shard INT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE Vehicle (
+    VehicleID INTEGER PRIMARY KEY AUTOINCREMENT,
+    VehicleType VARCHAR(50) NOT NULL,
+    Model VARCHAR(100) NOT NULL,
+    RegistrationNumber VARCHAR(50) NOT NULL UNIQUE,
+    RentalPrice DECIMAL(10,2) NOT NULL,
+    Status VARCHAR(30) NOT NULL
+        CHECK (Status IN ('Available','Rented','Maintenance')),
+    BranchID INT NOT NULL DEFAULT 1
+        REFERENCES Branch(BranchID) ON UPDATE CASCADE ON DELETE RESTRICT
+);
+
+-- vehicle filters: status first, then type, then price range
+CREATE INDEX idx_vehicle_status_type_price ON Vehicle (Status, VehicleType, RentalPrice);
+
+-- a branch's vehicles; MySQL indexes foreign keys itself
+CREATE INDEX idx_vehicle_branch ON Vehicle (BranchID);
+
+-- =========================
+-- 4. RENTAL TABLE
+-- =========================
+CREATE TABLE Rental (
+    RentalID INTEGER PRIMARY KEY AUTOINCREMENT,
+    UserID INT NOT NULL
+        REFERENCES User(UserID) ON DELETE CASCADE,
+    VehicleID INT NOT NULL
+        REFERENCES Vehicle(VehicleID) ON DELETE CASCADE,
+    RentalDate DATE NOT NULL,
+    ReturnDate DATE,
+    TotalAmount DECIMAL(10,2) NOT NULL,
+    -- set by the scheduler's overdue sweep / late-fee jobs (web/scheduler.py)
+    LateFee DECIMAL(10,2) NOT NULL DEFAULT 0,
+    OverdueSince DATE,
+    Status VARCHAR(30) NOT NULL
+        CHECK (Status IN ('Reserved','Active','Completed','Cancelled'))
+);
+
+-- a customer's active rentals
+CREATE INDEX idx_rental_user_status ON Rental (UserID, Status);
+
+-- admin reports: most recent rentals
+CREATE INDEX idx_rental_date ON Rental (RentalDate);
+
+-- analytics: active rentals and rentals still running in a date range
+CREATE INDEX idx_rental_status_return ON Rental (Status, ReturnDate);
+
+-- booking: a vehicle's active rentals and reservations overlapping a date range
+CREATE INDEX idx_rental_vehicle_status_date ON Rental (VehicleID, Status, RentalDate);
+
+-- =========================
+-- 5. PAYMENT TABLE
+-- =========================
+CREATE TABLE Payment (
+    PaymentID INTEGER PRIMARY KEY AUTOINCREMENT,
+    RentalID INT NOT NULL
+        REFERENCES Rental(RentalID) ON DELETE CASCADE,
+    PaymentDate DATE NOT NULL,
+    Amount DECIMAL(10,2) NOT NULL,
+    PaymentMode VARCHAR(20) NOT NULL
+);
+
+-- admin reports: most recent payments
+CREATE INDEX idx_payment_date ON Payment (PaymentDate);
+
+-- a rental's payments (cascades, the archiver); MySQL indexes foreign keys itself
+CREATE INDEX idx_payment_rental ON Payment (RentalID);
+
+-- =========================
+-- 6. SAMPLE DATA
+-- =========================
+
+INSERT INTO Role (RoleName) VALUES
+('Admin'),
+('Staff'),
+('Customer');
+
+INSERT INTO User (Name, Email, Phone, Password, RoleID) VALUES
+('Admin One', 'admin1@vrms.com', '1112223333', 'pass', 1),
+('Staff One', 'staff1@vrms.com', '2223334444', 'pass', 2),
+('Alice Johnson', 'alice@vrms.com', '3334445555', 'pass', 3),
+('Bob Smith', 'bob@vrms.com', '4445556666', 'pass', 3),
+('Charlie Brown', 'charlie@vrms.com', '5556667777', 'pass', 3),
+('David Miller', 'david@vrms.com', '6667778888', 'pass', 3),
+('Eve Adams', 'eve@vrms.com', '7778889999', 'pass', 3),
+('Frank Harris', 'frank@vrms.com', '8889990000', 'pass', 3),
+('Grace Lee', 'grace@vrms.com', '1231231234', 'pass', 3),
+('Henry Clark', 'henry@vrms.com', '4564564567', 'pass', 3);
+
+INSERT INTO Branch (Name, City) VALUES
+('Downtown', 'Austin'),
+('Airport', 'Austin');
+
+INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status, BranchID) VALUES
+('Car','Toyota Corolla','TX1001',50.00,'Available',1),
+('Car','Honda Civic','TX1002',55.00,'Available',1),
+('Car','Tesla Model 3','TX1003',120.00,'Available',1),
+('Bike','Yamaha MT-15','BK2001',25.00,'Available',1),
+('Bike','Royal Enfield Classic','BK2002',30.00,'Available',1),
+('SUV','Toyota Highlander','SUV3001',90.00,'Available',2),
+('SUV','Ford Explorer','SUV3002',95.00,'Available',2),
+('Van','Dodge Caravan','VN4001',80.00,'Available',2),
+('Truck','Ford F-150','TR5001',110.00,'Available',2),
+('Truck','Ram 1500','TR5002',115.00,'Available',2);
+
+-- =========================
+-- 7. TRIGGERS
+-- =========================
+
+CREATE TRIGGER trg_rental_insert_status
+AFTER INSERT ON Rental
+FOR EACH ROW
+WHEN NEW.Status = 'Active'
+BEGIN
+    UPDATE Vehicle
+    SET Status = 'Rented'
+    WHERE VehicleID = NEW.VehicleID;
+END;
+
+CREATE TRIGGER trg_rental_update_status
+AFTER UPDATE ON Rental
+FOR EACH ROW
+WHEN OLD.Status = 'Active' AND NEW.Status IN ('Completed','Cancelled')
+BEGIN
+    UPDATE Vehicle
+    SET Status = 'Available'
+    WHERE VehicleID = NEW.VehicleID;
+END;
+
+-- a reservation picked up (MySQL does both in trg_rental_update_status)
+CREATE TRIGGER trg_rental_pickup_status
+AFTER UPDATE ON Rental
+FOR EACH ROW
+WHEN OLD.Status = 'Reserved' AND NEW.Status = 'Active'
+BEGIN
+    UPDATE Vehicle
+    SET Status = 'Rented'
+    WHERE VehicleID = NEW.VehicleID;
+END;
+
+-- =========================
+-- 8. SAMPLE RENTALS & PAYMENTS (10 each)
+-- =========================
+
+INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status) VALUES
+(3,1,'2024-01-10','2024-01-12',100.00,'Completed'),
+(4,2,'2024-01-12','2024-01-15',165.00,'Completed'),
+(5,3,'2024-01-15','2024-01-17',240.00,'Completed'),
+(6,4,'2024-01-20','2024-01-21',25.00,'Completed'),
+(7,5,'2024-02-01','2024-02-03',60.00,'Completed'),
+(8,6,'2024-02-05','2024-02-08',270.00,'Completed'),
+(9,7,'2024-02-10','2024-02-11',95.00,'Completed'),
+(10,8,'2024-02-15','2024-02-18',240.00,'Completed'),
+(3,9,'2024-03-01','2024-03-04',330.00,'Completed'),
+(4,10,'2024-03-05',NULL,115.00,'Active');
+
+INSERT INTO Payment (RentalID, PaymentDate, Amount, PaymentMode) VALUES
+(1,'2024-01-12',100.00,'Cash'),
+(2,'2024-01-15',165.00,'Card'),
+(3,'2024-01-17',240.00,'Cash'),
+(4,'2024-01-21',25.00,'Card'),
+(5,'2024-02-03',60.00,'Cash'),
+(6,'2024-02-08',270.00,'Card'),
+(7,'2024-02-11',95.00,'Cash'),
+(8,'2024-02-18',240.00,'Card'),
+(9,'2024-03-04',330.00,'Cash'),
+(10,'2024-03-06',115.00,'Cash');
+
+-- =========================
+-- 9. REPORT TOTALS
+-- =========================
+
+-- Running totals for the admin reports page, maintained by the app on
+-- every insert/delete (web/aggregates.py) and reconciled periodically.
+-- Each metric is the sum of its 16 slots (aggregates.SLOTS); a write adds
+-- to one at random, so concurrent bookings rarely wait on the same row.
+CREATE TABLE ReportTotals (
+    Metric VARCHAR(50) NOT NULL,
+    Slot TINYINT NOT NULL DEFAULT 0,
+    Value DECIMAL(14,2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (Metric, Slot)
+);
+
+INSERT INTO ReportTotals (Metric, Slot, Value)
+SELECT 'total_users', 0, COUNT(*) FROM User
+UNION ALL SELECT 'total_vehicles', 0, COUNT(*) FROM Vehicle
+UNION ALL SELECT 'total_rentals', 0, COUNT(*) FROM Rental
+UNION ALL SELECT 'total_revenue', 0, IFNULL(SUM(Amount),0) FROM Payment;
+
+INSERT INTO ReportTotals (Metric, Slot, Value)
+SELECT m.Metric, s.Slot, 0
+FROM (SELECT 'total_users' AS Metric UNION ALL SELECT 'total_vehicles'
+      UNION ALL SELECT 'total_rentals' UNION ALL SELECT 'total_revenue') m
+CROSS JOIN (SELECT 1 AS Slot UNION ALL SELECT 2 UNION ALL SELECT 3 UNION ALL SELECT 4
+            UNION ALL SELECT 5 UNION ALL SELECT 6 UNION ALL SELECT 7 UNION ALL SELECT 8
+            UNION ALL SELECT 9 UNION ALL SELECT 10 UNION ALL SELECT 11 UNION ALL SELECT 12
+            UNION ALL SELECT 13 UNION ALL SELECT 14 UNION ALL SELECT 15) s;
+
+-- =========================
+-- 10. PRICING RULES
+-- =========================
+
+-- Rules web/pricing.py turns rental quotes with. VehicleType NULL = every
+-- type (matched case-insensitively). Kinds:
+--   weekend      Multiplier on each Saturday / Sunday of the rental
+--   season       Multiplier on each day from StartDate to EndDate (inclusive)
+--   long_rental  Multiplier on the whole rental from Threshold days on
+--   surge        Multiplier on the whole rental once Threshold (0..1) of the
+--                vehicle type's fleet is rented out
+-- Day rules multiply; of the long_rental / surge rules only the highest
+-- Threshold reached counts.
+CREATE TABLE PricingRule (
+    RuleID INTEGER PRIMARY KEY AUTOINCREMENT,
+    Kind VARCHAR(20) NOT NULL
+        CHECK (Kind IN ('weekend','season','long_rental','surge')),
+    VehicleType VARCHAR(50),
+    StartDate DATE,
+    EndDate DATE,
+    Threshold DECIMAL(8,3),
+    Multiplier DECIMAL(6,3) NOT NULL CHECK (Multiplier > 0)
+);
+
+INSERT INTO PricingRule (Kind, VehicleType, StartDate, EndDate, Threshold, Multiplier) VALUES
+('weekend', NULL, NULL, NULL, NULL, 1.15),
+('season', NULL, '2026-12-20', '2027-01-05', NULL, 1.25),
+('long_rental', NULL, NULL, NULL, 7, 0.90),
+('long_rental', NULL, NULL, NULL, 14, 0.85),
+('surge', NULL, NULL, NULL, 0.80, 1.20),
+('surge', 'SUV', NULL, NULL, 0.50, 1.10);
+
+-- =========================
+-- 11. SCHEDULED JOBS
+-- =========================
+
+-- One row per background job of web/scheduler.py: when it last ran, how it
+-- went, and the lease of the process running it now (LockedBy /
+-- LockedUntil), so only one app process runs a job at a time. Times are
+-- Unix epoch seconds.
+CREATE TABLE JobState (
+    JobName VARCHAR(50) PRIMARY KEY,
+    LockedBy VARCHAR(100),
+    LockedUntil REAL,
+    LastStarted REAL,
+    LastFinished REAL,
+    LastStatus VARCHAR(10),
+    LastDuration REAL,
+    LastResult TEXT,
+    Runs INT NOT NULL DEFAULT 0,
+    Failures INT NOT NULL DEFAULT 0
+);
+
+-- =========================
+-- 12. ARCHIVE
+-- =========================
+
+-- Completed / Cancelled rentals older than ARCHIVE_AFTER_DAYS, with their
+-- payments, moved out of Rental / Payment in batches by web/archive.py so
+-- the live tables and their indexes only hold recent and open rentals.
+-- Same columns (no foreign keys: a deleted user's or vehicle's archived
+-- rows are deleted by the app); PaymentArchive also carries its rental's
+-- UserID and VehicleID so a customer's archived payments are one index
+-- range. The storage layer reads both tiers where a listing or report
+-- reaches back that far. ArchivedBefore: no row dated before it is left
+-- in the live tables that the archiver would have moved.
+CREATE TABLE RentalArchive (
+    RentalID INTEGER PRIMARY KEY,
+    UserID INT NOT NULL,
+    VehicleID INT NOT NULL,
+    RentalDate DATE NOT NULL,
+    ReturnDate DATE,
+    TotalAmount DECIMAL(10,2) NOT NULL,
+    LateFee DECIMAL(10,2) NOT NULL DEFAULT 0,
+    OverdueSince DATE,
+    Status VARCHAR(30) NOT NULL
+);
+
+CREATE INDEX idx_rental_archive_user ON RentalArchive (UserID);
+CREATE INDEX idx_rental_archive_vehicle ON RentalArchive (VehicleID);
+CREATE INDEX idx_rental_archive_date ON RentalArchive (RentalDate);
+CREATE INDEX idx_rental_archive_return ON RentalArchive (ReturnDate);
+
+CREATE TABLE PaymentArchive (
+    PaymentID INTEGER PRIMARY KEY,
+    RentalID INT NOT NULL,
+    PaymentDate DATE NOT NULL,
+    Amount DECIMAL(10,2) NOT NULL,
+    PaymentMode VARCHAR(20) NOT NULL,
+    UserID INT NOT NULL,
+    VehicleID INT NOT NULL
+);
+
+CREATE INDEX idx_payment_archive_user ON PaymentArchive (UserID, PaymentID);
+CREATE INDEX idx_payment_archive_vehicle ON PaymentArchive (VehicleID);
+CREATE INDEX idx_payment_archive_date ON PaymentArchive (PaymentDate);
+
+CREATE TABLE ArchiveState (
+    Name VARCHAR(30) PRIMARY KEY,
+    ArchivedBefore DATE,
+    Rentals BIGINT NOT NULL DEFAULT 0,
+    Payments BIGINT NOT NULL DEFAULT 0,
+    LastRun REAL
+);
+
+INSERT INTO ArchiveState (Name) VALUES ('rentals');
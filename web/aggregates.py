@@ -0,0 +1,139 @@
+import random
+import threading
+import time
+
+# Running totals for the admin reports page, kept in the ReportTotals table
+# so the page reads four numbers instead of scanning User, Vehicle, Rental
+# and Payment on every load.
+#
+# Every write path calls bump() on its own cursor *before* committing, so
+# the totals change in the same transaction as the data. Each metric is
+# striped over SLOTS rows (Metric, Slot) and a bump updates one picked at
+# random: the row stays locked until the commit, and with a single row
+# per metric every booking -- of any vehicle -- would queue on it.
+# read_totals() sums the slots. reconcile()
+# recomputes everything from the base tables, reports any drift and
+# fixes it; run it from cron / the CLI or let start_reconciler() do it
+# on a timer.
+
+DEFAULTS = {
+    "REPORT_RECONCILE_INTERVAL": 0,   # seconds between reconciliations, 0 = off
+}
+
+SLOTS = 16                        # keep in step with db/vrms_export.sql's procedures
+
+COUNTERS = ("total_users", "total_vehicles", "total_rentals")
+METRICS = COUNTERS + ("total_revenue",)
+
+# how each metric is computed from scratch; rentals and payments moved to
+# the archive tables (archive.py) still count
+SOURCES = {
+    "total_users": "SELECT COUNT(*) FROM User",
+    "total_vehicles": "SELECT COUNT(*) FROM Vehicle",
+    "total_rentals": "SELECT (SELECT COUNT(*) FROM Rental) + (SELECT COUNT(*) FROM RentalArchive)",
+    "total_revenue": "SELECT (SELECT IFNULL(SUM(Amount),0) FROM Payment) "
+                     "+ (SELECT IFNULL(SUM(Amount),0) FROM PaymentArchive)",
+}
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    if app.config["REPORT_RECONCILE_INTERVAL"]:
+        start_reconciler(app, app.config["REPORT_RECONCILE_INTERVAL"])
+
+
+def bump(cur, **deltas):
+    # e.g. bump(cur, total_rentals=1) -- caller commits
+    for metric, delta in deltas.items():
+        if metric not in METRICS:
+            raise ValueError("unknown report metric: %s" % metric)
+        if delta:
+            cur.execute("UPDATE ReportTotals SET Value = Value + %s "
+                        "WHERE Metric = %s AND Slot = %s",
+                        (delta, metric, random.randrange(SLOTS)))
+
+
+def cascade_deltas(cur, column, key):
+    # what deleting a User/Vehicle takes with it through ON DELETE CASCADE;
+    # column is "UserID" or "VehicleID"
+    cur.execute("""
+        SELECT COUNT(DISTINCT r.RentalID) AS rentals, IFNULL(SUM(p.Amount),0) AS revenue
+        FROM Rental r
+        LEFT JOIN Payment p ON p.RentalID = r.RentalID
+        WHERE r.""" + column + """ = %s
+    """, (key,))
+    row = cur.fetchone()
+    if isinstance(row, dict):
+        return row["rentals"], row["revenue"]
+    return row[0], row[1]
+
+
+def read_totals(cn):
+    cur = cn.cursor()
+    cur.execute("SELECT Metric, SUM(Value) FROM ReportTotals GROUP BY Metric")
+    totals = dict(cur.fetchall())
+    cur.close()
+    out = {}
+    for metric in METRICS:
+        value = totals.get(metric, 0)
+        out[metric] = int(value) if metric in COUNTERS else value
+    return out
+
+
+def reconcile(cn):
+    # recompute every metric from the base tables; returns {metric: drift}
+    # for the ones that were wrong (and have now been corrected). Missing
+    # slot rows are created.
+    cur = cn.cursor()
+    cur.execute("SELECT Metric, Slot, Value FROM ReportTotals")
+    stored, slots = {}, {}
+    for metric, slot, value in cur.fetchall():
+        stored[metric] = stored.get(metric, 0) + value
+        slots.setdefault(metric, set()).add(slot)
+
+    drift = {}
+    for metric in METRICS:
+        missing = sorted(set(range(SLOTS)) - slots.get(metric, set()))
+        if missing:
+            cur.executemany("INSERT INTO ReportTotals (Metric, Slot, Value) VALUES (%s, %s, 0)",
+                            [(metric, slot) for slot in missing])
+        cur.execute(SOURCES[metric])
+        actual = cur.fetchone()[0]
+        if metric not in stored or float(stored[metric]) != float(actual):
+            # the whole value goes to slot 0, recomputed inside the UPDATE
+            # so writes that landed after the SELECT above are not lost
+            cur.execute("UPDATE ReportTotals SET Value = 0 WHERE Metric = %s AND Slot <> 0",
+                        (metric,))
+            cur.execute("UPDATE ReportTotals SET Value = (" + SOURCES[metric] + ") "
+                        "WHERE Metric = %s AND Slot = 0", (metric,))
+            drift[metric] = float(actual) - float(stored.get(metric, 0))
+    cn.commit()
+    cur.close()
+    return drift
+
+
+# ---------- PERIODIC RECONCILIATION ----------
+
+def reconcile_app(app):
+    # through the app's store, so it works for every backend
+    import storage
+    with app.app_context():
+        drift = storage.get_store(app).reports.reconcile()
+    if drift:
+        app.logger.warning("report totals drifted, corrected: %s", drift)
+    return drift
+
+
+def start_reconciler(app, interval):
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                reconcile_app(app)
+            except Exception:
+                app.logger.exception("report totals reconciliation failed")
+
+    t = threading.Thread(target=loop, name="vrms-reconcile", daemon=True)
+    t.start()
+    return t
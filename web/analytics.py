@@ -0,0 +1,501 @@
+import datetime
+import threading
+
+import numpy as np
+
+import archive
+
+# Revenue / rentals / utilization analytics for the admin reports page.
+#
+# Rows are pulled in bulk as plain columns (dates as day numbers via
+# TO_DAYS), already collapsed by a GROUP BY on the raw key columns so the
+# database ships one row per distinct (day, type, ...) rather than one per
+# rental; every group-by after that is a numpy bincount/cumsum, never a
+# Python loop per row. The columns come from a source object: SQLSource
+# below for MySQL / SQLite (ShardedSource over several database shards),
+# storage.memory's for the in-memory store. Finished days never change, so
+# their per-day rollups (per VehicleType: revenue, rentals started,
+# vehicle-days on rent) are cached in process; only today is recomputed on
+# each request. Deleting or retyping vehicles/users rewrites history, so
+# those paths call invalidate(), which reaches the other app processes too
+# (cachebus).
+# Archiving old rentals (archive.py) changes no result: a range that
+# starts before the archive's horizon reads both tiers in one statement.
+
+DEFAULTS = {
+    "ANALYTICS_MAX_DAYS": 3660,
+    "ANALYTICS_FETCH_SIZE": 100000,
+}
+
+GRANULARITIES = ("day", "week", "month")
+
+# python date.toordinal() == TO_DAYS(date) - 365
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    import cachebus
+    cachebus.handler("analytics")(_changed_elsewhere)
+
+
+def _fetch_columns(cn, sql, params, dtypes, batch):
+    # run `sql` and return one numpy array per selected column
+    cur = cn.cursor()
+    cur.execute(sql, params)
+    chunks = [[] for _ in dtypes]
+    while True:
+        rows = cur.fetchmany(batch)
+        if not rows:
+            break
+        for i, col in enumerate(zip(*rows)):
+            chunks[i].append(np.array(col, dtype=dtypes[i]))
+    cur.close()
+    return [np.concatenate(c) if c else np.empty(0, dtype=dtypes[i])
+            for i, c in enumerate(chunks)]
+
+
+_PAYMENTS = """
+    SELECT TO_DAYS(p.PaymentDate) - 365, v.VehicleType, SUM(p.Amount)
+    FROM Payment p
+    JOIN Rental r ON p.RentalID = r.RentalID
+    JOIN Vehicle v ON r.VehicleID = v.VehicleID
+    WHERE p.PaymentDate BETWEEN %s AND %s
+    GROUP BY p.PaymentDate, v.VehicleType
+"""
+
+# archived payments carry their rental's VehicleID
+_ARCHIVED_PAYMENTS = """
+    SELECT TO_DAYS(p.PaymentDate) - 365, v.VehicleType, SUM(p.Amount)
+    FROM PaymentArchive p
+    JOIN Vehicle v ON p.VehicleID = v.VehicleID
+    WHERE p.PaymentDate BETWEEN %s AND %s
+    GROUP BY p.PaymentDate, v.VehicleType
+"""
+
+_RENTALS = """
+    SELECT TO_DAYS(r.RentalDate) - 365,
+           COALESCE(TO_DAYS(r.ReturnDate), TO_DAYS(r.RentalDate)) - 365,
+           r.Status = 'Active', v.VehicleType, COUNT(*)
+    FROM {table} r
+    JOIN Vehicle v ON r.VehicleID = v.VehicleID
+    WHERE r.RentalDate <= %s
+      AND (r.Status = 'Active' OR (r.Status = 'Completed' AND r.ReturnDate >= %s))
+    GROUP BY r.RentalDate, r.ReturnDate, r.Status, v.VehicleType
+"""
+
+_VEHICLE_RENTALS = """
+    SELECT VehicleID, TO_DAYS(RentalDate) - 365,
+           COALESCE(TO_DAYS(ReturnDate), TO_DAYS(RentalDate)) - 365,
+           Status = 'Active', COUNT(*)
+    FROM {table}
+    WHERE RentalDate <= %s
+      AND (Status = 'Active' OR (Status = 'Completed' AND ReturnDate >= %s))
+    GROUP BY VehicleID, RentalDate, ReturnDate, Status
+"""
+
+
+class SQLSource:
+    # the engine's input columns, read from the tables over `cn`; a range
+    # starting before the archive's horizon also reads the archive tables,
+    # whose partial groups the engine adds up like any others
+
+    def __init__(self, cn, fetch_size=100000):
+        self.cn = cn
+        self.fetch_size = fetch_size
+        self._horizon = False           # not read yet
+
+    def _archived(self, lo):
+        if self._horizon is False:
+            self._horizon = archive.horizon(self.cn)
+        return self._horizon is not None and lo < self._horizon
+
+    def _fetch(self, live, archived, lo, params, dtypes):
+        sql = live
+        if self._archived(lo):
+            sql, params = live + " UNION ALL " + archived, params * 2
+        return _fetch_columns(self.cn, sql, params, dtypes, self.fetch_size)
+
+    def payments(self, lo, hi):
+        # (day, VehicleType, amount) for payments made lo..hi
+        return self._fetch(_PAYMENTS, _ARCHIVED_PAYMENTS, lo, (lo, hi),
+                           (np.int64, object, np.float64))
+
+    def rentals(self, lo, hi):
+        # (start day, end day, active, VehicleType, count) for rentals
+        # overlapping lo..hi
+        return self._fetch(_RENTALS.format(table="Rental"),
+                           _RENTALS.format(table="RentalArchive"), lo, (hi, lo),
+                           (np.int64, np.int64, bool, object, np.int64))
+
+    def vehicle_rentals(self, lo, hi):
+        # (VehicleID, start day, end day, active, count), same rentals
+        return self._fetch(_VEHICLE_RENTALS.format(table="Rental"),
+                           _VEHICLE_RENTALS.format(table="RentalArchive"), lo, (hi, lo),
+                           (np.int64, np.int64, np.int64, bool, np.int64))
+
+    def fleet(self):
+        # {VehicleType: number of vehicles}
+        cur = self.cn.cursor()
+        cur.execute("SELECT VehicleType, COUNT(*) FROM Vehicle GROUP BY VehicleType")
+        fleet = dict(cur.fetchall())
+        cur.close()
+        return fleet
+
+    def vehicles(self, ids):
+        # {VehicleID: {VehicleID, VehicleType, Model}}
+        placeholders = ", ".join(["%s"] * len(ids))
+        cur = self.cn.cursor(dictionary=True)
+        cur.execute("SELECT VehicleID, VehicleType, Model FROM Vehicle WHERE VehicleID IN ("
+                    + placeholders + ")", list(ids))
+        info = {row["VehicleID"]: row for row in cur.fetchall()}
+        cur.close()
+        return info
+
+
+class ShardedSource:
+    # the same columns over every database shard (shards.py): fan_out(fn)
+    # runs fn once per shard, concurrently, and make_source() there gives
+    # that shard's SQLSource. Each shard's groups are partial groups like
+    # the archive's, so the columns are simply concatenated
+
+    def __init__(self, make_source, fan_out):
+        self.make_source = make_source
+        self.fan_out = fan_out
+
+    def _columns(self, name, *args):
+        parts = self.fan_out(lambda: getattr(self.make_source(), name)(*args))
+        return [np.concatenate(columns) for columns in zip(*parts)]
+
+    def payments(self, lo, hi):
+        return self._columns("payments", lo, hi)
+
+    def rentals(self, lo, hi):
+        return self._columns("rentals", lo, hi)
+
+    def vehicle_rentals(self, lo, hi):
+        return self._columns("vehicle_rentals", lo, hi)
+
+    def fleet(self):
+        fleet = {}
+        for part in self.fan_out(lambda: self.make_source().fleet()):
+            for vehicle_type, vehicles in part.items():
+                fleet[vehicle_type] = fleet.get(vehicle_type, 0) + vehicles
+        return fleet
+
+    def vehicles(self, ids):
+        info = {}
+        for part in self.fan_out(lambda: self.make_source().vehicles(ids)):
+            info.update(part)
+        return info
+
+
+class DailyRollups:
+    # per-day, per-VehicleType arrays for a contiguous range of days
+
+    def __init__(self, first_day, ndays, ntypes):
+        self.first_day = first_day
+        self.revenue = np.zeros((ndays, ntypes))
+        self.rentals = np.zeros((ndays, ntypes), dtype=np.int64)
+        self.rented = np.zeros((ndays, ntypes), dtype=np.int64)   # vehicle-days
+
+    @property
+    def ndays(self):
+        return self.revenue.shape[0]
+
+    def widen(self, ntypes):
+        extra = ntypes - self.revenue.shape[1]
+        if extra > 0:
+            pad = ((0, 0), (0, extra))
+            self.revenue = np.pad(self.revenue, pad)
+            self.rentals = np.pad(self.rentals, pad)
+            self.rented = np.pad(self.rented, pad)
+
+    def concat(self, other):
+        ntypes = max(self.revenue.shape[1], other.revenue.shape[1])
+        self.widen(ntypes)
+        other.widen(ntypes)
+        first, second = (self, other) if self.first_day < other.first_day else (other, self)
+        out = DailyRollups(first.first_day, 0, ntypes)
+        out.revenue = np.concatenate([first.revenue, second.revenue])
+        out.rentals = np.concatenate([first.rentals, second.rentals])
+        out.rented = np.concatenate([first.rented, second.rented])
+        return out
+
+    def slice(self, d0, d1):
+        i, j = d0 - self.first_day, d1 - self.first_day + 1
+        out = DailyRollups(d0, 0, self.revenue.shape[1])
+        out.revenue = self.revenue[i:j]
+        out.rentals = self.rentals[i:j]
+        out.rented = self.rented[i:j]
+        return out
+
+
+class Analytics:
+
+    def __init__(self, max_days=3660):
+        self.max_days = max_days
+        self._lock = threading.Lock()
+        self._types = {}          # VehicleType -> column index, shared by all rollups
+        self._cache = None        # DailyRollups for closed days
+        self._vehicle_cache = {}  # (first, last closed day) -> rented days per vehicle
+        self.computed_days = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._cache = None
+            self._types = {}
+            self._vehicle_cache = {}
+
+    # ---------- bulk computation ----------
+
+    def _type_codes(self, names):
+        # map a column of VehicleType strings to stable column indexes
+        if len(names) == 0:
+            return np.empty(0, dtype=np.int64)
+        uniq, inverse = np.unique(names, return_inverse=True)
+        for name in uniq:
+            self._types.setdefault(name, len(self._types))
+        lookup = np.array([self._types[name] for name in uniq], dtype=np.int64)
+        return lookup[inverse]
+
+    def _compute(self, source, d0, d1, today):
+        # rollups for days d0..d1 (ordinals, inclusive) straight from the source
+        ndays = d1 - d0 + 1
+        lo, hi = datetime.date.fromordinal(d0), datetime.date.fromordinal(d1)
+
+        pay_day, pay_type, amount = source.payments(lo, hi)
+        start, end, active, rent_type, count = source.rentals(lo, hi)
+
+        pay_type = self._type_codes(pay_type)
+        rent_type = self._type_codes(rent_type)
+        ntypes = max(len(self._types), 1)
+        out = DailyRollups(d0, ndays, ntypes)
+        cells = ndays * ntypes
+
+        # revenue per (day, type)
+        idx = (pay_day - d0) * ntypes + pay_type
+        out.revenue = np.bincount(idx, weights=amount, minlength=cells).reshape(ndays, ntypes)
+
+        # rentals started per (day, type)
+        started = (start >= d0) & (start <= d1)
+        idx = (start[started] - d0) * ntypes + rent_type[started]
+        out.rentals = np.bincount(idx, weights=count[started],
+                                  minlength=cells).reshape(ndays, ntypes).astype(np.int64)
+
+        # vehicle-days on rent: each rental covers [start, end) -- at least one
+        # day -- and active ones run through today. difference array + cumsum
+        end = np.where(active, np.maximum(end, today + 1), np.maximum(end, start + 1))
+        s = np.clip(start, d0, d1 + 1) - d0
+        e = np.clip(end, d0, d1 + 1) - d0
+        keep = e > s
+        w = count[keep]
+        diff = (np.bincount(s[keep] * ntypes + rent_type[keep], weights=w, minlength=cells + ntypes)
+                - np.bincount(e[keep] * ntypes + rent_type[keep], weights=w, minlength=cells + ntypes))
+        out.rented = np.cumsum(diff.reshape(ndays + 1, ntypes), axis=0)[:ndays].astype(np.int64)
+
+        self.computed_days += ndays
+        return out
+
+    def rollups(self, source, d0, d1, today):
+        # closed days come from (and extend) the cache, today is always live
+        with self._lock:
+            parts = []
+            closed_end = min(d1, today - 1)
+            if d0 <= closed_end:
+                cache = self._cache
+                if cache is None:
+                    cache = self._compute(source, d0, closed_end, today)
+                else:
+                    cache_end = cache.first_day + cache.ndays - 1
+                    if d0 < cache.first_day:
+                        cache = cache.concat(self._compute(source, d0, cache.first_day - 1, today))
+                    if closed_end > cache_end:
+                        cache = cache.concat(self._compute(source, cache_end + 1, closed_end, today))
+                self._cache = cache
+                parts.append(cache.slice(d0, closed_end))
+            if d1 >= today:
+                parts.append(self._compute(source, max(d0, today), d1, today))
+
+            result = parts[0]
+            for part in parts[1:]:
+                result = result.concat(part)
+            result.widen(len(self._types))
+            return result, sorted(self._types, key=self._types.get)
+
+    # ---------- report ----------
+
+    def window(self, start, end, today=None):
+        # the (start, end) that report() covers: cut at today and at max_days
+        d1 = min(end.toordinal(), (today or datetime.date.today()).toordinal())
+        d0 = min(max(start.toordinal(), d1 - self.max_days + 1), d1)
+        return datetime.date.fromordinal(d0), datetime.date.fromordinal(d1)
+
+    def report(self, source, start, end, granularity="day", today=None):
+        start, end = self.window(start, end, today)
+        today = (today or datetime.date.today()).toordinal()
+        d0, d1 = start.toordinal(), end.toordinal()
+        ndays = d1 - d0 + 1
+
+        roll, types = self.rollups(source, d0, d1, today)
+
+        # revenue / rentals per period
+        days = np.arange(d0, d1 + 1) - _EPOCH
+        dates = days.astype("datetime64[D]")
+        if granularity == "month":
+            keys = dates.astype("datetime64[M]").astype("datetime64[D]")
+        elif granularity == "week":
+            keys = dates - ((days + 3) % 7).astype("timedelta64[D]")   # Monday
+        else:
+            keys = dates
+        periods, inverse = np.unique(keys, return_inverse=True)
+        revenue = np.bincount(inverse, weights=roll.revenue.sum(axis=1), minlength=len(periods))
+        rentals = np.bincount(inverse, weights=roll.rentals.sum(axis=1), minlength=len(periods))
+        series = [
+            {"period": str(p), "revenue": round(float(r), 2), "rentals": int(n)}
+            for p, r, n in zip(periods, revenue, rentals)
+        ]
+
+        # per VehicleType: rentals and utilization against the current fleet
+        fleet = source.fleet()
+        by_type = []
+        rentals_t = roll.rentals.sum(axis=0)
+        revenue_t = roll.revenue.sum(axis=0)
+        rented_t = roll.rented.sum(axis=0)
+        column = {name: i for i, name in enumerate(types)}
+        for name in set(types) | set(fleet):
+            i = column.get(name)
+            rented = int(rented_t[i]) if i is not None else 0
+            capacity = fleet.get(name, 0) * ndays
+            by_type.append({
+                "type": name,
+                "rentals": int(rentals_t[i]) if i is not None else 0,
+                "revenue": round(float(revenue_t[i]), 2) if i is not None else 0.0,
+                "rented_days": rented,
+                "utilization": round(100.0 * rented / capacity, 1) if capacity else 0.0,
+            })
+        by_type.sort(key=lambda t: (-t["rentals"], t["type"]))
+
+        total_capacity = sum(fleet.values()) * ndays
+        return {
+            "start": datetime.date.fromordinal(d0),
+            "end": datetime.date.fromordinal(d1),
+            "granularity": granularity,
+            "series": series,
+            "by_type": by_type,
+            "total_revenue": round(float(revenue.sum()), 2),
+            "total_rentals": int(rentals.sum()),
+            "utilization": round(100.0 * float(rented_t.sum()) / total_capacity, 1)
+                           if total_capacity else 0.0,
+        }
+
+    def _vehicle_days(self, source, d0, d1, today):
+        # (VehicleIDs, rented days of each) over d0..d1; sparse, as a shard's
+        # IDs start far above 0 (shards.py)
+        ids, start, end, active, count = source.vehicle_rentals(
+            datetime.date.fromordinal(d0), datetime.date.fromordinal(d1))
+        end = np.where(active, np.maximum(end, today + 1), np.maximum(end, start + 1))
+        days = np.clip(end, d0, d1 + 1) - np.clip(start, d0, d1 + 1)
+        return _sum_by(ids, days * count)
+
+    def vehicle_utilization(self, source, start, end, limit=10, today=None):
+        # rented-days / available-days per vehicle over [start, end];
+        # returns the `limit` busiest vehicles. Like the rollups, the closed
+        # part of the range is cached and only today is read live.
+        today = (today or datetime.date.today()).toordinal()
+        d0, d1 = start.toordinal(), min(end.toordinal(), today)
+        if d1 < d0:
+            return []
+
+        parts = []
+        closed_end = min(d1, today - 1)
+        if d0 <= closed_end:
+            with self._lock:
+                key = (d0, closed_end)
+                closed = self._vehicle_cache.get(key)
+                if closed is None:
+                    closed = self._vehicle_days(source, d0, closed_end, today)
+                    if len(self._vehicle_cache) >= 8:
+                        self._vehicle_cache.pop(next(iter(self._vehicle_cache)))
+                    self._vehicle_cache[key] = closed
+            parts.append(closed)
+        if d1 >= today:
+            parts.append(self._vehicle_days(source, max(d0, today), d1, today))
+
+        ids, rented = _sum_by(np.concatenate([p[0] for p in parts]),
+                              np.concatenate([p[1] for p in parts]))
+        # busiest first, ties by VehicleID
+        top = np.lexsort((ids, -rented))[:limit]
+        top = top[rented[top] > 0]
+        if len(top) == 0:
+            return []
+
+        info = source.vehicles([int(ids[i]) for i in top])
+
+        available = d1 - d0 + 1
+        out = []
+        for i in top:
+            vid = int(ids[i])
+            row = info.get(vid, {"VehicleType": "", "Model": "(deleted)"})
+            out.append({
+                "VehicleID": vid,
+                "VehicleType": row["VehicleType"],
+                "Model": row["Model"],
+                "rented_days": int(rented[i]),
+                "utilization": round(100.0 * float(rented[i]) / available, 1),
+            })
+        return out
+
+
+def _sum_by(ids, weights):
+    # (distinct ids, sum of the weights of each)
+    keys, inverse = np.unique(ids, return_inverse=True)
+    return keys, np.bincount(inverse, weights=weights, minlength=len(keys))
+
+
+_engine_lock = threading.Lock()
+
+
+def get_engine(app=None):
+    from flask import current_app
+    app = app or current_app
+    engine = app.extensions.get("vrms_analytics")
+    if engine is None:
+        with _engine_lock:
+            engine = app.extensions.get("vrms_analytics")
+            if engine is None:
+                engine = Analytics(max_days=app.config["ANALYTICS_MAX_DAYS"])
+                app.extensions["vrms_analytics"] = engine
+    return engine
+
+
+def invalidate():
+    import cachebus
+    get_engine().invalidate()
+    cachebus.publish("analytics")
+
+
+def _changed_elsewhere(app, key):
+    engine = app.extensions.get("vrms_analytics")
+    if engine is not None:
+        engine.invalidate()
+
+
+def parse_range(args, default_days=30):
+    # (start, end, granularity) from ?from=YYYY-MM-DD&to=YYYY-MM-DD&group=week
+    today = datetime.date.today()
+    try:
+        end = datetime.date.fromisoformat(args.get("to", ""))
+    except ValueError:
+        end = today
+    try:
+        start = datetime.date.fromisoformat(args.get("from", ""))
+    except ValueError:
+        start = end - datetime.timedelta(days=default_days - 1)
+    if start > end:
+        start, end = end, start
+    granularity = args.get("group", "day")
+    if granularity not in GRANULARITIES:
+        granularity = "day"
+    return start, end, granularity
@@ -1,18 +1,102 @@
-from flask import Flask, render_template, request, redirect, session, url_for
-import mysql.connector as mc
+import functools
+import io
+import json
+import time
+from datetime import date
+
+import click
+from flask import (Flask, Response, jsonify, render_template, request, redirect, session,
+                   stream_template, stream_with_context, url_for)
+
+import aggregates
+import analytics
+import archive
+import asyncdb
+import booking
+import bulk
+import cachebus
+import database
+import eventlog
+import httpcache
+import metrics
+import pagination
+import passwords
+import pricing
+import reservations
+import scheduler
+import search
+import shards
+import storage
+import users
+from storage import get_store
 
 app = Flask(__name__)
 app.secret_key = "mysecret"  # change if you like
 
-# ---------- DB CONNECTION ----------
-
-def get_db():
-    return mc.connect(
-        host="localhost",
-        user="root",
-        password="root@123",  # <<< CHANGE THIS
-        database="VehicleRentalDB"
-    )
+# ---------- DATA ACCESS ----------
+
+# every route reads and writes through the repositories of get_store()
+# (see storage/): MySQL, SQLite or in-memory depending on DB_BACKEND.
+# Connection settings and pool sizing for the SQL backends live in
+# database.DEFAULTS (MYSQL_*, DB_POOL_*); each request borrows one pooled
+# connection and it is returned automatically at teardown. The async views
+# run their independent reads concurrently, each on its own connection
+# (see asyncdb.py). Views marked @database.read_only read from the
+# DB_REPLICAS when there are any; writes always go to the primary. With
+# DB_SHARDS the branches' fleets are split across databases (shards.py)
+database.init_app(app)
+shards.init_app(app)
+storage.init_app(app)
+asyncdb.init_app(app)
+metrics.init_app(app)
+search.init_app(app)
+reservations.init_app(app)
+pricing.init_app(app)
+httpcache.init_app(app)
+eventlog.init_app(app)
+pagination.init_app(app)
+aggregates.init_app(app)
+analytics.init_app(app)
+archive.init_app(app)
+bulk.init_app(app)
+users.init_app(app)
+passwords.init_app(app)
+
+# ---------- CACHE COHERENCE ----------
+
+# the in-process caches above are updated by whichever worker writes;
+# the others hear about it over the cache bus and apply it before their
+# next request (see cachebus.py)
+cachebus.init_app(app)
+
+# ---------- BACKGROUND JOBS ----------
+
+# overdue rentals, late fees, report totals, vehicles stuck in maintenance,
+# archiving old rentals and per-process cleanup run on the scheduler's own threads and
+# connections (see scheduler.py); /admin/jobs shows how they went
+scheduler.init_app(app)
+
+# ---------- CURRENT USER ----------
+
+@app.before_request
+def load_current_user():
+    # role and name come from the user cache on every request rather than
+    # from what was put in the session at login, so role changes and
+    # deletions apply immediately (see users.py)
+    if "user_id" not in session:
+        return
+    user = users.get_user(session["user_id"])
+    if user is None:
+        session.clear()
+        return
+    if session.get("role") != user["RoleName"]:
+        session["role"] = user["RoleName"]
+    if session.get("name") != user["Name"]:
+        session["name"] = user["Name"]
+
+@app.errorhandler(passwords.PasswordBusy)
+def password_pool_busy(e):
+    return "The server is busy. Please try again in a moment.", 503
 
 # ---------- LOGIN / LOGOUT ----------
 
@@ -25,20 +109,28 @@ def login():
         if not email or not password:
             message = "Email and Password are required."
             return render_template("login.html", message=message)
-        
-        cn = get_db()
-        cur = cn.cursor(dictionary=True)
-        cur.execute("""
-            SELECT u.UserID, u.Password, r.RoleName, u.Name
-            FROM User u
-            LEFT JOIN Role r ON u.RoleID = r.RoleID
-            WHERE u.Email = %s
-        """, (email,))
-        user = cur.fetchone()
-        cur.close()
-        cn.close()
-
-        if user and user["Password"] == password:
+
+        # checked before any (slow) hashing is done
+        if not passwords.login_allowed(request.remote_addr, email):
+            message = "Too many login attempts. Please wait a minute and try again."
+            return render_template("login.html", message=message), 429
+
+        user = get_store().users.by_email(email)
+
+        # hashed on the password pool (see passwords.py)
+        try:
+            ok, rehash = passwords.verify_password(user["Password"] if user else None, password)
+        except passwords.PasswordBusy:
+            message = "The server is busy. Please try again."
+            return render_template("login.html", message=message), 503
+
+        if ok:
+            if rehash:
+                # plaintext or outdated hash: store a fresh one
+                try:
+                    passwords.upgrade(user["UserID"], user["Password"], password)
+                except passwords.PasswordBusy:
+                    pass   # try again at the next login
             session["user_id"] = user["UserID"]
             session["role"] = user["RoleName"]
             session["name"] = user["Name"] 
@@ -67,36 +159,23 @@ def register():
             message = "Name, Email, and Password are required."
             return render_template("register.html", message=message)
 
-        cn = get_db()
-        cur = cn.cursor(dictionary=True)
+        user_repo = get_store().users
 
         # find RoleID for 'Customer'
-        cur.execute("SELECT RoleID FROM Role WHERE RoleName = 'Customer'")
-        row = cur.fetchone()
-        if row:
-            role_id = row["RoleID"]
-        else:
+        role_id = user_repo.role_id("Customer")
+        if role_id is None:
             role_id = 3  # fallback if roles are already known
 
+        hashed = passwords.hash_password(password)
+
         # try to insert new user
         try:
-            cur2 = cn.cursor()
-            cur2.execute("""
-                INSERT INTO User (Name, Email, Phone, Password, RoleID)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (name, email, phone, password, role_id))
-            cn.commit()
-            cur2.close()
-            cur.close()
-            cn.close()
+            user_repo.add(name, email, phone, hashed, role_id)
 
             # After successful registration, show login page with message
             return render_template("login.html", message="Account created successfully. Please login.")
-        except Exception as e:
-            # most likely duplicate email or constraint error
-            cn.rollback()
-            cur.close()
-            cn.close()
+        except storage.ConstraintError:
+            # most likely duplicate email
             message = "Could not create account. Email may already be in use."
             return render_template("register.html", message=message)
 
@@ -109,10 +188,37 @@ def logout():
     session.clear()
     return redirect(url_for("login"))
 
+# ---------- BRANCHES ----------
+
+def _branch_arg():
+    # ?branch=<BranchID> narrows a dashboard to one branch's fleet, which
+    # is read from that branch's shard only; None for every branch
+    return request.args.get("branch", type=int)
+
+# ---------- VEHICLE SEARCH ----------
+
+@app.route("/vehicles/complete")
+@httpcache.cached("vehicles", "rentals")
+def vehicle_complete():
+    # autocompletion for the dashboards' filter boxes:
+    # ?field=type|model&prefix=Cor -> {"field": .., "prefix": .., "values": [..]}
+    if "user_id" not in session:
+        return jsonify({"error": "forbidden"}), 403
+    field = request.args.get("field", "model")
+    prefix = request.args.get("prefix", "").strip()
+    if field not in search.FIELDS:
+        return jsonify({"error": "field must be one of %s" % ", ".join(search.FIELDS)}), 400
+    limit = min(max(request.args.get("limit", app.config["SEARCH_SUGGESTIONS"], type=int), 1),
+                50)
+    values = get_store().vehicles.complete(field, prefix, limit) if prefix else []
+    return jsonify({"field": field, "prefix": prefix, "values": values})
+
 # ---------- CUSTOMER DASHBOARD (VIEW + RENT + RETURN) ----------
 
 @app.route("/customer")
-def customer_dashboard():
+@httpcache.cached("vehicles", "rentals", "pricing", daily=True)
+@database.read_only
+async def customer_dashboard():
     if "user_id" not in session:
         return redirect(url_for("login"))
     user_id = session["user_id"]
@@ -122,50 +228,54 @@ def customer_dashboard():
     f_model = request.args.get("model", "").strip()
     f_max_price = request.args.get("max_price", "").strip()
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
-
-    # build dynamic query for available vehicles
-    query = "SELECT * FROM Vehicle WHERE Status = 'Available'"
-    params = []
-
-    if f_type:
-        query += " AND VehicleType LIKE %s"
-        params.append("%" + f_type + "%")
-    if f_model:
-        query += " AND Model LIKE %s"
-        params.append("%" + f_model + "%")
+    max_val = None
     if f_max_price:
         try:
             max_val = float(f_max_price)
-            query += " AND RentalPrice <= %s"
-            params.append(max_val)
         except ValueError:
             pass  # ignore invalid price input
 
-    cur.execute(query, params)
-    vehicles = cur.fetchall()
-
-    # active rentals for this user (unchanged)
-    cur.execute("""
-        SELECT r.RentalID, v.Model, v.VehicleType, r.RentalDate,
-               r.ReturnDate, r.Status, r.TotalAmount
-        FROM Rental r
-        JOIN Vehicle v ON r.VehicleID = v.VehicleID
-        WHERE r.UserID = %s AND r.Status = 'Active'
-    """, (user_id,))
-    active_rentals = cur.fetchall()
-
-    cur.close()
-    cn.close()
+    # optional date range: vehicles free for the whole of [from, to)
+    dates = reservations.parse_range(request.args)
+    f_branch = _branch_arg()
+
+    store = get_store()
+
+    # available vehicles, best matches first (from the in-process search /
+    # reservation indexes), this user's active rentals and reservations,
+    # fetched concurrently
+    if dates:
+        find = functools.partial(store.vehicles.free_between, dates[0], dates[1],
+                                 vehicle_type=f_type, model=f_model, max_price=max_val,
+                                 branch=f_branch, ranked=True)
+    else:
+        find = functools.partial(store.vehicles.rank, status="Available", vehicle_type=f_type,
+                                 model=f_model, max_price=max_val, branch=f_branch)
+    vehicles, active_rentals, my_reservations = await asyncdb.get_executor().gather(
+        find,
+        functools.partial(store.rentals.active_for_user, user_id),
+        functools.partial(store.rentals.reservations_for_user, user_id))
+
+    # what each listed vehicle costs for the range (or one day from today),
+    # the same quote booking charges
+    start, days = (dates[0], (dates[1] - dates[0]).days) if dates else (date.today(), 1)
+    quotes = pricing.get_engine().quote_rows(store, vehicles, start, days)
 
     return render_template(
         "dashboard_customer.html",
         vehicles=vehicles,
+        quotes=quotes,
         active_rentals=active_rentals,
+        reservations=my_reservations,
         f_type=f_type,
         f_model=f_model,
-        f_max_price=f_max_price
+        f_max_price=f_max_price,
+        f_from=dates[0].isoformat() if dates else "",
+        f_to=dates[1].isoformat() if dates else "",
+        f_branch=f_branch,
+        branches=store.branches.all(),
+        days=days,
+        today=date.today()
     )
 
 
@@ -184,41 +294,60 @@ def customer_rent(vehicle_id):
     if days < 1:
         days = 1
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
+    # check availability, insert the rental and mark the vehicle 'Rented'
+    # in one atomic step (see booking.py)
+    try:
+        get_store().rentals.book(user_id, vehicle_id, days)
+    except booking.BookingConflict:
+        return redirect(url_for("customer_dashboard"))
+
+    return redirect(url_for("customer_dashboard"))
+
 
-    # Get vehicle & price
-    cur.execute(
-        "SELECT VehicleID, RentalPrice FROM Vehicle WHERE VehicleID=%s AND Status='Available'",
-        (vehicle_id,)
-    )
-    vehicle = cur.fetchone()
 
-    if not vehicle:
-        cur.close()
-        cn.close()
+@app.route("/customer/reserve/<int:vehicle_id>", methods=["POST"])
+def customer_reserve(vehicle_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+    user_id = session["user_id"]
+
+    # start date and number of days from the form; the vehicle must be
+    # free for all of them (see reservations.py)
+    try:
+        start = date.fromisoformat(request.form.get("start", ""))
+        days = int(request.form.get("days", "1"))
+        reservations.check_window(start, days)
+    except ValueError:
         return redirect(url_for("customer_dashboard"))
 
-    price_per_day = vehicle["RentalPrice"]
-    total = price_per_day * days
+    try:
+        get_store().rentals.reserve(user_id, vehicle_id, start, days)
+    except booking.BookingConflict:
+        return redirect(url_for("customer_dashboard"))
 
-    cur2 = cn.cursor()
-    cur2.execute("""
-        INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status)
-        VALUES (%s, %s, CURDATE(), DATE_ADD(CURDATE(), INTERVAL %s DAY), %s, 'Active')
-    """, (user_id, vehicle_id, days, total))
+    return redirect(url_for("customer_dashboard") + "#myReservations")
 
-    # you can keep or remove this if you add triggers later
-    cur2.execute("UPDATE Vehicle SET Status='Rented' WHERE VehicleID=%s", (vehicle_id,))
+@app.route("/customer/reservation/<int:rental_id>/cancel", methods=["POST"])
+def customer_cancel_reservation(rental_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
 
-    cn.commit()
-    cur2.close()
-    cur.close()
-    cn.close()
+    get_store().rentals.cancel(rental_id, user_id=session["user_id"])
 
-    return redirect(url_for("customer_dashboard"))
+    return redirect(url_for("customer_dashboard") + "#myReservations")
 
+@app.route("/customer/reservation/<int:rental_id>/pickup", methods=["POST"])
+def customer_pick_up(rental_id):
+    if "user_id" not in session:
+        return redirect(url_for("login"))
+
+    # turns a reservation starting today into an active rental
+    try:
+        get_store().rentals.pick_up(rental_id, user_id=session["user_id"])
+    except booking.BookingConflict:
+        pass   # the previous renter has not returned it yet
 
+    return redirect(url_for("customer_dashboard"))
 
 @app.route("/customer/return/<int:rental_id>")
 def customer_return(rental_id):
@@ -226,83 +355,36 @@ def customer_return(rental_id):
         return redirect(url_for("login"))
     user_id = session["user_id"]
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
-
-    # Get rental and vehicle
-    cur.execute("""
-        SELECT r.RentalID, r.UserID, r.VehicleID, r.TotalAmount, r.Status
-        FROM Rental r
-        WHERE r.RentalID = %s
-    """, (rental_id,))
-    rental = cur.fetchone()
-
-    if not rental or rental["UserID"] != user_id or rental["Status"] != "Active":
-        cur.close()
-        cn.close()
-        return redirect(url_for("customer_dashboard"))
-
-    amount = rental["TotalAmount"]
-    vehicle_id = rental["VehicleID"]
-
-    cur2 = cn.cursor()
-    # Update rental
-    cur2.execute("""
-        UPDATE Rental
-        SET Status='Completed', ReturnDate = CURDATE()
-        WHERE RentalID=%s
-    """, (rental_id,))
-
-    # Insert payment (mode fixed as 'Cash' for demo)
-    cur2.execute("""
-        INSERT INTO Payment (RentalID, PaymentDate, Amount, PaymentMode)
-        VALUES (%s, CURDATE(), %s, 'Cash')
-    """, (rental_id, amount))
-
-    # Free the vehicle
-    cur2.execute("""
-        UPDATE Vehicle
-        SET Status='Available'
-        WHERE VehicleID=%s
-    """, (vehicle_id,))
-
-    cn.commit()
-    cur2.close()
-    cur.close()
-    cn.close()
+    # one-item case of the staff bulk return (see booking.return_rentals)
+    get_store().rentals.return_rentals([rental_id], user_id=user_id)
 
     return redirect(url_for("customer_dashboard"))
 
 @app.route("/customer/payments")
+@httpcache.cached("payments", "vehicles")
+@database.read_only
 def customer_payments():
     if "user_id" not in session:
         return redirect(url_for("login"))
     user_id = session["user_id"]
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
+    after, limit, stream = pagination.page_args()
+    payment_repo = get_store().payments
 
-    # Payments made by this user (join Rental, Vehicle, Payment)
-    cur.execute("""
-        SELECT p.PaymentID, p.PaymentDate, p.Amount, p.PaymentMode,
-               r.RentalID, v.Model, v.VehicleType
-        FROM Payment p
-        JOIN Rental r ON p.RentalID = r.RentalID
-        JOIN Vehicle v ON r.VehicleID = v.VehicleID
-        WHERE r.UserID = %s
-        ORDER BY p.PaymentDate DESC
-    """, (user_id,))
-    payments = cur.fetchall()
+    # Payments made by this user, newest first, paged on PaymentID
+    if stream:
+        payments = payment_repo.for_user_stream(user_id, after)
+        return stream_template("customer_payments.html", payments=payments, page=None)
 
-    cur.close()
-    cn.close()
-
-    return render_template("customer_payments.html", payments=payments)
+    page = payment_repo.for_user_page(user_id, after, limit)
+    return render_template("customer_payments.html", payments=page.rows, page=page)
 
 
 # ---------- STAFF DASHBOARD (VEHICLE MANAGEMENT) ----------
 
 @app.route("/staff")
+@httpcache.cached("vehicles")
+@database.read_only
 def staff_dashboard():
     if "user_id" not in session or session.get("role") not in ("Staff", "Admin"):
         return redirect(url_for("login"))
@@ -310,34 +392,34 @@ def staff_dashboard():
     f_type = request.args.get("type", "").strip()
     f_model = request.args.get("model", "").strip()
     f_status = request.args.get("status", "").strip()
-
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
-
-    query = "SELECT * FROM Vehicle WHERE 1=1"
-    params = []
-
-    if f_type:
-        query += " AND VehicleType LIKE %s"
-        params.append("%" + f_type + "%")
-    if f_model:
-        query += " AND Model LIKE %s"
-        params.append("%" + f_model + "%")
-    if f_status:
-        query += " AND Status = %s"
-        params.append(f_status)
-
-    cur.execute(query, params)
-    vehicles = cur.fetchall()
-    cur.close()
-    cn.close()
-
-    return render_template(
+    f_branch = _branch_arg()
+
+    after, limit, stream = pagination.page_args()
+    store = get_store()
+    vehicle_repo = store.vehicles
+
+    if stream:
+        vehicles = vehicle_repo.iter_search(
+            status=f_status, vehicle_type=f_type, model=f_model, after=after, branch=f_branch)
+        page = None
+    else:
+        page = pagination.Page(
+            vehicle_repo.search(status=f_status, vehicle_type=f_type, model=f_model,
+                                after=after, limit=limit + 1, branch=f_branch),
+            "VehicleID", after, limit)
+        vehicles = page.rows
+
+    render = stream_template if stream else render_template
+    return render(
         "dashboard_staff.html",
         vehicles=vehicles,
+        counts=vehicle_repo.status_counts(f_branch),
+        page=page,
         f_type=f_type,
         f_model=f_model,
-        f_status=f_status
+        f_status=f_status,
+        f_branch=f_branch,
+        branches=store.branches.all()
     )
 
 
@@ -352,15 +434,76 @@ def staff_update_status(vehicle_id):
     if new_status not in ("Available", "Rented", "Maintenance"):
         return redirect(url_for("staff_dashboard"))
 
-    cn = get_db()
-    cur = cn.cursor()
-    cur.execute("UPDATE Vehicle SET Status=%s WHERE VehicleID=%s", (new_status, vehicle_id))
-    cn.commit()
-    cur.close()
-    cn.close()
+    get_store().vehicles.set_status(vehicle_id, new_status)
 
     return redirect(url_for("staff_dashboard"))
 
+@app.route("/staff/returns", methods=["GET", "POST"])
+def staff_returns():
+    # bulk check-in: a form (checkboxes / pasted IDs) or a JSON API,
+    # POST {"rental_ids": [..], "payment_mode": "Cash"}
+    if "user_id" not in session or session.get("role") not in ("Staff", "Admin"):
+        if request.is_json:
+            return jsonify({"error": "forbidden"}), 403
+        return redirect(url_for("login"))
+
+    store = get_store()
+    rental_repo = store.rentals
+    results = None
+    charged = {}
+    amount = 0
+
+    if request.method == "POST":
+        if request.is_json:
+            data = request.get_json(silent=True) or {}
+            raw_ids = data.get("rental_ids") or []
+            payment_mode = data.get("payment_mode", "Cash")
+        else:
+            raw_ids = request.form.getlist("rental_id")
+            raw_ids += request.form.get("rental_ids", "").replace(",", " ").split()
+            payment_mode = request.form.get("payment_mode", "Cash")
+
+        try:
+            rental_ids = [int(r) for r in raw_ids]
+        except (TypeError, ValueError):
+            rental_ids = None
+        if rental_ids is None or payment_mode not in booking.PAYMENT_MODES:
+            if request.is_json:
+                return jsonify({"error": "rental_ids must be integers and payment_mode one of %s"
+                                         % ", ".join(booking.PAYMENT_MODES)}), 400
+            return redirect(url_for("staff_returns"))
+
+        results, returned = rental_repo.return_rentals(rental_ids, payment_mode=payment_mode)
+        # what was charged: the late fee on top of the rental's total
+        charged = {row["RentalID"]: booking.amount_due(row) for row in returned}
+        amount = sum(charged.values())
+
+        if request.is_json:
+            return jsonify({
+                "returned": len(returned),
+                "amount": float(amount),
+                "results": [dict({"RentalID": rid, "result": result},
+                                 **({"amount": float(charged[rid])} if rid in charged else {}))
+                            for rid, result in results.items()],
+            })
+
+    # active rentals to pick from, oldest first; a branch's only read its shard
+    after, limit, _ = pagination.page_args()
+    f_branch = _branch_arg()
+    page = rental_repo.active_page(after, limit, f_branch)
+
+    return render_template(
+        "staff_returns.html",
+        rentals=page.rows,
+        page=page,
+        f_branch=f_branch,
+        branches=store.branches.all(),
+        results=results,
+        charged=charged,
+        amount=amount,
+        payment_modes=booking.PAYMENT_MODES
+    )
+
 # ---------- ADMIN DASHBOARD (USER MANAGEMENT + REPORTS LINK) ----------
 
 @app.route("/admin")
@@ -368,25 +511,19 @@ def admin_dashboard():
     if "user_id" not in session or session.get("role") != "Admin":
         return redirect(url_for("login"))
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
-
-    # Users + roles
-    cur.execute("""
-        SELECT u.UserID, u.Name, u.Email, r.RoleName, u.RoleID
-        FROM User u
-        LEFT JOIN Role r ON u.RoleID = r.RoleID
-    """)
-    users = cur.fetchall()
+    after, limit, stream = pagination.page_args()
+    user_repo = get_store().users
 
-    # roles for dropdown
-    cur.execute("SELECT RoleID, RoleName FROM Role")
-    roles = cur.fetchall()
+    # roles for dropdown (read first: a streamed user list holds the connection)
+    roles = users.get_roles()
 
-    cur.close()
-    cn.close()
+    # Users + roles
+    if stream:
+        rows = user_repo.stream(after)
+        return stream_template("dashboard_admin.html", users=rows, roles=roles, page=None)
 
-    return render_template("dashboard_admin.html", users=users, roles=roles)
+    page = user_repo.page(after, limit)
+    return render_template("dashboard_admin.html", users=page.rows, roles=roles, page=page)
 
 
 @app.route("/admin/user/<int:user_id>/set_role", methods=["POST"])
@@ -396,12 +533,8 @@ def admin_set_role(user_id):
 
     role_id = request.form.get("role_id")
 
-    cn = get_db()
-    cur = cn.cursor()
-    cur.execute("UPDATE User SET RoleID=%s WHERE UserID=%s", (role_id, user_id))
-    cn.commit()
-    cur.close()
-    cn.close()
+    get_store().users.set_role(user_id, role_id)
+    users.invalidate(user_id)
 
     return redirect(url_for("admin_dashboard"))
 
@@ -410,12 +543,8 @@ def admin_add_user():
     if "user_id" not in session or session.get("role") != "Admin":
         return redirect(url_for("login"))
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
-
     # get roles for dropdown
-    cur.execute("SELECT RoleID, RoleName FROM Role")
-    roles = cur.fetchall()
+    roles = users.get_roles()
 
     message = ""
 
@@ -430,26 +559,15 @@ def admin_add_user():
             message = "Name, Email and Password are required."
             return render_template("admin_add_user.html", roles=roles, message=message)
 
+        hashed = passwords.hash_password(password)
+
         try:
-            cur2 = cn.cursor()
-            cur2.execute("""
-                INSERT INTO User (Name, Email, Phone, Password, RoleID)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (name, email, phone, password, role_id))
-            cn.commit()
-            cur2.close()
-            cur.close()
-            cn.close()
+            get_store().users.add(name, email, phone, hashed, role_id)
             return redirect(url_for("admin_dashboard"))
-        except Exception:
-            cn.rollback()
+        except storage.ConstraintError:
             message = "Could not create user (email may already exist)."
-            cur.close()
-            cn.close()
             return render_template("admin_add_user.html", roles=roles, message=message)
 
-    cur.close()
-    cn.close()
     return render_template("admin_add_user.html", roles=roles, message=message)
 
 @app.route("/admin/users/edit/<int:user_id>", methods=["GET", "POST"])
@@ -457,20 +575,11 @@ def admin_edit_user(user_id):
     if "user_id" not in session or session.get("role") != "Admin":
         return redirect(url_for("login"))
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
-
-    # fetch roles
-    cur.execute("SELECT RoleID, RoleName FROM Role")
-    roles = cur.fetchall()
-
-    # fetch user
-    cur.execute("SELECT * FROM User WHERE UserID = %s", (user_id,))
-    user = cur.fetchone()
+    # roles and user, both from the user cache
+    roles = users.get_roles()
+    user = users.get_user(user_id)
 
     if not user:
-        cur.close()
-        cn.close()
         return redirect(url_for("admin_dashboard"))
 
     message = ""
@@ -486,36 +595,18 @@ def admin_edit_user(user_id):
             message = "Name and Email are required."
             return render_template("admin_edit_user.html", user=user, roles=roles, message=message)
 
+        hashed = passwords.hash_password(password) if password else None
+
         try:
-            cur2 = cn.cursor()
             # if password left blank, keep the old one
-            if password:
-                cur2.execute("""
-                    UPDATE User
-                    SET Name=%s, Email=%s, Phone=%s, Password=%s, RoleID=%s
-                    WHERE UserID=%s
-                """, (name, email, phone, password, role_id, user_id))
-            else:
-                cur2.execute("""
-                    UPDATE User
-                    SET Name=%s, Email=%s, Phone=%s, RoleID=%s
-                    WHERE UserID=%s
-                """, (name, email, phone, role_id, user_id))
-
-            cn.commit()
-            cur2.close()
-            cur.close()
-            cn.close()
+            get_store().users.update(user_id, name, email, phone, password=hashed,
+                                     role_id=role_id)
+            users.invalidate(user_id)
             return redirect(url_for("admin_dashboard"))
-        except Exception:
-            cn.rollback()
+        except storage.ConstraintError:
             message = "Could not update user (email may already exist)."
-            cur.close()
-            cn.close()
             return render_template("admin_edit_user.html", user=user, roles=roles, message=message)
 
-    cur.close()
-    cn.close()
     return render_template("admin_edit_user.html", user=user, roles=roles, message=message)
 
 @app.route("/admin/users/delete/<int:user_id>")
@@ -527,124 +618,316 @@ def admin_delete_user(user_id):
     if user_id == session.get("user_id"):
         return redirect(url_for("admin_dashboard"))
 
-    cn = get_db()
-    cur = cn.cursor()
-
+    # the user's rentals and payments go with it
     try:
-        cur.execute("DELETE FROM User WHERE UserID=%s", (user_id,))
-        cn.commit()
-    except Exception:
-        cn.rollback()
-    finally:
-        cur.close()
-        cn.close()
+        get_store().users.delete(user_id)
+        users.invalidate(user_id)
+        analytics.invalidate()
+    except storage.ConstraintError:
+        pass
 
     return redirect(url_for("admin_dashboard"))
 
 # ---------- ADMIN REPORTS ----------
 
 @app.route("/admin/reports")
-def admin_reports():
+@database.read_only
+async def admin_reports():
     if "user_id" not in session or session.get("role") != "Admin":
         return redirect(url_for("login"))
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
+    store = get_store()
+    reports = store.reports
 
-    # simple stats
-    cur.execute("SELECT COUNT(*) AS total_users FROM User")
-    total_users = cur.fetchone()["total_users"]
+    # revenue / rentals / utilization over a date range (see analytics.py)
+    start, end, granularity = analytics.parse_range(request.args)
+    engine = analytics.get_engine()
+    start, end = engine.window(start, end)
 
-    cur.execute("SELECT COUNT(*) AS total_vehicles FROM Vehicle")
-    total_vehicles = cur.fetchone()["total_vehicles"]
+    # all independent, fetched concurrently: the simple stats (kept up to
+    # date by the write paths, see aggregates.py), the date-range report,
+    # the busiest vehicles and the recent rentals and payments
+    totals, stats, top_vehicles, rentals, payments = await asyncdb.get_executor().gather(
+        reports.totals,
+        lambda: engine.report(reports.analytics_source(), start, end, granularity),
+        lambda: engine.vehicle_utilization(reports.analytics_source(), start, end),
+        functools.partial(store.rentals.recent, 10),
+        functools.partial(store.payments.recent, 10))
 
-    cur.execute("SELECT COUNT(*) AS total_rentals FROM Rental")
-    total_rentals = cur.fetchone()["total_rentals"]
+    return render_template(
+        "admin_reports.html",
+        total_users=totals["total_users"],
+        total_vehicles=totals["total_vehicles"],
+        total_rentals=totals["total_rentals"],
+        total_revenue=totals["total_revenue"],
+        rentals=rentals,
+        payments=payments,
+        stats=stats,
+        top_vehicles=top_vehicles
+    )
 
-    cur.execute("SELECT IFNULL(SUM(Amount),0) AS total_revenue FROM Payment")
-    total_revenue = cur.fetchone()["total_revenue"]
+@app.route("/admin/stats/pool")
+def admin_pool_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
 
-    # recent rentals
-        # recent rentals
-    cur.execute("""
-        SELECT r.RentalID, u.Name AS Customer, v.Model,
-               r.RentalDate, r.ReturnDate, r.Status, r.TotalAmount
-        FROM Rental r
-        JOIN User u ON r.UserID = u.UserID
-        JOIN Vehicle v ON r.VehicleID = v.VehicleID
-        ORDER BY r.RentalDate DESC
-        LIMIT 10
-    """)
-    rentals = cur.fetchall()
+    # connection pool for the SQL backends, table sizes for "memory"
+    return jsonify(get_store().stats())
 
-    # recent payments
-    cur.execute("""
-        SELECT PaymentID, RentalID, PaymentDate, Amount, PaymentMode
-        FROM Payment
-        ORDER BY PaymentDate DESC
-        LIMIT 10
-    """)
-    payments = cur.fetchall()
+@app.route("/admin/stats/search")
+def admin_search_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
 
-    cur.close()
-    cn.close()
+    return jsonify(get_store().vehicles.search_stats())
 
-    return render_template(
-        "admin_reports.html",
-        total_users=total_users,
-        total_vehicles=total_vehicles,
-        total_rentals=total_rentals,
-        total_revenue=total_revenue,
-        rentals=rentals,
-        payments=payments
-    )
+@app.route("/admin/stats/replicas")
+def admin_replica_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    router = database.get_router()
+    return jsonify(router.stats() if router is not None else {"replicas": []})
+
+@app.route("/admin/stats/shards")
+def admin_shard_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    # the branches on each database shard, its pool, and the fan-outs
+    return jsonify(get_store().branches.shard_stats())
+
+@app.route("/admin/stats/bus")
+def admin_cache_bus_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    bus = cachebus.get_bus()
+    return jsonify(bus.stats() if bus is not None else {"enabled": False})
+
+@app.route("/admin/stats/pricing")
+def admin_pricing_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    return jsonify(pricing.get_engine().stats())
+
+@app.route("/admin/stats/cache")
+def admin_response_cache_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    cache = httpcache.get_cache()
+    return jsonify(cache.stats() if cache is not None else {"enabled": False})
+
+@app.route("/admin/stats/events")
+def admin_event_log_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    projector = eventlog.get_projector()
+    if projector is None:
+        return jsonify({"enabled": False})
+    # fleet status as replayed from the log
+    fleet = projector.view(lambda models: models["fleet"].counts())
+    return jsonify({"log": projector.log.stats(), "replay": projector.stats(), "fleet": fleet})
+
+@app.route("/admin/history/user/<int:user_id>")
+def admin_user_history(user_id):
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    projector = eventlog.get_projector()
+    if projector is None:
+        return jsonify({"enabled": False})
+    # the user's rentals, reservations and payments, newest last
+    limit = request.args.get("limit", 200, type=int)
+    events = projector.view(lambda models: models["history"].for_user(user_id, limit))
+    return jsonify([eventlog.describe(event) for event in events])
+
+@app.route("/admin/stats/reservations")
+def admin_reservation_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    return jsonify(get_store().vehicles.reservation_stats())
+
+@app.route("/admin/stats/users")
+def admin_user_cache_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    return jsonify(users.get_cache().stats())
+
+@app.route("/admin/stats/passwords")
+def admin_password_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    return jsonify(passwords.stats())
+
+@app.route("/admin/stats/async")
+def admin_async_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    return jsonify(asyncdb.get_executor().stats())
+
+@app.route("/admin/stats/sql")
+def admin_sql_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    return jsonify(metrics.get_metrics().statements(limit=request.args.get("limit", 20, type=int)))
+
+@app.route("/metrics")
+def prometheus_metrics():
+    # scraped by Prometheus; protect with METRICS_TOKEN when exposed
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != "Bearer " + token:
+        return "forbidden", 403
+
+    cache = users.get_cache().stats()
+    extra = [
+        ("vrms_user_cache_hits_total", "counter", "User cache hits.", cache["hits"]),
+        ("vrms_user_cache_misses_total", "counter", "User cache misses.", cache["misses"]),
+    ]
+    responses = httpcache.get_cache()
+    if responses is not None:
+        stats = responses.stats()
+        extra += [
+            ("vrms_response_cache_hits_total", "counter", "Response cache hits.", stats["hits"]),
+            ("vrms_response_cache_misses_total", "counter", "Response cache misses.",
+             stats["misses"]),
+            ("vrms_response_cache_not_modified_total", "counter",
+             "Responses answered with 304 Not Modified.", stats["not_modified"]),
+            ("vrms_response_cache_entries", "gauge", "Cached pages.", stats["entries"]),
+        ]
+    if app.config["DB_BACKEND"] != "memory":
+        pool = database.get_pool().stats()
+        extra += [
+            ("vrms_db_pool_in_use", "gauge", "Pooled connections checked out.", pool["in_use"]),
+            ("vrms_db_pool_idle", "gauge", "Idle pooled connections.", pool["idle"]),
+            ("vrms_db_pool_waits_total", "counter", "Checkouts that had to wait.", pool["waits"]),
+            ("vrms_db_pool_timeouts_total", "counter", "Checkouts that timed out.", pool["timeouts"]),
+        ]
+    return Response(metrics.get_metrics().prometheus(extra),
+                    mimetype="text/plain; version=0.0.4")
 
 @app.route("/admin/vehicles")
+@httpcache.cached("vehicles")
 def admin_vehicles():
     if "user_id" not in session or session.get("role") != "Admin":
         return redirect(url_for("login"))
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
-    cur.execute("SELECT * FROM Vehicle")
-    vehicles = cur.fetchall()
-    cur.close()
-    cn.close()
+    after, limit, stream = pagination.page_args()
+    store = get_store()
+    vehicle_repo = store.vehicles
+    branch_names = {row["BranchID"]: row["Name"] for row in store.branches.all()}
+
+    if stream:
+        vehicles = vehicle_repo.stream(after)
+        return stream_template("admin_vehicles.html", vehicles=vehicles, page=None,
+                               branch_names=branch_names)
 
-    return render_template("admin_vehicles.html", vehicles=vehicles)
+    page = vehicle_repo.page(after, limit)
+    return render_template("admin_vehicles.html", vehicles=page.rows, page=page,
+                           branch_names=branch_names)
 
 @app.route("/admin/vehicles/add", methods=["GET", "POST"])
 def admin_add_vehicle():
     if "user_id" not in session or session.get("role") != "Admin":
         return redirect(url_for("login"))
 
+    store = get_store()
+
     if request.method == "POST":
         vtype = request.form["vehicle_type"]
         model = request.form["model"]
         regno = request.form["regno"]
         price = request.form["price"]
+        branch_id = request.form.get("branch_id", 1, type=int)
 
-        cn = get_db()
-        cur = cn.cursor()
-        cur.execute("""
-            INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status)
-            VALUES (%s, %s, %s, %s, 'Available')
-        """, (vtype, model, regno, price))
-        cn.commit()
-        cur.close()
-        cn.close()
+        try:
+            store.vehicles.add(vtype, model, regno, price, branch_id=branch_id)
+        except storage.ConstraintError:
+            message = "Could not add vehicle (registration number may already exist)."
+            return render_template("admin_add_vehicle.html", branches=store.branches.all(),
+                                   message=message)
 
         return redirect(url_for("admin_vehicles"))
 
-    return render_template("admin_add_vehicle.html")
+    return render_template("admin_add_vehicle.html", branches=store.branches.all())
+
+@app.route("/admin/vehicles/import", methods=["GET", "POST"])
+def admin_import_vehicles():
+    # upload a CSV / JSON Lines file from the form, or POST the file as the
+    # request body (text/csv or application/x-ndjson) and get JSON back
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    store = get_store()
+    if request.method == "GET":
+        return render_template("admin_import_vehicles.html", report=None,
+                               branches=store.branches.all())
+
+    upload = request.files.get("file")
+    if upload is not None:
+        fmt = request.form.get("format") or bulk.guess_format(upload.filename)
+        raw = upload.stream
+    else:
+        mimetype = request.mimetype
+        fmt = request.args.get("format") or ("jsonl" if "json" in mimetype else "csv")
+        raw = request.stream
+    if fmt not in bulk.FORMATS:
+        return jsonify({"error": "format must be one of %s" % ", ".join(bulk.FORMATS)}), 400
+
+    try:
+        chunk_size = int(request.values.get("chunk_size", app.config["IMPORT_CHUNK_SIZE"]))
+    except ValueError:
+        chunk_size = app.config["IMPORT_CHUNK_SIZE"]
+    chunk_size = max(1, chunk_size)
+    # every imported vehicle goes to one branch (?branch_id= for the API)
+    branch_id = request.values.get("branch_id", 1, type=int)
+
+    stream = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+    report = store.vehicles.import_records(bulk.read_records(stream, fmt), chunk_size,
+                                           app.config["IMPORT_MAX_ERRORS"], branch_id)
+
+    if upload is None:
+        return jsonify(report.to_dict())
+    return render_template("admin_import_vehicles.html", report=report,
+                           branches=store.branches.all())
+
+@app.route("/admin/export/<table>")
+def admin_export(table):
+    # ?format=csv|jsonl; streamed from the repository (an unbuffered cursor for SQL)
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    fmt = request.args.get("format", "csv")
+    if table not in bulk.EXPORTS or fmt not in bulk.FORMATS:
+        return redirect(url_for("admin_vehicles"))
+
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(
+        stream_with_context(bulk.export_chunks(_export_rows(table), table, fmt)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": "attachment; filename=%s.%s" % (table, fmt)}
+    )
+
+def _export_rows(table):
+    store = get_store()
+    return {"vehicles": store.vehicles, "rentals": store.rentals,
+            "payments": store.payments}[table].stream()
 
 @app.route("/admin/vehicles/edit/<int:vehicle_id>", methods=["GET", "POST"])
 def admin_edit_vehicle(vehicle_id):
     if "user_id" not in session or session.get("role") != "Admin":
         return redirect(url_for("login"))
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
+    store = get_store()
+    vehicle_repo = store.vehicles
 
     if request.method == "POST":
         vtype = request.form["vehicle_type"]
@@ -652,44 +935,156 @@ def admin_edit_vehicle(vehicle_id):
         regno = request.form["regno"]
         price = request.form["price"]
         status = request.form["status"]
+        branch_id = request.form.get("branch_id", type=int)
 
-        cur2 = cn.cursor()
-        cur2.execute("""
-            UPDATE Vehicle
-            SET VehicleType=%s, Model=%s, RegistrationNumber=%s,
-                RentalPrice=%s, Status=%s
-            WHERE VehicleID=%s
-        """, (vtype, model, regno, price, status, vehicle_id))
-
-        cn.commit()
-        cur2.close()
-        cur.close()
-        cn.close()
+        try:
+            vehicle_repo.update(vehicle_id, vtype, model, regno, price, status, branch_id)
+        except storage.ConstraintError as e:
+            # a taken registration number, or a branch whose fleet is on
+            # another shard
+            return render_template("admin_edit_vehicle.html", vehicle=vehicle_repo.get(vehicle_id),
+                                   branches=store.branches.all(), message=str(e))
+        analytics.invalidate()   # VehicleType may have changed
         return redirect(url_for("admin_vehicles"))
 
     # GET → load vehicle data
-    cur.execute("SELECT * FROM Vehicle WHERE VehicleID=%s", (vehicle_id,))
-    vehicle = cur.fetchone()
-    cur.close()
-    cn.close()
+    vehicle = vehicle_repo.get(vehicle_id)
 
-    return render_template("admin_edit_vehicle.html", vehicle=vehicle)
+    return render_template("admin_edit_vehicle.html", vehicle=vehicle,
+                           branches=store.branches.all())
 
 @app.route("/admin/vehicles/delete/<int:vehicle_id>")
 def admin_delete_vehicle(vehicle_id):
     if "user_id" not in session or session.get("role") != "Admin":
         return redirect(url_for("login"))
 
-    cn = get_db()
-    cur = cn.cursor()
+    # the vehicle's rentals and payments go with it
+    get_store().vehicles.delete(vehicle_id)
+    analytics.invalidate()
 
-    cur.execute("DELETE FROM Vehicle WHERE VehicleID=%s", (vehicle_id,))
-    cn.commit()
+    return redirect(url_for("admin_vehicles"))
 
-    cur.close()
-    cn.close()
+# ---------- ADMIN: PRICING RULES ----------
 
-    return redirect(url_for("admin_vehicles"))
+def _rule_from_form():
+    # a checked rule from the submitted form; ValueError if it isn't one
+    form = request.form
+    return pricing.check_rule(form.get("kind", ""), form.get("vehicle_type", ""),
+                              form.get("start_date"), form.get("end_date"),
+                              form.get("threshold") or None, form.get("multiplier", ""))
+
+@app.route("/admin/pricing", methods=["GET", "POST"])
+def admin_pricing():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    pricing_repo = get_store().pricing
+    error = None
+
+    if request.method == "POST":
+        try:
+            pricing_repo.add_rule(_rule_from_form())
+            return redirect(url_for("admin_pricing"))
+        except (TypeError, ValueError) as e:
+            error = str(e)
+
+    return render_template("admin_pricing.html", rules=pricing_repo.rules(),
+                           kinds=pricing.KINDS, error=error)
+
+@app.route("/admin/pricing/<int:rule_id>/edit", methods=["POST"])
+def admin_edit_pricing_rule(rule_id):
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    pricing_repo = get_store().pricing
+    try:
+        pricing_repo.update_rule(rule_id, _rule_from_form())
+    except (TypeError, ValueError) as e:
+        return render_template("admin_pricing.html", rules=pricing_repo.rules(),
+                               kinds=pricing.KINDS, error="Rule %d: %s" % (rule_id, e))
+
+    return redirect(url_for("admin_pricing"))
+
+@app.route("/admin/pricing/<int:rule_id>/delete", methods=["POST"])
+def admin_delete_pricing_rule(rule_id):
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    get_store().pricing.delete_rule(rule_id)
+
+    return redirect(url_for("admin_pricing"))
+
+# ---------- ADMIN: BACKGROUND JOBS ----------
+
+def _job_rows():
+    # JobState of the shared jobs, this process's runs of the local ones
+    states = {row["JobName"]: row for row in get_store().jobs.states()}
+    local = scheduler.get_scheduler().stats()["runs"]
+    intervals = scheduler.get_scheduler().intervals
+    rows = []
+    for name, (_, shared) in scheduler.JOBS.items():
+        row = {"name": name, "interval": intervals.get(name, 0), "locked_by": None,
+               "started": None, "status": None, "duration": None, "runs": 0, "failures": 0,
+               "result": None}
+        state = states.get(name) if shared else None
+        run = local.get(name) if not shared else None
+        if state is not None and state["LastStarted"] is not None:
+            row.update(locked_by=state["LockedBy"], status=state["LastStatus"],
+                       duration=state["LastDuration"], runs=state["Runs"],
+                       failures=state["Failures"], result=state["LastResult"],
+                       started=state["LastStarted"])
+        elif run is not None:
+            row.update(status=run["status"], duration=run["duration"], runs=1,
+                       failures=int(run["status"] != "ok"), result=json.dumps(run["result"]),
+                       started=run["started"])
+        if row["started"] is not None:
+            row["started"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["started"]))
+        rows.append(row)
+    return rows
+
+@app.route("/admin/jobs")
+def admin_jobs():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    jobs = _job_rows()
+    stuck = []
+    for job in jobs:
+        if job["name"] == "stuck_maintenance" and job["result"]:
+            stuck = json.loads(job["result"]).get("stuck", [])
+    return render_template("admin_jobs.html", jobs=jobs, stuck=stuck,
+                           message=request.args.get("message"))
+
+@app.route("/admin/jobs/<name>/run", methods=["POST"])
+def admin_run_job(name):
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    if name not in scheduler.JOBS:
+        return "No such job", 404
+    # on the scheduler's threads; the page shows the outcome once it's done
+    if scheduler.get_scheduler().submit(name, force=True) is None:
+        message = "%s is already running." % name
+    else:
+        message = "%s started." % name
+    return redirect(url_for("admin_jobs", message=message))
+
+@app.route("/admin/stats/jobs")
+def admin_job_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    return jsonify({"jobs": get_store().jobs.states(),
+                    "process": scheduler.get_scheduler().stats()})
+
+@app.route("/admin/stats/archive")
+def admin_archive_stats():
+    if "user_id" not in session or session.get("role") != "Admin":
+        return redirect(url_for("login"))
+
+    # how far back the live tables have been archived (see archive.py)
+    state = get_store().rentals.archive_state()
+    return jsonify(dict(state, cutoff=archive.cutoff(app.config).isoformat()))
 
 @app.route("/profile", methods=["GET", "POST"])
 def profile():
@@ -698,16 +1093,10 @@ def profile():
 
     user_id = session["user_id"]
 
-    cn = get_db()
-    cur = cn.cursor(dictionary=True)
-
-    # fetch current user info
-    cur.execute("SELECT UserID, Name, Email, Phone FROM User WHERE UserID = %s", (user_id,))
-    user = cur.fetchone()
+    # current user info (cached, see users.py)
+    user = users.get_user(user_id)
 
     if not user:
-        cur.close()
-        cn.close()
         return redirect(url_for("login"))
 
     message = ""
@@ -722,37 +1111,123 @@ def profile():
             message = "Name and Email are required."
             return render_template("profile.html", user=user, message=message)
 
-        try:
-            cur2 = cn.cursor()
-            if password:
-                cur2.execute("""
-                    UPDATE User
-                    SET Name=%s, Email=%s, Phone=%s, Password=%s
-                    WHERE UserID=%s
-                """, (name, email, phone, password, user_id))
-            else:
-                cur2.execute("""
-                    UPDATE User
-                    SET Name=%s, Email=%s, Phone=%s
-                    WHERE UserID=%s
-                """, (name, email, phone, user_id))
+        hashed = passwords.hash_password(password) if password else None
 
-            cn.commit()
-            cur2.close()
+        try:
+            get_store().users.update(user_id, name, email, phone, password=hashed)
 
             # refresh user data
-            cur.execute("SELECT UserID, Name, Email, Phone FROM User WHERE UserID = %s", (user_id,))
-            user = cur.fetchone()
+            users.invalidate(user_id)
+            user = users.get_user(user_id)
+            session["name"] = user["Name"]
             message = "Profile updated successfully."
-        except Exception:
-            cn.rollback()
+        except storage.ConstraintError:
             message = "Could not update profile (email may be in use)."
 
-    cur.close()
-    cn.close()
     return render_template("profile.html", user=user, message=message)
 
 
+@app.cli.command("reconcile-reports")
+def reconcile_reports_command():
+    drift = aggregates.reconcile_app(app)
+    print("report totals drift corrected: %s" % drift if drift else "report totals OK")
+
+
+@app.cli.command("import-vehicles")
+@click.argument("path", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--format", "fmt", type=click.Choice(bulk.FORMATS),
+              help="Defaults to the file extension, else csv.")
+@click.option("--chunk-size", type=int, help="Rows per INSERT (IMPORT_CHUNK_SIZE).")
+@click.option("--branch", type=int, default=1, help="BranchID of every imported vehicle.")
+def import_vehicles_command(path, fmt, chunk_size, branch):
+    fmt = fmt or bulk.guess_format(path)
+    with click.open_file(path, encoding="utf-8-sig") as f:
+        report = get_store().vehicles.import_records(
+            bulk.read_records(f, fmt), chunk_size or app.config["IMPORT_CHUNK_SIZE"],
+            app.config["IMPORT_MAX_ERRORS"], branch)
+    for line_no, reason in report.errors:
+        click.echo("line %d: %s" % (line_no, reason), err=True)
+    click.echo("inserted %d, rejected %d" % (report.inserted, report.rejected))
+
+
+@app.cli.command("export")
+@click.argument("table", type=click.Choice(sorted(bulk.EXPORTS)))
+@click.option("--format", "fmt", type=click.Choice(bulk.FORMATS), default="csv")
+@click.option("--output", "-o", default="-", type=click.Path(dir_okay=False, allow_dash=True))
+def export_command(table, fmt, output):
+    with click.open_file(output, "w", encoding="utf-8") as f:
+        for chunk in bulk.export_chunks(_export_rows(table), table, fmt):
+            f.write(chunk)
+
+
+@app.cli.command("seed-event-log")
+def seed_event_log_command():
+    log = eventlog.get_log(app)
+    if log is None:
+        raise click.ClickException("the event log is off (EVENT_LOG_ENABLED)")
+    if log.end() != (0, 0):
+        raise click.ClickException("%s already has events" % log.directory)
+    click.echo("wrote %d events" % eventlog.seed(get_store(), log))
+
+
+@app.cli.command("replay-event-log")
+@click.option("--snapshot/--no-snapshot", default=True, help="Save the rebuilt read models.")
+def replay_event_log_command(snapshot):
+    projector = eventlog.get_projector(app)
+    if projector is None:
+        raise click.ClickException("the event log is off (EVENT_LOG_ENABLED)")
+    t0 = time.perf_counter()
+    count = projector.rebuild()
+    click.echo("replayed %d events in %.2fs; fleet: %s"
+               % (count, time.perf_counter() - t0,
+                  projector.view(lambda models: models["fleet"].counts())))
+    if snapshot:
+        projector.snapshot()
+
+
+@app.cli.command("archive-rentals")
+@click.option("--before", type=click.DateTime(formats=["%Y-%m-%d"]),
+              help="Archive rentals that ended before this day (default: ARCHIVE_AFTER_DAYS ago).")
+@click.option("--batches", type=int, help="At most this many batches (ARCHIVE_MAX_BATCHES).")
+def archive_rentals_command(before, batches):
+    before = before.date() if before else archive.cutoff(app.config)
+    result = get_store().rentals.archive(before, app.config["ARCHIVE_BATCH_SIZE"],
+                                         batches or app.config["ARCHIVE_MAX_BATCHES"])
+    click.echo(json.dumps(result, default=str))
+
+
+@app.cli.command("run-job")
+@click.argument("name", type=click.Choice(sorted(scheduler.JOBS)))
+def run_job_command(name):
+    # now, whatever its interval; still waits its turn behind another
+    # process's lease
+    result = scheduler.get_scheduler(app).run(name, force=True)
+    if result is None:
+        raise click.ClickException("%s is being run by another process" % name)
+    click.echo(json.dumps(result, default=str))
+
+@app.cli.command("init-shards")
+def init_shards_command():
+    # readies every DB_SHARDS database (see shards.init_shard); re-run it
+    # to catch a shard up on Role / Branch / User writes it missed
+    if not shards.sharded(app):
+        raise click.ClickException("no DB_SHARDS configured")
+    for shard in range(1, shards.count(app)):
+        click.echo(json.dumps(shards.init_shard(app, shard), default=str))
+
+
+@app.cli.command("add-branch")
+@click.argument("name")
+@click.option("--city", help="Where it is.")
+@click.option("--shard", type=int, default=0,
+              help="The database holding its fleet: 0 the main one, n the nth of DB_SHARDS.")
+def add_branch_command(name, city, shard):
+    try:
+        branch_id = get_store().branches.add(name, city, shard)
+    except storage.ConstraintError as e:
+        raise click.ClickException(str(e))
+    click.echo("branch %d: %s, on shard %d" % (branch_id, name, shard))
+
 # ---------- MAIN ----------
 
 if __name__ == "__main__":
@@ -0,0 +1,194 @@
+import datetime
+import os
+import time
+
+# Hot/cold split of the rental history.
+#
+# Rental and Payment only ever grow, while nearly every request reads their
+# recent end: active rentals, a customer's latest payments, this month's
+# reports. archive() moves the Completed / Cancelled rentals that ended
+# before a cutoff (ARCHIVE_AFTER_DAYS ago), with their payments, into
+# RentalArchive / PaymentArchive (see db/), so the live tables and their
+# indexes stay the size of the current business. It works in batches of
+# ARCHIVE_BATCH_SIZE rentals, each its own short transaction (copy, then
+# delete, by primary key), at most ARCHIVE_MAX_BATCHES per run: the
+# scheduler's "archive" job, or `flask archive-rentals`. A rental with a
+# payment dated on or after the cutoff stays until that payment is old too.
+#
+# Readers don't have to know. The SQL store reads both tiers wherever a
+# listing reaches back that far:
+#   - a customer's payment history and the recent lists: one UNION ALL
+#     statement (pagination.union_query), each side a keyset range on its
+#     own index, so a page costs two short index scans whatever the size
+#     of the archive;
+#   - analytics over a range that starts before the horizon (ArchiveState.
+#     ArchivedBefore): the same grouped query over both tiers (the engine
+#     sums partial groups);
+#   - exports: archived rows first, then the live ones.
+# Report totals count both tiers, so archiving leaves them alone; deleting
+# a user or vehicle deletes their archived rows too (cascade()).
+#
+# The horizon is raised, committed, and ARCHIVE_GRACE seconds waited out
+# before the first row past the old one moves, so an analytics query that
+# read the old horizon has finished before rows it would have skipped
+# leave the live table.
+#
+# State at /admin/stats/archive. Before/after benchmark:
+# python3 -m bench.archive --rentals 10000000
+
+DEFAULTS = {
+    "ARCHIVE_AFTER_DAYS": int(os.environ.get("VRMS_ARCHIVE_AFTER_DAYS", "365")),
+    "ARCHIVE_BATCH_SIZE": 5000,         # rentals per transaction
+    "ARCHIVE_MAX_BATCHES": 200,         # per run; the next run picks up the rest
+    "ARCHIVE_GRACE": 2.0,               # seconds between raising the horizon and moving
+}
+
+# same columns as the live tables; PaymentArchive adds its rental's
+# UserID and VehicleID
+RENTAL_COLUMNS = ("RentalID", "UserID", "VehicleID", "RentalDate", "ReturnDate", "TotalAmount",
+                  "LateFee", "OverdueSince", "Status")
+PAYMENT_COLUMNS = ("PaymentID", "RentalID", "PaymentDate", "Amount", "PaymentMode")
+
+STATE = "rentals"                       # the ArchiveState row
+
+_MOVABLE = """
+    SELECT r.RentalID FROM Rental r
+    WHERE r.Status IN ('Completed', 'Cancelled') AND r.ReturnDate < %s
+      AND NOT EXISTS (SELECT 1 FROM Payment p
+                      WHERE p.RentalID = r.RentalID AND p.PaymentDate >= %s)
+    LIMIT %s
+"""
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def cutoff(cfg, today=None):
+    # rentals that ended before this date are archived
+    today = today or datetime.date.today()
+    return today - datetime.timedelta(days=cfg["ARCHIVE_AFTER_DAYS"])
+
+
+# ---------- MOVING ----------
+
+def state(cn):
+    # the ArchiveState row: ArchivedBefore, Rentals, Payments (moved so
+    # far), LastRun
+    cur = cn.cursor(dictionary=True)
+    cur.execute("SELECT ArchivedBefore, Rentals, Payments, LastRun FROM ArchiveState "
+                "WHERE Name = %s", (STATE,))
+    row = cur.fetchone()
+    cur.close()
+    return row or {"ArchivedBefore": None, "Rentals": 0, "Payments": 0, "LastRun": None}
+
+
+def horizon(cn):
+    # no rental that ended, nor payment made, before this date is left in
+    # the live tables unless the archiver kept it; None before the first run
+    return _date(state(cn)["ArchivedBefore"])
+
+
+def _date(value):
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value))
+
+
+def _raise_horizon(cn, before):
+    # True if it moved
+    cur = cn.cursor()
+    try:
+        cur.execute("SELECT ArchivedBefore FROM ArchiveState WHERE Name = %s", (STATE,))
+        row = cur.fetchone()
+        if row is None:
+            cur.execute("INSERT INTO ArchiveState (Name, ArchivedBefore) VALUES (%s, %s)",
+                        (STATE, before))
+        elif row[0] is None or _date(row[0]) < before:
+            cur.execute("UPDATE ArchiveState SET ArchivedBefore = %s WHERE Name = %s",
+                        (before, STATE))
+        else:
+            return False
+        cn.commit()
+        return True
+    except Exception:
+        cn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def move_batch(cn, before, size):
+    # one transaction: up to `size` rentals that ended before `before`
+    # (and their payments) copied into the archive and deleted from the
+    # live tables; (rentals, payments) moved
+    cur = cn.cursor()
+    try:
+        cur.execute(_MOVABLE, (before, before, size))
+        ids = [row[0] for row in cur.fetchall()]
+        if not ids:
+            cn.rollback()
+            return 0, 0
+        where = " WHERE RentalID IN (%s)" % ", ".join(["%s"] * len(ids))
+        rentals = ", ".join(RENTAL_COLUMNS)
+        cur.execute("INSERT INTO RentalArchive (" + rentals + ") SELECT " + rentals
+                    + " FROM Rental" + where, ids)
+        cur.execute("INSERT INTO PaymentArchive (" + ", ".join(PAYMENT_COLUMNS)
+                    + ", UserID, VehicleID) SELECT "
+                    + ", ".join("p." + c for c in PAYMENT_COLUMNS)
+                    + ", r.UserID, r.VehicleID FROM Payment p "
+                    "JOIN Rental r ON p.RentalID = r.RentalID WHERE p.RentalID IN ("
+                    + ", ".join(["%s"] * len(ids)) + ")", ids)
+        cur.execute("DELETE FROM Payment" + where, ids)
+        payments = cur.rowcount
+        cur.execute("DELETE FROM Rental" + where, ids)
+        moved = cur.rowcount
+        cur.execute("UPDATE ArchiveState SET Rentals = Rentals + %s, Payments = Payments + %s, "
+                    "LastRun = %s WHERE Name = %s", (moved, payments, time.time(), STATE))
+        cn.commit()
+        return moved, payments
+    except Exception:
+        cn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def archive(cn, before, batch_size=5000, max_batches=200, grace=2.0):
+    # moves what ended before `before`, batch by batch, until nothing is
+    # left or max_batches ran; a summary for the job's result
+    if _raise_horizon(cn, before) and grace:
+        time.sleep(grace)
+    out = {"before": before.isoformat(), "rentals": 0, "payments": 0, "batches": 0,
+           "done": False}
+    started = time.perf_counter()
+    while out["batches"] < max_batches:
+        rentals, payments = move_batch(cn, before, batch_size)
+        if not rentals:
+            out["done"] = True
+            break
+        out["batches"] += 1
+        out["rentals"] += rentals
+        out["payments"] += payments
+        if rentals < batch_size:
+            out["done"] = True
+            break
+    out["seconds"] = round(time.perf_counter() - started, 3)
+    return out
+
+
+def cascade(cur, column, key):
+    # deleting a User / Vehicle: its archived rentals and payments go too
+    # (there is no foreign key to cascade them); returns (rentals, revenue)
+    # removed, for the report totals -- caller commits
+    cur.execute("SELECT COUNT(*) FROM RentalArchive WHERE " + column + " = %s", (key,))
+    rentals = cur.fetchone()[0]
+    if not rentals:
+        return 0, 0
+    cur.execute("SELECT IFNULL(SUM(Amount), 0) FROM PaymentArchive WHERE " + column + " = %s",
+                (key,))
+    revenue = cur.fetchone()[0]
+    cur.execute("DELETE FROM PaymentArchive WHERE " + column + " = %s", (key,))
+    cur.execute("DELETE FROM RentalArchive WHERE " + column + " = %s", (key,))
+    return rentals, revenue
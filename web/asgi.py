@@ -0,0 +1,23 @@
+from a2wsgi import WSGIMiddleware
+
+from app import app
+
+# Production ASGI entry point:
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 8000 --workers 4
+#
+# The server's event loop accepts connections, reads request bodies and
+# writes responses, so idle keep-alive connections and slow clients cost
+# no thread. a2wsgi's WSGIMiddleware runs each request through the Flask
+# app on one of ASGI_THREADS worker threads, where the async views spread
+# their queries over the database executor (asyncdb.py). Streamed
+# responses (exports, long lists) are sent chunk by chunk as the app
+# produces them.
+
+
+def bridge(flask_app):
+    # the Flask app as an ASGI app, on ASGI_THREADS request threads
+    return WSGIMiddleware(flask_app, workers=flask_app.config["ASGI_THREADS"])
+
+
+application = bridge(app)
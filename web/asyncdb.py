@@ -0,0 +1,129 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import os
+import threading
+
+from flask import current_app
+
+# Executor-backed async database access for the I/O-bound routes.
+#
+# customer_dashboard and admin_reports are async views: they hand their
+# independent reads to gather() and await them together, so a request
+# costs its slowest query instead of the sum of all of them. A pooled
+# connection runs one statement at a time, so every call on the executor
+# gets its own app context -- and with it its own connection from
+# get_db(), returned as soon as the call is done. The caller's
+# contextvars are copied in, so the statements still count towards the
+# request in metrics.py (its DB time is then a sum and can exceed the
+# request's wall time).
+#
+# Flask runs async views through app.async_to_sync, which init_app points
+# at async_to_sync() below: each request thread keeps one event loop and
+# runs the view on it, no asgiref needed. The thread waits for the view as
+# before; asgi.py keeps connections and slow clients on the server's
+# event loop and bounds the request threads (ASGI_THREADS).
+#
+# With ASYNC_QUERIES off, or on the memory backend where there is nothing
+# to wait for, gather() just makes the calls one after the other.
+#
+# Throughput: python3 -m bench.serving
+
+DEFAULTS = {
+    "ASYNC_QUERIES": os.environ.get("VRMS_ASYNC_QUERIES", "1") == "1",
+    # 0 = as many as the pool can hand out (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW)
+    "ASYNC_DB_WORKERS": int(os.environ.get("VRMS_ASYNC_DB_WORKERS", "0")),
+    "ASGI_THREADS": int(os.environ.get("VRMS_ASGI_THREADS", "32")),   # see asgi.py
+}
+
+
+class DBExecutor:
+
+    def __init__(self, app, workers=16, enabled=True):
+        self.app = app
+        self.enabled = enabled
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="vrms-db")
+        self._lock = threading.Lock()
+        self.gathered = 0
+        self.calls = 0
+        self.inline_calls = 0
+
+    def _call(self, fn):
+        with self.app.app_context():
+            return fn()
+
+    def submit(self, fn, *args, **kwargs):
+        # concurrent.futures.Future of fn(*args, **kwargs) on its own connection
+        ctx = contextvars.copy_context()
+        return self._executor.submit(ctx.run, self._call, functools.partial(fn, *args, **kwargs))
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    async def gather(self, *calls):
+        # results of the zero-argument `calls`, in order; the first error is raised
+        concurrent = self.enabled and len(calls) > 1
+        with self._lock:
+            self.gathered += 1
+            if concurrent:
+                self.calls += len(calls)
+            else:
+                self.inline_calls += len(calls)
+        if not concurrent:
+            return [call() for call in calls]
+        return await asyncio.gather(*(self.run(call) for call in calls))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "gathered": self.gathered,
+                "calls": self.calls,
+                "inline_calls": self.inline_calls,
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+_loops = threading.local()
+
+
+def async_to_sync(func):
+    # Flask's hook for calling async views from a sync request thread:
+    # the coroutine runs to completion on this thread's own event loop
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        loop = getattr(_loops, "loop", None)
+        if loop is None:
+            loop = _loops.loop = asyncio.new_event_loop()
+        return loop.run_until_complete(func(*args, **kwargs))
+    return wrapper
+
+
+_executor_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.async_to_sync = async_to_sync
+
+
+def get_executor(app=None):
+    app = app or current_app._get_current_object()   # the executor keeps the app
+    executor = app.extensions.get("vrms_asyncdb")
+    if executor is None:
+        with _executor_lock:
+            executor = app.extensions.get("vrms_asyncdb")
+            if executor is None:
+                cfg = app.config
+                workers = (cfg["ASYNC_DB_WORKERS"]
+                           or cfg["DB_POOL_SIZE"] + cfg["DB_POOL_MAX_OVERFLOW"])
+                executor = DBExecutor(
+                    app, workers=max(1, workers),
+                    enabled=cfg["ASYNC_QUERIES"] and cfg["DB_BACKEND"] != "memory")
+                app.extensions["vrms_asyncdb"] = executor
+    return executor
@@ -0,0 +1,2 @@
+# Offline benchmarks and load tests. Run from the web/ directory, e.g.
+#   python3 -m bench.pool_load
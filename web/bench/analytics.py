@@ -0,0 +1,49 @@
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+import analytics
+import sqlite_compat
+from bench.report_totals import build
+
+# Cold vs warm analytics report over a synthetic SQLite database.
+# Cold = every day computed from the tables; warm = closed days served
+# from the cached rollups and only today computed live.
+#
+#   python3 -m bench.analytics --rentals 1000000
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=50000)
+    ap.add_argument("--vehicles", type=int, default=20000)
+    ap.add_argument("--rentals", type=int, default=1000000)
+    ap.add_argument("--days", type=int, default=1500)
+    ap.add_argument("--db", help="reuse/create this SQLite file")
+    args = ap.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="vrms-bench-"), "analytics.sqlite3")
+    if not os.path.exists(path):
+        build(path, args.users, args.vehicles, args.rentals)
+
+    cn = sqlite_compat.connect(path)
+    end = datetime.date(2024, 2, 9)   # the synthetic rentals span 2020-01-01 .. ~2024-02
+    start = end - datetime.timedelta(days=args.days - 1)
+    engine = analytics.Analytics()
+    source = analytics.SQLSource(cn)
+
+    for label, group in (("cold", "day"), ("warm", "day"), ("warm", "week"), ("warm", "month")):
+        t0 = time.perf_counter()
+        stats = engine.report(source, start, end, group, today=end)
+        top = engine.vehicle_utilization(source, start, end, today=end)
+        elapsed = time.perf_counter() - t0
+        print("%-5s %-6s %8.1fms  periods=%d revenue=%.2f rentals=%d utilization=%.1f%% top=%d"
+              % (label, group, elapsed * 1000, len(stats["series"]), stats["total_revenue"],
+                 stats["total_rentals"], stats["utilization"], len(top)))
+    cn.close()
+
+
+if __name__ == "__main__":
+    main()
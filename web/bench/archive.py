@@ -0,0 +1,218 @@
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import aggregates
+import analytics
+import archive
+import database
+import sqlite_compat
+import storage
+from bench.common import fmt_ms, percentiles, sqlite_app
+
+# Hot/cold archival (archive.py) on a synthetic SQLite database: --rentals
+# over the last --years, uniform over customers and vehicles, all
+# Completed and paid except the last few days' Active ones. The same reads
+# are timed before and after archive() moved everything that ended more
+# than --after-days ago:
+#
+#   payments page   a customer's first page of payment history
+#   history         a customer's whole payment history (merged tiers)
+#   active          the customer dashboard's active-rental join
+#   recent          the recent rentals / payments of /admin/reports
+#   report 30d      analytics columns for the last 30 days (live tier only)
+#   report all      analytics columns for the whole span (both tiers)
+#
+# and every result is checked to be the same after as before. Also: the
+# live tables' and indexes' size, and the archiver's throughput.
+#
+#   python3 -m bench.archive --rentals 10000000
+#   python3 -m bench.archive --db big.sqlite3      # reuse a database
+
+
+def build(path, users, vehicles, rentals, years, seed=1):
+    rnd = random.Random(seed)
+    sqlite_compat.create_database(path)
+    cn = sqlite_compat.connect(path)
+    cur = cn.cursor()
+    cur.executemany(
+        "INSERT INTO User (Name, Email, Phone, Password, RoleID) VALUES (%s, %s, %s, %s, 3)",
+        (("User %d" % i, "user%d@bench" % i, "", "pass") for i in range(users)))
+    cur.executemany(
+        "INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status) "
+        "VALUES (%s, %s, %s, %s, 'Available')",
+        ((rnd.choice(["Car", "SUV", "Bike", "Van", "Truck"]), "Model %d" % (i % 300),
+          "BA%07d" % i, rnd.randint(20, 150)) for i in range(vehicles)))
+
+    today = datetime.date.today()
+    span = years * 365
+    first = today - datetime.timedelta(days=span)
+    max_user = users + 10
+    max_vehicle = vehicles + 10
+
+    def rental_rows():
+        for i in range(rentals):
+            d = first + datetime.timedelta(days=i * span // rentals)
+            days = rnd.randint(1, 7)
+            status = "Active" if d + datetime.timedelta(days=days) >= today else "Completed"
+            yield (rnd.randint(1, max_user), rnd.randint(1, max_vehicle), d,
+                   d + datetime.timedelta(days=days), days * 50, status)
+
+    # bypass the status trigger; the few Active rentals don't need their
+    # vehicles 'Rented' for this
+    cn._raw.execute("DROP TRIGGER trg_rental_insert_status")
+    cur.executemany(
+        "INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status) "
+        "VALUES (%s, %s, %s, %s, %s, %s)", rental_rows())
+    cur.execute("""
+        INSERT INTO Payment (RentalID, PaymentDate, Amount, PaymentMode)
+        SELECT RentalID, ReturnDate, TotalAmount, 'Card' FROM Rental
+        WHERE RentalID > 10 AND Status = 'Completed'
+    """)
+    cn.commit()
+    aggregates.reconcile(cn)
+    cn._raw.execute("ANALYZE")
+    cn.close()
+
+
+def table_sizes(path):
+    # bytes per table / index of the live and archive tiers (dbstat)
+    cn = sqlite3.connect(path)
+    try:
+        rows = cn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall()
+    except sqlite3.OperationalError:
+        return None                     # SQLite built without dbstat
+    finally:
+        cn.close()
+    indexes = {"Rental": ("idx_rental_",), "Payment": ("idx_payment_date", "idx_payment_rental"),
+               "RentalArchive": ("idx_rental_archive",),
+               "PaymentArchive": ("idx_payment_archive",)}
+    sizes = dict(rows)
+    out = {}
+    for table, prefixes in indexes.items():
+        index_bytes = sum(size for name, size in sizes.items()
+                          if name.startswith(prefixes)
+                          and not (table == "Rental" and name.startswith("idx_rental_archive")))
+        out[table] = (sizes.get(table, 0), index_bytes)
+    return out
+
+
+def print_sizes(label, sizes):
+    if sizes is None:
+        return
+    print("%s: " % label + "  ".join("%s %.0fMB (+%.0fMB indexes)"
+                                     % (t, data / 2 ** 20, idx / 2 ** 20)
+                                     for t, (data, idx) in sizes.items()))
+
+
+def run_reads(app, customers, repeat, today, first):
+    # {read: [seconds]}, {read: result} for the comparison
+    times, results = {}, {}
+
+    def timed(name, fn, key=None):
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            value = fn()
+            times.setdefault(name, []).append(time.perf_counter() - t0)
+            if i == 0 and key is not None:
+                results[(name, key)] = value
+
+    with app.test_request_context():
+        store = storage.get_store()
+        for user_id in customers:
+            timed("payments page", lambda: [r["PaymentID"] for r in
+                                            store.payments.for_user_page(user_id, None, 50).rows],
+                  user_id)
+            timed("history", lambda: [r["PaymentID"] for r in
+                                      store.payments.for_user_stream(user_id)], user_id)
+            timed("active", lambda: sorted(r["RentalID"] for r in
+                                           store.rentals.active_for_user(user_id)), user_id)
+        timed("recent", lambda: ([r["RentalID"] for r in store.rentals.recent(10)],
+                                 [r["PaymentID"] for r in store.payments.recent(10)]), 0)
+
+        def report(lo):
+            # the tiers' partial groups only add up, so compare the sums
+            source = analytics.SQLSource(database.get_db())
+            day, _, amount = source.payments(lo, today)
+            start, _, _, _, count = source.rentals(lo, today)
+            return (len(set(day.tolist())), round(float(amount.sum()), 2),
+                    len(set(start.tolist())), int(count.sum()))
+
+        recent = today - datetime.timedelta(days=29)
+        timed("report 30d", lambda: report(recent), 0)
+        timed("report all", lambda: report(first), 0)
+    return times, results
+
+
+def print_times(label, times):
+    for name, samples in times.items():
+        pct = percentiles(samples)
+        print("%-6s %-14s p50=%-9s p95=%-9s p99=%s"
+              % (label, name, fmt_ms(pct["p50"]), fmt_ms(pct["p95"]), fmt_ms(pct["p99"])))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=200000)
+    ap.add_argument("--vehicles", type=int, default=20000)
+    ap.add_argument("--rentals", type=int, default=10000000)
+    ap.add_argument("--years", type=int, default=5)
+    ap.add_argument("--after-days", type=int, default=365, help="ARCHIVE_AFTER_DAYS")
+    ap.add_argument("--batch", type=int, default=5000, help="ARCHIVE_BATCH_SIZE")
+    ap.add_argument("--customers", type=int, default=50)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--db", help="reuse/create this SQLite file (archived in place!)")
+    args = ap.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="vrms-archive-"), "archive.sqlite3")
+    if not os.path.exists(path):
+        t0 = time.perf_counter()
+        build(path, args.users, args.vehicles, args.rentals, args.years)
+        print("built %s with %d rentals in %.1fs" % (path, args.rentals, time.perf_counter() - t0))
+
+    app = sqlite_app(path, ARCHIVE_AFTER_DAYS=args.after_days, ARCHIVE_GRACE=0,
+                     RESPONSE_CACHE_ENABLED=False, SLOW_QUERY_MS=0)
+    today = datetime.date.today()
+    first = today - datetime.timedelta(days=args.years * 365)
+    rng = random.Random(7)
+    customers = [rng.randint(11, args.users + 10) for _ in range(args.customers)]
+
+    with app.test_request_context():
+        totals = storage.get_store().reports.totals()
+    print_sizes("before", table_sizes(path))
+    run_reads(app, customers[:5], 1, today, first)          # warm the page cache
+    before, expected = run_reads(app, customers, args.repeat, today, first)
+    print_times("before", before)
+
+    with app.test_request_context():
+        cutoff = archive.cutoff(app.config)
+        t0 = time.perf_counter()
+        moved = storage.get_store().rentals.archive(cutoff, args.batch, 10 ** 9)
+        elapsed = time.perf_counter() - t0
+    print("archived %d rentals, %d payments ended before %s in %d batches: %.1fs, %.0f rentals/s"
+          % (moved["rentals"], moved["payments"], cutoff, moved["batches"], elapsed,
+             moved["rentals"] / elapsed if elapsed else 0))
+    print_sizes("after ", table_sizes(path))
+
+    run_reads(app, customers[:5], 1, today, first)
+    after, actual = run_reads(app, customers, args.repeat, today, first)
+    print_times("after", after)
+    for name in before:
+        b, a = percentiles(before[name])["p50"], percentiles(after[name])["p50"]
+        print("%-14s p50 %s -> %s  (%.1fx)" % (name, fmt_ms(b), fmt_ms(a), b / a if a else 0))
+
+    wrong = [key for key in expected if expected[key] != actual.get(key)]
+    assert not wrong, "results changed by archiving: %s" % wrong[:5]
+    with app.test_request_context():
+        store = storage.get_store()
+        assert store.reports.totals() == totals
+        assert store.reports.reconcile() == {}
+    print("all %d results identical; report totals unchanged" % len(expected))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import datetime
+import random
+import sys
+import threading
+import time
+
+import sqlite_compat
+from bench.common import fmt_ms, login, mysql_app, mysql_connect, percentiles, sqlite_app
+
+# Fires thousands of simultaneous POST /customer/rent/<id> requests at a
+# small pool of vehicles and checks that no vehicle ends up with more than
+# one active rental (i.e. no double booking). Also prints throughput. Exits
+# non-zero when a check fails.
+#
+# --backend mysql runs against a scratch database on the VRMS_MYSQL_*
+# server, loaded from db/vrms_export.sql, so the bookings go through
+# sp_book_vehicle and its triggers; it then reserves through
+# sp_reserve_vehicle as well and checks that the striped ReportTotals
+# slots add up to the Rental table.
+#
+#   python3 -m bench.booking_load --threads 32 --requests 4000 --vehicles 50
+#   VRMS_MYSQL_PASSWORD=... python3 -m bench.booking_load --backend mysql
+
+
+def check(ok, message):
+    if not ok:
+        sys.exit("FAILED: " + message)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--threads", type=int, default=32)
+    ap.add_argument("--requests", type=int, default=4000)
+    ap.add_argument("--vehicles", type=int, default=50)
+    ap.add_argument("--customers", type=int, default=200)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--backend", choices=("sqlite", "mysql"), default="sqlite")
+    ap.add_argument("--database", default="vrms_bench", help="scratch MySQL database")
+    args = ap.parse_args()
+
+    if args.backend == "mysql":
+        app = mysql_app(args.database, DB_POOL_SIZE=args.threads, DB_POOL_MAX_OVERFLOW=0)
+        cn = mysql_connect(args.database)
+    else:
+        app = sqlite_app(DB_POOL_SIZE=args.threads, DB_POOL_MAX_OVERFLOW=0)
+        cn = sqlite_compat.connect(app.config["SQLITE_PATH"])
+    cur = cn.cursor()
+    cur.executemany(
+        "INSERT INTO User (Name, Email, Phone, Password, RoleID) VALUES (%s, %s, '', 'pass', 3)",
+        [("Load %d" % i, "load%d@bench" % i) for i in range(args.customers)])
+    cur.executemany(
+        "INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status) "
+        "VALUES ('Car', 'Race Target', %s, 10, 'Available')",
+        [("RACE%04d" % i,) for i in range(args.vehicles)])
+    cn.commit()
+    cur.execute("SELECT VehicleID FROM Vehicle WHERE Model = 'Race Target'")
+    targets = [r[0] for r in cur.fetchall()]
+
+    per_thread = args.requests // args.threads
+    barrier = threading.Barrier(args.threads)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(n):
+        rnd = random.Random(args.seed + n)
+        client = login(app.test_client(), "load%d@bench" % (n % args.customers))
+        local = []
+        barrier.wait()   # everyone starts at once
+        for _ in range(per_thread):
+            t0 = time.perf_counter()
+            resp = client.post("/customer/rent/%d" % rnd.choice(targets), data={"days": "2"})
+            local.append(time.perf_counter() - t0)
+            if resp.status_code != 302:
+                errors.append(resp.status_code)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    cur.execute("""
+        SELECT VehicleID, COUNT(*) FROM Rental
+        WHERE Status = 'Active' AND VehicleID IN (%s)
+        GROUP BY VehicleID HAVING COUNT(*) > 1
+    """ % ", ".join(str(v) for v in targets))
+    doubles = cur.fetchall()
+    cur.execute("SELECT COUNT(*) FROM Rental WHERE VehicleID IN (%s)"
+                % ", ".join(str(v) for v in targets))
+    booked = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM Vehicle WHERE Model = 'Race Target' AND Status = 'Rented'")
+    rented = cur.fetchone()[0]
+    if args.backend == "mysql":
+        # a reservation of every target a week out, through the procedure
+        start = datetime.date.today() + datetime.timedelta(days=7)
+        for vehicle_id in targets:
+            cur.callproc("sp_reserve_vehicle", (1, vehicle_id, start, 2, None))
+            for result in cur.stored_results():
+                result.fetchall()
+        cn.commit()
+        cur.execute("SELECT COUNT(*) FROM Rental")
+        rentals = cur.fetchone()[0]
+        cur.execute("SELECT SUM(Value), COUNT(*) FROM ReportTotals WHERE Metric = 'total_rentals'")
+        total, slots = cur.fetchone()
+    cn.close()
+
+    pct = percentiles(latencies)
+    print("rent requests: %d in %.2fs (%.0f req/s)" % (len(latencies), elapsed, len(latencies) / elapsed))
+    print("latency: " + ", ".join("%s=%s" % (k, fmt_ms(v)) for k, v in pct.items()))
+    print("successful bookings: %d, vehicles rented: %d of %d" % (booked, rented, len(targets)))
+    check(not errors, "%d rent requests did not redirect: %s" % (len(errors), errors[:5]))
+    check(not doubles, "double bookings: %s" % doubles)
+    check(booked == rented, "bookings and rented vehicles disagree")
+    print("OK: no double bookings")
+    if args.backend == "mysql":
+        print("ReportTotals total_rentals: %d over %d slots, Rental rows: %d"
+              % (total, slots, rentals))
+        check(int(total) == rentals, "the procedures' ReportTotals slots don't add up")
+        print("OK: the procedures keep ReportTotals in step")
+
+
+if __name__ == "__main__":
+    main()
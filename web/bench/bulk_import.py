@@ -0,0 +1,72 @@
+import argparse
+import io
+import tracemalloc
+
+from bench.common import Timer, fmt_ms, login, sqlite_app
+
+# Fleet onboarding: N vehicles through the one-per-form admin_add_vehicle
+# path versus the bulk import endpoint at a few chunk sizes, then a full
+# streamed export with the peak Python memory it needed.
+#
+#   python3 -m bench.bulk_import --vehicles 5000
+
+
+def fleet_csv(prefix, n):
+    buf = io.StringIO()
+    buf.write("VehicleType,Model,RegistrationNumber,RentalPrice,Status\n")
+    for i in range(n):
+        buf.write("Car,Bench Model %d,%s%07d,%d.50,Available\n" % (i % 50, prefix, i, 20 + i % 80))
+    return buf.getvalue().encode()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--vehicles", type=int, default=5000)
+    ap.add_argument("--form-vehicles", type=int, default=1000,
+                    help="how many go through the one-by-one form path")
+    ap.add_argument("--chunk-sizes", default="1,100,500,2000")
+    args = ap.parse_args()
+
+    app = sqlite_app()
+    client = login(app.test_client(), "admin1@vrms.com")
+
+    n = args.form_vehicles
+    with Timer() as t:
+        for i in range(n):
+            resp = client.post("/admin/vehicles/add", data={
+                "vehicle_type": "Car", "model": "Form Model",
+                "regno": "FORM%07d" % i, "price": "25"})
+            assert resp.status_code == 302
+    print("form, one per request: %d vehicles in %s (%.0f vehicles/s)"
+          % (n, fmt_ms(t.elapsed), n / t.elapsed))
+
+    for k, chunk_size in enumerate(int(c) for c in args.chunk_sizes.split(",")):
+        data = fleet_csv("B%dX" % k, args.vehicles)
+        with Timer() as t:
+            resp = client.post("/admin/vehicles/import?chunk_size=%d" % chunk_size,
+                               data=data, content_type="text/csv")
+        report = resp.get_json()
+        assert report["inserted"] == args.vehicles, report
+        print("import, chunk %5d: %d vehicles in %s (%.0f vehicles/s)"
+              % (chunk_size, args.vehicles, fmt_ms(t.elapsed), args.vehicles / t.elapsed))
+
+    # re-importing the same file: every row rejected, nothing aborted
+    resp = client.post("/admin/vehicles/import", data=fleet_csv("B0X", args.vehicles),
+                       content_type="text/csv")
+    print("re-import of the same file: %(inserted)d inserted, %(rejected)d rejected"
+          % resp.get_json())
+
+    for table in ("vehicles", "rentals"):
+        tracemalloc.start()
+        with Timer() as t:
+            resp = client.get("/admin/export/%s?format=csv" % table, buffered=False)
+            lines = sum(chunk.count(b"\n") for chunk in resp.response)
+            resp.close()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("export %s: %d lines in %s, peak %.1f MiB"
+              % (table, lines, fmt_ms(t.elapsed), peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
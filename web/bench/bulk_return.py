@@ -0,0 +1,66 @@
+import argparse
+
+import sqlite_compat
+from bench.common import Timer, fmt_ms, login, sqlite_app
+
+# Depot close: check in N rentals one request at a time (GET
+# /customer/return/<id>, the per-item path) versus one POST /staff/returns
+# with all N ids. Both sides start from identical Active rentals.
+#
+#   python3 -m bench.bulk_return --rentals 500
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rentals", type=int, default=500)
+    args = ap.parse_args()
+    n = args.rentals
+
+    app = sqlite_app()
+    cn = sqlite_compat.connect(app.config["SQLITE_PATH"])
+    cur = cn.cursor()
+    cur.execute("INSERT INTO User (Name, Email, Phone, Password, RoleID) "
+                "VALUES ('Depot Customer', 'depot@bench', '', 'pass', 3)")
+    user_id = cur.lastrowid
+    cur.executemany(
+        "INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status) "
+        "VALUES ('Car', 'Depot Car', %s, 20, 'Available')",
+        [("DEPOT%05d" % i,) for i in range(2 * n)])
+    cur.execute("SELECT VehicleID FROM Vehicle WHERE Model = 'Depot Car' ORDER BY VehicleID")
+    vehicles = [r[0] for r in cur.fetchall()]
+    cur.executemany(
+        "INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status) "
+        "VALUES (%s, %s, CURDATE(), DATE_ADD(CURDATE(), INTERVAL 2 DAY), 40, 'Active')",
+        [(user_id, v) for v in vehicles])
+    cn.commit()
+    cur.execute("SELECT RentalID FROM Rental WHERE UserID = %s ORDER BY RentalID", (user_id,))
+    rentals = [r[0] for r in cur.fetchall()]
+    per_item, bulk = rentals[:n], rentals[n:]
+
+    customer = login(app.test_client(), "depot@bench")
+    with Timer() as t_item:
+        for rid in per_item:
+            assert customer.get("/customer/return/%d" % rid).status_code == 302
+
+    staff = login(app.test_client(), "staff1@vrms.com")
+    with Timer() as t_bulk:
+        resp = staff.post("/staff/returns", json={"rental_ids": bulk})
+    assert resp.status_code == 200
+    assert resp.get_json()["returned"] == n
+
+    cur.execute("SELECT COUNT(*) FROM Rental WHERE UserID = %s AND Status = 'Completed'", (user_id,))
+    completed = cur.fetchone()[0]
+    cur.execute("SELECT COUNT(*) FROM Vehicle WHERE Model = 'Depot Car' AND Status = 'Available'")
+    freed = cur.fetchone()[0]
+    cn.close()
+    assert completed == freed == 2 * n, (completed, freed)
+
+    print("per-item: %d requests in %s (%s per rental)"
+          % (n, fmt_ms(t_item.elapsed), fmt_ms(t_item.elapsed / n)))
+    print("bulk:     1 request  in %s (%s per rental)"
+          % (fmt_ms(t_bulk.elapsed), fmt_ms(t_bulk.elapsed / n)))
+    print("speedup:  %.1fx" % (t_item.elapsed / t_bulk.elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import traceback
+
+import sqlite_compat
+from bench.common import fmt_ms, login, percentiles, sqlite_app
+
+# The cache bus (cachebus.py) between real worker processes sharing one
+# SQLite database, each with its own app and caches:
+#
+#   coherence    worker 0 renames a vehicle (admin edit) or a user; the
+#                moment it returns, every other worker requests the page
+#                that shows it (/staff?model=..., the navbar of /profile)
+#                and counts the stale ones -- the search index and user
+#                cache are warm, so without the bus (--no-bus) they all
+#                are until the TTLs run out
+#   propagation  worker 0 keeps writing while the others stay idle; their
+#                background polls apply each message, and the delay from
+#                publish to applied is reported
+#
+# and exits non-zero unless, with the bus, no read was stale and every
+# idle worker caught up with every message without errors (with --no-bus,
+# unless the probes did see stale pages -- i.e. they can tell).
+#
+#   python3 -m bench.cachebus --workers 4 --rounds 100
+#   python3 -m bench.cachebus --workers 4 --rounds 100 --no-bus
+
+
+def worker(index, args, path, barrier, results):
+    try:
+        results.put(run_worker(index, args, path, barrier))
+    except BaseException:
+        barrier.abort()                 # the others stop waiting for this one
+        results.put({"worker": index, "error": traceback.format_exc()})
+
+
+def run_worker(index, args, path, barrier):
+    app = sqlite_app(path, CACHE_BUS_ENABLED=not args.no_bus, CACHE_BUS_POLL=args.poll,
+                     RESPONSE_CACHE_ENABLED=False)
+    staff = login(app.test_client(), "admin1@vrms.com")
+    customer = login(app.test_client(), "alice@vrms.com")
+    staff.get("/staff")                         # warm the search index
+    customer.get("/profile")                    # and the user cache
+    with app.app_context():
+        import storage
+        users = storage.get_store().users
+        alice = users.get(users.by_email("alice@vrms.com")["UserID"])
+    rng = random.Random(index)
+    stale = {"vehicle": 0, "user": 0}
+    write_times = []
+
+    barrier.wait()
+    for r in range(args.rounds):
+        kind = "vehicle" if r % 2 == 0 else "user"
+        probe = "Probe-%d" % r
+        if index == 0:
+            t0 = time.perf_counter()
+            if kind == "vehicle":
+                staff.post("/admin/vehicles/edit/1", data={
+                    "vehicle_type": "Car", "model": probe, "regno": "BUS-1",
+                    "price": "45", "status": "Available"})
+            else:
+                staff.post("/admin/users/edit/%d" % alice["UserID"], data={
+                    "name": probe, "email": alice["Email"], "phone": alice["Phone"],
+                    "password": "", "role_id": str(alice["RoleID"])})
+            write_times.append(time.perf_counter() - t0)
+        barrier.wait()                          # the write has returned
+        if index != 0:
+            if kind == "vehicle":
+                page = staff.get("/staff?model=%s" % probe).data
+                fresh = ("<td>%s</td>" % probe).encode() in page
+            else:
+                fresh = ("Welcome, %s" % probe).encode() in customer.get("/profile").data
+            stale[kind] += not fresh
+        barrier.wait()
+
+    # idle workers: only the bus's own poll thread applies the messages
+    import cachebus
+    bus = cachebus.get_bus(app)
+    if bus is not None:
+        bus.latencies.clear()
+    barrier.wait()
+    if index == 0:
+        for r in range(args.rounds):
+            time.sleep(rng.uniform(0, 2 * args.poll))
+            staff.post("/staff/vehicle/1/status",
+                       data={"status": "Maintenance" if r % 2 else "Available"})
+    barrier.wait()
+    time.sleep(3 * args.poll)
+    return {"worker": index, "stale": stale, "write_times": write_times,
+            "bus": bus.stats() if bus is not None else None,
+            "latencies": list(bus.latencies) if bus is not None else []}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--rounds", type=int, default=100)
+    ap.add_argument("--poll", type=float, default=0.05, help="CACHE_BUS_POLL")
+    ap.add_argument("--no-bus", action="store_true")
+    args = ap.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix="vrms-cachebus-"), "vrms.sqlite3")
+    sqlite_compat.create_database(path)
+    ctx = multiprocessing.get_context("fork")
+    barrier = ctx.Barrier(args.workers, timeout=60)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(i, args, path, barrier, results))
+             for i in range(args.workers)]
+    for p in procs:
+        p.start()
+    out = sorted((results.get() for _ in procs), key=lambda r: r["worker"])
+    for p in procs:
+        p.join()
+    failed = [r for r in out if "error" in r]
+    if failed:
+        raise SystemExit("worker %d failed:\n%s" % (failed[0]["worker"], failed[0]["error"]))
+
+    readers = out[1:]
+    checks = args.rounds // 2
+    failures = []
+    stale = {}
+    for kind in ("vehicle", "user"):
+        stale[kind] = sum(r["stale"][kind] for r in readers)
+        print("%-8s stale reads after a write: %d of %d"
+              % (kind, stale[kind], checks * len(readers)))
+    pct = percentiles(out[0]["write_times"])
+    print("write (edit + publish) p50=%s p95=%s" % (fmt_ms(pct["p50"]), fmt_ms(pct["p95"])))
+    if args.no_bus:
+        if not all(stale.values()):
+            failures.append("without the bus the probes saw no stale page: %s" % stale)
+        finish(failures)
+        return
+    failures += ["%d stale %s reads" % (n, kind) for kind, n in stale.items() if n]
+    head = out[0]["bus"]["version"]
+    for r in readers:
+        bus = r["bus"]
+        if bus["cursor"] != head or bus["errors"] or not r["latencies"]:
+            failures.append("worker %d did not catch up: %s (head %d)"
+                            % (r["worker"], bus, head))
+    latencies = [s for r in readers for s in r["latencies"]]
+    pct = percentiles(latencies)
+    print("idle propagation  p50=%s p95=%s p99=%s max=%s  (poll every %s)"
+          % (fmt_ms(pct["p50"]), fmt_ms(pct["p95"]), fmt_ms(pct["p99"]),
+             fmt_ms(max(latencies) if latencies else 0), fmt_ms(args.poll)))
+    for r in readers:
+        print("worker %d: %s" % (r["worker"], r["bus"]))
+    finish(failures)
+
+
+def finish(failures):
+    for failure in failures:
+        print("FAILED: " + failure)
+    if failures:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import time
+
+import sqlite_compat
+
+MYSQL_SCHEMA = os.path.join(os.path.dirname(__file__), "..", "..", "db", "vrms_export.sql")
+
+
+def sqlite_app(path=None, **config):
+    # the real Flask app, pointed at a fresh SQLite stand-in database
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(prefix="vrms-bench-"), "vrms.sqlite3")
+        sqlite_compat.create_database(path)
+
+    return _bench_app(os.path.dirname(path), DB_BACKEND="sqlite", SQLITE_PATH=path, **config)
+
+
+def _bench_app(directory, **config):
+    from app import app
+    # every bench client logs in from 127.0.0.1
+    config.setdefault("LOGIN_RATE_LIMIT_IP", 10 ** 9)
+    # and keeps its event log next to the database
+    config.setdefault("EVENT_LOG_DIR", os.path.join(directory, "events"))
+    # and its cache bus file
+    config.setdefault("CACHE_BUS_PATH", os.path.join(directory, "cache-bus.shm"))
+    # background jobs would only add noise to the timings
+    config.setdefault("SCHEDULER_ENABLED", False)
+    app.config.update(TESTING=True, **config)
+    for key in [k for k in app.extensions if k.startswith("vrms_")]:
+        app.extensions.pop(key)
+    return app
+
+
+def mysql_statements(script):
+    # the statements of a mysql-client script, following its DELIMITER
+    # lines (the procedures and triggers are written between them)
+    delimiter, lines = ";", []
+    for line in script.splitlines():
+        stripped = line.strip()
+        if stripped.upper().startswith("DELIMITER "):
+            delimiter = stripped.split()[1]
+            continue
+        if not lines and (not stripped or stripped.startswith("--")):
+            continue
+        lines.append(line)
+        if stripped.endswith(delimiter):
+            yield "\n".join(lines).rstrip()[:-len(delimiter)]
+            lines = []
+
+
+def mysql_connect(database=None):
+    # a connection to the VRMS_MYSQL_* server (database.DEFAULTS)
+    import mysql.connector
+    from database import DEFAULTS
+    return mysql.connector.connect(host=DEFAULTS["MYSQL_HOST"], user=DEFAULTS["MYSQL_USER"],
+                                   password=DEFAULTS["MYSQL_PASSWORD"], database=database)
+
+
+def mysql_app(database="vrms_bench", **config):
+    # the real Flask app on a scratch MySQL database, loaded from
+    # db/vrms_export.sql -- tables, triggers and procedures -- under
+    # another name; the server is the one VRMS_MYSQL_* points at
+    with open(MYSQL_SCHEMA) as f:
+        script = f.read().replace("VehicleRentalDB", database)
+    cn = mysql_connect()
+    cur = cn.cursor()
+    for statement in mysql_statements(script):
+        cur.execute(statement)
+    cn.commit()
+    cn.close()
+
+    return _bench_app(tempfile.mkdtemp(prefix="vrms-bench-"), DB_BACKEND="mysql",
+                      MYSQL_DATABASE=database, **config)
+
+
+def login(client, email, password="pass"):
+    resp = client.post("/", data={"email": email, "password": password})
+    assert resp.status_code == 302, "login failed for %s" % email
+    return client
+
+
+def percentiles(samples, points=(50, 95, 99)):
+    if not samples:
+        return {"p%d" % p: 0.0 for p in points}
+    ordered = sorted(samples)
+    out = {}
+    for p in points:
+        idx = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+        out["p%d" % p] = ordered[idx]
+    return out
+
+
+def fmt_ms(seconds):
+    return "%.2fms" % (seconds * 1000.0)
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
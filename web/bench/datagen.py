@@ -0,0 +1,183 @@
+import argparse
+import datetime
+import itertools
+import random
+
+import aggregates
+import sqlite_compat
+from werkzeug.security import generate_password_hash
+
+# Synthetic VRMS database for benchmarks, on top of the sample data in
+# db/vrms_sqlite.sql (so admin1@vrms.com, staff1@vrms.com, alice@vrms.com
+# ... still exist).
+#
+# The data is skewed the way a rental business is:
+#   - a few models are far more popular than the rest (Zipf), both in the
+#     fleet and in what gets rented,
+#   - a minority of customers make most of the rentals (repeat customers),
+#   - rentals are busier at weekends and in summer / December, and most
+#     are short,
+#   - the most recent ACTIVE_FRACTION of rentals are still Active (one per
+#     vehicle at most, and those vehicles are 'Rented'); the rest are
+#     Completed and paid.
+# Every bench user's password is "pass" (already hashed, so logins don't
+# pay for a rehash). Same seed, same database.
+#
+#   python3 -m bench.datagen bench.sqlite3 --users 20000 --vehicles 10000 --rentals 200000
+
+CATALOG = [
+    # (VehicleType, Model, base price per day)
+    ("Car", "Toyota Corolla", 45), ("Car", "Honda Civic", 48), ("Car", "Hyundai Elantra", 42),
+    ("Car", "Ford Focus", 40), ("Car", "Volkswagen Golf", 50), ("Car", "Tesla Model 3", 95),
+    ("Car", "BMW 3 Series", 110), ("Car", "Kia Rio", 35), ("Car", "Nissan Altima", 47),
+    ("Car", "Mazda 3", 46), ("Car", "Chevrolet Malibu", 44), ("Car", "Audi A4", 115),
+    ("SUV", "Toyota RAV4", 65), ("SUV", "Honda CR-V", 66), ("SUV", "Ford Explorer", 80),
+    ("SUV", "Jeep Wrangler", 85), ("SUV", "Hyundai Tucson", 60), ("SUV", "Kia Sportage", 58),
+    ("SUV", "Nissan Rogue", 62), ("SUV", "BMW X5", 150), ("SUV", "Mazda CX-5", 64),
+    ("Bike", "Yamaha R15", 25), ("Bike", "Honda Shine", 18), ("Bike", "Royal Enfield Classic", 30),
+    ("Bike", "Bajaj Pulsar", 20), ("Bike", "KTM Duke 390", 35), ("Bike", "Hero Splendor", 15),
+    ("Van", "Ford Transit", 90), ("Van", "Mercedes Sprinter", 120), ("Van", "Toyota HiAce", 95),
+    ("Van", "Renault Trafic", 85), ("Truck", "Ford F-150", 110), ("Truck", "Ram 1500", 115),
+    ("Truck", "Toyota Tacoma", 100), ("Truck", "Chevrolet Silverado", 112),
+]
+
+FIRST = ["Alex", "Sam", "Priya", "Chen", "Maria", "John", "Aisha", "Luca", "Yuki", "Omar",
+         "Emma", "Noah", "Olivia", "Liam", "Sofia", "Ravi", "Fatima", "Diego", "Anna", "Ben"]
+LAST = ["Smith", "Patel", "Garcia", "Kim", "Müller", "Rossi", "Nguyen", "Khan", "Silva",
+        "Brown", "Lee", "Cohen", "Ivanova", "Okafor", "Jensen", "Tanaka", "Haddad", "Lopez"]
+
+ACTIVE_FRACTION = 0.02
+PASSWORD = "pass"
+SEASON = {1: 0.8, 2: 0.8, 3: 0.9, 4: 1.0, 5: 1.1, 6: 1.4, 7: 1.6, 8: 1.5,
+          9: 1.0, 10: 0.9, 11: 0.8, 12: 1.3}
+
+
+def zipf_weights(n, s=1.1):
+    return [1.0 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def cumulative(weights):
+    return list(itertools.accumulate(weights))
+
+
+def generate(path, users=2000, vehicles=1000, rentals=20000, days=730, seed=1,
+             password_method="scrypt:32768:8:1", end=None):
+    rnd = random.Random(seed)
+    end = end or datetime.date.today()
+    start = end - datetime.timedelta(days=days)
+
+    sqlite_compat.create_database(path)
+    cn = sqlite_compat.connect(path)
+    raw = cn._raw
+    cur = cn.cursor()
+
+    # bulk load without the per-row status triggers; vehicle statuses are
+    # set once at the end
+    triggers = raw.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+    for name, _ in triggers:
+        raw.execute("DROP TRIGGER " + name)
+
+    cur.execute("SELECT COALESCE(MAX(UserID), 0) FROM User")
+    first_user = cur.fetchone()[0] + 1
+    cur.execute("SELECT COALESCE(MAX(VehicleID), 0) FROM Vehicle")
+    first_vehicle = cur.fetchone()[0] + 1
+
+    hashed = generate_password_hash(PASSWORD, password_method)
+    cur.executemany(
+        "INSERT INTO User (Name, Email, Phone, Password, RoleID) VALUES (%s, %s, %s, %s, 3)",
+        (("%s %s" % (rnd.choice(FIRST), rnd.choice(LAST)), "user%d@bench" % i,
+          "555%07d" % i, hashed) for i in range(users)))
+
+    # fleet: popular models make up more of it
+    model_cum = cumulative(zipf_weights(len(CATALOG)))
+    fleet = rnd.choices(range(len(CATALOG)), cum_weights=model_cum, k=vehicles)
+    cur.executemany(
+        "INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status) "
+        "VALUES (%s, %s, %s, %s, 'Available')",
+        ((CATALOG[m][0], CATALOG[m][1], "BN%07d" % i,
+          round(CATALOG[m][2] * rnd.uniform(0.85, 1.2), 2)) for i, m in enumerate(fleet)))
+
+    # rentals: popular models and repeat customers get picked more
+    vehicle_cum = cumulative([1.0 / (m + 1) ** 0.6 for m in fleet])
+    customer_cum = cumulative(zipf_weights(users, s=0.9))
+    dates = [start + datetime.timedelta(days=d) for d in range(days + 1)]
+    date_cum = cumulative([SEASON[d.month] * (1.3 if d.weekday() >= 4 else 1.0) for d in dates])
+    prices = {first_vehicle + i: None for i in range(vehicles)}
+    cur.execute("SELECT VehicleID, RentalPrice FROM Vehicle WHERE VehicleID >= %s", (first_vehicle,))
+    prices.update(cur.fetchall())
+
+    n_active = int(rentals * ACTIVE_FRACTION)
+    picked_dates = sorted(rnd.choices(dates, cum_weights=date_cum, k=rentals - n_active))
+    active_vehicles = set()
+
+    def rental_rows():
+        for rental_date in picked_dates:
+            vid = first_vehicle + rnd.choices(range(vehicles), cum_weights=vehicle_cum)[0]
+            uid = first_user + rnd.choices(range(users), cum_weights=customer_cum)[0]
+            length = min(30, 1 + int(rnd.expovariate(1 / 3.0)))
+            rental_date = min(rental_date, end - datetime.timedelta(days=length))
+            yield (uid, vid, rental_date, rental_date + datetime.timedelta(days=length),
+                   prices[vid] * length, "Completed")
+        # still out: recent, at most one per vehicle
+        for _ in range(n_active):
+            vid = first_vehicle + rnd.choices(range(vehicles), cum_weights=vehicle_cum)[0]
+            if vid in active_vehicles:
+                continue
+            active_vehicles.add(vid)
+            uid = first_user + rnd.choices(range(users), cum_weights=customer_cum)[0]
+            length = 1 + int(rnd.expovariate(1 / 3.0))
+            rental_date = end - datetime.timedelta(days=rnd.randint(0, min(length, 6)))
+            yield (uid, vid, rental_date, rental_date + datetime.timedelta(days=length),
+                   prices[vid] * length, "Active")
+
+    cur.executemany(
+        "INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status) "
+        "VALUES (%s, %s, %s, %s, %s, %s)", rental_rows())
+
+    modes = ("Card", "Card", "Card", "Cash")
+    cur.execute("SELECT COALESCE(MAX(RentalID), 0) FROM Payment")
+    last_paid = cur.fetchone()[0]
+    raw.create_function("payment_mode", 1, lambda rid: modes[rid % len(modes)])
+    cur.execute("""
+        INSERT INTO Payment (RentalID, PaymentDate, Amount, PaymentMode)
+        SELECT RentalID, ReturnDate, TotalAmount, payment_mode(RentalID)
+        FROM Rental
+        WHERE Status = 'Completed' AND RentalID > %s
+    """, (last_paid,))
+
+    cur.execute("""
+        UPDATE Vehicle SET Status = 'Rented'
+        WHERE VehicleID IN (SELECT VehicleID FROM Rental WHERE Status = 'Active')
+    """)
+    for _, sql in triggers:
+        raw.execute(sql)
+    cn.commit()
+
+    aggregates.reconcile(cn)
+    raw.execute("ANALYZE")
+    raw.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    cn.close()
+    return path
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("path")
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--vehicles", type=int, default=1000)
+    ap.add_argument("--rentals", type=int, default=20000)
+    ap.add_argument("--days", type=int, default=730)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    generate(args.path, args.users, args.vehicles, args.rentals, args.days, args.seed)
+    cn = sqlite_compat.connect(args.path)
+    cur = cn.cursor()
+    for table in ("User", "Vehicle", "Rental", "Payment"):
+        cur.execute("SELECT COUNT(*) FROM " + table)
+        print("%-8s %d" % (table, cur.fetchone()[0]))
+    cn.close()
+
+
+if __name__ == "__main__":
+    main()
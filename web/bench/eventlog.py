@@ -0,0 +1,115 @@
+import argparse
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import eventlog
+
+# The rental event log (eventlog.py) on a synthetic history: appends under
+# each fsync policy, a full replay into the read models, and a restart
+# that restores the snapshot and catches up on the events after it.
+#
+#   python3 -m bench.eventlog --events 1000000 --users 50000 --vehicles 10000
+
+
+def history(rng, events, users, vehicles):
+    # one record each: rentals (booked, returned, payment) and the odd
+    # status change
+    today = datetime.date.today()
+    rental_id = 0
+    out = []
+    while len(out) < events:
+        if rng.random() < 0.05:
+            out.append(eventlog.status_changed(rng.randint(1, vehicles),
+                                               rng.choice(("Available", "Maintenance"))))
+            continue
+        rental_id += 1
+        row = {"RentalID": rental_id, "UserID": rng.randint(1, users),
+               "VehicleID": rng.randint(1, vehicles), "TotalAmount": rng.uniform(20, 500)}
+        days = rng.randint(1, 14)
+        out.append(eventlog.booked(rental_id, row["UserID"], row["VehicleID"],
+                                   row["TotalAmount"], today, days))
+        both = eventlog.returned(row, "Card", today + datetime.timedelta(days=days))
+        out += [both[:eventlog.RECORD.size], both[eventlog.RECORD.size:]]
+    return out[:events]
+
+
+def rate(n, seconds):
+    return "%9.0f events/s  (%.2fs)" % (n / seconds, seconds)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=1000000)
+    ap.add_argument("--users", type=int, default=50000)
+    ap.add_argument("--vehicles", type=int, default=10000)
+    ap.add_argument("--appends", type=int, default=2000, help="single appends per fsync policy")
+    ap.add_argument("--tail", type=int, default=10000, help="events after the snapshot")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    records = history(rng, args.events + args.tail, args.users, args.vehicles)
+    workdir = tempfile.mkdtemp(prefix="vrms-eventlog-")
+    try:
+        # one repository call, one append
+        for policy in eventlog.FSYNC_POLICIES:
+            log = eventlog.EventLog(os.path.join(workdir, policy), fsync=policy)
+            t0 = time.perf_counter()
+            for record in records[:args.appends]:
+                log.append(record)
+            print("append fsync=%-9s %s" % (policy, rate(args.appends, time.perf_counter() - t0)))
+            log.close()
+
+        log = eventlog.EventLog(os.path.join(workdir, "log"), fsync="never")
+        t0 = time.perf_counter()
+        for i in range(0, args.events, 4096):
+            log.append(b"".join(records[i:min(i + 4096, args.events)]))
+        print("bulk append             %s  %d segments, %.0f MB"
+              % (rate(args.events, time.perf_counter() - t0), len(log.segments()),
+                 log.stats()["bytes"] / 1e6))
+
+        projector = eventlog.Projector(log, snapshot_every=0)
+        t0 = time.perf_counter()
+        projector.rebuild()
+        print("full replay             %s" % rate(args.events, time.perf_counter() - t0))
+        # the baseline: one event at a time, fleet status only
+        t0 = time.perf_counter()
+        status = {}
+        for event in log.read():
+            if event.kind in (eventlog.BOOKED, eventlog.PICKED_UP):
+                status[event.vehicle_id] = eventlog.RENTED
+            elif event.kind == eventlog.RETURNED:
+                status[event.vehicle_id] = eventlog.AVAILABLE
+            elif event.kind == eventlog.STATUS and event.code:
+                status[event.vehicle_id] = event.code
+        print("per-event replay (fleet) %s" % rate(args.events, time.perf_counter() - t0))
+        assert status == projector.view(lambda models: models["fleet"].status)
+
+        t0 = time.perf_counter()
+        projector.snapshot()
+        print("snapshot                %.2fs, %.0f MB" % (
+            time.perf_counter() - t0,
+            os.path.getsize(os.path.join(log.directory, eventlog.SNAPSHOT)) / 1e6))
+
+        log.append(b"".join(records[args.events:]))
+        restarted = eventlog.Projector(eventlog.EventLog(log.directory), snapshot_every=0)
+        t0 = time.perf_counter()
+        restarted.catch_up()
+        print("restart: snapshot + %d  %.2fs" % (args.tail, time.perf_counter() - t0))
+        t0 = time.perf_counter()
+        projector.catch_up()
+        print("catch-up of %d events   %.2fms" % (args.tail, (time.perf_counter() - t0) * 1000))
+        fleet = restarted.view(lambda models: models["fleet"].counts())
+        assert fleet == projector.view(lambda models: models["fleet"].counts())
+        print("fleet %s, %d users with history" % (
+            fleet, restarted.view(lambda models: len(models["history"].events))))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
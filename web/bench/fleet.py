@@ -0,0 +1,126 @@
+import argparse
+import decimal
+import random
+import sys
+import time
+import tracemalloc
+
+import fleet
+from bench.common import fmt_ms, percentiles
+from bench.datagen import CATALOG
+
+# The fleet model (fleet.py) on a synthetic fleet: memory per vehicle, the
+# bulk load, and the dashboard filters (status / type / model / max price,
+# first page and full result) against the same filters over a list of row
+# dicts, which is what the index held before.
+#
+#   python3 -m bench.fleet --vehicles 1000000 --queries 200
+
+
+def vehicles(rng, count):
+    statuses = ("Available",) * 8 + ("Rented",) * 3 + ("Maintenance",)
+    for i in range(count):
+        vtype, model, price = rng.choice(CATALOG)
+        yield {"VehicleID": i + 1, "VehicleType": vtype, "Model": model,
+               "RegistrationNumber": "BN%07d" % i,
+               "RentalPrice": decimal.Decimal(str(round(price * rng.uniform(0.85, 1.2), 2))),
+               "Status": rng.choice(statuses), "BranchID": 1 + i % 4}
+
+
+def filters(rng, count):
+    types = sorted({t for t, _, _ in CATALOG})
+    words = sorted({w for _, m, _ in CATALOG for w in m.split()})
+    out = []
+    for _ in range(count):
+        f = {"status": rng.choice((None, "Available", "Available", "Maintenance"))}
+        if rng.random() < 0.6:
+            f["vehicle_type"] = rng.choice(types)
+        if rng.random() < 0.3:
+            f["model"] = rng.choice(words)[:rng.randint(2, 5)]
+        if rng.random() < 0.4:
+            f["max_price"] = rng.choice((40, 60, 90, 150))
+        out.append(f)
+    return out
+
+
+def baseline(rows, status=None, vehicle_type="", model="", max_price=None, limit=None):
+    # one Python test per row
+    vehicle_type, model = vehicle_type.lower(), model.lower()
+    out = []
+    for row in rows:
+        if ((status is None or row["Status"] == status)
+                and (not vehicle_type or vehicle_type in row["VehicleType"].lower())
+                and (not model or model in row["Model"].lower())
+                and (max_price is None or row["RentalPrice"] <= max_price)):
+            out.append(row)
+            if limit is not None and len(out) >= limit:
+                break
+    return out
+
+
+def timed(fn, queries):
+    samples = []
+    for f in queries:
+        t0 = time.perf_counter()
+        fn(f)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def report(label, samples):
+    pct = percentiles(samples)
+    print("%-22s p50=%-9s p95=%-9s p99=%s"
+          % (label, fmt_ms(pct["p50"]), fmt_ms(pct["p95"]), fmt_ms(pct["p99"])))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--vehicles", type=int, default=1000000)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--page", type=int, default=50)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = list(vehicles(rng, args.vehicles))
+    queries = filters(rng, args.queries)
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    state = fleet.FleetState()
+    for lo in range(0, len(rows), 10000):
+        state.extend(rows[lo:lo + 10000])
+    load = time.perf_counter() - t0
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nbytes = state.nbytes()
+    # what the same vehicles take as dicts (shallow, values shared with
+    # the rows above are counted once per dict)
+    as_dicts = sum(sys.getsizeof(row) for row in rows[:10000]) / min(10000, len(rows))
+    print("%d vehicles loaded in %.2fs" % (len(state), load))
+    print("fleet columns  %.1f bytes/vehicle (+ %.1f of strings), %.1f traced"
+          % (nbytes["columns"] / len(state), nbytes["strings"] / len(state),
+             traced / len(state)))
+    print("row dicts      %.1f bytes/vehicle for the dicts alone" % as_dicts)
+
+    for f in queries[:20]:
+        # same vehicles, same order
+        assert ([r["VehicleID"] for r in state.rows(state.select(**f))]
+                == [r["VehicleID"] for r in baseline(rows, **f)]), f
+
+    report("fleet page", timed(
+        lambda f: state.rows(state.select(limit=args.page, **f)), queries))
+    report("row dicts page", timed(lambda f: baseline(rows, limit=args.page, **f), queries))
+    report("fleet count", timed(lambda f: len(state.select(**f)), queries))
+    report("row dicts count", timed(lambda f: len(baseline(rows, **f)), queries[:20]))
+    report("status counts", timed(lambda f: state.counts(), queries))
+    updates = [rng.randint(1, args.vehicles) for _ in range(10000)]
+    t0 = time.perf_counter()
+    for vid in updates:
+        state.set_status(vid, "Rented")
+    print("set_status             %.2fus each" % ((time.perf_counter() - t0) / len(updates) * 1e6))
+    print(state.counts())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import httpcache
+from bench.common import fmt_ms, login, percentiles, sqlite_app
+from bench.suite import SCALES, TYPES, dataset
+
+# The response cache (httpcache.py) on the cached pages of a synthetic
+# database: every page rendered afresh (cache off), served from the cache,
+# and revalidated with If-None-Match (304, no body); then a read/write mix
+# where every --write-every'th request books a vehicle, for the hit ratio
+# a busy site would see.
+#
+#   python3 -m bench.httpcache --scale small --requests 500
+
+
+def pages(rng, count):
+    # URLs on the cached routes
+    out = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.5:
+            url = "/customer?type=%s" % rng.choice(TYPES)
+        elif kind < 0.7:
+            url = "/customer/payments"
+        elif kind < 0.9:
+            url = "/staff?type=%s" % rng.choice(TYPES)
+        else:
+            url = "/admin/vehicles"
+        out.append(url)
+    return out
+
+
+def timed(client, urls, headers=None):
+    samples = []
+    for url in urls:
+        t0 = time.perf_counter()
+        resp = client.get(url, headers=headers(url) if headers else None)
+        samples.append(time.perf_counter() - t0)
+        assert resp.status_code in (200, 304), (url, resp.status_code)
+    return samples
+
+
+def report(label, samples):
+    pct = percentiles(samples)
+    print("%-14s %7.0f req/s  p50=%-9s p95=%-9s p99=%s"
+          % (label, len(samples) / sum(samples), fmt_ms(pct["p50"]), fmt_ms(pct["p95"]),
+             fmt_ms(pct["p99"])))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scale", choices=sorted(SCALES), default="small")
+    ap.add_argument("--requests", type=int, default=500)
+    ap.add_argument("--distinct", type=int, default=40, help="distinct pages requested")
+    ap.add_argument("--write-every", type=int, default=20)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--data", default=os.path.join(tempfile.gettempdir(), "vrms-bench-data"))
+    args = ap.parse_args()
+
+    sizes = SCALES[args.scale]
+    source = dataset(args.data, sizes, args.seed, "scrypt:32768:8:1")
+    rng = random.Random(args.seed)
+    urls = pages(rng, args.distinct)
+    workload = [rng.choice(urls) for _ in range(args.requests)]
+
+    for enabled in (False, True):
+        path = shutil.copy(source, tempfile.mkdtemp(prefix="vrms-httpcache-"))
+        app = sqlite_app(path, RESPONSE_CACHE_ENABLED=enabled, RESPONSE_CACHE_TTL=None)
+        # an admin sees every cached page
+        client = login(app.test_client(), "admin1@vrms.com")
+        timed(client, urls)                       # warm the indexes (and the cache)
+        if not enabled:
+            report("rendered", timed(client, workload))
+            continue
+        report("cache hit", timed(client, workload))
+        etags = {url: client.get(url).headers["ETag"] for url in urls}
+        report("304", timed(client, workload, lambda url: {"If-None-Match": etags[url]}))
+
+        customer = login(app.test_client(), "user0@bench")
+        cache = httpcache.get_cache(app)
+        before = cache.stats()
+        samples = []
+        for i, url in enumerate(workload):
+            if i % args.write_every == 0:
+                vehicle = rng.randint(1, sizes["vehicles"])
+                customer.post("/customer/rent/%d" % vehicle, data={"days": "1"})
+            t0 = time.perf_counter()
+            client.get(url)
+            samples.append(time.perf_counter() - t0)
+        report("with writes", samples)
+        after = cache.stats()
+        lookups = (after["hits"] - before["hits"]) + (after["misses"] - before["misses"])
+        print("hit ratio with a write every %d requests: %.2f"
+              % (args.write_every, (after["hits"] - before["hits"]) / lookups))
+        print(after)
+
+
+if __name__ == "__main__":
+    main()
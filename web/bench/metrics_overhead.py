@@ -0,0 +1,118 @@
+import argparse
+import statistics
+import time
+
+import database
+import sqlite_compat
+from bench.common import login, sqlite_app
+from metrics import InstrumentedConnection, Metrics
+
+# What the instrumentation costs:
+# 1. the wrapper alone, around a cursor that does nothing (no I/O noise),
+# 2. per statement: the same point SELECT + fetchone on a raw connection
+#    and on an instrumented one,
+# 3. per request: GET /customer with METRICS_ENABLED off and on.
+# Off/on rounds are interleaved and the best round of each is kept, so
+# noise from other processes doesn't land on one side only.
+#
+#   python3 -m bench.metrics_overhead
+
+
+class NullCursor:
+    rowcount = -1
+
+    def execute(self, sql, params=()):
+        return None
+
+    def fetchone(self):
+        return (1,)
+
+
+class NullConnection:
+    def cursor(self, **kwargs):
+        return NullCursor()
+
+
+def wrapper_cost(n, rounds):
+    sql = "SELECT VehicleID, Model FROM Vehicle WHERE VehicleID = %s"
+    best = {}
+    for _ in range(rounds):
+        for name, cn in (("bare", NullConnection()),
+                         ("wrapped", InstrumentedConnection(NullConnection(), Metrics()))):
+            cur = cn.cursor()
+            t0 = time.perf_counter()
+            for i in range(n):
+                cur.execute(sql, (i,))
+                cur.fetchone()
+            elapsed = (time.perf_counter() - t0) / n
+            best[name] = min(best.get(name, elapsed), elapsed)
+    print("wrapper alone: %.2fus per execute + fetchone" % ((best["wrapped"] - best["bare"]) * 1e6))
+
+
+def per_statement(path, n, rounds):
+    conns = {
+        "raw": sqlite_compat.connect(path),
+        "instrumented": InstrumentedConnection(sqlite_compat.connect(path), Metrics()),
+    }
+    best = {}
+    for _ in range(rounds):
+        for name, cn in conns.items():
+            cur = cn.cursor(dictionary=True)
+            t0 = time.perf_counter()
+            for i in range(n):
+                cur.execute("SELECT VehicleID, Model FROM Vehicle WHERE VehicleID = %s", (i % 10 + 1,))
+                cur.fetchone()
+            elapsed = (time.perf_counter() - t0) / n
+            cur.close()
+            best[name] = min(best.get(name, elapsed), elapsed)
+    for cn in conns.values():
+        cn.close()
+    print("per statement: raw %.2fus, instrumented %.2fus, overhead %.2fus"
+          % (best["raw"] * 1e6, best["instrumented"] * 1e6,
+             (best["instrumented"] - best["raw"]) * 1e6))
+
+
+def per_request(n, rounds):
+    app = sqlite_app(SLOW_QUERY_MS=0)
+    pools = {}
+    for enabled in (False, True):
+        app.config["METRICS_ENABLED"] = enabled
+        app.extensions.pop("vrms_pool", None)
+        with app.app_context():
+            pools[enabled] = database.get_pool()
+    client = login(app.test_client(), "alice@vrms.com")
+
+    best = {}
+    for _ in range(rounds):
+        for enabled in (False, True):
+            app.config["METRICS_ENABLED"] = enabled
+            app.extensions["vrms_pool"] = pools[enabled]
+            for _ in range(20):
+                client.get("/customer")
+            samples = []
+            for _ in range(n):
+                t0 = time.perf_counter()
+                client.get("/customer")
+                samples.append(time.perf_counter() - t0)
+            median = statistics.median(samples)
+            best[enabled] = min(best.get(enabled, median), median)
+    overhead = best[True] - best[False]
+    print("GET /customer median: off %.3fms, on %.3fms, overhead %.1fus (%.1f%%)"
+          % (best[False] * 1e3, best[True] * 1e3, overhead * 1e6, 100.0 * overhead / best[False]))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--statements", type=int, default=5000)
+    ap.add_argument("--requests", type=int, default=300)
+    ap.add_argument("--rounds", type=int, default=7)
+    args = ap.parse_args()
+
+    wrapper_cost(args.statements * 10, args.rounds)
+    app = sqlite_app()
+    per_statement(app.config["SQLITE_PATH"], args.statements, args.rounds)
+    per_request(args.requests, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import threading
+import time
+
+import sqlite_compat
+from bench.common import fmt_ms, login, percentiles, sqlite_app
+from passwords import Hasher
+from werkzeug.security import generate_password_hash
+
+# 1. what each PASSWORD_HASH_METHOD costs per hash (pick the slowest your
+#    login rate can afford),
+# 2. hashes/s through the pool at different PASSWORD_POOL_SIZE values,
+# 3. a login storm: --storm threads log in as fast as they can while one
+#    probe thread keeps loading /customer; its latency shows whether the
+#    hashing starves the rest of the app.
+#
+#   python3 -m bench.password_cost
+
+METHODS = ("pbkdf2:sha256:600000", "scrypt:16384:8:1", "scrypt:32768:8:1", "scrypt:65536:8:1")
+
+
+def cost_table(rounds):
+    print("cost per hash (single thread):")
+    for method in METHODS:
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            generate_password_hash("correct horse", method)
+        print("  %-22s %s" % (method, fmt_ms((time.perf_counter() - t0) / rounds)))
+
+
+def pool_throughput(method, callers, per_caller):
+    print("pool throughput (%s, %d callers):" % (method, callers))
+    for workers in (1, 2, 4, 8):
+        hasher = Hasher(method=method, workers=workers, max_pending=callers)
+
+        def worker():
+            for _ in range(per_caller):
+                hasher.hash("correct horse")
+
+        threads = [threading.Thread(target=worker) for _ in range(callers)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        print("  pool size %d: %.1f hashes/s" % (workers, callers * per_caller / elapsed))
+
+
+def login_storm(storm, seconds, pool_size):
+    app = sqlite_app(PASSWORD_POOL_SIZE=pool_size, LOGIN_RATE_LIMIT_ACCOUNT=10 ** 9,
+                     DB_POOL_SIZE=storm + 2)
+    cn = sqlite_compat.connect(app.config["SQLITE_PATH"])
+    cur = cn.cursor()
+    with app.app_context():
+        hashed = generate_password_hash("pass", app.config["PASSWORD_HASH_METHOD"])
+    cur.execute("UPDATE User SET Password = %s", (hashed,))
+    cn.commit()
+    cn.close()
+
+    probe = login(app.test_client(), "alice@vrms.com")
+    stop = time.monotonic() + seconds
+    logins, busy, probes = [0], [0], []
+    lock = threading.Lock()
+
+    def stormer():
+        client = app.test_client()
+        while time.monotonic() < stop:
+            code = client.post("/", data={"email": "bob@vrms.com", "password": "pass"}).status_code
+            with lock:
+                logins[0] += 1
+                busy[0] += code == 503
+
+    threads = [threading.Thread(target=stormer) for _ in range(storm)]
+    for t in threads:
+        t.start()
+    while time.monotonic() < stop:
+        t0 = time.perf_counter()
+        assert probe.get("/customer").status_code == 200
+        probes.append(time.perf_counter() - t0)
+        time.sleep(0.01)
+    for t in threads:
+        t.join()
+
+    pct = percentiles(probes)
+    print("login storm, %d threads, pool size %d: %.0f logins/s (%d busy), /customer %s"
+          % (storm, pool_size, logins[0] / seconds, busy[0],
+             ", ".join("%s=%s" % (k, fmt_ms(v)) for k, v in pct.items())))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=5)
+    ap.add_argument("--method", default="scrypt:32768:8:1")
+    ap.add_argument("--storm", type=int, default=16)
+    ap.add_argument("--seconds", type=float, default=5.0)
+    args = ap.parse_args()
+
+    cost_table(args.rounds)
+    pool_throughput(args.method, callers=16, per_caller=4)
+    for pool_size in (1, 4):
+        login_storm(args.storm, args.seconds, pool_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import threading
+import time
+
+import database
+from bench.common import fmt_ms, login, percentiles, sqlite_app
+
+# Hammers /customer from many threads through the Flask test client and
+# prints latency percentiles plus the connection pool counters. Compare
+# e.g. --pool-size 1 --overflow 0 against the defaults to see the effect
+# of pool sizing and waits.
+
+
+def run(threads, requests_per_thread, pool_size, overflow, timeout):
+    app = sqlite_app(DB_POOL_SIZE=pool_size, DB_POOL_MAX_OVERFLOW=overflow,
+                     DB_POOL_TIMEOUT=timeout)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        client = login(app.test_client(), "alice@vrms.com")
+        local = []
+        for _ in range(requests_per_thread):
+            t0 = time.perf_counter()
+            resp = client.get("/customer?type=Car")
+            local.append(time.perf_counter() - t0)
+            if resp.status_code != 200:
+                errors.append(resp.status_code)
+        with lock:
+            latencies.extend(local)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    t0 = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - t0
+
+    pct = percentiles(latencies)
+    print("requests: %d in %.2fs (%.0f req/s), errors: %d"
+          % (len(latencies), elapsed, len(latencies) / elapsed, len(errors)))
+    print("latency: " + ", ".join("%s=%s" % (k, fmt_ms(v)) for k, v in pct.items()))
+    print("pool:", database.get_pool(app).stats())
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--threads", type=int, default=16)
+    ap.add_argument("--requests", type=int, default=100)
+    ap.add_argument("--pool-size", type=int, default=5)
+    ap.add_argument("--overflow", type=int, default=10)
+    ap.add_argument("--timeout", type=float, default=10.0)
+    args = ap.parse_args()
+    run(args.threads, args.requests, args.pool_size, args.overflow, args.timeout)
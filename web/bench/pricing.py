@@ -0,0 +1,138 @@
+import argparse
+import datetime
+import random
+import time
+
+import pricing
+from bench.common import fmt_ms, percentiles
+
+# Batched quotes (pricing.py) against working out the same rules vehicle
+# by vehicle in Python, over a synthetic fleet; every batched total is
+# checked against the per-vehicle one.
+#
+#   python3 -m bench.pricing --vehicles 100000 --page 50
+
+TYPES = ["Car", "SUV", "Bike", "Van", "Truck", "Scooter", "Minibus", "Convertible"]
+
+
+def make_rules(seed):
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    rules = [
+        {"Kind": "weekend", "VehicleType": None, "Multiplier": 1.15},
+        {"Kind": "weekend", "VehicleType": "Convertible", "Multiplier": 1.3},
+        {"Kind": "long_rental", "VehicleType": None, "Threshold": 7, "Multiplier": 0.9},
+        {"Kind": "long_rental", "VehicleType": None, "Threshold": 14, "Multiplier": 0.85},
+        {"Kind": "long_rental", "VehicleType": "Van", "Threshold": 3, "Multiplier": 0.95},
+        {"Kind": "surge", "VehicleType": None, "Threshold": 0.8, "Multiplier": 1.2},
+        {"Kind": "surge", "VehicleType": "SUV", "Threshold": 0.5, "Multiplier": 1.1},
+    ]
+    for _ in range(12):
+        start = today + datetime.timedelta(days=rng.randint(0, 400))
+        rules.append({"Kind": "season", "VehicleType": rng.choice([None] + TYPES),
+                      "StartDate": start, "EndDate": start + datetime.timedelta(days=rng.randint(3, 40)),
+                      "Multiplier": rng.choice([0.8, 0.9, 1.1, 1.25])})
+    for rule in rules:
+        rule.setdefault("StartDate", None)
+        rule.setdefault("EndDate", None)
+        rule.setdefault("Threshold", None)
+    return rules
+
+
+def quote_one(rules, shares, vehicle, start, days):
+    # the rules applied to one rental, day by day
+    key = vehicle["VehicleType"].lower()
+    mine = [r for r in rules if not r["VehicleType"] or r["VehicleType"].lower() == key]
+    total = 0.0
+    for i in range(days):
+        day = start + datetime.timedelta(days=i)
+        factor = 1.0
+        for rule in mine:
+            if rule["Kind"] == "weekend" and day.weekday() >= 5:
+                factor *= rule["Multiplier"]
+            elif rule["Kind"] == "season" and rule["StartDate"] <= day <= rule["EndDate"]:
+                factor *= rule["Multiplier"]
+        total += factor
+    for kind, reached in (("long_rental", days), ("surge", shares.get(key, 0.0))):
+        best = None
+        for rule in mine:
+            if rule["Kind"] == kind and reached >= rule["Threshold"]:
+                if best is None or (rule["Threshold"], bool(rule["VehicleType"])) >= \
+                        (best["Threshold"], bool(best["VehicleType"])):
+                    best = rule
+        if best is not None:
+            total *= best["Multiplier"]
+    return round(float(vehicle["RentalPrice"]) * total, 2)
+
+
+class BenchStore:
+    # just what PricingEngine reads
+
+    def __init__(self, rules, fleet):
+        self.pricing = self
+        self.vehicles = self
+        self._rules = rules
+        self._fleet = fleet
+
+    def rules(self):
+        return self._rules
+
+    def utilization(self):
+        counts = {}
+        for row in self._fleet:
+            rented, total = counts.get(row["VehicleType"], (0, 0))
+            counts[row["VehicleType"]] = (rented + (row["Status"] == "Rented"), total + 1)
+        return counts
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--vehicles", type=int, default=100000)
+    ap.add_argument("--page", type=int, default=50, help="dashboard page size")
+    ap.add_argument("--pages", type=int, default=200)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    fleet = [{"VehicleID": i + 1, "VehicleType": rng.choice(TYPES),
+              "RentalPrice": round(rng.uniform(20, 200), 2),
+              "Status": "Rented" if rng.random() < 0.6 else "Available"}
+             for i in range(args.vehicles)]
+    rules = make_rules(args.seed)
+    store = BenchStore(rules, fleet)
+    engine = pricing.PricingEngine(ttl=None, utilization_ttl=None)
+
+    t0 = time.perf_counter()
+    engine.rule_set(store)
+    print("compile (rules + utilization): %s" % fmt_ms(time.perf_counter() - t0))
+    shares = pricing._shares(store.utilization())
+
+    today = datetime.date.today()
+    requests = [(today + datetime.timedelta(days=rng.randint(0, 300)), rng.randint(1, 21))
+                for _ in range(args.pages)]
+
+    print("%-22s %8s %12s %10s %10s" % ("", "rows", "rows/s", "p50", "p95"))
+    for label, size in (("dashboard page", args.page), ("whole fleet", args.vehicles)):
+        batched, looped = [], []
+        mismatches = 0
+        for i, (start, days) in enumerate(requests[:max(3, args.pages * args.page // size)]):
+            lo = rng.randrange(0, args.vehicles - size + 1)
+            rows = fleet[lo:lo + size]
+            t0 = time.perf_counter()
+            totals = engine.quote_rows(store, rows, start, days)
+            batched.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            expected = [quote_one(rules, shares, row, start, days) for row in rows]
+            looped.append(time.perf_counter() - t0)
+            mismatches += sum(abs(a - b) > 0.011 for a, b in zip(totals, expected))
+        for how, samples in (("batched", batched), ("per-row", looped)):
+            pct = percentiles(samples)
+            print("%-22s %8d %12.0f %10s %10s" % ("%s %s" % (label, how), size,
+                                                  size * len(samples) / sum(samples),
+                                                  fmt_ms(pct["p50"]), fmt_ms(pct["p95"])))
+        print("%-22s mismatches: %d" % (label, mismatches))
+    print(engine.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import argparse
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+import database
+from bench.common import fmt_ms, login, percentiles, sqlite_app
+
+# Read/write splitting (database.read_only, ReplicaRouter) with two SQLite
+# files: the primary and a copy playing its read replica, "replicated" by
+# an explicit backup -- so the replica lags exactly until the script says
+# otherwise. Checks, in order:
+#
+#   routing        the read-only pages read from the replica, writes go
+#                  to the primary
+#   read-your-writes  a customer who just rented sees the rental on their
+#                  dashboard although the replica hasn't got it; once the
+#                  pin expires they read the replica (stale) until it
+#                  catches up
+#   health         a broken replica is taken out of rotation (reads fall
+#                  back to the primary) and put back once it is repaired
+#
+# and then how many connections each database handed the read pages
+# (analytics, whose closed days are cached, reads the primary).
+#
+#   python3 -m bench.replicas --requests 200
+
+
+def replicate(primary, replica):
+    src, dst = sqlite3.connect(primary), sqlite3.connect(replica)
+    src.backup(dst)
+    src.close()
+    dst.close()
+
+
+def checkouts(app):
+    router = database.get_router(app)
+    return (database.get_pool(app).stats()["checkouts"],
+            router.replicas[0].pool.stats()["checkouts"])
+
+
+def active_rentals(client):
+    return re.findall(r"/customer/return/(\d+)", client.get("/customer").data.decode())
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=200)
+    ap.add_argument("--pin", type=float, default=1.0, help="DB_PIN_SECONDS")
+    args = ap.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="vrms-replicas-")
+    primary = os.path.join(directory, "primary.sqlite3")
+    replica = os.path.join(directory, "replica.sqlite3")
+    import sqlite_compat
+    sqlite_compat.create_database(primary)
+    replicate(primary, replica)
+    app = sqlite_app(primary, DB_REPLICAS=[replica], DB_PIN_SECONDS=args.pin,
+                     DB_REPLICA_CHECK_INTERVAL=0, RESPONSE_CACHE_ENABLED=False)
+    router = database.get_router(app)
+
+    admin = login(app.test_client(), "admin1@vrms.com")
+    customer = login(app.test_client(), "alice@vrms.com")
+    time.sleep(args.pin)                        # logging in pinned them
+
+    # routing
+    before = checkouts(app)
+    for url in ("/staff", "/customer/payments", "/admin/reports"):
+        client = customer if url.startswith("/customer") else admin
+        assert client.get(url).status_code == 200, url
+    after = checkouts(app)
+    print("read-only pages: primary checkouts +%d, replica +%d"
+          % (after[0] - before[0], after[1] - before[1]))
+    assert after[1] > before[1]
+
+    # read-your-writes
+    rented = active_rentals(customer)
+    resp = customer.post("/customer/rent/2", data={"days": "2"})
+    assert resp.status_code == 302, resp.status_code
+    mine = active_rentals(customer)
+    print("right after renting (pinned):     %d active rentals, was %d" % (len(mine), len(rented)))
+    assert len(mine) == len(rented) + 1
+    time.sleep(args.pin)
+    stale = active_rentals(customer)
+    print("pin expired, replica behind:       %d active rentals" % len(stale))
+    replicate(primary, replica)
+    caught_up = active_rentals(customer)
+    print("replica caught up:                 %d active rentals" % len(caught_up))
+    assert len(caught_up) == len(mine)
+
+    # health
+    bad = sqlite3.connect(replica)
+    bad.execute("DROP TABLE Role")
+    bad.commit()
+    bad.close()
+    router.check()
+    assert not router.replicas[0].healthy, router.stats()
+    fallback_before = router.primary_reads
+    assert customer.get("/customer/payments").status_code == 200
+    print("replica broken: healthy=%s, reads on the primary +%d (%s)"
+          % (router.replicas[0].healthy, router.primary_reads - fallback_before,
+             router.replicas[0].error))
+    replicate(primary, replica)
+    router.check()
+    assert router.primary_reads > fallback_before
+    assert router.replicas[0].healthy
+    print("replica repaired: healthy=%s" % router.replicas[0].healthy)
+
+    # the read pages under load
+    time.sleep(args.pin)
+    before = checkouts(app)
+    samples = []
+    urls = ["/staff", "/customer", "/customer/payments", "/admin/reports"]
+    for i in range(args.requests):
+        url = urls[i % len(urls)]
+        client = customer if url.startswith("/customer") else admin
+        t0 = time.perf_counter()
+        client.get(url)
+        samples.append(time.perf_counter() - t0)
+    after = checkouts(app)
+    pct = percentiles(samples)
+    print("%d read-only requests: p50=%s p95=%s; connections from the primary %d, "
+          "from the replica %d" % (args.requests, fmt_ms(pct["p50"]), fmt_ms(pct["p95"]),
+                                   after[0] - before[0], after[1] - before[1]))
+    print(router.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+import aggregates
+import sqlite_compat
+from bench.common import fmt_ms, login, percentiles, sqlite_app
+
+# Admin reports page before/after the ReportTotals summary table, on a
+# synthetic SQLite database (1M rentals by default).
+#
+#   python3 -m bench.report_totals --rentals 1000000 --repeat 20
+
+# what admin_reports ran before ReportTotals existed
+LEGACY_QUERIES = [
+    "SELECT COUNT(*) AS total_users FROM User",
+    "SELECT COUNT(*) AS total_vehicles FROM Vehicle",
+    "SELECT COUNT(*) AS total_rentals FROM Rental",
+    "SELECT IFNULL(SUM(Amount),0) AS total_revenue FROM Payment",
+]
+RECENT_QUERIES = [
+    """
+    SELECT r.RentalID, u.Name AS Customer, v.Model,
+           r.RentalDate, r.ReturnDate, r.Status, r.TotalAmount
+    FROM Rental r
+    JOIN User u ON r.UserID = u.UserID
+    JOIN Vehicle v ON r.VehicleID = v.VehicleID
+    ORDER BY r.RentalDate DESC
+    LIMIT 10
+    """,
+    """
+    SELECT PaymentID, RentalID, PaymentDate, Amount, PaymentMode
+    FROM Payment
+    ORDER BY PaymentDate DESC
+    LIMIT 10
+    """,
+]
+
+
+def build(path, users, vehicles, rentals, seed=1):
+    rnd = random.Random(seed)
+    sqlite_compat.create_database(path)
+    cn = sqlite_compat.connect(path)
+    cur = cn.cursor()
+    cur.executemany(
+        "INSERT INTO User (Name, Email, Phone, Password, RoleID) VALUES (%s, %s, %s, %s, 3)",
+        (("User %d" % i, "user%d@bench" % i, "", "pass") for i in range(users)))
+    cur.executemany(
+        "INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status) "
+        "VALUES (%s, %s, %s, %s, 'Available')",
+        ((rnd.choice(["Car", "SUV", "Bike", "Van", "Truck"]), "Model %d" % (i % 300),
+          "BR%07d" % i, rnd.randint(20, 150)) for i in range(vehicles)))
+
+    start = datetime.date(2020, 1, 1)
+    max_user = users + 10
+    max_vehicle = vehicles + 10
+
+    def rental_rows():
+        for i in range(rentals):
+            d = start + datetime.timedelta(days=i * 1500 // rentals)
+            days = rnd.randint(1, 7)
+            yield (rnd.randint(1, max_user), rnd.randint(1, max_vehicle), d,
+                   d + datetime.timedelta(days=days), days * 50, "Completed")
+
+    # bypass the status trigger: these are all historical, completed rentals
+    cn._raw.execute("DROP TRIGGER trg_rental_insert_status")
+    cur.executemany(
+        "INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status) "
+        "VALUES (%s, %s, %s, %s, %s, %s)", rental_rows())
+    cur.execute("""
+        INSERT INTO Payment (RentalID, PaymentDate, Amount, PaymentMode)
+        SELECT RentalID, ReturnDate, TotalAmount, 'Card' FROM Rental WHERE RentalID > 10
+    """)
+    cn.commit()
+    aggregates.reconcile(cn)
+    cn.close()
+
+
+def time_queries(cn, queries, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        cur = cn.cursor(dictionary=True)
+        for q in queries:
+            cur.execute(q)
+            cur.fetchall()
+        cur.close()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def time_totals(cn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        aggregates.read_totals(cn)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def report(label, samples):
+    pct = percentiles(samples)
+    print("%-34s %s" % (label, "  ".join("%s=%s" % (k, fmt_ms(v)) for k, v in pct.items())))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=50000)
+    ap.add_argument("--vehicles", type=int, default=20000)
+    ap.add_argument("--rentals", type=int, default=1000000)
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--db", help="reuse/create this SQLite file")
+    args = ap.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="vrms-bench-"), "reports.sqlite3")
+    if not os.path.exists(path):
+        t0 = time.perf_counter()
+        build(path, args.users, args.vehicles, args.rentals)
+        print("built %s with %d rentals in %.1fs" % (path, args.rentals, time.perf_counter() - t0))
+
+    cn = sqlite_compat.connect(path)
+    report("before: 4 scans + 2 recent lists", time_queries(cn, LEGACY_QUERIES + RECENT_QUERIES, args.repeat))
+    after = zip(time_totals(cn, args.repeat), time_queries(cn, RECENT_QUERIES, args.repeat))
+    report("after:  ReportTotals + 2 lists", [a + b for a, b in after])
+    report("  of which totals read", time_totals(cn, args.repeat))
+    cn.close()
+
+    app = sqlite_app(path)
+    client = login(app.test_client(), "admin1@vrms.com")
+    samples = []
+    for _ in range(args.repeat):
+        t0 = time.perf_counter()
+        assert client.get("/admin/reports").status_code == 200
+        samples.append(time.perf_counter() - t0)
+    report("GET /admin/reports (full page)", samples)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+import booking
+import reservations
+import sqlite_compat
+from bench.common import fmt_ms, percentiles
+
+# Date-range availability over a synthetic fleet: the interval index
+# (reservations.py) against a full NumPy scan of every interval, and with
+# --sqlite against the OVERLAPPING query booking.py runs on the Rental
+# table (idx_rental_vehicle_status_date).
+#
+#   python3 -m bench.reservations --vehicles 100000 --bookings 1000000
+#
+# Every vehicle gets bookings / vehicles back-to-back holds of 1..14 days
+# with gaps of 0..10 days between them, starting around BASE; --long of
+# them (Active, open-ended or longer than SHORT_DAYS) go to the side table.
+
+BASE = datetime.date(2025, 1, 1)
+
+
+def generate(vehicles, bookings, long_share, seed):
+    # (RentalID, VehicleID, RentalDate, ReturnDate) rows, non-overlapping per vehicle
+    rng = np.random.default_rng(seed)
+    per = max(1, bookings // vehicles)
+    lengths = rng.integers(1, 15, size=(vehicles, per))
+    gaps = rng.integers(0, 11, size=(vehicles, per))
+    ends = BASE.toordinal() + np.cumsum(lengths + gaps, axis=1)
+    starts = ends - lengths
+    long_rows = rng.random(vehicles) < long_share
+    # the last hold of a "long" vehicle runs for 90 days
+    ends[long_rows, -1] = starts[long_rows, -1] + 90
+
+    day = datetime.date.fromordinal
+    rows = []
+    rid = 0
+    for vid in range(vehicles):
+        for s, e in zip(starts[vid].tolist(), ends[vid].tolist()):
+            rid += 1
+            rows.append((rid, vid + 1, day(s), day(e)))
+    span = (day(int(starts.min())), day(int(ends.max())))
+    return rows, span
+
+
+def scan_busy(flat, a, b):
+    # the baseline: every interval tested
+    starts, ends, vids, rids = flat
+    return vids[(starts < _day(b)) & (ends > _day(a))]
+
+
+def scan_free(flat, fleet, a, b):
+    busy = set(scan_busy(flat, a, b).tolist())
+    return [vid for vid in fleet if vid not in busy]
+
+
+def _day(value):
+    return value.toordinal()
+
+
+def windows(rng, span, n, max_days=14):
+    first, last = span[0].toordinal(), span[1].toordinal()
+    out = []
+    for _ in range(n):
+        a = rng.randint(first, last - max_days)
+        out.append((datetime.date.fromordinal(a),
+                    datetime.date.fromordinal(a + rng.randint(1, max_days))))
+    return out
+
+
+def timed(fn, items):
+    samples = []
+    result = None
+    for item in items:
+        t0 = time.perf_counter()
+        result = fn(*item)
+        samples.append(time.perf_counter() - t0)
+    return samples, result
+
+
+def report(label, samples, note=""):
+    pct = percentiles(samples)
+    print("%-26s n=%-6d %9.0f/s  p50=%-9s p95=%-9s p99=%-9s %s"
+          % (label, len(samples), len(samples) / sum(samples), fmt_ms(pct["p50"]),
+             fmt_ms(pct["p95"]), fmt_ms(pct["p99"]), note))
+
+
+def build_sqlite(path, rows):
+    cn = sqlite_compat.connect(path)
+    raw = cn.cursor()
+    raw.execute("CREATE TABLE Rental (RentalID INTEGER PRIMARY KEY, VehicleID INTEGER, "
+                "RentalDate DATE, ReturnDate DATE, Status TEXT)")
+    raw.execute("CREATE INDEX idx_rental_vehicle_status_date "
+                "ON Rental (VehicleID, Status, RentalDate)")
+    raw.executemany("INSERT INTO Rental VALUES (%s, %s, %s, %s, 'Reserved')",
+                    [(rid, vid, s.isoformat(), e.isoformat()) for rid, vid, s, e in rows])
+    cn.commit()
+    raw.close()
+    return cn
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--vehicles", type=int, default=100000)
+    ap.add_argument("--bookings", type=int, default=1000000)
+    ap.add_argument("--long", type=float, default=0.001, help="share of vehicles with a long hold")
+    ap.add_argument("--checks", type=int, default=20000, help="single-vehicle checks")
+    ap.add_argument("--queries", type=int, default=50, help="fleet-wide free-vehicle queries")
+    ap.add_argument("--churn", type=int, default=20000, help="cancel + re-reserve pairs")
+    ap.add_argument("--sqlite", action="store_true", help="also time the SQL overlap query")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    rows, span = generate(args.vehicles, args.bookings, args.long, args.seed)
+    print("generated %d holds on %d vehicles, %s .. %s in %.1fs"
+          % (len(rows), args.vehicles, span[0], span[1], time.perf_counter() - t0))
+
+    index = reservations.ReservationIndex(ttl=None)
+    t0 = time.perf_counter()
+    index.load(rows)
+    print("index load %.2fs  %s" % (time.perf_counter() - t0, index.stats()))
+
+    rng = random.Random(args.seed)
+    fleet = list(range(1, args.vehicles + 1))
+
+    # single vehicle: what booking / reserving checks
+    checks = [(None, rng.randint(1, args.vehicles)) + w
+              for w in windows(rng, span, args.checks)]
+    samples, _ = timed(index.is_free, checks)
+    report("index is_free", samples)
+
+    # whole fleet: the dashboard's date filter
+    queries = windows(rng, span, args.queries)
+    samples, busy = timed(lambda a, b: index.busy_count(None, a, b), queries)
+    report("index busy_count", samples, "last: %d busy" % busy)
+    flat = reservations._arrays([(start, end, vid, rid)       # short and long holds
+                                 for rid, (vid, start, end) in index._rentals.items()])
+    samples, busy = timed(lambda a, b: len(np.unique(scan_busy(flat, a, b))), queries)
+    report("full scan busy_count", samples, "last: %d busy" % busy)
+    samples, free = timed(lambda a, b: index.free(None, fleet, a, b), queries)
+    report("index free(fleet)", samples, "last: %d free" % len(free))
+    samples, free = timed(lambda a, b: scan_free(flat, fleet, a, b), queries)
+    report("full scan free(fleet)", samples, "last: %d free" % len(free))
+
+    # writes: cancel a hold and put a new one in its place
+    live = [row[0] for row in rows]
+    next_rid = len(rows) + 1
+    samples = []
+    for _ in range(args.churn):
+        pos = rng.randrange(len(live))
+        rid = live[pos]
+        vid, s, e = index._rentals[rid]
+        t1 = time.perf_counter()
+        index.discard(rid)
+        index.put(next_rid, vid, datetime.date.fromordinal(s), datetime.date.fromordinal(e))
+        samples.append(time.perf_counter() - t1)
+        live[pos] = next_rid
+        next_rid += 1
+    report("churn discard+put", samples, "compactions=%d" % index.compactions)
+    samples, free = timed(lambda a, b: index.free(None, fleet, a, b), queries)
+    report("index free(fleet) after", samples, "pending=%d" % index.stats()["pending"])
+
+    if args.sqlite:
+        path = os.path.join(tempfile.mkdtemp(prefix="vrms-bench-"), "reservations.sqlite3")
+        t0 = time.perf_counter()
+        cn = build_sqlite(path, rows)
+        print("sqlite load %.1fs" % (time.perf_counter() - t0))
+        cur = cn.cursor()
+
+        def sql_check(_, vid, a, b):
+            cur.execute(booking.OVERLAPPING, (vid, b.isoformat(), a.isoformat()))
+            return cur.fetchone() is None
+
+        samples, _ = timed(sql_check, checks[:2000])
+        report("sqlite OVERLAPPING", samples)
+
+        def sql_busy(a, b):
+            cur.execute("SELECT DISTINCT VehicleID FROM Rental WHERE Status IN "
+                        "('Active', 'Reserved') AND RentalDate < %s "
+                        "AND COALESCE(ReturnDate, '9999-12-31') > %s",
+                        (b.isoformat(), a.isoformat()))
+            return cur.fetchall()
+
+        samples, busy = timed(sql_busy, queries[-10:])
+        report("sqlite busy_count", samples, "last: %d busy" % len(busy))
+        cur.close()
+        cn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import http.client
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import database
+from bench.common import fmt_ms, percentiles, sqlite_app
+from bench.suite import SCALES, TYPES, dataset
+
+# Concurrent-request throughput over real HTTP: the threaded development
+# server (what `python3 app.py` runs, queries one after the other) against
+# the ASGI entry point under uvicorn (asgi.py, queries concurrent through
+# asyncdb.py), on the same synthetic database.
+#
+# SQLite answers in microseconds, which hides what the async mode is for;
+# --db-latency adds a sleep to every statement, like the round trip to a
+# MySQL server on another host.
+#
+#   python3 -m bench.serving --scale small --clients 1,16,64 --db-latency 2
+
+
+class SlowConnection:
+    # a connection whose statements take `delay` seconds longer
+
+    def __init__(self, cn, delay):
+        self._cn = cn
+        self._delay = delay
+
+    def cursor(self, *args, **kwargs):
+        return SlowCursor(self._cn.cursor(*args, **kwargs), self._delay)
+
+    def __getattr__(self, name):
+        return getattr(self._cn, name)
+
+
+class SlowCursor:
+
+    def __init__(self, cur, delay):
+        self._cur = cur
+        self._delay = delay
+
+    def execute(self, *args, **kwargs):
+        time.sleep(self._delay)
+        return self._cur.execute(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+def slow_connect(delay):
+    make = database.connect_factory
+
+    def connect_factory(config):
+        connect = make(config)
+        return lambda: SlowConnection(connect(), delay)
+    return connect_factory
+
+
+# ---------- servers ----------
+
+def start_threaded(app, port):
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)   # no line per request
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.shutdown
+
+
+def start_asgi(app, port):
+    import uvicorn
+    import asgi
+    server = uvicorn.Server(uvicorn.Config(asgi.bridge(app), host="127.0.0.1", port=port,
+                                           log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return stop
+
+
+SERVERS = {
+    # mode -> (starter, ASYNC_QUERIES)
+    "threaded": (start_threaded, False),
+    "asgi": (start_asgi, True),
+}
+
+
+# ---------- clients ----------
+
+class Client:
+    # one keep-alive HTTP connection with a session cookie
+
+    def __init__(self, port):
+        self.cn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        self.cookie = None
+
+    def request(self, method, path, form=None):
+        headers = {}
+        body = None
+        if form is not None:
+            body = urllib.parse.urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+        self.cn.request(method, path, body=body, headers=headers)
+        resp = self.cn.getresponse()
+        resp.read()
+        cookie = resp.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return resp.status
+
+    def login(self, email):
+        assert self.request("POST", "/", {"email": email, "password": "pass"}) == 302, email
+        return self
+
+    def close(self):
+        self.cn.close()
+
+
+def customer_paths(n):
+    # the dashboard with a rotating type filter
+    return ["/customer?type=%s" % TYPES[i % len(TYPES)] for i in range(n)]
+
+
+def run_clients(port, clients, requests, workload):
+    # one login (password hashing is not what is measured here), shared by
+    # every connection; all requests are reads
+    email = "admin1@vrms.com" if workload == "admin_reports" else "user0@bench"
+    first = Client(port).login(email)
+    sessions = [first] + [Client(port) for _ in range(clients - 1)]
+    for client in sessions:
+        client.cookie = first.cookie
+    paths = (["/admin/reports"] * requests if workload == "admin_reports"
+             else customer_paths(requests))
+    for client in sessions:
+        client.request("GET", paths[0])   # warm up
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def worker(client, share):
+        local = []
+        barrier.wait()
+        for path in share:
+            t0 = time.perf_counter()
+            status = client.request("GET", path)
+            local.append(time.perf_counter() - t0)
+            if status != 200:
+                errors.append(status)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(client, paths[i::clients]))
+               for i, client in enumerate(sessions)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+    for client in sessions:
+        client.close()
+    return len(latencies), len(errors), elapsed, percentiles(latencies)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scale", choices=sorted(SCALES), default="small")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--clients", default="1,16,64", help="comma-separated concurrency levels")
+    ap.add_argument("--requests", type=int, default=400, help="per concurrency level")
+    ap.add_argument("--workloads", default="customer_dashboard,admin_reports")
+    ap.add_argument("--modes", default="threaded,asgi")
+    ap.add_argument("--db-latency", type=float, default=2.0, help="ms added to every statement")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--data", default=os.path.join(tempfile.gettempdir(), "vrms-bench-data"))
+    args = ap.parse_args()
+
+    levels = [int(c) for c in args.clients.split(",")]
+    sizes = SCALES[args.scale]
+    source = dataset(args.data, sizes, args.seed, "scrypt:32768:8:1")
+    if args.db_latency:
+        database.connect_factory = slow_connect(args.db_latency / 1000.0)
+
+    print("%-9s %-19s %7s %8s %6s %9s %9s %9s"
+          % ("server", "workload", "clients", "req/s", "errors", "p50", "p95", "p99"))
+    for mode in args.modes.split(","):
+        start, concurrent = SERVERS[mode]
+        for workload in args.workloads.split(","):
+            for clients in levels:
+                workdir = tempfile.mkdtemp(prefix="vrms-serving-")
+                try:
+                    path = shutil.copy(source, workdir)
+                    pool = clients + 8
+                    app = sqlite_app(path, ASYNC_QUERIES=concurrent, METRICS_ENABLED=False,
+                                     DB_POOL_SIZE=pool, DB_POOL_MAX_OVERFLOW=0,
+                                     LOGIN_RATE_LIMIT_ACCOUNT=10 ** 9)
+                    stop = start(app, args.port)
+                    try:
+                        done, errors, elapsed, pct = run_clients(
+                            args.port, clients, args.requests, workload)
+                    finally:
+                        stop()
+                        database.get_pool(app).close()
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                print("%-9s %-19s %7d %8.1f %6d %9s %9s %9s"
+                      % (mode, workload, clients, done / elapsed, errors,
+                         fmt_ms(pct["p50"]), fmt_ms(pct["p95"]), fmt_ms(pct["p99"])))
+
+
+if __name__ == "__main__":
+    main()
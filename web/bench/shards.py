@@ -0,0 +1,277 @@
+import argparse
+import datetime
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import time
+
+import aggregates
+import analytics
+import database
+import shards
+import sqlite_compat
+import storage
+from bench.common import fmt_ms, login, percentiles, sqlite_app
+
+# Branches partitioned across database shards (shards.py) with three
+# SQLite files: the main database (shard 0, the sample branches) and two
+# shards made by `flask init-shards`, one new branch on each. Vehicles are
+# added through the admin form and the import API, the rental history is
+# written straight into each file. Checks, in order:
+#
+#   ids            each branch's vehicles got IDs from its shard's range
+#   routing        the staff dashboard, returns page, renting and
+#                  returning for one branch check out connections from
+#                  that branch's shard (and shard 0, for the session user
+#                  and pricing rules) only -- never from the other shard
+#   fan-out        /admin/reports reads every shard; the merged report
+#                  totals, vehicle listing and a customer's payment
+#                  history match the three files read directly, and
+#                  reconcile() finds nothing to fix
+#
+# and then the analytics columns for the whole history fetched by the
+# fan-out, concurrently, against the same reads one shard after the other.
+#
+#   python3 -m bench.shards --vehicles 300 --rentals 200000
+
+
+def build_history(path, vehicle_ids, users, rentals, years, seed):
+    # `rentals` Completed and paid rentals of these vehicles over the last
+    # `years`, written directly (the Rental triggers only fire for Active)
+    rnd = random.Random(seed)
+    today = datetime.date.today()
+    span = years * 365
+    first = today - datetime.timedelta(days=span)
+
+    def rental_rows():
+        for i in range(rentals):
+            d = first + datetime.timedelta(days=i * span // rentals)
+            days = rnd.randint(1, 7)
+            end = min(d + datetime.timedelta(days=days), today - datetime.timedelta(days=1))
+            yield (rnd.randint(1, users), rnd.choice(vehicle_ids), d, end, days * 50,
+                   "Completed")
+
+    cn = sqlite_compat.connect(path)
+    cur = cn.cursor()
+    cur.execute("SELECT MAX(RentalID) FROM Rental")
+    last = cur.fetchone()[0] or 0
+    cur.executemany(
+        "INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status) "
+        "VALUES (%s, %s, %s, %s, %s, %s)", rental_rows())
+    cur.execute("""
+        INSERT INTO Payment (RentalID, PaymentDate, Amount, PaymentMode)
+        SELECT RentalID, ReturnDate, TotalAmount, 'Card' FROM Rental WHERE RentalID > %s
+    """, (last,))
+    cn.commit()
+    aggregates.reconcile(cn)
+    cn._raw.execute("ANALYZE")
+    cn.close()
+
+
+def direct(path, sql, params=()):
+    cn = sqlite3.connect(path)
+    try:
+        return cn.execute(sql, params).fetchall()
+    finally:
+        cn.close()
+
+
+def checkouts(app):
+    return [database.get_shard_pool(shard, app).stats()["checkouts"]
+            for shard in shards.all_shards(app)]
+
+
+def import_csv(admin, branch_id, prefix, count):
+    rows = ["VehicleType,Model,RegistrationNumber,RentalPrice,Status"]
+    kinds = ["Car", "SUV", "Bike", "Van"]
+    rows += ["%s,Model %d,%s%06d,%d,Available" % (kinds[i % 4], i % 40, prefix, i, 20 + i % 90)
+             for i in range(count)]
+    resp = admin.post("/admin/vehicles/import?branch_id=%d" % branch_id,
+                      data="\n".join(rows) + "\n", content_type="text/csv")
+    assert resp.status_code == 200, resp.status_code
+    assert resp.get_json()["inserted"] == count, resp.get_json()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--vehicles", type=int, default=300, help="per branch")
+    ap.add_argument("--users", type=int, default=2000)
+    ap.add_argument("--rentals", type=int, default=200000, help="history per shard")
+    ap.add_argument("--years", type=int, default=2)
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="vrms-shards-")
+    main_path = os.path.join(directory, "main.sqlite3")
+    shard_paths = [os.path.join(directory, "shard%d.sqlite3" % n) for n in (1, 2)]
+    sqlite_compat.create_database(main_path)
+    cn = sqlite3.connect(main_path)
+    cn.executemany("INSERT INTO User (Name, Email, Phone, Password, RoleID) "
+                   "VALUES (?, ?, '', 'pass', 3)",
+                   (("User %d" % i, "user%d@bench" % i) for i in range(args.users)))
+    cn.commit()
+    cn.close()
+    users = args.users + 10
+
+    app = sqlite_app(main_path, DB_SHARDS=shard_paths, RESPONSE_CACHE_ENABLED=False,
+                     SLOW_QUERY_MS=0)
+    cli = app.test_cli_runner()
+    result = cli.invoke(args=["init-shards"])
+    assert result.exit_code == 0, result.output
+    print(result.output.strip())
+    branches = {0: [1, 2]}
+    for shard, name in ((1, "North"), (2, "South")):
+        result = cli.invoke(args=["add-branch", name, "--city", "Dallas", "--shard", str(shard)])
+        assert result.exit_code == 0, result.output
+        print(result.output.strip())
+        branches[shard] = [int(re.search(r"branch (\d+)", result.output).group(1))]
+    home = {b: shard for shard, ids in branches.items() for b in ids}
+
+    admin = login(app.test_client(), "admin1@vrms.com")
+    customer = login(app.test_client(), "alice@vrms.com")
+    t0 = time.perf_counter()
+    for branch, shard in sorted(home.items()):
+        for i in range(3):
+            resp = admin.post("/admin/vehicles/add", data={
+                "vehicle_type": "Car", "model": "Corolla", "regno": "B%dF%d" % (branch, i),
+                "price": "40", "branch_id": str(branch)})
+            assert resp.status_code == 302, resp.status_code
+        import_csv(admin, branch, "B%dI" % branch, args.vehicles - 3)
+    print("added %d vehicles to each of %d branches in %.1fs"
+          % (args.vehicles, len(home), time.perf_counter() - t0))
+
+    # ids
+    with app.test_request_context():
+        store = storage.get_store()
+        fleet = {b: [row["VehicleID"] for row in store.vehicles.search(branch=b)] for b in home}
+    for branch, ids in sorted(fleet.items()):
+        first, end = shards.id_range(home[branch])
+        assert ids and all(first <= i < end for i in ids), (branch, ids[:3])
+        print("branch %d (shard %d): %d vehicles, IDs %d..%d"
+              % (branch, home[branch], len(ids), min(ids), max(ids)))
+
+    t0 = time.perf_counter()
+    for shard, path in enumerate([main_path] + shard_paths):
+        ids = [i for b in branches[shard] for i in fleet[b]]
+        build_history(path, ids, users, args.rentals, args.years, seed=shard)
+    print("wrote %d rentals per shard in %.1fs" % (args.rentals, time.perf_counter() - t0))
+
+    # routing
+    def indexes_fresh():
+        # the in-process indexes span every shard: their first load reads
+        # all of them, and a vehicle another round rented or returned is
+        # re-read (from its shard) on the next use after that
+        customer.get("/customer")
+        with app.test_request_context():
+            today = datetime.date.today()
+            storage.get_store().vehicles.free_between(today, today)
+
+    for shard in (1, 2):
+        branch = branches[shard][0]
+        vehicle = fleet[branch][5]
+        indexes_fresh()
+        before = checkouts(app)
+        assert admin.get("/staff?branch=%d&type=car" % branch).status_code == 200
+        assert customer.post("/customer/rent/%d" % vehicle, data={"days": "2"}).status_code == 302
+        page = admin.get("/staff/returns?branch=%d" % branch).data.decode()
+        rental = max(int(r) for r in re.findall(r'name="rental_id" value="(\d+)"', page))
+        assert shards.shard_of(rental) == shard, rental
+        resp = admin.post("/staff/returns?branch=%d" % branch, json={"rental_ids": [rental]})
+        assert resp.get_json()["returned"] == 1, resp.get_json()
+        after = checkouts(app)
+        delta = [a - b for a, b in zip(after, before)]
+        print("branch %d's staff dashboard, rent, returns page, return: checkouts per shard %s"
+              % (branch, delta))
+        other = 3 - shard
+        assert delta[shard] > 0 and delta[other] == 0, delta
+
+        before = checkouts(app)
+        assert customer.get("/customer?branch=%d" % branch).status_code == 200
+        delta = [a - b for a, b in zip(checkouts(app), before)]
+        print("branch %d's customer search (and the customer's own rentals): %s"
+              % (branch, delta))
+
+    # fan-out
+    with app.test_request_context():
+        fanout = shards.get_fanout()
+        calls = fanout.stats()["calls"]
+        before = checkouts(app)
+        assert admin.get("/admin/reports").status_code == 200
+        delta = [a - b for a, b in zip(checkouts(app), before)]
+        print("/admin/reports: checkouts per shard %s, %d fanned-out calls"
+              % (delta, fanout.stats()["calls"] - calls))
+        assert all(delta), delta
+
+        store = storage.get_store()
+        paths = [main_path] + shard_paths
+        totals = store.reports.totals()
+        expected = {
+            "total_users": direct(main_path, "SELECT COUNT(*) FROM User")[0][0],
+            "total_vehicles": sum(direct(p, "SELECT COUNT(*) FROM Vehicle")[0][0] for p in paths),
+            "total_rentals": sum(direct(p, "SELECT COUNT(*) FROM Rental")[0][0] for p in paths),
+        }
+        revenue = sum(direct(p, "SELECT IFNULL(SUM(Amount), 0) FROM Payment")[0][0]
+                      for p in paths)
+        assert all(totals[k] == v for k, v in expected.items()), (totals, expected)
+        assert abs(float(totals["total_revenue"]) - revenue) < 0.01, (totals, revenue)
+        assert store.reports.reconcile() == {}
+        print("report totals match the files: %s" % totals)
+
+        listed, after = [], None
+        while True:
+            page = store.vehicles.page(after, 500)
+            listed += [row["VehicleID"] for row in page.rows]
+            if page.next_cursor is None:
+                break
+            after = page.next_cursor
+        every = sorted(r[0] for p in paths for r in direct(p, "SELECT VehicleID FROM Vehicle"))
+        assert listed == every, (len(listed), len(every))
+        user_id = 11
+        paid, after = [], None
+        while True:
+            page = store.payments.for_user_page(user_id, after, 25)
+            paid += [row["PaymentID"] for row in page.rows]
+            if page.next_cursor is None:
+                break
+            after = page.next_cursor
+        mine = sorted((r[0] for p in paths for r in direct(
+            p, "SELECT p.PaymentID FROM Payment p JOIN Rental r ON p.RentalID = r.RentalID "
+               "WHERE r.UserID = ?", (user_id,))), reverse=True)
+        assert paid == mine and paid == [row["PaymentID"]
+                                         for row in store.payments.for_user_stream(user_id)]
+        print("vehicle listing (%d) and user %d's payments (%d) merge in key order"
+              % (len(listed), user_id, len(paid)))
+
+        # fan-out vs one shard after the other
+        def sequential(fn):
+            out = []
+            for shard in shards.all_shards():
+                with database.on_shard(shard):
+                    out.append(fn())
+            return out
+
+        size = app.config["ANALYTICS_FETCH_SIZE"]
+        today = datetime.date.today()
+        lo = today - datetime.timedelta(days=args.years * 365)
+        times = {}
+        for label, fan in (("sequential", sequential), ("fan-out", shards.fan_out)) * 2:
+            source = analytics.ShardedSource(
+                lambda: analytics.SQLSource(database.primary_db(), size), fan)
+            samples = times.setdefault(label, [])
+            samples.clear()                     # the first round warms the page cache
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                report = analytics.Analytics().report(source, lo, today)
+                samples.append(time.perf_counter() - t0)
+            times[label + " result"] = report["total_revenue"]
+        assert times["sequential result"] == times["fan-out result"]
+        seq, fan = percentiles(times["sequential"])["p50"], percentiles(times["fan-out"])["p50"]
+        print("analytics over %d days, 3 shards: sequential p50=%s, fan-out p50=%s (%.1fx)"
+              % ((today - lo).days, fmt_ms(seq), fmt_ms(fan), seq / fan if fan else 0))
+        print(store.branches.shard_stats()["fanout"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,395 @@
+import argparse
+import datetime
+import hashlib
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import sqlite_compat
+import storage
+from bench import datagen
+from bench.common import fmt_ms, login, percentiles, sqlite_app
+
+# Load-test suite: scripted workloads against the real Flask routes, on a
+# synthetic SQLite database (bench/datagen.py), through the test client
+# with N concurrent virtual users. Runs fully offline.
+#
+# Each workload runs as its own phase (warmup, then --requests timed
+# requests spread over --threads workers); "mixed" interleaves them. The
+# report gives throughput and p50/p95/p99 per workload and can be saved as
+# JSON and compared against a run from another commit:
+#
+#   python3 -m bench.suite --scale small -o before.json
+#   ... change things ...
+#   python3 -m bench.suite --scale small -o after.json --baseline before.json
+#   python3 -m bench.suite --compare before.json after.json
+#
+# The generated database is cached under --data (keyed by sizes and seed)
+# and copied for every run, so runs on different commits start from the
+# same rows. Timing is wall-clock on this machine: compare runs made on the
+# same host, and repeat a run when a difference is close to the noise.
+
+SCALES = {
+    "tiny": dict(users=200, vehicles=100, rentals=2000),
+    "small": dict(users=2000, vehicles=1000, rentals=20000),
+    "medium": dict(users=20000, vehicles=10000, rentals=200000),
+    "large": dict(users=100000, vehicles=50000, rentals=2000000),
+}
+
+MIX = {"customer_dashboard": 60, "rent": 12, "return": 12, "login": 8, "admin_reports": 8}
+
+TYPES = sorted({t for t, _, _ in datagen.CATALOG})
+
+
+class Fleet:
+    # what the workloads pick from: read once from the database, untimed
+
+    def __init__(self, path, users):
+        cn = sqlite_compat.connect(path)
+        cur = cn.cursor()
+        cur.execute("SELECT VehicleID, Model FROM Vehicle")
+        rows = cur.fetchall()
+        cn.close()
+        per_model = {}
+        for _, model in rows:
+            per_model[model] = per_model.get(model, 0) + 1
+        # popular models are the common ones in the fleet
+        self.vehicle_ids = [vid for vid, _ in rows]
+        self.vehicle_cum = list(itertools.accumulate(per_model[m] for _, m in rows))
+        self.models = sorted(per_model, key=per_model.get, reverse=True)
+        self.users = users
+        self.user_cum = list(itertools.accumulate(datagen.zipf_weights(users, s=0.9)))
+
+    def vehicle(self, rnd):
+        return rnd.choices(self.vehicle_ids, cum_weights=self.vehicle_cum)[0]
+
+    def user(self, rnd):
+        return rnd.choices(range(self.users), cum_weights=self.user_cum)[0]
+
+
+class VirtualUser:
+    # one worker thread: a logged-in customer (its own bench user, so
+    # returns never race) and an admin session; untimed lookups go
+    # straight to the app's store
+
+    def __init__(self, app, fleet, n, seed):
+        self.app = app
+        self.fleet = fleet
+        self.rnd = random.Random(seed * 1000 + n)
+        self.email = "user%d@bench" % n
+        self.client = login(app.test_client(), self.email)
+        self.admin = None
+        with app.app_context():
+            self.user_id = storage.get_store().users.by_email(self.email)["UserID"]
+
+    def active_rental(self):
+        with self.app.app_context():
+            rentals = storage.get_store().rentals.active_for_user(self.user_id)
+        return rentals[0]["RentalID"] if rentals else None
+
+
+# ---------- WORKLOADS ----------
+# prepare(vu) does untimed setup and returns the request to time; the
+# request returns the response status, checked against `expect`
+
+def login_workload(vu):
+    email = "user%d@bench" % vu.fleet.user(vu.rnd)
+    client = vu.app.test_client()
+    return lambda: client.post("/", data={"email": email, "password": datagen.PASSWORD}).status_code
+
+
+def dashboard_workload(vu):
+    rnd = vu.rnd
+    params = {}
+    if rnd.random() < 0.6:
+        params["type"] = rnd.choice(TYPES)
+    if rnd.random() < 0.3:
+        # people search for the popular models
+        model = vu.fleet.models[min(len(vu.fleet.models) - 1, int(rnd.expovariate(0.3)))]
+        params["model"] = model.split()[-1] if rnd.random() < 0.5 else model
+    if rnd.random() < 0.4:
+        params["max_price"] = str(rnd.choice((30, 50, 75, 100, 150)))
+    return lambda: vu.client.get("/customer", query_string=params).status_code
+
+
+def rent_workload(vu):
+    vehicle_id = vu.fleet.vehicle(vu.rnd)
+    days = str(1 + int(vu.rnd.expovariate(1 / 3.0)))
+    # a taken vehicle is a conflict, which redirects just the same
+    return lambda: vu.client.post("/customer/rent/%d" % vehicle_id, data={"days": days}).status_code
+
+
+def return_workload(vu):
+    rental_id = vu.active_rental()
+    while rental_id is None:
+        vu.client.post("/customer/rent/%d" % vu.fleet.vehicle(vu.rnd), data={"days": "2"})
+        rental_id = vu.active_rental()
+    return lambda: vu.client.get("/customer/return/%d" % rental_id).status_code
+
+
+def reports_workload(vu):
+    if vu.admin is None:
+        vu.admin = login(vu.app.test_client(), "admin1@vrms.com")
+    return lambda: vu.admin.get("/admin/reports").status_code
+
+
+WORKLOADS = {
+    # name: (prepare, expected status)
+    "login": (login_workload, 302),
+    "customer_dashboard": (dashboard_workload, 200),
+    "rent": (rent_workload, 302),
+    "return": (return_workload, 302),
+    "admin_reports": (reports_workload, 200),
+}
+
+
+def mixed_workload(vu):
+    name = vu.rnd.choices(list(MIX), weights=list(MIX.values()))[0]
+    prepare, expect = WORKLOADS[name]
+    request = prepare(vu)
+    return lambda: request() == expect
+
+
+# ---------- RUNNER ----------
+
+def run_phase(vus, name, requests, warmup):
+    if name == "mixed":
+        prepare, check = mixed_workload, (lambda result: result)
+    else:
+        prepare, expect = WORKLOADS[name]
+        check = lambda result: result == expect     # noqa: E731
+
+    for i in range(warmup):
+        prepare(vus[i % len(vus)])()
+
+    counts = [requests // len(vus) + (1 if i < requests % len(vus) else 0) for i in range(len(vus))]
+    barrier = threading.Barrier(len(vus) + 1)
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker(vu, count):
+        local, failed = [], 0
+        barrier.wait()
+        for _ in range(count):
+            request = prepare(vu)
+            t0 = time.perf_counter()
+            try:
+                ok = check(request())
+            except Exception:
+                ok = False
+            local.append(time.perf_counter() - t0)
+            failed += not ok
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker, args=(vu, n)) for vu, n in zip(vus, counts)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    result = {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+        "max": max(latencies) if latencies else 0.0,
+    }
+    result.update(percentiles(latencies))
+    return result
+
+
+def dataset(data_dir, sizes, seed, password_method):
+    # generation is deterministic per seed; the schema's hash in the name
+    # regenerates the file when a commit changes the tables
+    with open(sqlite_compat.SCHEMA_FILE, "rb") as f:
+        schema = hashlib.sha1(f.read()).hexdigest()[:8]
+    name = "vrms-%(users)d-%(vehicles)d-%(rentals)d" % sizes + "-%d-%s.sqlite3" % (seed, schema)
+    path = os.path.join(data_dir, name)
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        print("generating %s ..." % path, file=sys.stderr)
+        tmp = path + ".tmp"
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(tmp + suffix):
+                os.remove(tmp + suffix)
+        datagen.generate(tmp, seed=seed, password_method=password_method, **sizes)
+        os.replace(tmp, path)
+    return path
+
+
+def git_revision():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=here,
+                                         stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                             cwd=here, stderr=subprocess.DEVNULL, text=True).strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def run(args):
+    sizes = dict(SCALES[args.scale])
+    for key in ("users", "vehicles", "rentals"):
+        if getattr(args, key) is not None:
+            sizes[key] = getattr(args, key)
+    if sizes["users"] < args.threads:
+        raise SystemExit("need at least --threads bench users")
+
+    base = dataset(args.data, sizes, args.seed, args.password_method)
+    workdir = tempfile.mkdtemp(prefix="vrms-suite-")
+    path = os.path.join(workdir, "vrms.sqlite3")
+    shutil.copyfile(base, path)
+
+    app = sqlite_app(path, DB_POOL_SIZE=args.threads, DB_POOL_MAX_OVERFLOW=0,
+                     LOGIN_RATE_LIMIT_ACCOUNT=10 ** 9)
+    if args.backend == "memory":
+        # loaded from the same generated rows
+        app.config.update(DB_BACKEND="memory", MEMORY_SEED=path)
+    fleet = Fleet(path, sizes["users"])
+    vus = [VirtualUser(app, fleet, n, args.seed) for n in range(args.threads)]
+
+    names = args.workloads.split(",") if args.workloads else list(WORKLOADS) + ["mixed"]
+    results = {}
+    print(HEADER)
+    try:
+        for name in names:
+            if name not in WORKLOADS and name != "mixed":
+                raise SystemExit("unknown workload %r (have: %s, mixed)" % (name, ", ".join(WORKLOADS)))
+            requests = args.login_requests if name == "login" else args.requests
+            results[name] = run_phase(vus, name, requests, args.warmup)
+            print_result(name, results[name])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    commit, dirty = git_revision()
+    return {
+        "meta": {
+            "commit": commit,
+            "dirty": dirty,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "backend": args.backend,
+            "scale": args.scale,
+            "sizes": sizes,
+            "seed": args.seed,
+            "threads": args.threads,
+            "requests": args.requests,
+            "password_method": args.password_method,
+        },
+        "results": results,
+    }
+
+
+# ---------- REPORTING ----------
+
+HEADER = "%-20s %8s %6s %10s %10s %10s %10s" % ("workload", "requests", "errors", "req/s", "p50", "p95", "p99")
+
+
+def print_result(name, r):
+    print("%-20s %8d %6d %10.1f %10s %10s %10s" % (
+        name, r["requests"], r["errors"], r["throughput"],
+        fmt_ms(r["p50"]), fmt_ms(r["p95"]), fmt_ms(r["p99"])))
+
+
+def compare(old, new, threshold):
+    # prints the change per workload; returns the regressions beyond
+    # `threshold` (a fraction) in throughput or p95
+    def label(meta):
+        commit = (meta.get("commit") or "?")[:10]
+        return commit + ("+dirty" if meta.get("dirty") else "")
+
+    print("baseline %s  vs  %s" % (label(old["meta"]), label(new["meta"])))
+    for key in ("sizes", "threads", "backend"):
+        if old["meta"].get(key) != new["meta"].get(key):
+            print("note: runs used a different %s (%s vs %s)"
+                  % (key, old["meta"].get(key), new["meta"].get(key)))
+    print("%-20s %22s %22s %22s %22s" % ("workload", "req/s", "p50", "p95", "p99"))
+
+    regressions = []
+    for name, b in old["results"].items():
+        a = new["results"].get(name)
+        if a is None:
+            continue
+        cells = []
+        for key in ("throughput", "p50", "p95", "p99"):
+            before, after = b[key], a[key]
+            change = (after - before) / before if before else 0.0
+            fmt = (lambda v: "%.1f" % v) if key == "throughput" else fmt_ms
+            cells.append("%9s->%-9s%+4.0f%%" % (fmt(before), fmt(after), change * 100))
+            # fewer req/s or a slower p95 is worse
+            worse = -change if key == "throughput" else change
+            if key in ("throughput", "p95") and worse > threshold:
+                regressions.append((name, key, change))
+        print("%-20s %s" % (name, " ".join(cells)))
+
+    for name, key, change in regressions:
+        print("REGRESSION %s %s %+.0f%%" % (name, key, change * 100))
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scale", choices=sorted(SCALES), default="small")
+    ap.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite")
+    ap.add_argument("--users", type=int)
+    ap.add_argument("--vehicles", type=int)
+    ap.add_argument("--rentals", type=int)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--requests", type=int, default=400, help="timed requests per workload")
+    ap.add_argument("--login-requests", type=int, default=100,
+                    help="timed logins (each one runs the password KDF)")
+    ap.add_argument("--warmup", type=int, default=20)
+    ap.add_argument("--workloads", help="comma-separated subset of: %s, mixed" % ", ".join(WORKLOADS))
+    ap.add_argument("--password-method", default="scrypt:32768:8:1",
+                    help="hash for the generated users (part of the cached dataset)")
+    ap.add_argument("--data", default=os.path.join(tempfile.gettempdir(), "vrms-bench-data"),
+                    help="where generated databases are cached")
+    ap.add_argument("-o", "--output", help="write the results as JSON")
+    ap.add_argument("--baseline", help="compare this run against an earlier JSON result")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                    help="only compare two JSON results")
+    ap.add_argument("--threshold", type=float, default=0.10,
+                    help="regression threshold for --compare/--baseline (fraction)")
+    args = ap.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("wrote", args.output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            old = json.load(f)
+        print()
+        sys.exit(1 if compare(old, report, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
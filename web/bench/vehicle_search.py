@@ -0,0 +1,180 @@
+import argparse
+import decimal
+import random
+import time
+
+import fleet
+import search
+from bench.common import fmt_ms, percentiles
+from bench.datagen import CATALOG, zipf_weights
+from bench.fleet import baseline
+
+# Ranked fuzzy search and autocompletion (fleet.py, search.py) over a
+# synthetic fleet: the datagen catalogue's models in --trims variants each
+# ("Toyota Corolla Hybrid"), skewed like real fleets, with Zipf-distributed
+# rental counts. Timed, through search.VehicleSearchIndex as the routes
+# use it:
+#
+#   load            the columns, vocabularies, trigram postings and tries
+#   rank exact      rank() of a model word / type, best 50 and all
+#   rank typo       the same with one typo in the word ("Corola"), the first
+#                   time the term is seen (scores not yet cached) and again
+#   filter typo     search() first page for a typo'd term (ID order)
+#   complete        complete() for 1-5 typed characters, and typo'd ones
+#   updates         put() of a new model, rented(), discard()
+#
+# and checked: a typo'd word finds the vehicles of the word it came from
+# (recall), where a substring scan over row dicts finds nothing.
+#
+#   python3 -m bench.vehicle_search --vehicles 1000000
+
+TRIMS = ["", "Hybrid", "Sport", "LX", "EX", "Touring", "Limited", "SE", "Premium", "Base",
+         "Turbo", "Eco", "GT", "Plus", "Elite", "Trail"]
+
+
+def vehicles(rng, count, trims):
+    statuses = ("Available",) * 8 + ("Rented",) * 3 + ("Maintenance",)
+    weights = zipf_weights(len(CATALOG))
+    for i in range(count):
+        vtype, model, price = rng.choices(CATALOG, weights=weights)[0]
+        trim = rng.choice(TRIMS[:trims])
+        yield {"VehicleID": i + 1, "VehicleType": vtype,
+               "Model": (model + " " + trim).strip(), "RegistrationNumber": "BS%07d" % i,
+               "RentalPrice": decimal.Decimal(str(round(price * rng.uniform(0.85, 1.2), 2))),
+               "Status": rng.choice(statuses), "BranchID": 1 + i % 4}
+
+
+def typo(rng, word):
+    # one dropped, doubled, swapped or replaced letter
+    i = rng.randrange(1, len(word) - 1)
+    kind = rng.choice(("drop", "double", "swap", "replace"))
+    if kind == "drop":
+        return word[:i] + word[i + 1:]
+    if kind == "double":
+        return word[:i] + word[i] + word[i:]
+    if kind == "swap":
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + rng.choice("aeioulnrst".replace(word[i], "")) + word[i + 1:]
+
+
+def timed(fn, args):
+    samples = []
+    for a in args:
+        t0 = time.perf_counter()
+        fn(a)
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def report(label, samples):
+    pct = percentiles(samples)
+    print("%-24s p50=%-9s p95=%-9s p99=%s"
+          % (label, fmt_ms(pct["p50"]), fmt_ms(pct["p95"]), fmt_ms(pct["p99"])))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--vehicles", type=int, default=1000000)
+    ap.add_argument("--trims", type=int, default=len(TRIMS))
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--page", type=int, default=50)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    rows = list(vehicles(rng, args.vehicles, args.trims))
+    zipf = zipf_weights(1000)
+    rentals = {row["VehicleID"]: n for row, n in
+               zip(rows, rng.choices(range(1000), weights=zipf, k=len(rows)))}
+
+    index = search.VehicleSearchIndex(ttl=None)
+    t0 = time.perf_counter()
+    index.load(rows, rentals)
+    stats = index.stats()
+    print("%d vehicles, %d models, %d types loaded in %.2fs (%d trie nodes)"
+          % (stats["vehicles"], stats["models"], stats["types"], time.perf_counter() - t0,
+             stats["trie_nodes"]))
+
+    words = sorted({w for _, m, _ in CATALOG for w in fleet.tokens(m) if len(w) >= 5})
+    types = sorted({t for t, _, _ in CATALOG})
+    exact = [rng.choice(words) for _ in range(args.queries)]
+    typos = [(w, typo(rng, w)) for w in (rng.choice(words) for _ in range(args.queries))]
+    typos = [(w, t) for w, t in typos if t not in words]
+
+    # recall: a typo'd word finds every vehicle of the models with the word
+    found = missed = 0
+    for word, wrong in typos[:50]:
+        expected = {r["VehicleID"] for r in baseline(rows, model=word, status="Available")}
+        got = {r["VehicleID"] for r in index.search(None, status="Available", model=wrong)}
+        found += len(expected & got)
+        missed += len(expected - got)
+        assert not baseline(rows[:20000], model=wrong), wrong
+    recall = found / float(found + missed)
+    print("typo'd words: recall %.3f over %d terms (a substring scan finds none)"
+          % (recall, len(typos[:50])))
+    assert recall > 0.9, recall
+
+    # ranking: best first, and the same as ranking all of them
+    ranked = index.rank(None, status="Available", model=exact[0], limit=args.page)
+    assert all(a["Score"] >= b["Score"] for a, b in zip(ranked, ranked[1:]))
+    assert ranked == index.rank(None, status="Available", model=exact[0])[:args.page]
+    print("rank(model=%r) best: %s" % (exact[0], [(r["Model"], r["RentalPrice"], r["Score"])
+                                                 for r in ranked[:3]]))
+
+    def rank(term, limit=args.page, **f):
+        return index.rank(None, status="Available", model=term, limit=limit, **f)
+
+    def cold(term):
+        # as the first time the term is typed: no cached scores
+        index.fleet.models._scores.clear()
+        return rank(term)
+
+    report("rank exact (page)", timed(rank, exact))
+    report("rank exact (all)", timed(lambda w: rank(w, limit=None), exact[:50]))
+    report("rank type (page)", timed(lambda t: index.rank(None, vehicle_type=t,
+                                                          limit=args.page), types * 10))
+    report("rank typo, first time", timed(cold, [t for _, t in typos]))
+    report("rank typo (page)", timed(rank, [t for _, t in typos]))
+    report("rank typo + type, price", timed(
+        lambda wt: rank(wt[1], vehicle_type=rng.choice(types), max_price=80), typos))
+    report("filter typo (page)", timed(
+        lambda wt: index.search(None, status="Available", model=wt[1], limit=args.page),
+        typos))
+
+    prefixes = [w[:rng.randint(1, 5)] for w in exact]
+    typo_prefixes = [typo(rng, w)[:rng.randint(4, 6)] for w in exact]
+    print("complete(%r): %s" % (prefixes[0], index.complete(None, "model", prefixes[0])))
+    print("complete(%r): %s" % (typo_prefixes[0], index.complete(None, "model",
+                                                                 typo_prefixes[0])))
+    report("complete 1-5 chars", timed(lambda p: index.complete(None, "model", p), prefixes))
+    report("complete typo'd", timed(lambda p: index.complete(None, "model", p), typo_prefixes))
+
+    # incremental: a new model is searchable and completes right away
+    t0 = time.perf_counter()
+    for i in range(1000):
+        index.put({"VehicleID": args.vehicles + 1 + i, "VehicleType": "Car",
+                   "Model": "Lucid Air %d" % (i % 10), "RegistrationNumber": "BX%05d" % i,
+                   "RentalPrice": decimal.Decimal("150.00"), "Status": "Available",
+                   "BranchID": 1})
+    put = (time.perf_counter() - t0) / 1000
+    assert index.complete(None, "model", "luc")[0].startswith("Lucid Air")
+    assert len(index.search(None, model="Lucdi")) == 1000
+    t0 = time.perf_counter()
+    for i in range(1000):
+        index.rented(args.vehicles + 1 + i)
+    rented = (time.perf_counter() - t0) / 1000
+    t0 = time.perf_counter()
+    for i in range(1000):
+        index.discard(args.vehicles + 1 + i)
+    discard = (time.perf_counter() - t0) / 1000
+    assert index.complete(None, "model", "luc") == []
+    # the completion weights kept up to date match them recomputed
+    kept = index.fleet.weights("model").copy()
+    index.fleet._weights.clear()
+    assert (kept == index.fleet.weights("model")).all()
+    print("put %.1fus, rented %.1fus, discard %.1fus each"
+          % (put * 1e6, rented * 1e6, discard * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+from datetime import date, timedelta
+
+import aggregates
+
+# Booking a vehicle as one atomic step. Two customers racing for the same
+# vehicle can't both get it: the loser gets BookingConflict.
+#
+# MySQL: a single CALL sp_book_vehicle(...) round trip. The procedure locks
+# the vehicle row (SELECT ... FOR UPDATE), inserts the Rental (the
+# trg_rental_insert_status trigger flips the vehicle to 'Rented'), bumps
+# ReportTotals and returns the new RentalID.
+#
+# SQLite stand-in (no procedures): the write lock is taken up front and the
+# Rental is inserted with a single INSERT ... SELECT that only matches an
+# 'Available' vehicle, so availability check and insert are one statement.
+#
+# Either way the new rental must not overlap a reservation of the vehicle:
+# rentals hold their vehicle for [RentalDate, ReturnDate). Reservations
+# (reserve_vehicle, Status 'Reserved') are rentals that start on a later
+# day; they don't touch Vehicle.Status until they are picked up
+# (pick_up), which turns them 'Active' and the vehicle 'Rented'
+# (trg_rental_update_status). The fast pre-check against the in-process
+# interval index lives in the repositories (see reservations.py).
+#
+# The amount charged is the caller's quote (`total`, from pricing.py, so
+# the dashboard and the booking agree); without one it is RentalPrice *
+# days.
+#
+# The caller commits on success and rolls back on BookingConflict.
+#
+# Returns go through return_rentals(), which checks a whole list of
+# RentalIDs in one locked SELECT and then closes them with one UPDATE and
+# one batched Payment INSERT. The vehicles are freed by trg_rental_update_status,
+# so there is no separate Vehicle UPDATE. customer_return is just the
+# one-item case; staff use it for bulk check-in at depot close.
+
+
+class BookingConflict(Exception):
+    pass
+
+
+# rentals of vehicle %s holding it somewhere in [%s, %s) -- params: VehicleID, end, start
+OVERLAPPING = """
+    SELECT 1 FROM Rental h
+    WHERE h.VehicleID = %s AND h.Status IN ('Active', 'Reserved')
+      AND h.RentalDate < %s AND COALESCE(h.ReturnDate, '9999-12-31') > %s
+"""
+
+
+def book_vehicle(cn, user_id, vehicle_id, days, total=None, backend="mysql"):
+    # returns (rental_id, total_amount)
+    if days < 1:
+        days = 1
+    if backend == "sqlite":
+        return _book_sqlite(cn, user_id, vehicle_id, days, total)
+    return _book_mysql(cn, user_id, vehicle_id, days, total)
+
+
+def _book_mysql(cn, user_id, vehicle_id, days, total):
+    cur = cn.cursor()
+    try:
+        cur.callproc("sp_book_vehicle", (user_id, vehicle_id, days, total))
+        row = None
+        for result in cur.stored_results():
+            row = result.fetchone()
+    except Exception as e:
+        # SIGNAL SQLSTATE '45000' from the procedure
+        if getattr(e, "sqlstate", None) == "45000":
+            raise BookingConflict("vehicle %s is not available" % vehicle_id)
+        raise
+    finally:
+        cur.close()
+    return row[0], row[1]
+
+
+def _book_sqlite(cn, user_id, vehicle_id, days, total):
+    cn.start_transaction()
+    cur = cn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status)
+            SELECT %s, VehicleID, CURDATE(), DATE_ADD(CURDATE(), INTERVAL %s DAY),
+                   COALESCE(%s, RentalPrice * %s), 'Active'
+            FROM Vehicle
+            WHERE VehicleID = %s AND Status = 'Available'
+              AND NOT EXISTS (""" + OVERLAPPING + """)
+        """, (user_id, days, total, days, vehicle_id, vehicle_id,
+              date.today() + timedelta(days=days), date.today()))
+        if cur.rowcount != 1:
+            raise BookingConflict("vehicle %s is not available" % vehicle_id)
+        rental_id = cur.lastrowid
+        aggregates.bump(cur, total_rentals=1)
+        cur.execute("SELECT TotalAmount FROM Rental WHERE RentalID = %s", (rental_id,))
+        total = cur.fetchone()[0]
+    finally:
+        cur.close()
+    return rental_id, total
+
+
+# ---------- reservations ----------
+
+def reserve_vehicle(cn, user_id, vehicle_id, start, days, total=None, backend="mysql"):
+    # a 'Reserved' rental over [start, start + days); returns
+    # (rental_id, total_amount). The caller validates the window
+    # (reservations.check_window) and commits.
+    if backend == "sqlite":
+        return _reserve_sqlite(cn, user_id, vehicle_id, start, days, total)
+    return _reserve_mysql(cn, user_id, vehicle_id, start, days, total)
+
+
+def _reserve_mysql(cn, user_id, vehicle_id, start, days, total):
+    cur = cn.cursor()
+    try:
+        cur.callproc("sp_reserve_vehicle", (user_id, vehicle_id, start, days, total))
+        row = None
+        for result in cur.stored_results():
+            row = result.fetchone()
+    except Exception as e:
+        if getattr(e, "sqlstate", None) == "45000":
+            raise BookingConflict("vehicle %s is not available from %s" % (vehicle_id, start))
+        raise
+    finally:
+        cur.close()
+    return row[0], row[1]
+
+
+def _reserve_sqlite(cn, user_id, vehicle_id, start, days, total):
+    end = start + timedelta(days=days)
+    cn.start_transaction()
+    cur = cn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO Rental (UserID, VehicleID, RentalDate, ReturnDate, TotalAmount, Status)
+            SELECT %s, VehicleID, %s, %s, COALESCE(%s, RentalPrice * %s), 'Reserved'
+            FROM Vehicle
+            WHERE VehicleID = %s AND Status <> 'Maintenance'
+              AND NOT EXISTS (""" + OVERLAPPING + """)
+        """, (user_id, start, end, total, days, vehicle_id, vehicle_id, end, start))
+        if cur.rowcount != 1:
+            raise BookingConflict("vehicle %s is not available from %s" % (vehicle_id, start))
+        rental_id = cur.lastrowid
+        aggregates.bump(cur, total_rentals=1)
+        cur.execute("SELECT TotalAmount FROM Rental WHERE RentalID = %s", (rental_id,))
+        total = cur.fetchone()[0]
+    finally:
+        cur.close()
+    return rental_id, total
+
+
+def _reservation(cur, rental_id, user_id, lock):
+    cur.execute("SELECT RentalID, UserID, VehicleID, RentalDate, Status FROM Rental "
+                "WHERE RentalID = %s" + lock, (rental_id,))
+    row = cur.fetchone()
+    if row is None or (user_id is not None and row["UserID"] != user_id):
+        return None
+    return row
+
+
+def cancel_reservation(cn, rental_id, user_id=None, backend="mysql"):
+    # the reservation's VehicleID, or None if there was no such reservation
+    # (with user_id set: none of this user's). Caller commits.
+    lock = _lock(cn, backend)
+    cur = cn.cursor(dictionary=True)
+    try:
+        row = _reservation(cur, rental_id, user_id, lock)
+        if row is None or row["Status"] != "Reserved":
+            return None
+        cur.execute("UPDATE Rental SET Status = 'Cancelled' WHERE RentalID = %s", (rental_id,))
+        return row["VehicleID"]
+    finally:
+        cur.close()
+
+
+def pick_up(cn, rental_id, user_id=None, backend="mysql"):
+    # a reservation starting today (or earlier) becomes the Active rental,
+    # the vehicle 'Rented'; returns its VehicleID, None if there is no such
+    # reservation, and BookingConflict while the vehicle isn't back yet.
+    # Caller commits.
+    lock = _lock(cn, backend)
+    cur = cn.cursor(dictionary=True)
+    try:
+        row = _reservation(cur, rental_id, user_id, lock)
+        if row is None or row["Status"] != "Reserved" or row["RentalDate"] > date.today():
+            return None
+        # the vehicle is checked under its own row lock rather than in the
+        # UPDATE: the Rental trigger writes Vehicle, which MySQL refuses
+        # (error 1442) for a statement that also reads it
+        cur.execute("SELECT Status FROM Vehicle WHERE VehicleID = %s" + lock,
+                    (row["VehicleID"],))
+        vehicle = cur.fetchone()
+        if vehicle is None or vehicle["Status"] != "Available":
+            raise BookingConflict("vehicle %s is not back yet" % row["VehicleID"])
+        cur.execute("UPDATE Rental SET Status = 'Active' "
+                    "WHERE RentalID = %s AND Status = 'Reserved'", (rental_id,))
+        if cur.rowcount != 1:
+            return None
+        return row["VehicleID"]
+    finally:
+        cur.close()
+
+
+def _lock(cn, backend):
+    if backend == "sqlite":
+        cn.start_transaction()
+        return ""
+    return " FOR UPDATE"
+
+
+# per-rental outcome of return_rentals()
+RETURNED = "returned"
+NOT_FOUND = "not_found"
+NOT_ACTIVE = "not_active"
+
+PAYMENT_MODES = ("Cash", "Card")
+
+
+def amount_due(row):
+    # what returning a rental costs: its total plus the late fee
+    return row["TotalAmount"] + (row.get("LateFee") or 0)
+
+
+def return_rentals(cn, rental_ids, user_id=None, payment_mode="Cash", backend="mysql"):
+    # returns ({RentalID: RETURNED/NOT_FOUND/NOT_ACTIVE}, returned rows)
+    # in request order; with user_id set, other users' rentals count as
+    # NOT_FOUND. Caller commits.
+    ids = list(dict.fromkeys(int(r) for r in rental_ids))
+    results = {}
+    if not ids:
+        return results, []
+
+    if backend == "sqlite":
+        cn.start_transaction()
+        lock = ""
+    else:
+        lock = " FOR UPDATE"
+
+    placeholders = ", ".join(["%s"] * len(ids))
+    cur = cn.cursor(dictionary=True)
+    try:
+        # one query validates the whole batch (and locks the rows, so two
+        # clerks returning the same rental can't both take the payment)
+        cur.execute("""
+            SELECT RentalID, UserID, VehicleID, TotalAmount, LateFee, Status
+            FROM Rental
+            WHERE RentalID IN (""" + placeholders + ")" + lock, ids)
+        found = {row["RentalID"]: row for row in cur.fetchall()}
+
+        returned = []
+        for rid in ids:
+            row = found.get(rid)
+            if row is None or (user_id is not None and row["UserID"] != user_id):
+                results[rid] = NOT_FOUND
+            elif row["Status"] != "Active":
+                results[rid] = NOT_ACTIVE
+            else:
+                results[rid] = RETURNED
+                returned.append(row)
+
+        if returned:
+            done = [row["RentalID"] for row in returned]
+            cur.execute("""
+                UPDATE Rental
+                SET Status='Completed', ReturnDate = CURDATE()
+                WHERE RentalID IN (""" + ", ".join(["%s"] * len(done)) + ")", done)
+            # the payment settles the rental and any late fee the scheduler
+            # accrued; mysql.connector turns this into one multi-row INSERT
+            cur.executemany("""
+                INSERT INTO Payment (RentalID, PaymentDate, Amount, PaymentMode)
+                VALUES (%s, CURDATE(), %s, %s)
+            """, [(row["RentalID"], amount_due(row), payment_mode) for row in returned])
+            aggregates.bump(cur, total_revenue=sum(amount_due(row) for row in returned))
+    finally:
+        cur.close()
+    return results, returned
@@ -0,0 +1,265 @@
+import csv
+import datetime
+import decimal
+import io
+import json
+
+from flask import current_app
+
+import aggregates
+
+# Bulk fleet import and table export.
+#
+# Import reads CSV or JSON Lines one record at a time, validates each row
+# against the Vehicle constraints (required fields, lengths, price, allowed
+# Status, unique RegistrationNumber) and inserts the good ones with one
+# multi-row INSERT per chunk, committing chunk by chunk, all into one
+# Branch. Bad rows are reported with their line number; they never abort
+# the rest of the file.
+#
+# Export formats the rows of a storage stream() (for SQL an unbuffered
+# cursor read in fetchmany batches), so a table is never held in memory as
+# a whole.
+
+DEFAULTS = {
+    "IMPORT_CHUNK_SIZE": 500,
+    "IMPORT_MAX_ERRORS": 1000,   # rejected rows listed in the report; the rest are only counted
+}
+
+FORMATS = ("csv", "jsonl")
+
+VEHICLE_COLUMNS = ("VehicleType", "Model", "RegistrationNumber", "RentalPrice", "Status")
+VEHICLE_STATUSES = ("Available", "Rented", "Maintenance")
+MAX_LENGTH = {"VehicleType": 50, "Model": 100, "RegistrationNumber": 50}
+MAX_PRICE = decimal.Decimal("99999999.99")   # DECIMAL(10,2)
+
+# table -> exported columns
+EXPORTS = {
+    "vehicles": ("VehicleID",) + VEHICLE_COLUMNS + ("BranchID",),
+    "rentals": ("RentalID", "UserID", "VehicleID", "RentalDate", "ReturnDate",
+                "TotalAmount", "Status"),
+    "payments": ("PaymentID", "RentalID", "PaymentDate", "Amount", "PaymentMode"),
+}
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def guess_format(filename, default="csv"):
+    name = (filename or "").lower()
+    if name.endswith((".jsonl", ".ndjson", ".json")):
+        return "jsonl"
+    if name.endswith(".csv"):
+        return "csv"
+    return default
+
+
+# ---------- IMPORT ----------
+
+def read_records(stream, fmt):
+    # yields (line number, record dict or None, error or None) from a text stream
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, "invalid JSON: %s" % e
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, "expected a JSON object"
+            continue
+        yield line_no, record, None
+
+
+def validate_vehicle(record):
+    # (row tuple in VEHICLE_COLUMNS order, None) or (None, reason)
+    values = []
+    for column in ("VehicleType", "Model", "RegistrationNumber"):
+        value = record.get(column)
+        value = "" if value is None else str(value).strip()
+        if not value:
+            return None, "%s is required" % column
+        if len(value) > MAX_LENGTH[column]:
+            return None, "%s is longer than %d characters" % (column, MAX_LENGTH[column])
+        values.append(value)
+
+    try:
+        price = decimal.Decimal(str(record.get("RentalPrice")).strip())
+    except decimal.InvalidOperation:
+        return None, "RentalPrice is not a number"
+    if not price.is_finite() or price < 0 or price > MAX_PRICE:
+        return None, "RentalPrice is out of range"
+    values.append(str(price.quantize(decimal.Decimal("0.01"))))
+
+    status = str(record.get("Status") or "").strip() or "Available"
+    if status not in VEHICLE_STATUSES:
+        return None, "Status must be one of %s" % ", ".join(VEHICLE_STATUSES)
+    values.append(status)
+    return tuple(values), None
+
+
+class ImportReport:
+
+    def __init__(self, max_errors=1000):
+        self.max_errors = max_errors
+        self.inserted = 0
+        self.rejected = 0
+        self.chunks = 0
+        self.errors = []        # [(line number, reason)], first max_errors only
+
+    def reject(self, line_no, reason):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line_no, reason))
+
+    def to_dict(self):
+        return {
+            "inserted": self.inserted,
+            "rejected": self.rejected,
+            "chunks": self.chunks,
+            "errors": [{"line": line_no, "reason": reason} for line_no, reason in self.errors],
+            "errors_truncated": self.rejected > len(self.errors),
+        }
+
+
+def valid_chunks(records, report, chunk_size=500):
+    # [(line number, row)] lists of up to chunk_size valid rows; rejected
+    # records go straight into `report`
+    seen = set()        # RegistrationNumbers already taken by earlier lines of the file
+    chunk = []
+    for line_no, record, error in records:
+        row = None
+        if error is None:
+            row, error = validate_vehicle(record)
+        if error is None and row[2].casefold() in seen:
+            error = "duplicate RegistrationNumber %s in file" % row[2]
+        if error is not None:
+            report.reject(line_no, error)
+            continue
+        seen.add(row[2].casefold())
+        chunk.append((line_no, row))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def import_vehicles(cn, records, chunk_size=500, max_errors=1000, branch_id=1,
+                    taken_elsewhere=None):
+    # records come from read_records(); commits after every chunk.
+    # taken_elsewhere(regnos), if given, returns those of a chunk's
+    # registration numbers (casefolded) that other databases already hold
+    # -- the other shards' fleets
+    report = ImportReport(max_errors)
+    for chunk in valid_chunks(records, report, chunk_size):
+        _import_chunk(cn, chunk, report, branch_id, taken_elsewhere)
+    report.errors.sort()
+    return report
+
+
+def _insert_vehicles(cur, rows, branch_id):
+    # one multi-row INSERT for the whole chunk
+    values = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(rows))
+    cur.execute("INSERT INTO Vehicle (" + ", ".join(VEHICLE_COLUMNS) + ", BranchID) VALUES "
+                + values, [value for row in rows for value in tuple(row) + (branch_id,)])
+    aggregates.bump(cur, total_vehicles=len(rows))
+
+
+def _is_constraint_error(e):
+    # mysql.connector and sqlite3 both call it IntegrityError
+    return type(e).__name__ == "IntegrityError"
+
+
+def _import_chunk(cn, chunk, report, branch_id, taken_elsewhere):
+    report.chunks += 1
+    cur = cn.cursor()
+    try:
+        # registration numbers already in the table (one query per chunk;
+        # casefold because MySQL's default collation compares case-insensitively)
+        regnos = [row[2] for _, row in chunk]
+        cur.execute("SELECT RegistrationNumber FROM Vehicle WHERE RegistrationNumber IN ("
+                    + ", ".join(["%s"] * len(regnos)) + ")", regnos)
+        taken = {r[0].casefold() for r in cur.fetchall()}
+        if taken_elsewhere is not None:
+            taken |= taken_elsewhere(regnos)
+
+        fresh = []
+        for line_no, row in chunk:
+            if row[2].casefold() in taken:
+                report.reject(line_no, "RegistrationNumber %s already exists" % row[2])
+            else:
+                fresh.append((line_no, row))
+        if not fresh:
+            return
+
+        try:
+            _insert_vehicles(cur, [row for _, row in fresh], branch_id)
+            cn.commit()
+            report.inserted += len(fresh)
+            return
+        except Exception as e:
+            cn.rollback()
+            if not _is_constraint_error(e):
+                raise
+
+        # something slipped past the checks (e.g. a vehicle added concurrently):
+        # redo this chunk row by row so only the offending rows are rejected
+        for line_no, row in fresh:
+            try:
+                _insert_vehicles(cur, [row], branch_id)
+                cn.commit()
+                report.inserted += 1
+            except Exception as e:
+                cn.rollback()
+                if not _is_constraint_error(e):
+                    raise
+                report.reject(line_no, str(e))
+    finally:
+        cur.close()
+
+
+# ---------- EXPORT ----------
+
+def _plain(value):
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def export_chunks(rows, table, fmt):
+    # generator of text chunks (a batch of lines each) for a streamed response
+    columns = EXPORTS[table]
+    batch = current_app.config["STREAM_BATCH_SIZE"]
+
+    buf = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerow(columns)
+    pending = 0
+    for row in rows:
+        if writer is not None:
+            writer.writerow([_plain(row[c]) for c in columns])
+        else:
+            buf.write(json.dumps({c: _plain(row[c]) for c in columns}) + "\n")
+        pending += 1
+        if pending >= batch:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            pending = 0
+    if buf.tell():
+        yield buf.getvalue()
@@ -0,0 +1,302 @@
+import collections
+import importlib
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:     # Windows: a single app process needs no bus
+    fcntl = None
+
+# Cache-invalidation bus between app processes (gunicorn workers, hosts).
+#
+# Every in-process cache here -- the vehicle search index, the reservation
+# index, pricing rules, the user cache, cached pages, analytics rollups --
+# is kept current by the process that writes: its repositories update or
+# invalidate it after committing. The other processes only had their TTLs.
+# Now those same calls also publish() a message (channel, key), and every
+# other process applies it to its own copy through the handler the cache
+# module registered for the channel: the vehicle / user / rental's entry is
+# dropped and reloaded on next use, or the whole cache when the key is
+# None.
+#
+# Messages are numbered: the transport gives each a sequence number (the
+# bus's version) and a process keeps the last one it applied. Each request
+# first applies whatever is newer -- one 8-byte read when nothing is -- so
+# a request that starts after another worker's write has returned never
+# reads the old entry; a background thread does the same every
+# CACHE_BUS_POLL seconds so idle workers drop entries too. A process that
+# fell so far behind that messages were overwritten before it read them
+# flushes every cache instead.
+#
+# The default transport, "shm", is a ring of CACHE_BUS_SLOTS messages with
+# a version counter in a shared memory-mapped file (CACHE_BUS_PATH; put it
+# on /dev/shm), written under an flock -- for workers on one host. For
+# several hosts set CACHE_BUS_TRANSPORT to "package.module:factory", a
+# callable taking the app config and returning an object with the same
+# head() / publish() / receive() / close() methods as SharedMemoryTransport,
+# backed by a broker. The TTLs stay as the bound for changes made outside
+# the app (the SQL console).
+#
+# Propagation, per process: /admin/stats/bus. Multi-process coherence and
+# latency check: python3 -m bench.cachebus --workers 4
+
+DEFAULTS = {
+    "CACHE_BUS_ENABLED": os.environ.get("VRMS_CACHE_BUS", "1") == "1",
+    "CACHE_BUS_TRANSPORT": os.environ.get("VRMS_CACHE_BUS_TRANSPORT", "shm"),
+    "CACHE_BUS_PATH": os.environ.get("VRMS_CACHE_BUS_PATH", "cache-bus.shm"),
+    "CACHE_BUS_SLOTS": 4096,
+    "CACHE_BUS_POLL": 0.05,             # seconds between background polls
+}
+
+# a message's channel is stored as its index here, so only ever append
+CHANNELS = ("vehicles", "reservations", "pricing", "users", "responses", "analytics",
+            "branches")
+
+# seq, published at (time.time()), origin, channel, key (-1: all)
+MESSAGE = struct.Struct("<QdIBxxxq")
+
+Message = collections.namedtuple("Message", "seq at origin channel key")
+
+# magic, layout version, slots, head (last sequence number published)
+HEADER = struct.Struct("<4sIIxxxxQ")
+HEADER_SIZE = 64
+MAGIC = b"VCB1"
+LAYOUT = 1
+_HEAD = struct.Struct("<Q")
+_HEAD_OFFSET = 16
+
+_handlers = {}          # channel -> fn(app, key)
+
+
+def handler(channel):
+    # registers fn(app, key) to apply another process's message on
+    # `channel` to this process's cache; key None means everything
+    def register(fn):
+        _handlers[channel] = fn
+        return fn
+    return register
+
+
+# ---------- TRANSPORTS ----------
+
+class SharedMemoryTransport:
+
+    def __init__(self, path, slots=4096):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._flock()
+        try:
+            if os.fstat(self._fd).st_size < HEADER_SIZE:
+                os.ftruncate(self._fd, HEADER_SIZE + slots * MESSAGE.size)
+                os.pwrite(self._fd, HEADER.pack(MAGIC, LAYOUT, slots, 0), 0)
+            magic, layout, slots, _ = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+            if magic != MAGIC or layout != LAYOUT:
+                raise ValueError("%s is not a cache bus file" % path)
+        finally:
+            self._funlock()
+        self.slots = slots
+        self._map = mmap.mmap(self._fd, HEADER_SIZE + slots * MESSAGE.size)
+
+    def _flock(self):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def _funlock(self):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def head(self):
+        return _HEAD.unpack_from(self._map, _HEAD_OFFSET)[0]
+
+    def publish(self, origin, channel, key):
+        # the message's sequence number
+        with self._lock:
+            self._flock()
+            try:
+                seq = self.head() + 1
+                MESSAGE.pack_into(self._map, HEADER_SIZE + (seq % self.slots) * MESSAGE.size,
+                                  seq, time.time(), origin, channel, key)
+                # the slot before the counter: a reader that sees `seq`
+                # finds the message in place
+                _HEAD.pack_into(self._map, _HEAD_OFFSET, seq)
+            finally:
+                self._funlock()
+        return seq
+
+    def receive(self, cursor):
+        # (new cursor, messages after `cursor`, lost); lost means some were
+        # overwritten before they could be read
+        head = self.head()
+        if head == cursor:
+            return cursor, [], False
+        if head - cursor > self.slots:
+            return head, [], True
+        out = []
+        for seq in range(cursor + 1, head + 1):
+            message = Message._make(MESSAGE.unpack_from(
+                self._map, HEADER_SIZE + (seq % self.slots) * MESSAGE.size))
+            if message.seq != seq:
+                if message.seq > seq:
+                    return self.head(), [], True
+                break                           # not written yet
+            out.append(message)
+        # a publisher may have lapped the ring while we read
+        if self.head() - self.slots >= cursor + 1:
+            return self.head(), [], True
+        return (out[-1].seq if out else cursor), out, False
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def _transport(cfg):
+    name = cfg["CACHE_BUS_TRANSPORT"]
+    if name == "shm":
+        return SharedMemoryTransport(cfg["CACHE_BUS_PATH"], slots=cfg["CACHE_BUS_SLOTS"])
+    module, _, factory = name.partition(":")
+    return getattr(importlib.import_module(module), factory)(cfg)
+
+
+# ---------- BUS ----------
+
+class CacheBus:
+
+    def __init__(self, app, transport, poll=0.05):
+        self.app = app
+        self.transport = transport
+        self.poll_interval = poll
+        self.pid = os.getpid()
+        # tells this process's own messages apart (pids repeat across hosts)
+        self.origin = random.getrandbits(32)
+        self.cursor = transport.head()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.published = 0
+        self.applied = 0
+        self.flushes = 0
+        self.errors = 0
+        self.latencies = collections.deque(maxlen=1024)   # publish -> applied, seconds
+
+    def start(self):
+        if self._thread is not None or not self.poll_interval:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="vrms-cache-bus",
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.transport.close()
+
+    def _loop(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception:
+                self.errors += 1
+
+    def publish(self, channel, key=None):
+        self.transport.publish(self.origin, CHANNELS.index(channel),
+                               -1 if key is None else int(key))
+        self.published += 1
+
+    def poll(self):
+        # applies the messages published since the last poll; how many
+        if self.transport.head() == self.cursor:
+            return 0
+        with self._lock:
+            self.cursor, messages, lost = self.transport.receive(self.cursor)
+            if lost:
+                self.flushes += 1
+                for channel in CHANNELS:
+                    self._apply(channel, None)
+                return 0
+            now = time.time()
+            applied = 0
+            for message in messages:
+                if message.origin == self.origin:
+                    continue
+                self._apply(CHANNELS[message.channel],
+                            None if message.key < 0 else message.key)
+                self.latencies.append(now - message.at)
+                applied += 1
+            self.applied += applied
+            return applied
+
+    def _apply(self, channel, key):
+        fn = _handlers.get(channel)
+        if fn is not None:
+            fn(self.app, key)
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+        out = {"origin": self.origin, "version": self.transport.head(),
+               "cursor": self.cursor, "published": self.published, "applied": self.applied,
+               "flushes": self.flushes, "errors": self.errors}
+        if latencies:
+            out["latency_ms"] = {
+                "p50": round(latencies[len(latencies) // 2] * 1000, 3),
+                "p99": round(latencies[min(len(latencies) - 1,
+                                           int(len(latencies) * 0.99))] * 1000, 3),
+                "max": round(latencies[-1] * 1000, 3)}
+        return out
+
+
+_bus_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.before_request(_poll)
+
+
+def get_bus(app=None):
+    # this process's bus (a forked worker gets a new one); None when
+    # disabled or with the in-memory store, which no other process shares
+    app = app or current_app._get_current_object()   # the bus keeps the app
+    cfg = app.config
+    if not cfg["CACHE_BUS_ENABLED"] or cfg["DB_BACKEND"] == "memory":
+        return None
+    bus = app.extensions.get("vrms_cachebus")
+    if bus is None or bus.pid != os.getpid():
+        with _bus_lock:
+            bus = app.extensions.get("vrms_cachebus")
+            if bus is None or bus.pid != os.getpid():
+                bus = CacheBus(app, _transport(cfg), poll=cfg["CACHE_BUS_POLL"])
+                app.extensions["vrms_cachebus"] = bus
+                bus.start()
+    return bus
+
+
+def _poll():
+    bus = get_bus()
+    if bus is not None:
+        bus.poll()
+
+
+def publish(channel, key=None):
+    # after committing a write that `channel`'s caches hold (key None:
+    # all of it)
+    bus = get_bus()
+    if bus is not None:
+        bus.publish(channel, key)
@@ -0,0 +1,625 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+
+from flask import current_app, g, request, session
+
+# ---------- CONFIG ----------
+
+# defaults for app.config; every key can be overridden from the environment
+DEFAULTS = {
+    "DB_BACKEND": os.environ.get("VRMS_DB_BACKEND", "mysql"),   # "mysql", "sqlite" or "memory"
+    "MYSQL_HOST": os.environ.get("VRMS_MYSQL_HOST", "localhost"),
+    "MYSQL_USER": os.environ.get("VRMS_MYSQL_USER", "root"),
+    "MYSQL_PASSWORD": os.environ.get("VRMS_MYSQL_PASSWORD", "root@123"),  # <<< CHANGE THIS
+    "MYSQL_DATABASE": os.environ.get("VRMS_MYSQL_DATABASE", "VehicleRentalDB"),
+    "SQLITE_PATH": os.environ.get("VRMS_SQLITE_PATH", "vrms.sqlite3"),
+    "DB_POOL_SIZE": int(os.environ.get("VRMS_DB_POOL_SIZE", "5")),
+    "DB_POOL_MAX_OVERFLOW": int(os.environ.get("VRMS_DB_POOL_MAX_OVERFLOW", "10")),
+    "DB_POOL_TIMEOUT": float(os.environ.get("VRMS_DB_POOL_TIMEOUT", "10")),
+    "DB_POOL_IDLE_TIMEOUT": float(os.environ.get("VRMS_DB_POOL_IDLE_TIMEOUT", "300")),
+    "DB_POOL_PING": os.environ.get("VRMS_DB_POOL_PING", "1") == "1",
+    # read replicas: MySQL hosts or, for DB_BACKEND=sqlite, file paths;
+    # a dict overrides any of the keys above for one replica
+    "DB_REPLICAS": [r for r in os.environ.get("VRMS_DB_REPLICAS", "").split(",") if r],
+    "DB_REPLICA_POOL_SIZE": int(os.environ.get("VRMS_DB_REPLICA_POOL_SIZE", "5")),
+    "DB_PIN_SECONDS": float(os.environ.get("VRMS_DB_PIN_SECONDS", "5")),
+    "DB_REPLICA_CHECK_INTERVAL": 5.0,   # seconds between health checks
+    "DB_REPLICA_MAX_LAG": 30.0,         # seconds behind the primary (MySQL)
+    # shards 1, 2, ... for the branches' data (see shards.py), given like
+    # DB_REPLICAS; shard 0 is the database above
+    "DB_SHARDS": [s for s in os.environ.get("VRMS_DB_SHARDS", "").split(",") if s],
+    "DB_SHARD_POOL_SIZE": int(os.environ.get("VRMS_DB_SHARD_POOL_SIZE", "5")),
+}
+
+logger = logging.getLogger("vrms.db")
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# ---------- CONNECTION POOL ----------
+
+class ConnectionPool:
+    # keeps up to `size` idle connections around; under load it opens up to
+    # `max_overflow` extra ones which are closed again when they come back.
+    # acquire() blocks for at most `timeout` seconds when everything is busy.
+
+    def __init__(self, connect, size=5, max_overflow=10, timeout=10.0,
+                 idle_timeout=300.0, ping=True):
+        self._connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.ping = ping
+
+        self._cond = threading.Condition()
+        self._idle = collections.deque()   # (connection, time it was returned)
+        self._opened = 0
+        self._in_use = 0
+
+        # counters for stats()
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._ping_failures = 0
+        self._closed_idle = 0
+
+    def acquire(self):
+        conn = None
+        started = None
+        with self._cond:
+            while True:
+                self._prune_idle()
+                if self._idle:
+                    conn, _ = self._idle.pop()   # newest first, keeps a warm core
+                    break
+                if self._opened < self.size + self.max_overflow:
+                    self._opened += 1
+                    break
+                # everything is checked out: wait for a release
+                now = time.monotonic()
+                if started is None:
+                    started = now
+                    self._waits += 1
+                remaining = self.timeout - (now - started)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        "no database connection available after %.1fs" % self.timeout)
+                self._cond.wait(remaining)
+
+            self._in_use += 1
+            self._checkouts += 1
+            if started is not None:
+                waited = time.monotonic() - started
+                self._wait_time += waited
+                self._max_wait = max(self._max_wait, waited)
+
+        try:
+            if conn is not None and self.ping and not self._is_alive(conn):
+                with self._cond:
+                    self._ping_failures += 1
+                self._close_quietly(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            # connecting failed: give the slot back so others can try
+            with self._cond:
+                self._opened -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def release(self, conn, discard=False):
+        if not discard:
+            # never hand an open transaction to the next request
+            try:
+                conn.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+            self._in_use -= 1
+            if discard or len(self._idle) >= self.size:
+                self._opened -= 1
+                to_close = conn
+            else:
+                self._idle.append((conn, time.monotonic()))
+                to_close = None
+            self._cond.notify()
+
+        if to_close is not None:
+            self._close_quietly(to_close)
+
+    def close(self):
+        with self._cond:
+            idle = [c for c, _ in self._idle]
+            self._idle.clear()
+            self._opened -= len(idle)
+        for conn in idle:
+            self._close_quietly(conn)
+
+    def prune(self):
+        # closes the connections idle for longer than idle_timeout now
+        # rather than at the next acquire(); how many
+        with self._cond:
+            before = self._closed_idle
+            self._prune_idle()
+            return self._closed_idle - before
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "max_overflow": self.max_overflow,
+                "opened": self._opened,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_time_total": round(self._wait_time, 6),
+                "wait_time_max": round(self._max_wait, 6),
+                "timeouts": self._timeouts,
+                "ping_failures": self._ping_failures,
+                "closed_idle": self._closed_idle,
+            }
+
+    def _prune_idle(self):
+        # oldest idle connections sit on the left; called with the lock held
+        if self.idle_timeout is None:
+            return
+        cutoff = time.monotonic() - self.idle_timeout
+        while self._idle and self._idle[0][1] < cutoff:
+            conn, _ = self._idle.popleft()
+            self._opened -= 1
+            self._closed_idle += 1
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            conn.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+# ---------- BACKENDS ----------
+
+def connect_factory(config):
+    # returns a zero-argument callable that opens one raw connection
+    if config["DB_BACKEND"] == "sqlite":
+        import sqlite_compat
+        path = config["SQLITE_PATH"]
+        return lambda: sqlite_compat.connect(path)
+
+    import mysql.connector as mc
+    params = {
+        "host": config["MYSQL_HOST"],
+        "user": config["MYSQL_USER"],
+        "password": config["MYSQL_PASSWORD"],
+        "database": config["MYSQL_DATABASE"],
+    }
+    return lambda: mc.connect(**params)
+
+
+# ---------- READ REPLICAS ----------
+# Views decorated with read_only() send their queries to a read replica,
+# round robin over the healthy ones; everything else -- every write, and
+# any view not marked -- stays on the primary. A logged-in user who just
+# made a request on the primary is pinned to it for DB_PIN_SECONDS (a
+# timestamp in their session, so it holds whichever worker or host serves
+# them next): their next pages can't miss what they just booked because a
+# replica hasn't caught up.
+#
+# A health check every DB_REPLICA_CHECK_INTERVAL seconds takes a replica
+# out of rotation while it can't be reached, fails a query, or (MySQL)
+# lags more than DB_REPLICA_MAX_LAG seconds, and back in once it passes; a
+# replica whose connection fails mid-request is taken out at once and the
+# request falls back to the primary. The in-process caches (search.py,
+# reservations.py, users.py, pricing.py) always load from the primary
+# (primary() / primary_db()) -- a copy of a lagging replica would outlive
+# the lag.
+
+_route_to_replica = contextvars.ContextVar("vrms_db_replica", default=False)
+
+# replica lag; NULL when it isn't replicating (then it counts as current)
+LAG_QUERIES = {"mysql": "SHOW REPLICA STATUS"}
+HEALTH_QUERY = "SELECT 1 FROM Role LIMIT 1"
+
+
+class Replica:
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = True
+        self.lag = None
+        self.error = None
+        self.checked_at = None
+        self.failures = 0
+        self.reads = 0
+
+
+class ReplicaRouter:
+
+    def __init__(self, replicas, backend="sqlite", interval=5.0, max_lag=30.0):
+        self.replicas = replicas
+        self.backend = backend
+        self.interval = interval
+        self.max_lag = max_lag
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._next = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.primary_reads = 0      # read-only requests that stayed on the primary
+        self.pinned = 0
+        self.fallbacks = 0
+
+    def start(self):
+        if self._thread is not None or not self.interval:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="vrms-replicas",
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        for replica in self.replicas:
+            replica.pool.close()
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def check(self):
+        # runs the health check on every replica now
+        for replica in self.replicas:
+            ok, lag, error = self._probe(replica)
+            with self._lock:
+                if ok and not replica.healthy:
+                    logger.warning("replica %s is back in rotation", replica.name)
+                elif not ok and replica.healthy:
+                    logger.warning("replica %s out of rotation: %s", replica.name, error)
+                replica.healthy, replica.lag, replica.error = ok, lag, error
+                replica.checked_at = time.time()
+                replica.failures += not ok
+
+    def _probe(self, replica):
+        # (healthy, lag in seconds, why not)
+        try:
+            conn = replica.pool.acquire()
+        except Exception as e:
+            return False, None, "%s: %s" % (type(e).__name__, e)
+        discard = False
+        try:
+            cur = conn.cursor(dictionary=True)
+            cur.execute(HEALTH_QUERY)
+            cur.fetchall()
+            lag = None
+            if self.backend in LAG_QUERIES:
+                cur.execute(LAG_QUERIES[self.backend])
+                status = cur.fetchone() or {}
+                cur.fetchall()
+                lag = status.get("Seconds_Behind_Source")
+            cur.close()
+        except Exception as e:
+            discard = True
+            return False, None, "%s: %s" % (type(e).__name__, e)
+        finally:
+            replica.pool.release(conn, discard=discard)
+        if lag is not None and lag > self.max_lag:
+            return False, lag, "%ss behind the primary" % lag
+        return True, lag, None
+
+    def choose(self):
+        # the next healthy replica, or None
+        with self._lock:
+            for i in range(len(self.replicas)):
+                replica = self.replicas[(self._next + i) % len(self.replicas)]
+                if replica.healthy:
+                    self._next = (self._next + i + 1) % len(self.replicas)
+                    replica.reads += 1
+                    return replica
+            self.primary_reads += 1
+            return None
+
+    def failed(self, replica, error):
+        with self._lock:
+            if replica.healthy:
+                logger.warning("replica %s out of rotation: %s", replica.name, error)
+            replica.healthy = False
+            replica.error = "%s: %s" % (type(error).__name__, error)
+            replica.failures += 1
+            self.fallbacks += 1
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "primary_reads": self.primary_reads,
+                "pinned": self.pinned,
+                "fallbacks": self.fallbacks,
+                "replicas": [{
+                    "name": r.name, "healthy": r.healthy, "lag": r.lag, "error": r.error,
+                    "checked_at": r.checked_at, "failures": r.failures, "reads": r.reads,
+                    "pool": r.pool.stats()} for r in self.replicas],
+            }
+
+
+def _pinned():
+    return session.get("db_pinned_until", 0) > time.time()
+
+
+def read_only(view):
+    # marks a view that never writes: its queries may go to a replica
+    # (unless the user is pinned to the primary)
+    def route():
+        if get_router() is None:
+            return False
+        if _pinned():
+            get_router().count("pinned")
+            return False
+        return True
+
+    if inspect.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            token = _route_to_replica.set(route())
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                _route_to_replica.reset(token)
+    else:
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            token = _route_to_replica.set(route())
+            try:
+                return view(*args, **kwargs)
+            finally:
+                _route_to_replica.reset(token)
+    wrapper.read_only = True
+    return wrapper
+
+
+@contextlib.contextmanager
+def primary():
+    # the queries made inside go to the primary even in a read_only view
+    token = _route_to_replica.set(False)
+    try:
+        yield
+    finally:
+        _route_to_replica.reset(token)
+
+
+class _PrimaryConnection:
+    # stands in for the primary's connection until a cursor is needed
+    def cursor(self, *args, **kwargs):
+        with primary():
+            return get_db().cursor(*args, **kwargs)
+
+
+_PRIMARY = _PrimaryConnection()
+
+
+def primary_db():
+    # a connection for loading an in-process cache: the request's own,
+    # unless it reads from a replica -- then the primary's, acquired only
+    # if the cache actually loads
+    return _PRIMARY if _route_to_replica.get() else get_db()
+
+
+def _pin_after_write(response):
+    # a logged-in user's request that used the primary outside a read_only
+    # view (a write, or a view nobody marked) pins them to it for a while
+    view = current_app.view_functions.get(request.endpoint)
+    if ("db" in g and "user_id" in session and not getattr(view, "read_only", False)
+            and get_router() is not None):
+        session["db_pinned_until"] = time.time() + current_app.config["DB_PIN_SECONDS"]
+    return response
+
+
+# ---------- SHARDS ----------
+# With DB_SHARDS each branch's vehicles, rentals and payments live in one
+# of several databases (shards.py decides which). get_db() inside
+# on_shard(n) hands out the request's connection to shard n -- one per
+# shard per request, all returned in close_db(). Shard 0 is the main
+# database and the only one with read replicas; the others are always
+# read on their primary.
+
+_shard = contextvars.ContextVar("vrms_db_shard", default=0)
+
+
+@contextlib.contextmanager
+def on_shard(shard):
+    # the queries made inside go to shard `shard`
+    token = _shard.set(shard)
+    try:
+        yield
+    finally:
+        _shard.reset(token)
+
+
+def current_shard():
+    return _shard.get()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.teardown_appcontext(close_db)
+    app.after_request(_pin_after_write)
+
+
+def get_pool(app=None):
+    app = app or current_app
+    pool = app.extensions.get("vrms_pool")
+    if pool is None:
+        with _pool_lock:
+            pool = app.extensions.get("vrms_pool")
+            if pool is None:
+                cfg = app.config
+                connect = connect_factory(cfg)
+                if cfg.get("METRICS_ENABLED"):
+                    # per-statement timing, see metrics.py
+                    import metrics
+                    connect = metrics.get_metrics(app).instrument(connect)
+                pool = ConnectionPool(
+                    connect,
+                    size=cfg["DB_POOL_SIZE"],
+                    max_overflow=cfg["DB_POOL_MAX_OVERFLOW"],
+                    timeout=cfg["DB_POOL_TIMEOUT"],
+                    idle_timeout=cfg["DB_POOL_IDLE_TIMEOUT"],
+                    ping=cfg["DB_POOL_PING"],
+                )
+                app.extensions["vrms_pool"] = pool
+    return pool
+
+
+_pool_lock = threading.Lock()
+
+
+def _replica_config(cfg, replica):
+    if isinstance(replica, dict):
+        return dict(cfg, **replica)
+    key = "SQLITE_PATH" if cfg["DB_BACKEND"] == "sqlite" else "MYSQL_HOST"
+    return dict(cfg, **{key: replica})
+
+
+def get_router(app=None):
+    # this process's ReplicaRouter (a forked worker gets a new one); None
+    # without DB_REPLICAS
+    app = app or current_app
+    cfg = app.config
+    if not cfg["DB_REPLICAS"] or cfg["DB_BACKEND"] == "memory":
+        return None
+    router = app.extensions.get("vrms_replicas")
+    if router is None or router.pid != os.getpid():
+        with _pool_lock:
+            router = app.extensions.get("vrms_replicas")
+            if router is None or router.pid != os.getpid():
+                replicas = []
+                for replica in cfg["DB_REPLICAS"]:
+                    rcfg = _replica_config(cfg, replica)
+                    connect = connect_factory(rcfg)
+                    if cfg.get("METRICS_ENABLED"):
+                        import metrics
+                        connect = metrics.get_metrics(app).instrument(connect)
+                    name = (rcfg["SQLITE_PATH"] if cfg["DB_BACKEND"] == "sqlite"
+                            else rcfg["MYSQL_HOST"])
+                    replicas.append(Replica(name, ConnectionPool(
+                        connect, size=cfg["DB_REPLICA_POOL_SIZE"],
+                        max_overflow=cfg["DB_POOL_MAX_OVERFLOW"],
+                        timeout=cfg["DB_POOL_TIMEOUT"],
+                        idle_timeout=cfg["DB_POOL_IDLE_TIMEOUT"],
+                        ping=cfg["DB_POOL_PING"])))
+                router = ReplicaRouter(replicas, backend=cfg["DB_BACKEND"],
+                                       interval=cfg["DB_REPLICA_CHECK_INTERVAL"],
+                                       max_lag=cfg["DB_REPLICA_MAX_LAG"])
+                app.extensions["vrms_replicas"] = router
+                router.start()
+    return router
+
+
+def shard_config(cfg, shard):
+    # the connection settings of shard n (1, 2, ...)
+    return _replica_config(cfg, cfg["DB_SHARDS"][shard - 1])
+
+
+def get_shard_pool(shard, app=None):
+    # the pool of shard n; shard 0's is get_pool()
+    app = app or current_app
+    if not shard:
+        return get_pool(app)
+    pools = app.extensions.setdefault("vrms_shard_pools", {})
+    pool = pools.get(shard)
+    if pool is None:
+        with _pool_lock:
+            pool = pools.get(shard)
+            if pool is None:
+                cfg = app.config
+                connect = connect_factory(shard_config(cfg, shard))
+                if cfg.get("METRICS_ENABLED"):
+                    import metrics
+                    connect = metrics.get_metrics(app).instrument(connect)
+                pool = ConnectionPool(
+                    connect, size=cfg["DB_SHARD_POOL_SIZE"],
+                    max_overflow=cfg["DB_POOL_MAX_OVERFLOW"],
+                    timeout=cfg["DB_POOL_TIMEOUT"],
+                    idle_timeout=cfg["DB_POOL_IDLE_TIMEOUT"],
+                    ping=cfg["DB_POOL_PING"])
+                pools[shard] = pool
+    return pool
+
+
+def get_db():
+    # one pooled connection per request (and shard), handed back in
+    # close_db(): a replica's inside a read_only view, the primary's
+    # otherwise
+    shard = _shard.get()
+    if shard:
+        if "db_shards" not in g:
+            g.db_shards = {}
+        cn = g.db_shards.get(shard)
+        if cn is None:
+            cn = g.db_shards[shard] = get_shard_pool(shard).acquire()
+        return cn
+    if _route_to_replica.get():
+        if "db_replica" not in g:
+            router = get_router()
+            replica = router.choose()
+            while replica is not None:
+                try:
+                    g.db_replica = replica.pool.acquire()
+                    g.db_replica_pool = replica.pool
+                    break
+                except Exception as e:
+                    router.failed(replica, e)
+                    replica = router.choose()
+            else:
+                g.db_replica = None         # none healthy: the primary it is
+        if g.db_replica is not None:
+            return g.db_replica
+    if "db" not in g:
+        started = time.perf_counter()
+        g.db = get_pool().acquire()
+        g.db_wait = time.perf_counter() - started
+    return g.db
+
+
+def close_db(exc=None):
+    cn = g.pop("db", None)
+    if cn is not None:
+        get_pool().release(cn)
+    cn = g.pop("db_replica", None)
+    if cn is not None:
+        g.pop("db_replica_pool").release(cn)
+    for shard, cn in g.pop("db_shards", {}).items():
+        get_shard_pool(shard).release(cn)
@@ -0,0 +1,629 @@
+import collections
+import datetime
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+from flask import current_app
+
+try:
+    import fcntl
+except ImportError:     # Windows: one writing process per log directory
+    fcntl = None
+
+# Append-only log of rental state changes, for history and auditing.
+#
+# The repositories record every transition after committing it: a rental
+# booked, reserved, picked up, cancelled or returned, the payment a return
+# takes, a vehicle's status set (added, changed by staff, deleted). The
+# Rental / Vehicle / Payment rows still only hold the current state; the
+# log keeps how they got there, outside the database, so the hot tables
+# take no extra writes.
+#
+# Events are fixed-size 40-byte records (RECORD, with a CRC) in segment
+# files under EVENT_LOG_DIR, 00000000.log, 00000001.log, ... Each
+# repository call appends its events with one write() under an exclusive
+# flock, so app processes sharing the directory never interleave records;
+# a segment past EVENT_LOG_SEGMENT_BYTES is closed by creating the next
+# one. EVENT_LOG_FSYNC is "always" (fsync every append), "interval" (at
+# most every EVENT_LOG_FSYNC_INTERVAL seconds; a process crash loses
+# nothing, a machine crash up to that much) or "never".
+#
+# Read models -- the current fleet status and each user's rental history
+# -- are built by replaying the log (Projector). A position in the log is
+# a (segment, offset) cursor: the projector remembers where it stopped and
+# every read first applies just the events appended since. Every
+# EVENT_LOG_SNAPSHOT_EVERY events it pickles the models with their cursor
+# to snapshot.pickle, so a restarted process replays only what came after.
+#
+# `flask seed-event-log` writes the history already in the tables into an
+# empty log; `flask replay-event-log` rebuilds the read models from it.
+#
+# Benchmark: python3 -m bench.eventlog --events 1000000
+
+DEFAULTS = {
+    "EVENT_LOG_ENABLED": os.environ.get("VRMS_EVENT_LOG", "1") == "1",
+    "EVENT_LOG_DIR": os.environ.get("VRMS_EVENT_LOG_DIR", "events"),
+    "EVENT_LOG_SEGMENT_BYTES": 64 * 1024 * 1024,
+    "EVENT_LOG_FSYNC": os.environ.get("VRMS_EVENT_LOG_FSYNC", "interval"),
+    "EVENT_LOG_FSYNC_INTERVAL": 1.0,
+    "EVENT_LOG_SNAPSHOT_EVERY": 100000,
+}
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+# event kinds
+BOOKED = 1
+RESERVED = 2
+PICKED_UP = 3
+CANCELLED = 4
+RETURNED = 5
+PAYMENT = 6
+STATUS = 7
+
+KIND_NAMES = {BOOKED: "booked", RESERVED: "reserved", PICKED_UP: "picked_up",
+              CANCELLED: "cancelled", RETURNED: "returned", PAYMENT: "payment",
+              STATUS: "status_changed"}
+
+# a record's `code` is the index + 1 into one of these (0: none); they are
+# stored, so only ever append to them
+STATUSES = ("Available", "Rented", "Maintenance", "Deleted")
+PAYMENT_MODES = ("Cash", "Card")
+
+# crc32 of the rest, kind, code, days, time, RentalID, UserID, VehicleID,
+# amount, start date (ordinal)
+RECORD = struct.Struct("<IBBHdIIIdI")
+
+# RECORD as a NumPy dtype, for replaying records in bulk
+DTYPE = np.dtype([("crc", "<u4"), ("kind", "u1"), ("code", "u1"), ("days", "<u2"),
+                  ("at", "<f8"), ("rental_id", "<u4"), ("user_id", "<u4"),
+                  ("vehicle_id", "<u4"), ("amount", "<f8"), ("start", "<u4")])
+RAW = np.dtype((np.void, RECORD.size))
+
+Event = collections.namedtuple(
+    "Event", "kind at rental_id user_id vehicle_id amount start days code")
+
+SEGMENT_SUFFIX = ".log"
+SNAPSHOT = "snapshot.pickle"
+SNAPSHOT_VERSION = 1
+
+
+def pack(kind, rental_id=0, user_id=0, vehicle_id=0, amount=0.0, start=None, days=0,
+         code=0, at=None):
+    body = RECORD.pack(0, kind, code, days, time.time() if at is None else at,
+                       rental_id or 0, user_id or 0, vehicle_id or 0, float(amount or 0),
+                       start.toordinal() if start else 0)[4:]
+    return struct.pack("<I", zlib.crc32(body)) + body
+
+
+def unpack(buf, pos=0):
+    # the Event at buf[pos:], None if its CRC doesn't match
+    crc, kind, code, days, at, rental_id, user_id, vehicle_id, amount, start = \
+        RECORD.unpack_from(buf, pos)
+    if zlib.crc32(buf[pos + 4:pos + RECORD.size]) != crc:
+        return None
+    return Event(kind, at, rental_id, user_id, vehicle_id, amount,
+                 datetime.date.fromordinal(start) if start else None, days, code)
+
+
+def _code(values, value):
+    return values.index(value) + 1 if value in values else 0
+
+
+def describe(event):
+    # an Event as a JSON-friendly dict
+    out = {"event": KIND_NAMES.get(event.kind, str(event.kind)),
+           "at": datetime.datetime.fromtimestamp(event.at).isoformat(timespec="seconds")}
+    for field in ("rental_id", "user_id", "vehicle_id"):
+        if getattr(event, field):
+            out[field] = getattr(event, field)
+    if event.kind in (BOOKED, RESERVED, RETURNED, PAYMENT):
+        out["amount"] = round(event.amount, 2)
+    if event.start and event.kind == RETURNED:
+        out["date"] = event.start.isoformat()
+    elif event.start:
+        out["start"] = event.start.isoformat()
+        out["days"] = event.days
+    if event.code and event.kind == STATUS:
+        out["status"] = STATUSES[event.code - 1]
+    elif event.code and event.kind == PAYMENT:
+        out["payment_mode"] = PAYMENT_MODES[event.code - 1]
+    return out
+
+
+# ---------- RECORDS FOR EACH TRANSITION ----------
+
+def booked(rental_id, user_id, vehicle_id, total, start, days):
+    return pack(BOOKED, rental_id, user_id, vehicle_id, total, start, days)
+
+
+def reserved(rental_id, user_id, vehicle_id, total, start, days):
+    return pack(RESERVED, rental_id, user_id, vehicle_id, total, start, days)
+
+
+def picked_up(rental_id, user_id, vehicle_id):
+    return pack(PICKED_UP, rental_id, user_id, vehicle_id)
+
+
+def cancelled(rental_id, user_id, vehicle_id):
+    return pack(CANCELLED, rental_id, user_id, vehicle_id)
+
+
+def returned(row, payment_mode, day=None):
+    # a return_rentals() row: the return and the payment it took
+    return (pack(RETURNED, row["RentalID"], row["UserID"], row["VehicleID"],
+                 row["TotalAmount"], day)
+            + pack(PAYMENT, row["RentalID"], row["UserID"], row["VehicleID"],
+                   row["TotalAmount"] + (row.get("LateFee") or 0),
+                   code=_code(PAYMENT_MODES, payment_mode)))
+
+
+def status_changed(vehicle_id, status):
+    return pack(STATUS, vehicle_id=vehicle_id, code=_code(STATUSES, status))
+
+
+# ---------- THE LOG ----------
+
+class EventLog:
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync="interval",
+                 fsync_interval=1.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("EVENT_LOG_FSYNC must be one of %s" % ", ".join(FSYNC_POLICIES))
+        self.directory = directory
+        # whole records, so a segment never ends in the middle of one
+        self.segment_bytes = max(RECORD.size, segment_bytes - segment_bytes % RECORD.size)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+        segments = self.segments()
+        self._segment = segments[-1] if segments else 0
+        self._synced_at = time.monotonic()
+
+        self.appends = 0
+        self.events = 0
+        self.fsyncs = 0
+        self.rotations = 0
+        self.repaired = 0
+        self.corrupt = 0
+
+    def path(self, segment):
+        return os.path.join(self.directory, "%08d%s" % (segment, SEGMENT_SUFFIX))
+
+    def segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+    # ---------- writing ----------
+
+    def _open(self):
+        # reopened after a fork: flock() locks belong to the open file,
+        # which a child would share with its parent
+        if self._fd is not None and self._pid != os.getpid():
+            self._fd = None
+        if self._fd is None:
+            self._fd = os.open(self.path(self._segment),
+                               os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def _close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+    def append(self, data):
+        # whole records (see pack()), written in one go
+        if not data:
+            return
+        with self._lock:
+            while True:
+                fd = self._open()
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    if os.path.exists(self.path(self._segment + 1)):
+                        moved = True      # another process started the next segment
+                    else:
+                        moved = self._write(fd, data)
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(fd, fcntl.LOCK_UN)
+                if not moved:
+                    break
+                self._close()
+                self._segment += 1
+            self.appends += 1
+            self.events += len(data) // RECORD.size
+
+    def _write(self, fd, data):
+        # under the flock; True when the segment is full and the next one
+        # has been started instead
+        size = os.fstat(fd).st_size
+        if size % RECORD.size:
+            # the torn tail of a write cut short by a crash
+            os.ftruncate(fd, size - size % RECORD.size)
+            size -= size % RECORD.size
+            self.repaired += 1
+        if size and size + len(data) > self.segment_bytes:
+            os.close(os.open(self.path(self._segment + 1), os.O_WRONLY | os.O_CREAT, 0o644))
+            self.rotations += 1
+            return True
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        if self.fsync == "always" or (self.fsync == "interval" and
+                                      time.monotonic() - self._synced_at >= self.fsync_interval):
+            os.fsync(fd)
+            self._synced_at = time.monotonic()
+            self.fsyncs += 1
+        return False
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None and self.fsync != "never":
+                os.fsync(self._fd)
+            self._close()
+
+    # ---------- reading ----------
+
+    def read_batches(self, cursor=(0, 0), batch=65536):
+        # (cursor after them, records, raw bytes) for up to `batch` complete
+        # records at a time from `cursor` on: `records` a NumPy array of
+        # DTYPE, `raw` the same records as stored. Records that fail their
+        # CRC are left out (counted in .corrupt).
+        segment, offset = cursor
+        segments = self.segments()
+        if segments and segment < segments[0]:
+            segment, offset = segments[0], 0
+        while True:
+            # a segment is complete once the next one exists: check first,
+            # then read to the end
+            sealed = os.path.exists(self.path(segment + 1))
+            try:
+                f = open(self.path(segment), "rb")
+            except FileNotFoundError:
+                return
+            with f:
+                f.seek(offset)
+                while True:
+                    buf = f.read(RECORD.size * batch)
+                    usable = len(buf) - len(buf) % RECORD.size
+                    if usable:
+                        offset += usable
+                        records, raw = self._checked(buf[:usable])
+                        yield (segment, offset), records, raw
+                    if usable < RECORD.size * batch:
+                        break
+            if not sealed:
+                return
+            segment, offset = segment + 1, 0
+
+    def _checked(self, buf):
+        records = np.frombuffer(buf, dtype=DTYPE)
+        view = memoryview(buf)
+        size = RECORD.size
+        crcs = np.fromiter((zlib.crc32(view[pos + 4:pos + size])
+                            for pos in range(0, len(buf), size)),
+                           dtype=np.uint32, count=len(records))
+        good = crcs == records["crc"]
+        if good.all():
+            return records, buf
+        self.corrupt += int((~good).sum())
+        return records[good], np.frombuffer(buf, dtype=RAW)[good].tobytes()
+
+    def read(self, cursor=(0, 0)):
+        # every Event from `cursor` on, one by one
+        for _, _, raw in self.read_batches(cursor):
+            for pos in range(0, len(raw), RECORD.size):
+                yield unpack(raw, pos)
+
+    def end(self):
+        # the cursor after the last complete record
+        segments = self.segments()
+        if not segments:
+            return (0, 0)
+        size = os.path.getsize(self.path(segments[-1]))
+        return (segments[-1], size - size % RECORD.size)
+
+    def stats(self):
+        segments = self.segments()
+        return {
+            "directory": os.path.abspath(self.directory),
+            "segments": len(segments),
+            "bytes": sum(os.path.getsize(self.path(s)) for s in segments),
+            "end": list(self.end()),
+            "fsync": self.fsync,
+            "appends": self.appends,
+            "events_appended": self.events,
+            "fsyncs": self.fsyncs,
+            "rotations": self.rotations,
+            "repaired": self.repaired,
+            "corrupt": self.corrupt,
+        }
+
+
+# ---------- READ MODELS ----------
+
+AVAILABLE, RENTED, DELETED = (STATUSES.index(s) + 1 for s in ("Available", "Rented", "Deleted"))
+
+
+class FleetStatus:
+    # each vehicle's current status as the log has it
+
+    def __init__(self):
+        self.status = {}            # VehicleID -> status code
+        self.changed_at = {}        # VehicleID -> time of the last change
+
+    def apply(self, records, raw):
+        kind = records["kind"]
+        code = np.where((kind == BOOKED) | (kind == PICKED_UP), RENTED,
+                        np.where(kind == RETURNED, AVAILABLE,
+                                 np.where(kind == STATUS, records["code"], 0)))
+        hit = np.flatnonzero(code)
+        if not len(hit):
+            return
+        # only the last change of each vehicle in the batch counts
+        vehicles = records["vehicle_id"][hit][::-1]
+        _, first = np.unique(vehicles, return_index=True)
+        last = hit[::-1][first]
+        for vehicle_id, status, at in zip(records["vehicle_id"][last].tolist(),
+                                          code[last].tolist(), records["at"][last].tolist()):
+            if status == DELETED:
+                self.status.pop(vehicle_id, None)
+                self.changed_at.pop(vehicle_id, None)
+            else:
+                self.status[vehicle_id] = status
+                self.changed_at[vehicle_id] = at
+
+    def get(self, vehicle_id):
+        code = self.status.get(vehicle_id)
+        return STATUSES[code - 1] if code else None
+
+    def counts(self):
+        counts = collections.Counter(self.status.values())
+        return {STATUSES[code - 1]: n for code, n in sorted(counts.items())}
+
+
+class UserHistory:
+    # the records of each user's rentals, oldest first, as stored (a
+    # bytearray per user: compact, and quick to snapshot)
+
+    def __init__(self):
+        self.rentals = {}           # RentalID -> UserID
+        self.events = {}            # UserID -> bytearray of records
+
+    def apply(self, records, raw):
+        kind = records["kind"]
+        opened = np.flatnonzero((kind == BOOKED) | (kind == RESERVED))
+        self.rentals.update(zip(records["rental_id"][opened].tolist(),
+                                records["user_id"][opened].tolist()))
+        users = records["user_id"].copy()
+        # e.g. a cancellation made without the user (by an admin): the
+        # user who booked it
+        for i in np.flatnonzero((users == 0) & (records["rental_id"] != 0)).tolist():
+            users[i] = self.rentals.get(int(records["rental_id"][i]), 0)
+        keep = np.flatnonzero(users)
+        order = keep[np.argsort(users[keep], kind="stable")]
+        if not len(order):
+            return
+        ordered = np.frombuffer(raw, dtype=RAW)[order]
+        ids, starts = np.unique(users[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        events = self.events
+        for user_id, lo, hi in zip(ids.tolist(), starts.tolist(), ends.tolist()):
+            chunk = ordered[lo:hi].tobytes()
+            if user_id in events:
+                events[user_id] += chunk
+            else:
+                events[user_id] = bytearray(chunk)
+
+    def for_user(self, user_id, limit=None):
+        raw = self.events.get(user_id, b"")
+        first = max(0, len(raw) // RECORD.size - limit) if limit else 0
+        return [unpack(raw, pos)._replace(user_id=user_id)
+                for pos in range(first * RECORD.size, len(raw), RECORD.size)]
+
+
+class Projector:
+    # the read models, kept up to date by replaying the log
+
+    def __init__(self, log, snapshot_every=100000):
+        self.log = log
+        self.snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self.models = None
+        self.cursor = (0, 0)
+        self._since_snapshot = 0
+
+        self.applied = 0
+        self.restored_from = None
+        self.snapshots = 0
+        self.last_catch_up = 0.0
+
+    def _fresh(self):
+        return {"fleet": FleetStatus(), "history": UserHistory()}
+
+    def _snapshot_path(self):
+        return os.path.join(self.log.directory, SNAPSHOT)
+
+    def _restore(self):
+        try:
+            with open(self._snapshot_path(), "rb") as f:
+                saved = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            saved = None
+        if saved and saved.get("version") == SNAPSHOT_VERSION:
+            self.models, self.cursor = saved["models"], tuple(saved["cursor"])
+            self.restored_from = self.cursor
+        else:
+            self.models, self.cursor = self._fresh(), (0, 0)
+
+    def snapshot(self):
+        # write the models and their cursor out, unless a snapshot at least
+        # as far along is already there (another process may have made it)
+        with self._lock:
+            self._catch_up()
+            path = self._snapshot_path()
+            try:
+                with open(path, "rb") as f:
+                    if tuple(pickle.load(f)["cursor"]) >= self.cursor:
+                        return False
+            except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+                pass
+            tmp = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp, "wb") as f:
+                pickle.dump({"version": SNAPSHOT_VERSION, "cursor": self.cursor,
+                             "models": self.models}, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            self._since_snapshot = 0
+            self.snapshots += 1
+            return True
+
+    def _catch_up(self):
+        if self.models is None:
+            self._restore()
+        t0 = time.perf_counter()
+        models = list(self.models.values())
+        n = 0
+        for cursor, records, raw in self.log.read_batches(self.cursor):
+            for model in models:
+                model.apply(records, raw)
+            self.cursor = cursor
+            n += len(records)
+        self.applied += n
+        self._since_snapshot += n
+        self.last_catch_up = time.perf_counter() - t0
+        return n
+
+    def catch_up(self):
+        # apply what was appended since the last call; how many events
+        with self._lock:
+            n = self._catch_up()
+            due = self.snapshot_every and self._since_snapshot >= self.snapshot_every
+        if due:
+            self.snapshot()
+        return n
+
+    def view(self, fn):
+        # fn({"fleet": FleetStatus, "history": UserHistory}) on the caught-up
+        # models, with no event applied meanwhile
+        self.catch_up()
+        with self._lock:
+            return fn(self.models)
+
+    def rebuild(self):
+        # replay the whole log from the start, ignoring the snapshot
+        with self._lock:
+            self.models, self.cursor = self._fresh(), (0, 0)
+            self.restored_from = None
+            return self._catch_up()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "cursor": list(self.cursor),
+                "applied": self.applied,
+                "restored_from": list(self.restored_from) if self.restored_from else None,
+                "snapshots": self.snapshots,
+                "since_snapshot": self._since_snapshot,
+                "last_catch_up_ms": round(self.last_catch_up * 1000.0, 3),
+            }
+
+
+_log_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def get_log(app=None):
+    # None with EVENT_LOG_ENABLED off
+    app = app or current_app
+    if not app.config["EVENT_LOG_ENABLED"]:
+        return None
+    log = app.extensions.get("vrms_eventlog")
+    if log is None:
+        with _log_lock:
+            log = app.extensions.get("vrms_eventlog")
+            if log is None:
+                cfg = app.config
+                log = EventLog(cfg["EVENT_LOG_DIR"], segment_bytes=cfg["EVENT_LOG_SEGMENT_BYTES"],
+                               fsync=cfg["EVENT_LOG_FSYNC"],
+                               fsync_interval=cfg["EVENT_LOG_FSYNC_INTERVAL"])
+                app.extensions["vrms_eventlog"] = log
+    return log
+
+
+def get_projector(app=None):
+    # None with EVENT_LOG_ENABLED off
+    app = app or current_app
+    log = get_log(app)
+    if log is None:
+        return None
+    projector = app.extensions.get("vrms_eventlog_projector")
+    if projector is None:
+        with _log_lock:
+            projector = app.extensions.get("vrms_eventlog_projector")
+            if projector is None:
+                projector = Projector(log, app.config["EVENT_LOG_SNAPSHOT_EVERY"])
+                app.extensions["vrms_eventlog_projector"] = projector
+    return projector
+
+
+def append(*records):
+    # after committing the transitions these records describe
+    log = get_log()
+    if log is not None:
+        log.append(b"".join(records))
+
+
+def _history(store):
+    def at(day):
+        return time.mktime(day.timetuple()) if day else time.time()
+
+    for row in store.rentals.stream():
+        start, end = row["RentalDate"], row["ReturnDate"]
+        days = max(1, (end - start).days) if start and end else 1
+        kind = RESERVED if row["Status"] in ("Reserved", "Cancelled") else BOOKED
+        yield pack(kind, row["RentalID"], row["UserID"], row["VehicleID"],
+                   row["TotalAmount"], start, days, at=at(start))
+        if row["Status"] == "Completed":
+            yield pack(RETURNED, row["RentalID"], row["UserID"], row["VehicleID"],
+                       row["TotalAmount"], end, at=at(end))
+        elif row["Status"] == "Cancelled":
+            yield pack(CANCELLED, row["RentalID"], row["UserID"], row["VehicleID"],
+                       at=at(start))
+    for row in store.payments.stream():
+        yield pack(PAYMENT, row["RentalID"], amount=row["Amount"],
+                   code=_code(PAYMENT_MODES, row["PaymentMode"]), at=at(row["PaymentDate"]))
+    for row in store.vehicles.stream():
+        yield status_changed(row["VehicleID"], row["Status"])
+
+
+def seed(store, log, batch=4096):
+    # the history already in the tables, into an empty log: each rental's
+    # booking (or reservation), return or cancellation, each payment, then
+    # every vehicle's current status. Times are the rows' dates; returns
+    # the number of events written.
+    count = 0
+    records = []
+    for record in _history(store):
+        records.append(record)
+        if len(records) == batch:
+            log.append(b"".join(records))
+            count += len(records)
+            records = []
+    log.append(b"".join(records))
+    return count + len(records)
@@ -0,0 +1,624 @@
+import bisect
+import collections
+import decimal
+import re
+
+import numpy as np
+
+# Column store of the fleet: one slot per vehicle in parallel NumPy arrays
+# (VehicleID, type code, model code, price in cents, status code,
+# BranchID, rental count) plus the registration numbers, instead of a dict
+# per vehicle. VehicleType and Model are dictionary-encoded: each distinct
+# string is stored once, in a Vocabulary that also finds the strings
+# matching a search term, so a type/model filter becomes a lookup table
+# over the codes. Status, type, model, max-price, branch and keyset
+# (VehicleID > after) filters are evaluated as boolean masks over the
+# columns, a chunk at a time so a page stops scanning once it is full;
+# rows (dicts) are only built for what is returned.
+#
+# A term matches the values containing it, as LIKE '%term%' does; when
+# none does, it matches the values within a few typos of it instead
+# ("Corola" finds Corolla), by how many trigrams their words have in
+# common (2 x shared / all of both). rank() orders the matches by that relevance, the vehicles'
+# rental counts and their price; each Vocabulary's PrefixTrie completes
+# what is typed into a filter box.
+#
+# Slots are ordered by VehicleID (new IDs only ever grow and are
+# appended). A deleted vehicle's slot is marked DELETED and reclaimed by
+# the next compaction. Not thread-safe: search.VehicleSearchIndex, which
+# owns one, serializes access.
+#
+# About 29 bytes per vehicle in the arrays, plus its registration number
+# string. Benchmarks: python3 -m bench.fleet --vehicles 1000000,
+# python3 -m bench.vehicle_search --vehicles 1000000
+
+STATUSES = ("Available", "Rented", "Maintenance")
+DELETED = 255               # status code of a free slot
+
+# column -> dtype; price is in cents
+COLUMNS = (("ids", np.int32), ("type", np.int32), ("model", np.int32), ("price", np.int64),
+           ("status", np.uint8), ("branch", np.int32), ("rentals", np.int32))
+
+CHUNK = 65536               # slots per mask when a page can stop early
+
+MIN_SIMILARITY = 0.3        # of a typo'd term's words to a value's, 0..1 (pg_trgm's)
+MIN_PREFIX_SHARE = 0.6      # of a typo'd prefix's trigrams a word must have
+
+# relevance of a value's word to a term's word it equals / starts with /
+# contains; a word only similar to it scores its trigram similarity
+EQUAL, PREFIX, INFIX = 1.0, 0.9, 0.8
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokens(text):
+    return _TOKEN.findall((text or "").lower())
+
+
+def trigrams(token, end=True):
+    # the token's trigrams, padded at the start with two blanks and at the
+    # end with one (as pg_trgm does): "ab" -> "  a", " ab", "ab "; without
+    # the end's for a word still being typed
+    padded = "  " + token + (" " if end else "")
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def cents(price):
+    # DECIMAL(10,2) value (Decimal, float, int or str) -> whole cents;
+    # exact in a double for every value the column can hold
+    return int(round(float(price) * 100))
+
+
+class PrefixTrie:
+    # words -> codes of the values they come from; every node keeps the
+    # codes of all the words below it, so completing a prefix is one walk
+    # down it. A node is a dict of its children by character, with its
+    # codes under the key None.
+
+    def __init__(self):
+        self.root = {}
+        self.nodes = 1
+
+    def insert(self, word, code):
+        node = self.root
+        for ch in word:
+            child = node.get(ch)
+            if child is None:
+                child = node[ch] = {None: set()}
+                self.nodes += 1
+            child[None].add(code)
+            node = child
+
+    def codes(self, prefix):
+        # codes of the values with a word starting with `prefix`
+        node = self.root
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return set()
+        return node.get(None, set())
+
+
+class Vocabulary:
+    # the distinct values of one text column, coded 0..n-1 in order of
+    # first appearance. Every suffix of every word of a value is a key,
+    # so a sorted key list + bisect finds the words containing a term;
+    # the words' trigrams find those similar to it, and the words and
+    # whole values go into a PrefixTrie for completion.
+
+    def __init__(self):
+        self.values = []
+        self.trie = PrefixTrie()
+        self._codes = {}
+        self._words = []                    # code -> the value's words
+        self._word_codes = {}               # word -> set(code)
+        self._postings = {}                 # suffix -> set(word)
+        self._keys = None                   # sorted suffixes (lazy)
+        self._grams = {}                    # trigram -> set(word)
+        self._gram_counts = {}              # word -> trigrams in it
+        self._scores = {}                   # (term, min_similarity) -> scores()
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+            words = tokens(value)
+            self._words.append(words)
+            for word in words:
+                codes = self._word_codes.get(word)
+                if codes is None:
+                    codes = self._word_codes[word] = set()
+                    self._add_word(word)
+                codes.add(code)
+                self.trie.insert(word, code)
+            if len(words) > 1:
+                self.trie.insert(" ".join(words), code)
+            self._scores.clear()
+        return code
+
+    def _add_word(self, word):
+        for i in range(len(word)):
+            words = self._postings.get(word[i:])
+            if words is None:
+                words = self._postings[word[i:]] = set()
+                self._keys = None
+            words.add(word)
+        grams = trigrams(word)
+        self._gram_counts[word] = len(grams)
+        for gram in grams:
+            self._grams.setdefault(gram, set()).add(word)
+
+    def _words_containing(self, tok):
+        keys = self._keys
+        if keys is None:
+            keys = self._keys = sorted(self._postings)
+        out = set()
+        i = bisect.bisect_left(keys, tok)
+        while i < len(keys) and keys[i].startswith(tok):
+            out |= self._postings[keys[i]]
+            i += 1
+        return out
+
+    def _containing(self, tok):
+        out = set()
+        for word in self._words_containing(tok):
+            out |= self._word_codes[word]
+        return out
+
+    def matching(self, term):
+        # codes of the values containing `term`, case-insensitively -- the
+        # same values LIKE '%term%' matches
+        needle = term.lower()
+        toks = tokens(needle)
+        if toks:
+            codes = None
+            for tok in toks:
+                found = self._containing(tok)
+                codes = found if codes is None else codes & found
+                if not codes:
+                    return []
+        else:
+            codes = range(len(self.values))
+        return [c for c in codes if needle in self.values[c].lower()]
+
+    def _similar_words(self, tok, min_similarity):
+        # {word: relevance} of the words containing `tok` or similar to it
+        out = {}
+        for word in self._words_containing(tok):
+            out[word] = EQUAL if word == tok else PREFIX if word.startswith(tok) else INFIX
+        grams = trigrams(tok)
+        for word, n in self._sharing(grams).items():
+            if word not in out:
+                similarity = 2.0 * n / (len(grams) + self._gram_counts[word])
+                if similarity >= min_similarity:
+                    out[word] = similarity
+        return out
+
+    def _sharing(self, grams):
+        # {word: how many of `grams` it has}
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self._grams.get(gram, ()))
+        return shared
+
+    def _completing_words(self, tok):
+        # {word: share} of the words that look like they start with a
+        # typo'd `tok`: they have that share of its trigrams (bar the end's)
+        grams = trigrams(tok, end=False)
+        return {word: n / float(len(grams)) for word, n in self._sharing(grams).items()
+                if n >= MIN_PREFIX_SHARE * len(grams)}
+
+    def scores(self, term, min_similarity=MIN_SIMILARITY):
+        # {code: relevance 0..1} of the values `term` matches: the values
+        # containing it (all of them, as matching() finds) or, if there
+        # are none, the values whose words are similar enough to its
+        # words. A value's relevance is the mean over the term's words of
+        # the best match among the value's words.
+        key = (term.lower(), min_similarity)
+        scores = self._scores.get(key)
+        if scores is not None:
+            return scores
+        toks = tokens(term)
+        exact = self.matching(term)
+        if not toks:
+            scores = dict.fromkeys(exact, EQUAL)
+        else:
+            best = collections.defaultdict(lambda: [0.0] * len(toks))
+            for t, tok in enumerate(toks):
+                for word, score in self._similar_words(tok, min_similarity).items():
+                    for code in self._word_codes[word]:
+                        if best[code][t] < score:
+                            best[code][t] = score
+            if exact:
+                scores = {code: sum(best[code]) / len(toks) for code in exact}
+            else:
+                scores = {code: sum(per) / len(toks) for code, per in best.items()}
+                scores = {code: score for code, score in scores.items()
+                          if score >= min_similarity}
+        if len(self._scores) >= 1024:
+            self._scores.clear()
+        self._scores[key] = scores
+        return scores
+
+    def relevance_table(self, term, min_similarity=MIN_SIMILARITY):
+        # relevance (float32) indexed by code, 0 where `term` doesn't
+        # match; None when it matches nothing
+        scores = self.scores(term, min_similarity)
+        if not scores:
+            return None
+        table = np.zeros(len(self.values), dtype=np.float32)
+        table[list(scores)] = list(scores.values())
+        return table
+
+    def lookup_table(self, term, min_similarity=MIN_SIMILARITY):
+        # boolean array indexed by code, or None when nothing matches
+        scores = self.scores(term, min_similarity)
+        if not scores:
+            return None
+        table = np.zeros(len(self.values), dtype=bool)
+        table[list(scores)] = True
+        return table
+
+    def complete(self, prefix, weights, limit=10, min_similarity=MIN_SIMILARITY):
+        # up to `limit` values with a word (or words) starting with
+        # `prefix`, heaviest first (weights: array by code; values
+        # weighing 0 are left out). Failing that, the values similar to it
+        # (scores()) or with a word that looks like a typo'd start of its
+        # last word, closest first.
+        words = tokens(prefix)
+        if not words:
+            return []
+        codes = self.trie.codes(" ".join(words))
+        if codes:
+            ranked = sorted(codes, key=lambda c: (-weights[c], self.values[c]))
+        else:
+            share = {}
+            for word, n in self._completing_words(words[-1]).items():
+                for code in self._word_codes[word]:
+                    share[code] = max(share.get(code, 0.0), n)
+            if len(words) > 1:
+                others = self.scores(" ".join(words[:-1]), min_similarity)
+                share = {code: n for code, n in share.items() if code in others}
+            for code, score in self.scores(prefix, min_similarity).items():
+                share[code] = max(share.get(code, 0.0), score)
+            ranked = sorted(share, key=lambda c: (-share[c], -weights[c], self.values[c]))
+        return [self.values[c] for c in ranked if weights[c] > 0][:limit]
+
+    def nbytes(self):
+        return sum(len(v) for v in self.values)
+
+
+class FleetState:
+
+    def __init__(self, capacity=1024, min_similarity=MIN_SIMILARITY):
+        capacity = max(1, capacity)
+        self.min_similarity = min_similarity
+        self.size = 0                       # slots in use (live or DELETED)
+        self.deleted = 0
+        self.types = Vocabulary()
+        self.models = Vocabulary()
+        self.statuses = list(STATUSES)      # code -> Status; others are added as seen
+        self.regnos = []
+        self._weights = {}                  # weights() by column, kept up to date
+        for name, dtype in COLUMNS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.status[:] = DELETED
+
+    def _grow(self):
+        capacity = len(self.ids) * 2
+        for name, dtype in COLUMNS:
+            column = np.zeros(capacity, dtype=dtype)
+            column[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, column)
+        self.status[self.size:] = DELETED
+
+    # ---------- writes ----------
+
+    def _status_code(self, status):
+        try:
+            return self.statuses.index(status)
+        except ValueError:
+            self.statuses.append(status)
+            return len(self.statuses) - 1
+
+    def _key(self, vehicle_id):
+        return self.ids.dtype.type(vehicle_id)
+
+    def _slot(self, vehicle_id):
+        # slot holding `vehicle_id` (live or not), or None
+        # (the key in the column's dtype, or NumPy converts the whole column)
+        i = int(np.searchsorted(self.ids[:self.size], self._key(vehicle_id)))
+        if i < self.size and self.ids[i] == vehicle_id:
+            return i
+        return None
+
+    def _set(self, i, row):
+        self._weights.clear()
+        self.type[i] = self.types.code(row["VehicleType"])
+        self.model[i] = self.models.code(row["Model"])
+        self.price[i] = cents(row["RentalPrice"])
+        self.status[i] = self._status_code(row["Status"])
+        self.branch[i] = row["BranchID"]
+        self.regnos[i] = row["RegistrationNumber"]
+
+    def put(self, row):
+        # add or replace one vehicle (a search.COLUMNS row)
+        vehicle_id = int(row["VehicleID"])
+        i = self._slot(vehicle_id)
+        if i is not None:
+            if self.status[i] == DELETED:
+                self.deleted -= 1
+        else:
+            if self.size == len(self.ids):
+                self._grow()
+            i = self.size
+            if self.size and vehicle_id < self.ids[self.size - 1]:
+                # an ID below the newest one (added by another process
+                # before a later one we saw): shift the tail up
+                i = int(np.searchsorted(self.ids[:self.size], self._key(vehicle_id)))
+                for name, _ in COLUMNS:
+                    column = getattr(self, name)
+                    column[i + 1:self.size + 1] = column[i:self.size].copy()
+                self.regnos.insert(i, None)
+            else:
+                self.regnos.append(None)
+            self.ids[i] = vehicle_id
+            self.rentals[i] = 0
+            self.size += 1
+        self._set(i, row)
+
+    def extend(self, rows):
+        # many vehicles at once, as loaded in bulk: new IDs in ascending
+        # order are written with one array assignment per column
+        rows = list(rows)
+        if not rows:
+            return
+        ids = np.fromiter((row["VehicleID"] for row in rows), dtype=np.int64, count=len(rows))
+        if ((self.size and ids[0] <= self.ids[self.size - 1])
+                or (len(ids) > 1 and not (np.diff(ids) > 0).all())):
+            for row in rows:
+                self.put(row)
+            return
+        while self.size + len(rows) > len(self.ids):
+            self._grow()
+        new = slice(self.size, self.size + len(rows))
+        self.ids[new] = ids
+        self.type[new] = [self.types.code(row["VehicleType"]) for row in rows]
+        self.model[new] = [self.models.code(row["Model"]) for row in rows]
+        self.price[new] = [cents(row["RentalPrice"]) for row in rows]
+        self.status[new] = [self._status_code(row["Status"]) for row in rows]
+        self.branch[new] = [row["BranchID"] for row in rows]
+        self.rentals[new] = 0
+        self._weights.clear()
+        self.regnos.extend(row["RegistrationNumber"] for row in rows)
+        self.size += len(rows)
+
+    def set_status(self, vehicle_id, status):
+        # False if the vehicle isn't here
+        i = self._slot(vehicle_id)
+        if i is None or self.status[i] == DELETED:
+            return False
+        self.status[i] = self._status_code(status)
+        return True
+
+    def add_rentals(self, vehicle_id, n=1):
+        # a vehicle's rental count (popularity) moves by n
+        i = self._slot(vehicle_id)
+        if i is not None and self.status[i] != DELETED:
+            before = int(self.rentals[i])
+            self.rentals[i] = max(0, before + n)
+            self._weigh(i, int(self.rentals[i]) - before)
+
+    def set_rentals(self, ids, counts):
+        # rental counts of many vehicles (sorted VehicleIDs) at once
+        ids = np.asarray(ids, dtype=self.ids.dtype)
+        slots = np.searchsorted(self.ids[:self.size], ids)
+        ok = slots < self.size
+        ok[ok] = self.ids[slots[ok]] == ids[ok]
+        self.rentals[slots[ok]] = np.asarray(counts)[ok]
+        self._weights.clear()
+
+    def _weigh(self, i, delta):
+        # slot i's weight changed by delta
+        for column, weights in self._weights.items():
+            weights[getattr(self, column)[i]] += delta
+
+    def discard(self, vehicle_id):
+        i = self._slot(vehicle_id)
+        if i is None or self.status[i] == DELETED:
+            return
+        self._weigh(i, -1 - int(self.rentals[i]))
+        self.status[i] = DELETED
+        self.regnos[i] = None
+        self.deleted += 1
+        if self.deleted > 1024 and self.deleted * 4 > self.size:
+            self.compact()
+
+    def compact(self):
+        # drops the DELETED slots
+        keep = np.flatnonzero(self.status[:self.size] != DELETED)
+        for name, _ in COLUMNS:
+            column = getattr(self, name)
+            column[:len(keep)] = column[keep]
+        self.status[len(keep):self.size] = DELETED
+        self.regnos = [self.regnos[i] for i in keep]
+        self.size = len(keep)
+        self.deleted = 0
+
+    # ---------- queries ----------
+
+    def _mask(self, lo, hi, status, type_table, model_table, max_cents, branch):
+        if status is None:
+            mask = self.status[lo:hi] != DELETED
+        else:
+            mask = self.status[lo:hi] == status
+        if type_table is not None:
+            mask &= type_table[self.type[lo:hi]] > 0
+        if model_table is not None:
+            mask &= model_table[self.model[lo:hi]] > 0
+        if max_cents is not None:
+            mask &= self.price[lo:hi] <= max_cents
+        if branch is not None:
+            mask &= self.branch[lo:hi] == branch
+        return mask
+
+    def _filters(self, status, vehicle_type, model, max_price):
+        # (status code, type relevance table, model relevance table, max
+        # cents) for _mask(), or None when they can match nothing
+        code = None
+        if status:
+            if status not in self.statuses:
+                return None
+            code = self.statuses.index(status)
+        type_table = model_table = None
+        if vehicle_type:
+            type_table = self.types.relevance_table(vehicle_type, self.min_similarity)
+            if type_table is None:
+                return None
+        if model:
+            model_table = self.models.relevance_table(model, self.min_similarity)
+            if model_table is None:
+                return None
+        max_cents = None
+        if max_price is not None:
+            max_cents = int(np.floor(float(max_price) * 100 + 1e-6))
+        return code, type_table, model_table, max_cents
+
+    def select(self, status=None, vehicle_type="", model="", max_price=None,
+               after=None, limit=None, branch=None):
+        # slots of the matching vehicles, by VehicleID; the filters are
+        # those of search.VehicleSearchIndex.search()
+        empty = np.zeros(0, dtype=np.intp)
+        filters = self._filters(status, vehicle_type, model, max_price)
+        if filters is None:
+            return empty
+        code, type_table, model_table, max_cents = filters
+
+        lo = 0 if after is None else int(np.searchsorted(self.ids[:self.size],
+                                                         self._key(after), "right"))
+        step = self.size if limit is None else CHUNK
+        found = []
+        count = 0
+        while lo < self.size:
+            hi = min(self.size, lo + step)
+            hits = np.flatnonzero(self._mask(lo, hi, code, type_table, model_table, max_cents,
+                                             branch))
+            if len(hits):
+                found.append(hits + lo)
+                count += len(hits)
+            if limit is not None and count >= limit:
+                break
+            lo = hi
+        slots = np.concatenate(found) if found else empty
+        return slots[:limit] if limit is not None else slots
+
+    def rank(self, status=None, vehicle_type="", model="", max_price=None, branch=None,
+             limit=None, popularity=0.2, price=0.1):
+        # (slots, scores) of the matching vehicles, best first: the mean
+        # relevance of the type and model terms (1 without any), plus
+        # `popularity` times the vehicle's rental count and `price` times
+        # how cheap it is, both scaled 0..1 over the matches (the count on
+        # a log scale); ties by VehicleID (the slots' order)
+        empty = np.zeros(0, dtype=np.intp)
+        filters = self._filters(status, vehicle_type, model, max_price)
+        if filters is None:
+            return empty, np.zeros(0)
+        code, type_table, model_table, max_cents = filters
+        slots = np.flatnonzero(self._mask(0, self.size, code, type_table, model_table,
+                                          max_cents, branch))
+        if not len(slots):
+            return slots, np.zeros(0)
+
+        tables = [(t, column) for t, column in ((type_table, self.type),
+                                                (model_table, self.model)) if t is not None]
+        score = np.zeros(len(slots))
+        for table, column in tables:
+            score += table[column[slots]]
+        score = score / len(tables) if tables else score + 1.0
+        if popularity:
+            used = np.log1p(self.rentals[slots])
+            top = used.max()
+            if top > 0:
+                score += popularity * used / top
+        if price:
+            cost = self.price[slots]
+            lo, hi = cost.min(), cost.max()
+            if hi > lo:
+                score += price * (hi - cost) / float(hi - lo)
+
+        if limit is not None and limit < len(slots):
+            # only what can make the first `limit` (with ties) is sorted
+            kth = np.partition(score, len(score) - limit)[len(score) - limit]
+            keep = np.flatnonzero(score >= kth)
+            slots, score = slots[keep], score[keep]
+        order = np.argsort(-score, kind="stable")[:limit]
+        return slots[order], score[order]
+
+    def weights(self, column):
+        # per code of "type" / "model": live vehicles + their rentals,
+        # what completions are ordered by
+        weights = self._weights.get(column)
+        if weights is None:
+            vocabulary = self.types if column == "type" else self.models
+            live = self.status[:self.size] != DELETED
+            weights = self._weights[column] = np.bincount(
+                getattr(self, column)[:self.size][live],
+                weights=1.0 + self.rentals[:self.size][live], minlength=len(vocabulary))
+        return weights
+
+    def complete(self, column, prefix, limit=10):
+        # values of "type" / "model" completing `prefix` (Vocabulary.complete)
+        vocabulary = self.types if column == "type" else self.models
+        return vocabulary.complete(prefix, self.weights(column), limit, self.min_similarity)
+
+    def row(self, i):
+        return {
+            "VehicleID": int(self.ids[i]),
+            "VehicleType": self.types.values[self.type[i]],
+            "Model": self.models.values[self.model[i]],
+            "RegistrationNumber": self.regnos[i],
+            "RentalPrice": decimal.Decimal(int(self.price[i])).scaleb(-2),
+            "Status": self.statuses[self.status[i]],
+            "BranchID": int(self.branch[i]),
+        }
+
+    def rows(self, slots):
+        return [self.row(i) for i in slots.tolist()]
+
+    def get(self, vehicle_id):
+        i = self._slot(vehicle_id)
+        if i is None or self.status[i] == DELETED:
+            return None
+        return self.row(i)
+
+    def slots_of(self, ids):
+        # slots of the live vehicles among `ids` (sorted VehicleIDs)
+        ids = np.asarray(ids, dtype=self.ids.dtype)
+        slots = np.searchsorted(self.ids[:self.size], ids)
+        ok = slots < self.size
+        slots = slots[ok]
+        ok = (self.ids[slots] == ids[ok]) & (self.status[slots] != DELETED)
+        return slots[ok]
+
+    def counts(self, branch=None):
+        # {Status: vehicles}, of one branch or all
+        status = self.status[:self.size]
+        if branch is not None:
+            status = status[self.branch[:self.size] == branch]
+        counts = np.bincount(status, minlength=DELETED + 1)
+        return {status: int(counts[code]) for code, status in enumerate(self.statuses)}
+
+    def __len__(self):
+        return self.size - self.deleted
+
+    def nbytes(self):
+        # the arrays as allocated, the vocabularies' and registration
+        # numbers' characters
+        arrays = sum(getattr(self, name).nbytes for name, _ in COLUMNS)
+        return {"columns": arrays,
+                "strings": (self.types.nbytes() + self.models.nbytes()
+                            + sum(len(r) for r in self.regnos if r is not None))}
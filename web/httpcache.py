@@ -0,0 +1,246 @@
+import collections
+import datetime
+import functools
+import hashlib
+import os
+import threading
+import time
+
+from flask import Response, current_app, make_response, request, session
+
+import cachebus
+
+# Whole-response cache for the read-mostly pages (vehicle lists, the
+# customer dashboard, payment history), with HTTP validators.
+#
+# A page is cached under (endpoint, role, user, name, filter parameters)
+# -- the name because the navbar shows it -- together with the version
+# numbers of the tables it is built from. The repositories call bump()
+# after every committed write to Vehicle, Rental, Payment or PricingRule,
+# so the next request sees different versions and renders afresh; nothing
+# is scanned or cleared. Other processes bump their versions too
+# (cachebus); RESPONSE_CACHE_TTL bounds how long writes made outside the
+# app can go unseen.
+#
+# Responses carry a strong ETag (a hash of the body) and Last-Modified
+# (when this cache first saw that body), with "Cache-Control: private,
+# no-cache": browsers revalidate on every visit and get a bodiless 304
+# when nothing changed -- straight from the cache, or after a re-render
+# that came out the same.
+#
+# Streamed listings (?stream=1), anonymous requests and anything but a
+# plain 200 are passed through. Beyond RESPONSE_CACHE_MAX_ENTRIES or
+# RESPONSE_CACHE_MAX_BYTES the least recently used pages are dropped.
+
+DEFAULTS = {
+    "RESPONSE_CACHE_ENABLED": os.environ.get("VRMS_RESPONSE_CACHE", "1") == "1",
+    "RESPONSE_CACHE_MAX_ENTRIES": 4096,
+    "RESPONSE_CACHE_MAX_BYTES": 64 * 1024 * 1024,
+    "RESPONSE_CACHE_TTL": 30.0,
+}
+
+TABLES = ("vehicles", "rentals", "payments", "pricing")
+
+
+class Entry:
+    __slots__ = ("body", "mimetype", "etag", "last_modified", "versions", "stored_at")
+
+    def __init__(self, body, mimetype, etag, last_modified, versions):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+        self.last_modified = last_modified
+        self.versions = versions
+        self.stored_at = time.monotonic()
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries=4096, max_bytes=64 * 1024 * 1024, ttl=30.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()     # key -> Entry, least recent first
+        self._bytes = 0
+        self._versions = dict.fromkeys(TABLES, 0)
+
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bumps = 0
+        self.passed = 0
+
+    # ---------- versions ----------
+
+    def bump(self, *tables):
+        with self._lock:
+            for table in tables:
+                self._versions[table] += 1
+            self.bumps += 1
+
+    def versions(self, tables):
+        with self._lock:
+            return tuple(self._versions[t] for t in tables)
+
+    # ---------- entries ----------
+
+    def lookup(self, key, versions):
+        # the entry for `key` if it was built from `versions` and is fresh
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and entry.versions == versions
+                    and (self.ttl is None or time.monotonic() - entry.stored_at <= self.ttl)):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    def store(self, key, versions, body, mimetype):
+        etag = hashlib.sha1(body).hexdigest()[:32]
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.body)
+            # unchanged content keeps the time it was first seen
+            last_modified = (old.last_modified if old is not None and old.etag == etag
+                             else datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0))
+            entry = Entry(body, mimetype, etag, last_modified, versions)
+            if len(body) <= self.max_bytes // 8:
+                self._entries[key] = entry
+                self._bytes += len(body)
+                self.stores += 1
+                while self._entries and (len(self._entries) > self.max_entries
+                                         or self._bytes > self.max_bytes):
+                    _, dropped = self._entries.popitem(last=False)
+                    self._bytes -= len(dropped.body)
+                    self.evictions += 1
+        return entry
+
+    def prune(self):
+        # drops the entries older than the TTL; how many
+        if self.ttl is None:
+            return 0
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if entry.stored_at < cutoff]
+            for key in stale:
+                self._bytes -= len(self._entries.pop(key).body)
+        return len(stale)
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "not_modified": self.not_modified,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "bumps": self.bumps,
+                "passed_through": self.passed,
+                "versions": dict(self._versions),
+            }
+
+
+def _key(daily):
+    # None when the request must not be cached
+    if "user_id" not in session or "stream" in request.args:
+        return None
+    params = tuple(sorted((name, value.strip()) for name, values in request.args.lists()
+                          for value in values if value.strip()))
+    key = (request.endpoint, session.get("role"), session["user_id"], session.get("name"), params)
+    if daily:
+        key += (datetime.date.today(),)
+    return key
+
+
+def _respond(cache, entry):
+    response = Response(entry.body, mimetype=entry.mimetype)
+    response.set_etag(entry.etag)
+    response.last_modified = entry.last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    response.make_conditional(request)
+    if response.status_code == 304:
+        cache.count("not_modified")
+    return response
+
+
+def cached(*tables, daily=False):
+    # view decorator: cache the page, built from `tables` (see TABLES);
+    # daily=True for pages that also depend on today's date
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = get_cache()
+            key = _key(daily) if cache is not None else None
+            if key is None:
+                if cache is not None:
+                    cache.count("passed")
+                return current_app.ensure_sync(view)(*args, **kwargs)
+            key += (tuple(sorted(kwargs.items())),)
+            versions = cache.versions(tables)
+            entry = cache.lookup(key, versions)
+            if entry is None:
+                response = make_response(current_app.ensure_sync(view)(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                entry = cache.store(key, versions, response.get_data(), response.mimetype)
+            return _respond(cache, entry)
+        return wrapper
+    return decorate
+
+
+_cache_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def get_cache(app=None):
+    # None with RESPONSE_CACHE_ENABLED off
+    app = app or current_app
+    if not app.config["RESPONSE_CACHE_ENABLED"]:
+        return None
+    cache = app.extensions.get("vrms_httpcache")
+    if cache is None:
+        with _cache_lock:
+            cache = app.extensions.get("vrms_httpcache")
+            if cache is None:
+                cfg = app.config
+                cache = ResponseCache(max_entries=cfg["RESPONSE_CACHE_MAX_ENTRIES"],
+                                      max_bytes=cfg["RESPONSE_CACHE_MAX_BYTES"],
+                                      ttl=cfg["RESPONSE_CACHE_TTL"])
+                app.extensions["vrms_httpcache"] = cache
+    return cache
+
+
+def bump(*tables):
+    # after committing a write to these tables
+    cache = get_cache()
+    if cache is not None:
+        cache.bump(*tables)
+        for table in tables:
+            cachebus.publish("responses", TABLES.index(table))
+
+
+@cachebus.handler("responses")
+def _changed_elsewhere(app, table):
+    cache = app.extensions.get("vrms_httpcache")
+    if cache is not None:
+        cache.bump(*(TABLES if table is None else (TABLES[table],)))
@@ -0,0 +1,421 @@
+import bisect
+import contextvars
+import functools
+import logging
+import re
+import threading
+import time
+
+from flask import current_app, g, request
+from flask.signals import before_render_template, template_rendered
+
+# Request and SQL instrumentation, exported at /metrics in the Prometheus
+# text format.
+#
+# Connections are wrapped where the pool opens them (database.get_pool),
+# so every cursor records each statement's time and row count under a
+# normalized fingerprint (literals and IN lists folded to "?"). Statements
+# slower than SLOW_QUERY_MS are logged to the "vrms.sql" logger.
+#
+# Each request is split into time waiting for a pooled connection, time in
+# the database (execute + fetch + commit), time rendering templates (DB
+# time spent inside a streamed render is not counted twice) and the rest,
+# with a histogram per endpoint for each. Streamed pages are finalized
+# when the server closes the response, so they are measured to the last
+# byte (their template time includes handing the chunks to the server).
+#
+# Overhead: python3 -m bench.metrics_overhead
+
+DEFAULTS = {
+    "METRICS_ENABLED": True,
+    "METRICS_TOKEN": None,          # if set, /metrics needs "Authorization: Bearer <token>"
+    "METRICS_MAX_FINGERPRINTS": 500,
+    "SLOW_QUERY_MS": 200.0,         # 0 = no slow-query log
+}
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+PARTS = ("total", "db", "template", "pool_wait")
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.)*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|\?")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_VALUES_LIST = re.compile(r"(\(\?(?:, \?)*\))(?:\s*,\s*\1)+")
+_SPACE = re.compile(r"\s+")
+
+logger = logging.getLogger("vrms.sql")
+
+
+@functools.lru_cache(maxsize=4096)
+def fingerprint(sql):
+    # "SELECT * FROM Vehicle WHERE VehicleID IN (%s, %s)" -> "... IN (?)"
+    fp = _STRING.sub("?", sql)
+    fp = _NUMBER.sub("?", fp)
+    fp = _PLACEHOLDER.sub("?", fp)
+    fp = _SPACE.sub(" ", fp).strip()
+    fp = _VALUES_LIST.sub(r"\1", fp)      # multi-row INSERT ... VALUES (...), (...)
+    fp = _IN_LIST.sub("(?)", fp)
+    return fp
+
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class StatementStats:
+    __slots__ = ("count", "seconds", "rows", "errors", "slow")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.errors = 0
+        self.slow = 0
+
+
+class RequestTimes:
+    # accumulated while one request runs
+    __slots__ = ("start", "db", "template", "render_start", "db_at_render", "endpoint")
+
+    def __init__(self, endpoint):
+        self.start = time.perf_counter()
+        self.db = 0.0
+        self.template = 0.0
+        self.render_start = None
+        self.db_at_render = 0.0
+        self.endpoint = endpoint
+
+
+_current = contextvars.ContextVar("vrms_request_times", default=None)
+
+
+class Metrics:
+
+    def __init__(self, slow_query_seconds=0.2, max_fingerprints=500):
+        self.slow_query_seconds = slow_query_seconds
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._statements = {}       # fingerprint -> StatementStats
+        self._routes = {}           # endpoint -> [Histogram per PARTS]
+        self._requests = {}         # (endpoint, method, status) -> count
+        self._jobs = {}             # job name -> Histogram of run times
+        self._job_runs = {}         # (job name, "ok"/"error") -> count
+
+    # ---------- SQL ----------
+
+    def _stats_for(self, sql):
+        # called with the lock held
+        fp = fingerprint(sql)
+        stats = self._statements.get(fp)
+        if stats is None:
+            if len(self._statements) >= self.max_fingerprints:
+                fp = "other"
+                stats = self._statements.get(fp)
+            if stats is None:
+                stats = self._statements[fp] = StatementStats()
+        return stats
+
+    def statement(self, sql, seconds, rows=0, error=False):
+        # one execute; returns the fingerprint's stats for fetched()
+        times = _current.get()
+        if times is not None:
+            times.db += seconds
+        with self._lock:
+            stats = self._stats_for(sql)
+            stats.count += 1
+            stats.seconds += seconds
+            stats.rows += rows
+            if error:
+                stats.errors += 1
+            slow = self.slow_query_seconds and seconds >= self.slow_query_seconds
+            if slow:
+                stats.slow += 1
+        if slow:
+            logger.warning("slow query %.1fms rows=%d endpoint=%s: %s",
+                           seconds * 1000.0, rows,
+                           times.endpoint if times is not None else "-", fingerprint(sql))
+        return stats
+
+    def fetched(self, stats, seconds, rows):
+        # rows read back from a statement recorded by statement()
+        times = _current.get()
+        if times is not None:
+            times.db += seconds
+        with self._lock:
+            stats.seconds += seconds
+            stats.rows += rows
+
+    def instrument(self, connect):
+        # wraps a zero-argument connect callable (see database.connect_factory)
+        return lambda: InstrumentedConnection(connect(), self)
+
+    # ---------- REQUESTS ----------
+
+    def request(self, endpoint, method, status, total, db, template, pool_wait):
+        with self._lock:
+            hists = self._routes.get(endpoint)
+            if hists is None:
+                hists = self._routes[endpoint] = [Histogram() for _ in PARTS]
+            hists[0].observe(total)
+            hists[1].observe(db)
+            hists[2].observe(template)
+            hists[3].observe(pool_wait)
+            key = (endpoint, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+    # ---------- BACKGROUND JOBS ----------
+
+    def job(self, name, seconds, ok):
+        # one run of a scheduler.py job
+        with self._lock:
+            hist = self._jobs.get(name)
+            if hist is None:
+                hist = self._jobs[name] = Histogram()
+            hist.observe(seconds)
+            key = (name, "ok" if ok else "error")
+            self._job_runs[key] = self._job_runs.get(key, 0) + 1
+
+    # ---------- EXPORT ----------
+
+    def statements(self, limit=20):
+        # slowest fingerprints by total time, for humans
+        with self._lock:
+            items = [(fp, s.count, s.seconds, s.rows, s.errors, s.slow)
+                     for fp, s in self._statements.items()]
+        items.sort(key=lambda i: i[2], reverse=True)
+        return [{"fingerprint": fp, "count": count, "seconds": round(seconds, 6),
+                 "rows": rows, "errors": errors, "slow": slow}
+                for fp, count, seconds, rows, errors, slow in items[:limit]]
+
+    def prometheus(self, extra=()):
+        # extra: (name, "gauge"/"counter", help, value) from other components
+        with self._lock:
+            requests = sorted(self._requests.items())
+            routes = sorted((endpoint, [(list(h.counts), h.total, h.count) for h in hists])
+                            for endpoint, hists in self._routes.items())
+            statements = sorted((fp, (s.count, s.seconds, s.rows, s.errors, s.slow))
+                                for fp, s in self._statements.items())
+            jobs = sorted((name, list(h.counts), h.total, h.count) for name, h in self._jobs.items())
+            job_runs = sorted(self._job_runs.items())
+
+        out = []
+        out.append("# HELP vrms_http_requests_total Requests by endpoint, method and status.")
+        out.append("# TYPE vrms_http_requests_total counter")
+        for (endpoint, method, status), n in requests:
+            out.append("vrms_http_requests_total{%s} %d" % (
+                _labels(endpoint=endpoint, method=method, status=status), n))
+
+        for i, part in enumerate(PARTS):
+            name = "vrms_http_request_%s_seconds" % part
+            out.append("# HELP %s Request time (%s) by endpoint." % (name, part.replace("_", " ")))
+            out.append("# TYPE %s histogram" % name)
+            for endpoint, hists in routes:
+                counts, total, count = hists[i]
+                cumulative = 0
+                for bound, n in zip(BUCKETS + (None,), counts):
+                    cumulative += n
+                    le = "+Inf" if bound is None else repr(bound)
+                    out.append("%s_bucket{%s} %d" % (name, _labels(endpoint=endpoint, le=le), cumulative))
+                out.append("%s_sum{%s} %.6f" % (name, _labels(endpoint=endpoint), total))
+                out.append("%s_count{%s} %d" % (name, _labels(endpoint=endpoint), count))
+
+        for name, index, kind, help_text in (
+                ("vrms_sql_statements_total", 0, "counter", "Statements executed, by fingerprint."),
+                ("vrms_sql_seconds_total", 1, "counter", "Time in execute/fetch, by fingerprint."),
+                ("vrms_sql_rows_total", 2, "counter", "Rows fetched or affected, by fingerprint."),
+                ("vrms_sql_errors_total", 3, "counter", "Failed statements, by fingerprint."),
+                ("vrms_sql_slow_total", 4, "counter", "Statements over SLOW_QUERY_MS.")):
+            out.append("# HELP %s %s" % (name, help_text))
+            out.append("# TYPE %s %s" % (name, kind))
+            for fp, values in statements:
+                value = values[index]
+                fmt = "%s{%s} %.6f" if isinstance(value, float) else "%s{%s} %d"
+                out.append(fmt % (name, _labels(fingerprint=fp), value))
+
+        name = "vrms_job_duration_seconds"
+        out.append("# HELP %s Background job run time, by job." % name)
+        out.append("# TYPE %s histogram" % name)
+        for job, counts, total, count in jobs:
+            cumulative = 0
+            for bound, n in zip(BUCKETS + (None,), counts):
+                cumulative += n
+                le = "+Inf" if bound is None else repr(bound)
+                out.append("%s_bucket{%s} %d" % (name, _labels(job=job, le=le), cumulative))
+            out.append("%s_sum{%s} %.6f" % (name, _labels(job=job), total))
+            out.append("%s_count{%s} %d" % (name, _labels(job=job), count))
+        out.append("# HELP vrms_job_runs_total Background job runs, by job and status.")
+        out.append("# TYPE vrms_job_runs_total counter")
+        for (job, status), n in job_runs:
+            out.append("vrms_job_runs_total{%s} %d" % (_labels(job=job, status=status), n))
+
+        for name, kind, help_text, value in extra:
+            out.append("# HELP %s %s" % (name, help_text))
+            out.append("# TYPE %s %s" % (name, kind))
+            out.append("%s %s" % (name, value))
+        return "\n".join(out) + "\n"
+
+
+def _labels(**labels):
+    return ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for k, v in labels.items())
+
+
+# ---------- CONNECTION / CURSOR WRAPPERS ----------
+
+class InstrumentedCursor:
+
+    def __init__(self, cur, metrics):
+        self._cur = cur
+        self._metrics = metrics
+        self._stats = None
+
+    def _timed(self, sql, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self._metrics.statement(sql, time.perf_counter() - t0, error=True)
+            raise
+        elapsed = time.perf_counter() - t0
+        # affected rows for writes; SELECTs report their rows as they are fetched
+        rows = self._cur.rowcount
+        self._stats = self._metrics.statement(sql, elapsed, rows if rows and rows > 0 else 0)
+        return self if result is self._cur else result
+
+    def execute(self, sql, params=(), *args, **kwargs):
+        return self._timed(sql, self._cur.execute, sql, params, *args, **kwargs)
+
+    def executemany(self, sql, seq_params):
+        return self._timed(sql, self._cur.executemany, sql, seq_params)
+
+    def callproc(self, name, args=()):
+        return self._timed("CALL " + name, self._cur.callproc, name, args)
+
+    def _fetched(self, t0, rows):
+        if self._stats is not None:
+            self._metrics.fetched(self._stats, time.perf_counter() - t0, rows)
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        row = self._cur.fetchone()
+        self._fetched(t0, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=1):
+        t0 = time.perf_counter()
+        rows = self._cur.fetchmany(size)
+        self._fetched(t0, len(rows))
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        rows = self._cur.fetchall()
+        self._fetched(t0, len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def __getattr__(self, name):
+        # rowcount, lastrowid, description, stored_results, close, ...
+        return getattr(self._cur, name)
+
+
+class InstrumentedConnection:
+
+    def __init__(self, conn, metrics):
+        self._conn = conn
+        self._metrics = metrics
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._metrics)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        self._conn.commit()
+        self._metrics.statement("COMMIT", time.perf_counter() - t0)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+_metrics_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+
+
+def get_metrics(app=None):
+    app = app or current_app
+    metrics = app.extensions.get("vrms_metrics")
+    if metrics is None:
+        with _metrics_lock:
+            metrics = app.extensions.get("vrms_metrics")
+            if metrics is None:
+                metrics = Metrics(slow_query_seconds=(app.config["SLOW_QUERY_MS"] or 0) / 1000.0,
+                                  max_fingerprints=app.config["METRICS_MAX_FINGERPRINTS"])
+                app.extensions["vrms_metrics"] = metrics
+    return metrics
+
+
+def _start_request():
+    if current_app.config["METRICS_ENABLED"]:
+        _current.set(RequestTimes(request.endpoint or "unmatched"))
+
+
+def _finish_request(response):
+    times = _current.get()
+    if times is None:
+        return response
+    metrics = get_metrics()
+    method = request.method
+    pool_wait = g.get("db_wait", 0.0)
+
+    def done():
+        metrics.request(times.endpoint, method, response.status_code,
+                        time.perf_counter() - times.start, times.db, times.template, pool_wait)
+        _current.set(None)
+
+    if response.is_streamed:
+        # body not generated yet: finish when the server closes the response
+        response.call_on_close(done)
+    else:
+        done()
+    return response
+
+
+def _render_started(sender, template, context, **extra):
+    times = _current.get()
+    if times is not None:
+        times.render_start = time.perf_counter()
+        times.db_at_render = times.db
+
+
+def _render_finished(sender, template, context, **extra):
+    times = _current.get()
+    if times is not None and times.render_start is not None:
+        # a streamed render pulls rows while it renders; that part is DB time
+        elapsed = time.perf_counter() - times.render_start
+        times.template += max(0.0, elapsed - (times.db - times.db_at_render))
+        times.render_start = None
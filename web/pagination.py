@@ -0,0 +1,142 @@
+from flask import current_app, request, url_for
+
+# Keyset ("seek") pagination for the long listings. Instead of OFFSET we
+# remember the last key of the page (?after=<id>) and continue with
+# "WHERE key > after ORDER BY key LIMIT n", which stays an index range scan
+# however deep the page is. ?stream=1 renders the whole listing through
+# stream_template from an unbuffered cursor instead, so memory stays flat.
+
+DEFAULTS = {
+    "PAGE_SIZE": 50,
+    "PAGE_SIZE_MAX": 500,
+    "STREAM_BATCH_SIZE": 500,
+}
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+class Page:
+
+    def __init__(self, rows, key, after, limit):
+        self.after = after
+        self.limit = limit
+        self.has_next = len(rows) > limit
+        self.rows = rows[:limit]
+        field = key.split(".")[-1]
+        self.next_cursor = self.rows[-1][field] if self.has_next else None
+
+    @property
+    def next_url(self):
+        if self.next_cursor is None:
+            return None
+        return _url_with(after=self.next_cursor)
+
+    @property
+    def first_url(self):
+        return _url_with(after=None)
+
+
+def _url_with(**changes):
+    args = request.args.to_dict()
+    args.update(changes)
+    args = {k: v for k, v in args.items() if v is not None}
+    return url_for(request.endpoint, **request.view_args, **args)
+
+
+def page_args():
+    # (after, limit, stream) from the query string, with limit clamped
+    cfg = current_app.config
+    try:
+        after = int(request.args["after"])
+    except (KeyError, ValueError):
+        after = None
+    try:
+        limit = int(request.args.get("limit", cfg["PAGE_SIZE"]))
+    except ValueError:
+        limit = cfg["PAGE_SIZE"]
+    limit = max(1, min(limit, cfg["PAGE_SIZE_MAX"]))
+    stream = request.args.get("stream") == "1"
+    return after, limit, stream
+
+
+def keyset_query(sql, params, key, after=None, limit=None, descending=False):
+    # `sql` must end in a WHERE clause ("WHERE 1=1" is fine)
+    params = list(params)
+    if after is not None:
+        sql += " AND %s %s %%s" % (key, "<" if descending else ">")
+        params.append(after)
+    sql += " ORDER BY %s %s" % (key, "DESC" if descending else "ASC")
+    if limit is not None:
+        sql += " LIMIT %s"
+        params.append(limit)
+    return sql, params
+
+
+def union_query(parts, key, after=None, limit=None, descending=False, ordered=True):
+    # keyset_query() over a listing whose rows are split across tables
+    # (the live and archive ones, see archive.py) as one UNION ALL
+    # statement, so a row moving between them is seen exactly once.
+    # `parts` are (sql, params, key) as for keyset_query; each is
+    # narrowed and limited on its own index, and the union is ordered on
+    # `key`, a result column name. ordered=False leaves the rows in part
+    # order (whole-table exports, where sorting everything would cost more
+    # than the order is worth).
+    queries, query_params = [], []
+    for i, (sql, params, part_key) in enumerate(parts):
+        query, params = keyset_query(sql, params, part_key, after, limit, descending)
+        queries.append("SELECT * FROM (%s) AS part%d" % (query, i))
+        query_params.extend(params)
+    query = " UNION ALL ".join(queries)
+    if ordered:
+        query += " ORDER BY %s %s" % (key, "DESC" if descending else "ASC")
+    if limit is not None:
+        query += " LIMIT %s"
+        query_params.append(limit)
+    return query, query_params
+
+
+def fetch_page(cn, sql, params, key, after, limit, descending=False):
+    # one extra row tells us whether there is a next page
+    query, query_params = keyset_query(sql, params, key, after, limit + 1, descending)
+    return Page(_fetch_all(cn, query, query_params), key, after, limit)
+
+
+def fetch_union_page(cn, parts, key, after, limit, descending=False):
+    query, query_params = union_query(parts, key, after, limit + 1, descending)
+    return Page(_fetch_all(cn, query, query_params), key, after, limit)
+
+
+def _fetch_all(cn, query, params):
+    cur = cn.cursor(dictionary=True)
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def stream_rows(cn, sql, params, key, after=None, descending=False):
+    query, query_params = keyset_query(sql, params, key, after, None, descending)
+    return stream_query(cn, query, query_params)
+
+
+def stream_query(cn, query, query_params):
+    # generator for stream_template(); rows are pulled from an unbuffered
+    # (server-side) cursor in batches, never the whole result at once
+    batch = current_app.config["STREAM_BATCH_SIZE"]
+    cur = cn.cursor(dictionary=True, buffered=False)
+    try:
+        cur.execute(query, query_params)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        try:
+            cur.close()
+        except Exception:
+            pass   # unread rows on an aborted stream; the pool drops the connection
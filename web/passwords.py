@@ -0,0 +1,243 @@
+import collections
+import concurrent.futures
+import hmac
+import os
+import threading
+import time
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+import storage
+
+# Password hashing off the request threads.
+#
+# Hashes are Werkzeug's "method$salt$hash" strings (scrypt by default,
+# pbkdf2 also works). The KDF is deliberately slow, so hashing and checking
+# run on a small, bounded executor: at most PASSWORD_POOL_SIZE run at once
+# and at most PASSWORD_POOL_QUEUE are accepted (running + waiting); beyond
+# that callers get PasswordBusy straight away instead of piling up. The
+# request thread waits for its hash, so the queue must stay well below the
+# server's request threads or a login storm parks all of them: by default
+# it is a quarter of ASGI_THREADS (set that to gunicorn's --threads when
+# serving WSGI), and never more than ASGI_THREADS - 1. OpenSSL
+# releases the GIL while it hashes, so a thread pool keeps the CPU work off
+# the interpreter; "process" is there for KDFs that don't.
+#
+# Rows still holding a plaintext password (everything created before this)
+# are compared as before and rehashed on the next successful login, as are
+# hashes made with older cost parameters than PASSWORD_HASH_METHOD.
+#
+# login_allowed() is a fixed-window rate limit per client address and per
+# account, checked before any hashing happens.
+#
+# Cost benchmark: python3 -m bench.password_cost
+
+DEFAULTS = {
+    "PASSWORD_HASH_METHOD": "scrypt:32768:8:1",     # or e.g. "pbkdf2:sha256:600000"
+    "PASSWORD_SALT_LENGTH": 16,
+    "PASSWORD_POOL": "thread",                      # "thread" or "process"
+    "PASSWORD_POOL_SIZE": min(4, os.cpu_count() or 1),
+    "PASSWORD_POOL_QUEUE": None,                    # None = max_pending() of the request threads
+    "LOGIN_RATE_WINDOW": 60.0,                      # seconds
+    "LOGIN_RATE_LIMIT_IP": 30,                      # attempts per window per client address
+    "LOGIN_RATE_LIMIT_ACCOUNT": 10,                 # attempts per window per email
+}
+
+HASH_PREFIXES = ("scrypt", "pbkdf2")
+
+
+class PasswordBusy(Exception):
+    pass
+
+
+def is_hashed(stored):
+    return "$" in stored and stored.split(":", 1)[0].split("$", 1)[0] in HASH_PREFIXES
+
+
+class Hasher:
+
+    def __init__(self, method="scrypt:32768:8:1", salt_length=16, pool="thread",
+                 workers=4, max_pending=8):
+        self.method = method
+        self.salt_length = salt_length
+        executor = (concurrent.futures.ProcessPoolExecutor if pool == "process"
+                    else concurrent.futures.ThreadPoolExecutor)
+        kwargs = {} if pool == "process" else {"thread_name_prefix": "vrms-kdf"}
+        self._executor = executor(max_workers=workers, **kwargs)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._dummy = None          # hash checked for unknown accounts
+        self._lock = threading.Lock()
+
+        self.hashed = 0
+        self.verified = 0
+        self.rehashed = 0
+        self.rejected_busy = 0
+        self.kdf_time = 0.0
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected_busy += 1
+            raise PasswordBusy("password hashing queue is full")
+        try:
+            t0 = time.perf_counter()
+            result = self._executor.submit(fn, *args).result()
+            with self._lock:
+                self.kdf_time += time.perf_counter() - t0
+            return result
+        finally:
+            self._slots.release()
+
+    def hash(self, password, rehash=False):
+        result = self._run(generate_password_hash, password, self.method, self.salt_length)
+        with self._lock:
+            self.hashed += 1
+            if rehash:
+                self.rehashed += 1
+        return result
+
+    def needs_rehash(self, stored):
+        return not is_hashed(stored) or stored.split("$", 1)[0] != self.method
+
+    def verify(self, stored, password):
+        # (ok, needs_rehash); stored=None (no such account) still costs one
+        # hash check so unknown emails can't be told apart by timing
+        with self._lock:
+            self.verified += 1
+        if stored is None:
+            if self._dummy is None:
+                self._dummy = self._run(generate_password_hash, "", self.method, self.salt_length)
+            self._run(check_password_hash, self._dummy, password)
+            return False, False
+        if not is_hashed(stored):
+            # legacy plaintext row
+            return hmac.compare_digest(stored.encode(), password.encode()), True
+        ok = self._run(check_password_hash, stored, password)
+        return ok, ok and self.needs_rehash(stored)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "method": self.method,
+                "hashed": self.hashed,
+                "verified": self.verified,
+                "rehashed": self.rehashed,
+                "rejected_busy": self.rejected_busy,
+                "kdf_time_total": round(self.kdf_time, 3),
+            }
+
+
+class RateLimiter:
+    # fixed-window counter per key
+
+    def __init__(self, window=60.0):
+        self.window = window
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+        self._window_start = time.monotonic()
+        self.limited = 0
+
+    def hit(self, key, limit):
+        # counts one attempt; False once `key` is over `limit` this window
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= self.window:
+                self._counts.clear()
+                self._window_start = now
+            self._counts[key] += 1
+            if self._counts[key] > limit:
+                self.limited += 1
+                return False
+            return True
+
+    def prune(self):
+        # forgets a window that has ended (hit() would on the next login);
+        # how many keys were dropped
+        with self._lock:
+            if time.monotonic() - self._window_start < self.window:
+                return 0
+            dropped = len(self._counts)
+            self._counts.clear()
+            self._window_start = time.monotonic()
+            return dropped
+
+
+_hasher_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def max_pending(cfg):
+    # hashes accepted at once (running + waiting), each holding a request
+    # thread: PASSWORD_POOL_QUEUE or a quarter of the request threads, and
+    # always leaving at least one thread for the other routes
+    threads = cfg["ASGI_THREADS"]
+    limit = cfg["PASSWORD_POOL_QUEUE"] or max(cfg["PASSWORD_POOL_SIZE"], threads // 4)
+    return max(1, min(limit, threads - 1))
+
+
+def get_hasher(app=None):
+    app = app or current_app
+    hasher = app.extensions.get("vrms_passwords")
+    if hasher is None:
+        with _hasher_lock:
+            hasher = app.extensions.get("vrms_passwords")
+            if hasher is None:
+                cfg = app.config
+                hasher = Hasher(method=cfg["PASSWORD_HASH_METHOD"],
+                                salt_length=cfg["PASSWORD_SALT_LENGTH"],
+                                pool=cfg["PASSWORD_POOL"],
+                                workers=cfg["PASSWORD_POOL_SIZE"],
+                                max_pending=max_pending(cfg))
+                app.extensions["vrms_passwords"] = hasher
+    return hasher
+
+
+def _get_limiter(app=None):
+    app = app or current_app
+    limiter = app.extensions.get("vrms_login_limiter")
+    if limiter is None:
+        with _hasher_lock:
+            limiter = app.extensions.get("vrms_login_limiter")
+            if limiter is None:
+                limiter = RateLimiter(window=app.config["LOGIN_RATE_WINDOW"])
+                app.extensions["vrms_login_limiter"] = limiter
+    return limiter
+
+
+def hash_password(password):
+    return get_hasher().hash(password)
+
+
+def verify_password(stored, password):
+    return get_hasher().verify(stored, password)
+
+
+def upgrade(user_id, stored, password):
+    # after a successful login against a plaintext or outdated hash; only
+    # replaces `stored`, so a concurrent password change stays intact
+    storage.get_store().users.replace_password(
+        user_id, stored, get_hasher().hash(password, rehash=True))
+
+
+def login_allowed(address, email):
+    cfg = current_app.config
+    limiter = _get_limiter()
+    ip_ok = limiter.hit(("ip", address), cfg["LOGIN_RATE_LIMIT_IP"])
+    account_ok = limiter.hit(("account", email.lower()), cfg["LOGIN_RATE_LIMIT_ACCOUNT"])
+    return ip_ok and account_ok
+
+
+def prune_login_limits():
+    # frees the counters of an ended window (the scheduler's cleanup job)
+    return _get_limiter().prune()
+
+
+def stats():
+    out = get_hasher().stats()
+    out["login_rate_limited"] = _get_limiter().limited
+    return out
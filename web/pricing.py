@@ -0,0 +1,289 @@
+import datetime
+import math
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+
+import cachebus
+import database
+
+# Rental quotes from the PricingRule table, for whole pages of vehicles at
+# once. This is the only place a rental's price is worked out: the
+# customer dashboard shows quote_rows() for the listed vehicles and the
+# repositories pass quote() for the one being booked or reserved to
+# booking.py, which stores it as the TotalAmount.
+#
+# The rules (db/vrms_export.sql, section PRICING RULES) are compiled into
+# a RuleSet: per vehicle type, a day-by-day multiplier over the next
+# PRICING_CALENDAR_DAYS (weekend x season) kept as a running sum, a
+# long-rental multiplier per rental length, and a surge multiplier from
+# the type's current utilization. A quote is then, for every row at once,
+#
+#   RentalPrice * (cum[type, end] - cum[type, start]) * long[type, days] * surge[type]
+#
+# rounded to cents: a few NumPy gathers however many vehicles are listed.
+#
+# The compiled set is cached. Admin edits go through the repositories,
+# which call invalidate() (other processes get it over cachebus);
+# PRICING_RULES_TTL picks up edits made outside the app,
+# PRICING_UTILIZATION_TTL re-reads the fleet utilization, and the
+# calendar moves on at midnight.
+#
+# Benchmark: python3 -m bench.pricing --vehicles 100000
+
+DEFAULTS = {
+    "PRICING_RULES_TTL": 300.0,
+    "PRICING_UTILIZATION_TTL": 60.0,
+    # RESERVATION_HORIZON_DAYS + RESERVATION_MAX_DAYS fit in here; longer
+    # ranges get a one-off rule set
+    "PRICING_CALENDAR_DAYS": 450,
+}
+
+KINDS = ("weekend", "season", "long_rental", "surge")
+SATURDAY = 5
+
+
+def _type_key(value):
+    return (value or "").strip().lower()
+
+
+class RuleSet:
+    # the rules compiled for the days [first, first + days)
+
+    def __init__(self, rules, utilization, first, days):
+        self.first = first.toordinal()
+        self.days = days
+        # row 0 is for vehicle types the set doesn't know: global rules,
+        # no utilization
+        keys = {_type_key(rule["VehicleType"]) for rule in rules} | set(utilization)
+        keys.discard("")
+        self.types = {key: i + 1 for i, key in enumerate(sorted(keys))}
+        n = len(self.types) + 1
+
+        factor = np.ones((n, days))
+        ordinals = np.arange(self.first, self.first + days)
+        weekend = (ordinals + 6) % 7 >= SATURDAY      # date.weekday() of an ordinal
+        tiers = {"long_rental": [], "surge": []}
+        for rule in rules:
+            rows = self._rows(rule["VehicleType"])
+            multiplier = float(rule["Multiplier"])
+            if rule["Kind"] == "weekend":
+                factor[rows, weekend] *= multiplier
+            elif rule["Kind"] == "season":
+                lo = max(0, _date(rule["StartDate"]).toordinal() - self.first)
+                hi = min(days, _date(rule["EndDate"]).toordinal() + 1 - self.first)
+                if lo < hi:
+                    factor[rows, lo:hi] *= multiplier
+            else:
+                # ascending threshold, type rules after global ones: the
+                # highest threshold reached is written last and wins
+                tiers[rule["Kind"]].append((float(rule["Threshold"]), isinstance(rows, int),
+                                            rows, multiplier))
+        self._cum = np.zeros((n, days + 1))
+        np.cumsum(factor, axis=1, out=self._cum[:, 1:])
+
+        long_tiers = sorted(tiers["long_rental"], key=lambda t: t[:2])
+        longest = max([int(math.ceil(t[0])) for t in long_tiers] + [1])
+        self._long = np.ones((n, longest + 1))
+        for threshold, _, rows, multiplier in long_tiers:
+            self._long[rows, max(1, int(math.ceil(threshold))):] = multiplier
+
+        used = np.zeros(n)
+        for key, share in utilization.items():
+            if key in self.types:
+                used[self.types[key]] = share
+        self._surge = np.ones(n)
+        for threshold, _, rows, multiplier in sorted(tiers["surge"], key=lambda t: t[:2]):
+            hit = np.zeros(n, dtype=bool)
+            hit[rows] = True
+            self._surge[hit & (used >= threshold)] = multiplier
+
+    def _rows(self, vehicle_type):
+        key = _type_key(vehicle_type)
+        return self.types[key] if key else slice(None)
+
+    def covers(self, first, last):
+        # whether the days [first, last) (date ordinals) are in the calendar
+        return first >= self.first and last <= self.first + self.days
+
+    def codes(self, vehicle_types):
+        # row numbers for a sequence of VehicleType values
+        if not len(vehicle_types):
+            return np.zeros(0, dtype=np.intp)
+        uniq, inverse = np.unique(np.asarray(vehicle_types, dtype=str), return_inverse=True)
+        lookup = np.array([self.types.get(_type_key(t), 0) for t in uniq], dtype=np.intp)
+        return lookup[inverse]
+
+    def quote(self, prices, codes, starts, days):
+        # totals for the rentals (price, type row, start ordinal, days);
+        # starts / days may be arrays or one value for all
+        starts = np.asarray(starts, dtype=np.int64) - self.first
+        days = np.maximum(np.asarray(days, dtype=np.int64), 1)
+        per_day = self._cum[codes, starts + days] - self._cum[codes, starts]
+        length = self._long[codes, np.minimum(days, self._long.shape[1] - 1)]
+        return np.round(np.asarray(prices, dtype=np.float64) * per_day * length
+                        * self._surge[codes], 2)
+
+
+class PricingEngine:
+
+    def __init__(self, ttl=300.0, utilization_ttl=60.0, calendar_days=450):
+        self.ttl = ttl
+        self.utilization_ttl = utilization_ttl
+        self.calendar_days = calendar_days
+        self._lock = threading.Lock()
+        self._rules = None
+        self._rules_at = None
+        self._utilization = None
+        self._utilization_at = None
+        self._compiled = None
+        self._dirty = True
+
+        self.compiles = 0
+        self.batches = 0
+        self.quotes = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._dirty = True
+
+    def _expired(self, loaded_at, ttl):
+        return loaded_at is None or (ttl is not None and time.monotonic() - loaded_at > ttl)
+
+    def rule_set(self, store, first=None, last=None):
+        # the compiled rules; [first, last) are the days to be quoted
+        today = datetime.date.today()
+        with self._lock:
+            if self._dirty or self._expired(self._rules_at, self.ttl):
+                with database.primary():
+                    self._rules = store.pricing.rules()
+                self._rules_at = time.monotonic()
+                self._dirty = False
+                self._compiled = None
+            if self._expired(self._utilization_at, self.utilization_ttl):
+                with database.primary():
+                    self._utilization = _shares(store.vehicles.utilization())
+                self._utilization_at = time.monotonic()
+                self._compiled = None
+            compiled = self._compiled
+            if compiled is None or compiled.first != today.toordinal():
+                compiled = self._compiled = RuleSet(self._rules, self._utilization,
+                                                    today, self.calendar_days)
+                self.compiles += 1
+            rules, utilization = self._rules, self._utilization
+        first = first or today
+        last = last or first + datetime.timedelta(days=1)
+        if compiled.covers(first.toordinal(), last.toordinal()):
+            return compiled
+        # a range outside the calendar (a long rental, a past date)
+        start = min(first, today)
+        return RuleSet(rules, utilization, start, (last - start).days)
+
+    def quote_rows(self, store, rows, start, days):
+        # totals for renting each of `rows` (vehicle dicts) for `days`
+        # days from `start`, in order
+        if not rows:
+            return []
+        days = max(1, days)
+        rule_set = self.rule_set(store, start, start + datetime.timedelta(days=days))
+        prices = np.fromiter((float(row["RentalPrice"]) for row in rows),
+                             dtype=np.float64, count=len(rows))
+        codes = rule_set.codes([row["VehicleType"] for row in rows])
+        totals = rule_set.quote(prices, codes, start.toordinal(), days)
+        with self._lock:
+            self.batches += 1
+            self.quotes += len(rows)
+        return totals.tolist()
+
+    def quote(self, store, vehicle, start, days):
+        return self.quote_rows(store, [vehicle], start, days)[0]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rules": len(self._rules or ()),
+                "types": len(self._compiled.types) if self._compiled else 0,
+                "utilization": dict(self._utilization or {}),
+                "compiles": self.compiles,
+                "batches": self.batches,
+                "quotes": self.quotes,
+            }
+
+
+def _shares(counts):
+    # {VehicleType: (rented, in service)} -> {type key: rented share}
+    totals = {}
+    for vehicle_type, (rented, in_service) in counts.items():
+        key = _type_key(vehicle_type)
+        was = totals.get(key, (0, 0))
+        totals[key] = (was[0] + int(rented or 0), was[1] + int(in_service or 0))
+    return {key: (rented / in_service if in_service else 0.0)
+            for key, (rented, in_service) in totals.items()}
+
+
+def check_rule(kind, vehicle_type="", start=None, end=None, threshold=None, multiplier=None):
+    # a PricingRule row (without RuleID) from form values, or ValueError
+    if kind not in KINDS:
+        raise ValueError("unknown rule kind %r" % kind)
+    multiplier = float(multiplier)
+    if not multiplier > 0:
+        raise ValueError("the multiplier must be positive")
+    rule = {"Kind": kind, "VehicleType": (vehicle_type or "").strip() or None,
+            "StartDate": None, "EndDate": None, "Threshold": None, "Multiplier": multiplier}
+    if kind == "season":
+        rule["StartDate"] = _date(start)
+        rule["EndDate"] = _date(end)
+        if rule["EndDate"] < rule["StartDate"]:
+            raise ValueError("a season ends after it starts")
+    elif kind == "long_rental":
+        rule["Threshold"] = float(threshold)
+        if rule["Threshold"] < 1:
+            raise ValueError("a long rental is at least 1 day")
+    elif kind == "surge":
+        rule["Threshold"] = float(threshold)
+        if not 0 <= rule["Threshold"] <= 1:
+            raise ValueError("a surge threshold is a share between 0 and 1")
+    return rule
+
+
+def _date(value):
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(value or "")
+
+
+_engine_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def get_engine(app=None):
+    app = app or current_app
+    engine = app.extensions.get("vrms_pricing")
+    if engine is None:
+        with _engine_lock:
+            engine = app.extensions.get("vrms_pricing")
+            if engine is None:
+                cfg = app.config
+                engine = PricingEngine(ttl=cfg["PRICING_RULES_TTL"],
+                                       utilization_ttl=cfg["PRICING_UTILIZATION_TTL"],
+                                       calendar_days=cfg["PRICING_CALENDAR_DAYS"])
+                app.extensions["vrms_pricing"] = engine
+    return engine
+
+
+def invalidate():
+    get_engine().invalidate()
+    cachebus.publish("pricing")
+
+
+@cachebus.handler("pricing")
+def _changed_elsewhere(app, key):
+    engine = app.extensions.get("vrms_pricing")
+    if engine is not None:
+        engine.invalidate()
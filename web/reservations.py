@@ -0,0 +1,383 @@
+import bisect
+import datetime
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+
+import cachebus
+
+# Interval index over the rentals that hold a vehicle: 'Active' ones and
+# future 'Reserved' ones. Each holds its vehicle for the days
+# [RentalDate, ReturnDate) -- the return day is free for the next
+# customer; an Active rental without a ReturnDate holds it indefinitely.
+# Days are date ordinals.
+#
+# Two views of the same intervals:
+#   - per vehicle, start / end / RentalID lists sorted by start. A
+#     vehicle's intervals never overlap, so the ends are sorted too and one
+#     bisect answers "is vehicle v free over [a, b)" -- used when booking;
+#   - fleet-wide, NumPy arrays of every interval sorted by start, for
+#     "which vehicles are free from a to b". An interval overlapping
+#     [a, b) starts in (a - SHORT_DAYS, b) as long as it is no longer than
+#     SHORT_DAYS, so two searchsorted calls bound the slice to look at;
+#     longer intervals sit in a small side table that is scanned whole.
+#     Writes go to a delta (intervals added, RentalIDs removed) that
+#     queries apply on top; after COMPACT_AT of them the arrays are rebuilt.
+#
+# Like search.py, the index follows the Rental table: write paths call
+# invalidate(vehicle_id) after committing, the next query reloads that
+# vehicle's intervals; other processes get the same invalidation over
+# cachebus, and a TTL reloads everything now and then to pick up bookings
+# made outside the app. The database stays the authority for the
+# SQL backends -- booking re-checks overlaps in the statement that
+# inserts. The in-memory store keeps its own index current with put() /
+# discard() and a ttl of None.
+#
+# Benchmark: python3 -m bench.reservations --vehicles 100000 --bookings 1000000
+
+DEFAULTS = {
+    "RESERVATION_INDEX_TTL": 300.0,
+    "RESERVATION_MAX_DAYS": 60,         # longest reservation
+    "RESERVATION_HORIZON_DAYS": 365,    # how far ahead it can start
+}
+
+HOLDING = ("Active", "Reserved")
+SHORT_DAYS = 60
+COMPACT_AT = 4096
+OPEN_END = datetime.date.max.toordinal()
+
+COLUMNS = "RentalID, VehicleID, RentalDate, ReturnDate"
+
+
+def _day(value):
+    return value.toordinal() if value is not None else OPEN_END
+
+
+class ReservationIndex:
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._vehicles = {}         # VehicleID -> ([start], [end], [RentalID])
+        self._rentals = {}          # RentalID -> (VehicleID, start, end)
+        self._flat = _empty()       # (starts, ends, vehicle ids, rental ids), by start
+        self._long = {}             # RentalID -> (VehicleID, start, end), > SHORT_DAYS
+        self._added = {}            # RentalID -> (VehicleID, start, end), not in _flat yet
+        self._removed = set()       # RentalIDs still in _flat that are gone
+        self._removed_array = None
+        self._loaded_at = None
+        self._dirty = set()
+        self._dirty_all = True
+
+        self.checks = 0
+        self.queries = 0
+        self.rebuilds = 0
+        self.refreshes = 0
+        self.compactions = 0
+
+    # ---------- invalidation ----------
+
+    def invalidate(self, vehicle_id=None):
+        with self._lock:
+            if vehicle_id is None:
+                self._dirty_all = True
+            else:
+                self._dirty.add(int(vehicle_id))
+
+    def _ensure_fresh(self, cn):
+        if cn is None:
+            return
+        with self._lock:
+            expired = (self._loaded_at is None or
+                       (self.ttl is not None and time.monotonic() - self._loaded_at > self.ttl))
+            if self._dirty_all or expired:
+                self._rebuild(cn)
+            elif self._dirty:
+                self._refresh(cn, sorted(self._dirty))
+
+    def _rebuild(self, cn):
+        cur = cn.cursor()
+        cur.execute("SELECT " + COLUMNS + " FROM Rental WHERE Status IN ('Active', 'Reserved')")
+        rows = cur.fetchall()
+        cur.close()
+        self._reset(rows)
+
+    def _refresh(self, cn, vehicle_ids):
+        if hasattr(cn, "holding"):              # all shards: just these vehicles'
+            cn = cn.holding(vehicle_ids)
+        placeholders = ", ".join(["%s"] * len(vehicle_ids))
+        cur = cn.cursor()
+        cur.execute("SELECT " + COLUMNS + " FROM Rental WHERE VehicleID IN (" + placeholders
+                    + ") AND Status IN ('Active', 'Reserved')", vehicle_ids)
+        rows = cur.fetchall()
+        cur.close()
+        for vid in vehicle_ids:
+            self._drop_vehicle(vid)
+        for rid, vid, start, end in rows:
+            self._insert(rid, vid, _day(start), _day(end))
+        self._dirty.clear()
+        self.refreshes += 1
+
+    def _reset(self, rows):
+        # rows: (RentalID, VehicleID, RentalDate, ReturnDate)
+        items = sorted((vid, _day(start), _day(end), rid) for rid, vid, start, end in rows)
+        self._vehicles = {}
+        self._rentals = {}
+        self._long = {}
+        for vid, start, end, rid in items:
+            entry = self._vehicles.get(vid)
+            if entry is None:
+                entry = self._vehicles[vid] = ([], [], [])
+            entry[0].append(start)
+            entry[1].append(end)
+            entry[2].append(rid)
+            self._rentals[rid] = (vid, start, end)
+            if end - start > SHORT_DAYS:
+                self._long[rid] = (vid, start, end)
+
+        short = [(start, end, vid, rid) for vid, start, end, rid in items
+                 if end - start <= SHORT_DAYS]
+        short.sort()
+        self._flat = _arrays(short)
+        self._added = {}
+        self._removed = set()
+        self._removed_array = None
+
+        self._loaded_at = time.monotonic()
+        self._dirty.clear()
+        self._dirty_all = False
+        self.rebuilds += 1
+
+    # ---------- direct maintenance ----------
+
+    def load(self, rows):
+        # rows: (RentalID, VehicleID, RentalDate, ReturnDate) of the holding rentals
+        with self._lock:
+            self._reset(list(rows))
+
+    def put(self, rental_id, vehicle_id, start, end):
+        with self._lock:
+            self._delete(rental_id)
+            self._insert(rental_id, vehicle_id, _day(start), _day(end))
+
+    def discard(self, rental_id):
+        with self._lock:
+            self._delete(rental_id)
+
+    def discard_vehicle(self, vehicle_id):
+        with self._lock:
+            self._drop_vehicle(vehicle_id)
+
+    # ---------- index maintenance (lock held) ----------
+
+    def _insert(self, rid, vid, start, end):
+        entry = self._vehicles.get(vid)
+        if entry is None:
+            entry = self._vehicles[vid] = ([], [], [])
+        starts, ends, rids = entry
+        i = bisect.bisect_right(starts, start)
+        starts.insert(i, start)
+        ends.insert(i, end)
+        rids.insert(i, rid)
+        self._rentals[rid] = (vid, start, end)
+        if end - start > SHORT_DAYS:
+            self._long[rid] = (vid, start, end)
+        else:
+            self._added[rid] = (vid, start, end)
+            self._maybe_compact()
+
+    def _delete(self, rid):
+        found = self._rentals.pop(rid, None)
+        if found is None:
+            return
+        vid, start, end = found
+        starts, ends, rids = self._vehicles[vid]
+        i = bisect.bisect_left(starts, start)
+        while rids[i] != rid:
+            i += 1
+        del starts[i], ends[i], rids[i]
+        if not starts:
+            del self._vehicles[vid]
+        if self._long.pop(rid, None) is None and self._added.pop(rid, None) is None:
+            self._removed.add(rid)
+            self._removed_array = None
+            self._maybe_compact()
+
+    def _drop_vehicle(self, vid):
+        entry = self._vehicles.get(vid)
+        if entry is not None:
+            for rid in list(entry[2]):
+                self._delete(rid)
+
+    def _maybe_compact(self):
+        if len(self._added) + len(self._removed) >= COMPACT_AT:
+            self._compact()
+
+    def _compact(self):
+        # fold the delta into the sorted arrays
+        starts, ends, vids, rids = self._flat
+        if self._removed:
+            keep = ~np.isin(rids, np.fromiter(self._removed, dtype=np.int64))
+            starts, ends, vids, rids = starts[keep], ends[keep], vids[keep], rids[keep]
+        if self._added:
+            added = _arrays([(start, end, vid, rid)
+                             for rid, (vid, start, end) in self._added.items()])
+            starts, ends, vids, rids = (np.concatenate(pair) for pair in
+                                        zip((starts, ends, vids, rids), added))
+            order = np.argsort(starts, kind="stable")
+            starts, ends, vids, rids = starts[order], ends[order], vids[order], rids[order]
+        self._flat = (starts, ends, vids, rids)
+        self._added = {}
+        self._removed = set()
+        self._removed_array = None
+        self.compactions += 1
+
+    # ---------- queries (lock held) ----------
+
+    def _conflicts(self, vid, a, b):
+        entry = self._vehicles.get(vid)
+        if entry is None:
+            return []
+        starts, ends, rids = entry
+        out = []
+        i = bisect.bisect_right(ends, a)        # first interval ending after a
+        while i < len(starts) and starts[i] < b:
+            out.append(rids[i])
+            i += 1
+        return out
+
+    def _busy(self, a, b):
+        # VehicleIDs (NumPy array, may repeat) held somewhere in [a, b)
+        starts, ends, vids, rids = self._flat
+        lo = np.searchsorted(starts, a - SHORT_DAYS, side="right")
+        hi = np.searchsorted(starts, b, side="left")
+        mask = ends[lo:hi] > a
+        if self._removed:
+            if self._removed_array is None:
+                self._removed_array = np.fromiter(self._removed, dtype=np.int64)
+            mask &= ~np.isin(rids[lo:hi], self._removed_array)
+        extra = [vid for table in (self._added, self._long)
+                 for vid, start, end in table.values() if start < b and end > a]
+        busy = vids[lo:hi][mask]
+        if extra:
+            busy = np.concatenate((busy, np.array(extra, dtype=np.int64)))
+        return busy
+
+    # ---------- public queries ----------
+
+    def conflicts(self, cn, vehicle_id, start, end):
+        # RentalIDs holding `vehicle_id` somewhere in [start, end)
+        self._ensure_fresh(cn)
+        with self._lock:
+            self.checks += 1
+            return self._conflicts(vehicle_id, _day(start), _day(end))
+
+    def is_free(self, cn, vehicle_id, start, end):
+        return not self.conflicts(cn, vehicle_id, start, end)
+
+    def free(self, cn, vehicle_ids, start, end):
+        # the ones of `vehicle_ids` not held anywhere in [start, end), in order
+        self._ensure_fresh(cn)
+        with self._lock:
+            self.queries += 1
+            busy = set(self._busy(_day(start), _day(end)).tolist())
+        return [vid for vid in vehicle_ids if vid not in busy]
+
+    def busy_count(self, cn, start, end):
+        self._ensure_fresh(cn)
+        with self._lock:
+            self.queries += 1
+            return len(np.unique(self._busy(_day(start), _day(end))))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "intervals": len(self._rentals),
+                "vehicles": len(self._vehicles),
+                "long": len(self._long),
+                "pending": len(self._added) + len(self._removed),
+                "checks": self.checks,
+                "queries": self.queries,
+                "rebuilds": self.rebuilds,
+                "refreshes": self.refreshes,
+                "compactions": self.compactions,
+                "stale_vehicles": len(self._dirty),
+            }
+
+
+def _empty():
+    return (np.empty(0, dtype=np.int64),) * 4
+
+
+def _arrays(items):
+    # (start, end, VehicleID, RentalID) tuples -> four int64 columns
+    if not items:
+        return _empty()
+    table = np.array(items, dtype=np.int64)
+    return tuple(np.ascontiguousarray(table[:, i]) for i in range(4))
+
+
+# ---------- date ranges ----------
+
+def parse_range(args, today=None):
+    # (start, end) from ?from=YYYY-MM-DD&to=YYYY-MM-DD, or None when no
+    # "from" is given; "to" defaults to the next day, end > start
+    today = today or datetime.date.today()
+    try:
+        start = datetime.date.fromisoformat(args.get("from", ""))
+    except ValueError:
+        return None
+    try:
+        end = datetime.date.fromisoformat(args.get("to", ""))
+    except ValueError:
+        end = start + datetime.timedelta(days=1)
+    start = max(start, today)
+    if end <= start:
+        end = start + datetime.timedelta(days=1)
+    return start, end
+
+
+def check_window(start, days, today=None, config=None):
+    # a reservation request within the configured limits, or ValueError
+    config = config or current_app.config
+    today = today or datetime.date.today()
+    if start < today:
+        raise ValueError("the start date is in the past")
+    if start > today + datetime.timedelta(days=config["RESERVATION_HORIZON_DAYS"]):
+        raise ValueError("reservations open %d days ahead" % config["RESERVATION_HORIZON_DAYS"])
+    if not 1 <= days <= config["RESERVATION_MAX_DAYS"]:
+        raise ValueError("a reservation is 1 to %d days" % config["RESERVATION_MAX_DAYS"])
+
+
+_index_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def get_index(app=None):
+    app = app or current_app
+    index = app.extensions.get("vrms_reservations")
+    if index is None:
+        with _index_lock:
+            index = app.extensions.get("vrms_reservations")
+            if index is None:
+                index = ReservationIndex(ttl=app.config["RESERVATION_INDEX_TTL"])
+                app.extensions["vrms_reservations"] = index
+    return index
+
+
+def invalidate(vehicle_id=None):
+    get_index().invalidate(vehicle_id)
+    cachebus.publish("reservations", vehicle_id)
+
+
+@cachebus.handler("reservations")
+def _changed_elsewhere(app, vehicle_id):
+    index = app.extensions.get("vrms_reservations")
+    if index is not None:
+        index.invalidate(vehicle_id)
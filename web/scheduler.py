@@ -0,0 +1,329 @@
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from flask import current_app, g
+
+import archive
+import database
+import eventlog
+import httpcache
+import metrics
+import passwords
+import storage
+import users
+
+# Background jobs, run by every app process next to the request workers.
+#
+#   overdue_sweep      marks the Active rentals past their ReturnDate
+#                      (Rental.OverdueSince) -- one UPDATE over
+#                      idx_rental_status_return, not a row-by-row loop
+#   late_fees          LateFee = days overdue * LATE_FEE_RATE * daily
+#                      price, charged with the rental's payment on return
+#   report_rollups     aggregates.reconcile() of the report totals
+#   stuck_maintenance  vehicles in 'Maintenance' for more than
+#                      MAINTENANCE_STUCK_DAYS (per the event log's fleet
+#                      model; without it every one is listed)
+#   archive            moves rentals finished more than ARCHIVE_AFTER_DAYS
+#                      ago, with their payments, to the archive tables in
+#                      bounded batches (archive.py)
+#   session_cleanup    this process's expired session state: user cache
+#                      entries, ended login-limit windows, stale cached
+#                      pages, idle pooled connections
+#
+# All but the last are shared: their JobState row (see db/) is the lock. A
+# process claims a job with a conditional UPDATE that only matches when
+# the job is due (JOB_INTERVALS) and no one else holds an unexpired lease
+# (SCHEDULER_LEASE), so with several app processes or hosts each run
+# happens once; the outcome, duration and result go back into the row for
+# /admin/jobs. session_cleanup is per process and runs in all of them.
+#
+# Jobs stay out of the request workers' way: they run on a bounded thread
+# pool (SCHEDULER_WORKERS) with connections of their own
+# (SCHEDULER_DB_POOL_SIZE), never one from the request pool, a job is
+# never queued twice, and every statement is a short set-based one. The
+# tick thread starts with the first request of each process, so forked
+# workers (gunicorn) each get their own. Run times are exported at
+# /metrics as vrms_job_duration_seconds / vrms_job_runs_total.
+
+DEFAULTS = {
+    "SCHEDULER_ENABLED": os.environ.get("VRMS_SCHEDULER", "1") == "1",
+    "SCHEDULER_WORKERS": int(os.environ.get("VRMS_SCHEDULER_WORKERS", "2")),
+    "SCHEDULER_TICK": float(os.environ.get("VRMS_SCHEDULER_TICK", "15")),
+    "SCHEDULER_LEASE": 600.0,           # seconds a claimed job stays locked
+    "SCHEDULER_DB_POOL_SIZE": 2,
+    "JOB_INTERVALS": {                  # seconds between runs; 0 = never on its own
+        "overdue_sweep": 300,
+        "late_fees": 3600,
+        "report_rollups": 900,
+        "stuck_maintenance": 3600,
+        "archive": 3600,
+        "session_cleanup": 300,
+    },
+    "LATE_FEE_RATE": 1.5,               # times the daily price, per day overdue
+    "MAINTENANCE_STUCK_DAYS": 7,
+}
+
+logger = logging.getLogger("vrms.jobs")
+
+
+# ---------- JOBS ----------
+# each runs in an app context with g.db on the scheduler's pool and
+# returns a JSON-able summary
+
+def overdue_sweep():
+    return {"marked": storage.get_store().rentals.mark_overdue(datetime.date.today())}
+
+
+def late_fees():
+    overdue, total = storage.get_store().rentals.accrue_late_fees(
+        datetime.date.today(), current_app.config["LATE_FEE_RATE"])
+    return {"overdue": overdue, "outstanding": total}
+
+
+def report_rollups():
+    drift = storage.get_store().reports.reconcile()
+    if drift:
+        logger.warning("report totals drifted, corrected: %s", drift)
+    return {"drift": {metric: float(value) for metric, value in drift.items()}}
+
+
+def stuck_maintenance():
+    vehicles = storage.get_store().vehicles.search(status="Maintenance")
+    projector = eventlog.get_projector()
+    if projector is None:
+        since = {}
+    else:
+        since = projector.view(lambda models: dict(models["fleet"].changed_at))
+    cutoff = time.time() - current_app.config["MAINTENANCE_STUCK_DAYS"] * 86400
+    stuck = []
+    for v in vehicles:
+        changed = since.get(v["VehicleID"])
+        if changed is None or changed < cutoff:
+            stuck.append({"VehicleID": v["VehicleID"], "Model": v["Model"],
+                          "RegistrationNumber": v["RegistrationNumber"],
+                          "Since": (datetime.datetime.fromtimestamp(changed).date().isoformat()
+                                    if changed is not None else None)})
+    if stuck:
+        logger.warning("%d vehicle(s) in maintenance for over %d days", len(stuck),
+                       current_app.config["MAINTENANCE_STUCK_DAYS"])
+    return {"maintenance": len(vehicles), "stuck": stuck[:100], "stuck_count": len(stuck)}
+
+
+def archive_rentals():
+    cfg = current_app.config
+    return storage.get_store().rentals.archive(archive.cutoff(cfg), cfg["ARCHIVE_BATCH_SIZE"],
+                                               cfg["ARCHIVE_MAX_BATCHES"])
+
+
+def session_cleanup():
+    out = {"user_cache": users.get_cache().prune(),
+           "login_limits": passwords.prune_login_limits()}
+    cache = httpcache.get_cache()
+    if cache is not None:
+        out["cached_pages"] = cache.prune()
+    if current_app.config["DB_BACKEND"] != "memory":
+        out["idle_connections"] = database.get_pool().prune()
+    return out
+
+
+# name -> (job, shared by all processes)
+JOBS = {
+    "overdue_sweep": (overdue_sweep, True),
+    "late_fees": (late_fees, True),
+    "report_rollups": (report_rollups, True),
+    "stuck_maintenance": (stuck_maintenance, True),
+    "archive": (archive_rentals, True),
+    "session_cleanup": (session_cleanup, False),
+}
+
+
+# ---------- SCHEDULER ----------
+
+class Scheduler:
+
+    def __init__(self, app, workers=2, tick=15.0, lease=600.0, intervals=None, pool=None):
+        self.app = app
+        self.tick = tick
+        self.lease = lease
+        self.intervals = dict(intervals or {})
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        self.pid = os.getpid()
+        self._pool = pool               # None: the store needs no connection (memory)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="vrms-job")
+        self._lock = threading.Lock()
+        self._running = set()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = {}                  # name -> this process's last run
+        self.skipped = 0                # claims lost to another process / not due
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="vrms-scheduler",
+                                                daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._executor.shutdown(wait=True)
+        if self._pool is not None:
+            self._pool.close()
+
+    def _loop(self):
+        while not self._stop.wait(self.tick):
+            try:
+                self.run_pending()
+            except Exception:
+                logger.exception("scheduler tick failed")
+
+    def run_pending(self):
+        # submits every job that may be due; the shared ones are checked
+        # against JobState when they are claimed
+        now = time.time()
+        for name, (_, shared) in JOBS.items():
+            interval = self.intervals.get(name, 0)
+            if not interval:
+                continue
+            last = self.runs.get(name)
+            if not shared and last is not None and last["started"] > now - interval:
+                continue
+            self.submit(name)
+
+    def submit(self, name, force=False):
+        # Future of run(name), or None while the job is already queued or
+        # running in this process
+        with self._lock:
+            if name in self._running:
+                return None
+            self._running.add(name)
+        try:
+            return self._executor.submit(self._run, name, force)
+        except RuntimeError:
+            # shut down
+            with self._lock:
+                self._running.discard(name)
+            return None
+
+    def _run(self, name, force):
+        try:
+            return self.run(name, force)
+        except Exception:
+            # claiming / recording failed (the job's own errors are caught
+            # in run()); nobody waits on the Future to see it
+            logger.exception("scheduling job %s failed", name)
+            raise
+        finally:
+            with self._lock:
+                self._running.discard(name)
+
+    def run(self, name, force=False):
+        # runs the job now in this thread; its summary, or None if it
+        # wasn't due (force=True ignores the interval) or another process
+        # holds it. Job failures are logged and recorded, not raised.
+        fn, shared = JOBS[name]
+        with self.app.app_context():
+            conn = None
+            if self._pool is not None:
+                conn = self._pool.acquire()
+                g.db = conn
+            try:
+                return self._run_claimed(name, fn, shared, force)
+            finally:
+                if conn is not None:
+                    # ours, not the request pool's: keep close_db() off it
+                    g.pop("db", None)
+                    self._pool.release(conn)
+
+    def _run_claimed(self, name, fn, shared, force):
+        jobs = storage.get_store().jobs
+        interval = 0 if force else self.intervals.get(name, 0)
+        started = time.time()
+        if shared and not jobs.claim(name, self.owner, self.lease, interval, started):
+            with self._lock:
+                self.skipped += 1
+            return None
+
+        t0 = time.perf_counter()
+        try:
+            result = fn()
+            status = "ok"
+        except Exception as e:
+            logger.exception("job %s failed", name)
+            result = {"error": "%s: %s" % (type(e).__name__, e)}
+            status = "error"
+        duration = time.perf_counter() - t0
+
+        if shared and not jobs.finish(name, self.owner, status, duration,
+                                      json.dumps(result, default=str), time.time()):
+            logger.warning("job %s outlived its %ss lease; its run was not recorded",
+                           name, self.lease)
+        if self.app.config["METRICS_ENABLED"]:
+            metrics.get_metrics(self.app).job(name, duration, status == "ok")
+        with self._lock:
+            self.runs[name] = {"started": started, "status": status,
+                               "duration": round(duration, 6), "result": result}
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                "owner": self.owner,
+                "running": sorted(self._running),
+                "skipped": self.skipped,
+                "runs": {name: dict(run) for name, run in self.runs.items()},
+                "pool": self._pool.stats() if self._pool is not None else None,
+            }
+
+
+_scheduler_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    app.before_request(_ensure_started)
+
+
+def _create(app):
+    cfg = app.config
+    pool = None
+    if cfg["DB_BACKEND"] != "memory":
+        connect = database.connect_factory(cfg)
+        if cfg["METRICS_ENABLED"]:
+            connect = metrics.get_metrics(app).instrument(connect)
+        pool = database.ConnectionPool(connect, size=cfg["SCHEDULER_DB_POOL_SIZE"],
+                                       max_overflow=0, timeout=cfg["DB_POOL_TIMEOUT"],
+                                       idle_timeout=cfg["DB_POOL_IDLE_TIMEOUT"],
+                                       ping=cfg["DB_POOL_PING"])
+    intervals = dict(DEFAULTS["JOB_INTERVALS"], **cfg["JOB_INTERVALS"])
+    return Scheduler(app, workers=cfg["SCHEDULER_WORKERS"], tick=cfg["SCHEDULER_TICK"],
+                     lease=cfg["SCHEDULER_LEASE"], intervals=intervals, pool=pool)
+
+
+def get_scheduler(app=None):
+    # this process's scheduler (a forked worker gets a new one), not
+    # necessarily started
+    app = app or current_app._get_current_object()   # the scheduler keeps the app
+    scheduler = app.extensions.get("vrms_scheduler")
+    if scheduler is None or scheduler.pid != os.getpid():
+        with _scheduler_lock:
+            scheduler = app.extensions.get("vrms_scheduler")
+            if scheduler is None or scheduler.pid != os.getpid():
+                scheduler = _create(app)
+                app.extensions["vrms_scheduler"] = scheduler
+    return scheduler
+
+
+def _ensure_started():
+    if current_app.config["SCHEDULER_ENABLED"]:
+        get_scheduler().start()
@@ -0,0 +1,368 @@
+import threading
+import time
+
+from flask import current_app
+
+import cachebus
+import fleet
+
+# In-process model of the Vehicle table, used instead of querying it for
+# the vehicle lists and filters: a fleet.FleetState of NumPy columns (id,
+# type, model, price, status, branch, rental count -- about 29 bytes a
+# vehicle) where a status / type / model / max-price / branch filter is a
+# vectorized mask and a model or type term is matched once against the
+# distinct strings, not per vehicle. A term finds what the old "Model LIKE
+# '%x%'" queries found; one that finds nothing falls back to the values
+# within a few typos of it (SEARCH_MIN_SIMILARITY). rank() orders the
+# matches by relevance, popularity (rentals in the Rental table, i.e. not
+# yet archived) and price, weighted SEARCH_RANK_POPULARITY / _PRICE;
+# complete() serves the filter boxes' autocompletion.
+#
+# It is loaded on first use, in one query per database shard (shards.py).
+# The SQL write paths update it write-through after committing (put() /
+# set_status() / discard()); a bulk import calls invalidate(), and the
+# next search reloads. A TTL forces a full reload now and then to pick
+# up changes made outside the app. Reloads and re-reads of single
+# vehicles query the database without holding the lock -- one thread at a
+# time, while the others keep searching the current state -- and the
+# vehicles written meanwhile are read again afterwards. The in-memory store (storage/memory.py) keeps its own
+# index current the same way, with a ttl of None. Other app processes
+# get each change over cachebus and re-read just that vehicle; rental
+# counts are bumped write-through by bookings (rented()) in the process
+# that booked, and the others pick them up at their next reload.
+
+DEFAULTS = {
+    "SEARCH_INDEX_TTL": 300.0,
+    "SEARCH_MIN_SIMILARITY": fleet.MIN_SIMILARITY,
+    "SEARCH_RANK_POPULARITY": 0.2,
+    "SEARCH_RANK_PRICE": 0.1,
+    "SEARCH_SUGGESTIONS": 8,
+}
+
+COLUMNS = "VehicleID, VehicleType, Model, RegistrationNumber, RentalPrice, Status, BranchID"
+
+RENTAL_COUNTS = "SELECT VehicleID, COUNT(*) FROM Rental WHERE Status <> 'Cancelled'"
+
+POPULARITY = RENTAL_COUNTS + " GROUP BY VehicleID ORDER BY VehicleID"
+
+LOAD_BATCH = 10000
+
+FIELDS = ("type", "model")                      # what complete() completes
+
+
+def options(config):
+    # VehicleSearchIndex keyword arguments from the app config
+    return {"min_similarity": config["SEARCH_MIN_SIMILARITY"],
+            "popularity": config["SEARCH_RANK_POPULARITY"],
+            "price": config["SEARCH_RANK_PRICE"]}
+
+
+class VehicleSearchIndex:
+
+    def __init__(self, ttl=300.0, min_similarity=fleet.MIN_SIMILARITY, popularity=0.2,
+                 price=0.1):
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.popularity = popularity
+        self.price = price
+        self._lock = threading.RLock()
+        self.fleet = fleet.FleetState(min_similarity=min_similarity)
+        self._loaded_at = None
+        self._dirty = set()
+        self._dirty_all = True
+        self._recount = set()                   # rental counts to re-read
+        self._reading = False                   # a thread is reading the database
+        self._read_done = threading.Condition(self._lock)
+
+        self.queries = 0
+        self.completions = 0
+        self.rebuilds = 0
+        self.refreshes = 0
+
+    # ---------- invalidation ----------
+
+    def invalidate(self, vehicle_id=None):
+        with self._lock:
+            if vehicle_id is None:
+                self._dirty_all = True
+            else:
+                self._dirty.add(int(vehicle_id))
+
+    def _ensure_fresh(self, cn):
+        # the database is read without the lock, by one thread at a time;
+        # the others keep using the current state meanwhile (or wait for
+        # the first load, and try it themselves if that failed)
+        with self._lock:
+            while self._reading:
+                if self._loaded_at is not None:
+                    return
+                self._read_done.wait()
+            expired = (self._loaded_at is None or
+                       (self.ttl is not None and time.monotonic() - self._loaded_at > self.ttl))
+            rebuild = self._dirty_all or expired
+            if not (rebuild or self._dirty or self._recount):
+                return
+            # what changes from here on is read again afterwards
+            ids, recount = sorted(self._dirty), sorted(self._recount)
+            self._dirty_all = False
+            self._dirty.clear()
+            self._recount.clear()
+            self._reading = True
+        try:
+            if rebuild:
+                state = self._build(cn)
+            else:
+                rows, counts = self._read(cn, ids, recount)
+        except Exception:
+            with self._lock:
+                if rebuild:
+                    self._dirty_all = True
+                self._dirty.update(ids)
+                self._recount.update(recount)
+                self._reading = False
+                self._read_done.notify_all()
+            raise
+        with self._lock:
+            if rebuild:
+                self._reset(state)
+            else:
+                self._apply(ids, rows, recount, counts)
+            self._reading = False
+            self._read_done.notify_all()
+
+    def _build(self, cn):
+        # a new FleetState read from the database, outside the lock
+        state = fleet.FleetState(min_similarity=self.min_similarity)
+        cur = cn.cursor(dictionary=True)
+        cur.execute("SELECT " + COLUMNS + " FROM Vehicle ORDER BY VehicleID")
+        while True:
+            rows = cur.fetchmany(LOAD_BATCH)
+            if not rows:
+                break
+            state.extend(rows)
+        cur.close()
+        cur = cn.cursor()
+        cur.execute(POPULARITY)
+        counts = cur.fetchall()
+        cur.close()
+        if counts:
+            state.set_rentals(*zip(*counts))
+        return state
+
+    def _reset(self, state):
+        # swaps in a rebuilt / loaded state; vehicles changed while it was
+        # being built stay pending
+        self.fleet = state
+        self._loaded_at = time.monotonic()
+        self.rebuilds += 1
+
+    def _read(self, cn, ids, recount):
+        # the rows of these vehicles and the rental counts of `recount`,
+        # outside the lock
+        if hasattr(cn, "holding"):              # all shards: just these vehicles'
+            cn = cn.holding(ids + recount)
+        rows = counts = {}
+        if ids:
+            placeholders = ", ".join(["%s"] * len(ids))
+            cur = cn.cursor(dictionary=True)
+            cur.execute("SELECT " + COLUMNS + " FROM Vehicle WHERE VehicleID IN ("
+                        + placeholders + ")", ids)
+            rows = {row["VehicleID"]: row for row in cur.fetchall()}
+            cur.close()
+        if recount:
+            placeholders = ", ".join(["%s"] * len(recount))
+            cur = cn.cursor()
+            cur.execute(RENTAL_COUNTS + " AND VehicleID IN (" + placeholders
+                        + ") GROUP BY VehicleID", recount)
+            counts = dict(cur.fetchall())
+            cur.close()
+        return rows, counts
+
+    def _apply(self, ids, rows, recount, counts):
+        for vid in ids:
+            if vid in rows:
+                self.fleet.put(rows[vid])
+            else:
+                self.fleet.discard(vid)
+        if recount:
+            self.fleet.set_rentals(recount, [counts.get(vid, 0) for vid in recount])
+        self.refreshes += 1
+
+    # ---------- write-through ----------
+
+    def load(self, rows, rentals=None):
+        # rentals: {VehicleID: rental count}
+        state = fleet.FleetState(min_similarity=self.min_similarity)
+        state.extend(sorted(rows, key=lambda row: row["VehicleID"]))
+        if rentals:
+            ids = sorted(rentals)
+            state.set_rentals(ids, [rentals[i] for i in ids])
+        with self._lock:
+            self._dirty_all = False
+            self._dirty.clear()
+            self._recount.clear()
+            self._reset(state)
+
+    def put(self, row):
+        # add or replace one vehicle (every COLUMNS field)
+        with self._lock:
+            self.fleet.put(row)
+            self._changed(row["VehicleID"])
+
+    def set_status(self, vehicle_id, status):
+        with self._lock:
+            if not self.fleet.set_status(vehicle_id, status) or self._reading:
+                # not loaded yet, or added by someone else: read it back
+                self._dirty.add(int(vehicle_id))
+
+    def discard(self, vehicle_id):
+        with self._lock:
+            self.fleet.discard(vehicle_id)
+            self._changed(vehicle_id)
+
+    def rented(self, vehicle_id, n=1):
+        # a booking (n=1) or a cancelled reservation (n=-1) of the vehicle
+        with self._lock:
+            self.fleet.add_rentals(vehicle_id, n)
+            if self._reading:
+                self._recount.add(int(vehicle_id))
+
+    def _changed(self, vehicle_id):
+        # a write-through change: a rebuild or re-read in flight may have
+        # read the vehicle before it, so it is read again after that
+        if self._reading:
+            self._dirty.add(int(vehicle_id))
+        else:
+            self._dirty.discard(vehicle_id)
+
+    # ---------- queries ----------
+
+    def search(self, cn, status=None, vehicle_type="", model="", max_price=None,
+               after=None, limit=None, branch=None):
+        # rows ordered by VehicleID; after/limit give keyset pages
+        self._ensure_fresh(cn)
+        with self._lock:
+            self.queries += 1
+            slots = self.fleet.select(status, vehicle_type, model, max_price, after, limit,
+                                      branch)
+            return self.fleet.rows(slots)
+
+    def get(self, cn, vehicle_id):
+        # one vehicle's row as the searches see it, or None
+        self._ensure_fresh(cn)
+        with self._lock:
+            return self.fleet.get(vehicle_id)
+
+    def iter_search(self, cn, status=None, vehicle_type="", model="", max_price=None,
+                    after=None, branch=None):
+        # same as search() but builds rows lazily, for streamed pages;
+        # vehicles deleted meanwhile are skipped
+        self._ensure_fresh(cn)
+        with self._lock:
+            self.queries += 1
+            state = self.fleet
+            ids = state.ids[state.select(status, vehicle_type, model, max_price, after,
+                                         branch=branch)]
+        for lo in range(0, len(ids), LOAD_BATCH):
+            with self._lock:
+                rows = self.fleet.rows(self.fleet.slots_of(ids[lo:lo + LOAD_BATCH]))
+            yield from rows
+
+    def rank(self, cn, status=None, vehicle_type="", model="", max_price=None, branch=None,
+             limit=None):
+        # rows of the matching vehicles, best first (fleet.FleetState.rank),
+        # each with its "Score"
+        self._ensure_fresh(cn)
+        with self._lock:
+            self.queries += 1
+            slots, scores = self.fleet.rank(status, vehicle_type, model, max_price, branch,
+                                            limit, self.popularity, self.price)
+            rows = self.fleet.rows(slots)
+        for row, score in zip(rows, scores.tolist()):
+            row["Score"] = round(score, 3)
+        return rows
+
+    def complete(self, cn, field, prefix, limit=8):
+        # up to `limit` VehicleType / Model values for a filter box
+        # (field "type" / "model") completing `prefix`
+        self._ensure_fresh(cn)
+        with self._lock:
+            self.completions += 1
+            return self.fleet.complete(field, prefix, limit)
+
+    def counts(self, cn, branch=None):
+        # {Status: vehicles}, of one branch or all
+        self._ensure_fresh(cn)
+        with self._lock:
+            return self.fleet.counts(branch)
+
+    def stats(self):
+        with self._lock:
+            state = self.fleet
+            nbytes = state.nbytes()
+            return {
+                "vehicles": len(state),
+                "types": len(state.types),
+                "models": len(state.models),
+                "trie_nodes": state.types.trie.nodes + state.models.trie.nodes,
+                "column_bytes": nbytes["columns"],
+                "string_bytes": nbytes["strings"],
+                "queries": self.queries,
+                "completions": self.completions,
+                "rebuilds": self.rebuilds,
+                "refreshes": self.refreshes,
+                "pending": len(self._dirty),
+                "reading": self._reading,
+            }
+
+
+_index_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def get_index(app=None):
+    app = app or current_app
+    index = app.extensions.get("vrms_search")
+    if index is None:
+        with _index_lock:
+            index = app.extensions.get("vrms_search")
+            if index is None:
+                index = VehicleSearchIndex(ttl=app.config["SEARCH_INDEX_TTL"],
+                                           **options(app.config))
+                app.extensions["vrms_search"] = index
+    return index
+
+
+def invalidate(vehicle_id=None):
+    get_index().invalidate(vehicle_id)
+    cachebus.publish("vehicles", vehicle_id)
+
+
+def put(row):
+    get_index().put(row)
+    cachebus.publish("vehicles", row["VehicleID"])
+
+
+def set_status(vehicle_id, status):
+    get_index().set_status(vehicle_id, status)
+    cachebus.publish("vehicles", vehicle_id)
+
+
+def discard(vehicle_id):
+    get_index().discard(vehicle_id)
+    cachebus.publish("vehicles", vehicle_id)
+
+
+def rented(vehicle_id, n=1):
+    get_index().rented(vehicle_id, n)
+
+
+@cachebus.handler("vehicles")
+def _changed_elsewhere(app, vehicle_id):
+    index = app.extensions.get("vrms_search")
+    if index is not None:
+        index.invalidate(vehicle_id)
@@ -0,0 +1,413 @@
+import concurrent.futures
+import contextvars
+import os
+import threading
+import time
+
+from flask import current_app
+
+import aggregates
+import cachebus
+import database
+import sqlite_compat
+
+# Multi-branch partitioning of the fleet across databases.
+#
+# Every vehicle belongs to a Branch and every branch to a shard: shard 0
+# is the main database, DB_SHARDS (database.py) lists the others. A
+# branch's vehicles, their rentals and payments, archived ones included,
+# live in its shard only. Role, Branch and User -- small, rarely written,
+# and joined by the rental queries and foreign keys -- are reference
+# tables: written to every shard (the main database first) and read from
+# shard 0; a shard that missed a write is caught up by `flask init-shards`,
+# which copies them again (copy_reference()). PricingRule and JobState
+# only live on shard 0; ReportTotals is per shard, each counting its own
+# rows (and every user).
+#
+# IDs say where a row lives: each shard hands out VehicleIDs, RentalIDs
+# and PaymentIDs from its own range, [n << ID_BITS, (n + 1) << ID_BITS),
+# so shard_of(id) is a shift rather than a directory lookup, and a listing
+# keyed on the ID is the shards' listings one after the other. prepare()
+# sets the ranges on a new shard (`flask init-shards`); MAX_SHARDS ranges
+# of 268M keep every ID in a signed INT.
+#
+# Routing, in storage/sql.py: one vehicle, rental or payment is read and
+# written on its shard, a new vehicle goes to its branch's; a branch's
+# pages (staff dashboard, returns, the customer search by branch) read
+# only that shard; a customer's own rentals and payments, the admin
+# reports and the exports cover every shard -- fan_out() runs the call
+# on each concurrently, on the fan-out executor's threads with their own
+# connections, and the caller merges. The in-process indexes (search.py,
+# reservations.py) load through all_db(), which reads the shards one after
+# the other, so a stale index entry can make a branch's request read
+# another shard.
+#
+# With no DB_SHARDS there is one shard and every fan-out is a plain call.
+#
+# Shards, branches and fan-out counters: /admin/stats/shards. Several
+# SQLite files as shards: python3 -m bench.shards
+
+DEFAULTS = {
+    "SHARD_WORKERS": int(os.environ.get("VRMS_SHARD_WORKERS", "8")),
+    "BRANCH_CACHE_TTL": 300.0,
+}
+
+ID_BITS = 28
+MAX_SHARDS = 8
+REFERENCE_TABLES = (("Role", "RoleID"), ("Branch", "BranchID"), ("User", "UserID"))
+ID_TABLES = ("Vehicle", "Rental", "Payment")
+
+# what a new shard must not keep from the sample data in db/
+_SHARD_LOCAL = ("PaymentArchive", "RentalArchive", "Payment", "Rental", "Vehicle")
+
+
+def shard_of(row_id):
+    # the shard holding this VehicleID / RentalID / PaymentID
+    return int(row_id) >> ID_BITS
+
+
+def home(row_id, shards=None):
+    # shard_of(), but 0 for an ID no configured shard hands out -- it is
+    # looked for (and not found) there
+    shard = int(row_id) >> ID_BITS
+    return shard if 0 <= shard < (count() if shards is None else shards) else 0
+
+
+def id_range(shard):
+    # [first, end) of the shard's IDs
+    return shard << ID_BITS, (shard + 1) << ID_BITS
+
+
+def count(app=None):
+    cfg = (app or current_app).config
+    return 1 if cfg["DB_BACKEND"] == "memory" else 1 + len(cfg["DB_SHARDS"])
+
+
+def all_shards(app=None):
+    return range(count(app))
+
+
+def sharded(app=None):
+    return count(app) > 1
+
+
+# ---------- BRANCHES ----------
+
+class BranchDirectory:
+    # the Branch table (shard 0), cached: {BranchID: row}
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rows = None
+        self._loaded_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._rows = None
+
+    def rows(self, cn):
+        with self._lock:
+            if (self._rows is None or
+                    (self.ttl is not None and time.monotonic() - self._loaded_at > self.ttl)):
+                cur = cn.cursor(dictionary=True)
+                cur.execute("SELECT BranchID, Name, City, Shard FROM Branch ORDER BY BranchID")
+                self._rows = {row["BranchID"]: row for row in cur.fetchall()}
+                cur.close()
+                self._loaded_at = time.monotonic()
+            return self._rows
+
+
+def branch_shard(branches, branch_id, shards):
+    # the shard of `branch_id` given the BranchDirectory rows; an unknown
+    # branch maps to shard 0, where its foreign key turns the write down
+    row = branches.get(int(branch_id))
+    if row is None:
+        return 0
+    if not 0 <= row["Shard"] < shards:
+        raise ValueError("branch %s is on shard %s, but DB_SHARDS only configures %d"
+                         % (branch_id, row["Shard"], shards))
+    return row["Shard"]
+
+
+# ---------- FAN-OUT ----------
+
+class FanOut:
+    # runs a call once per shard, concurrently; each run gets its own app
+    # context -- so its own connection from get_db() -- inside on_shard()
+
+    def __init__(self, app, workers=8):
+        self.app = app
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="vrms-shard")
+        self._lock = threading.Lock()
+        self.fan_outs = 0
+        self.calls = 0
+        self.single = 0
+
+    def _call(self, shard, fn):
+        with self.app.app_context(), database.on_shard(shard):
+            return fn()
+
+    def map(self, fn, shards):
+        # [fn() on each of `shards`], in order; the first error is raised
+        shards = list(shards)
+        if len(shards) == 1:
+            with self._lock:
+                self.single += 1
+            with database.on_shard(shards[0]):
+                return [fn()]
+        with self._lock:
+            self.fan_outs += 1
+            self.calls += len(shards)
+        futures = [self._executor.submit(contextvars.copy_context().run, self._call, shard, fn)
+                   for shard in shards]
+        return [future.result() for future in futures]
+
+    def stats(self):
+        with self._lock:
+            return {"fan_outs": self.fan_outs, "calls": self.calls, "single_shard": self.single}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+# ---------- ALL SHARDS AS ONE CONNECTION ----------
+
+class _AllShardsCursor:
+    # a read-only cursor over the same statement run on every shard's
+    # primary in turn: rows come shard by shard, each shard's in its own
+    # order (so ORDER BY an ID is ordered overall)
+
+    def __init__(self, shards, kwargs):
+        self._shards = shards
+        self._kwargs = kwargs
+        self._cur = None
+        self._pending = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=()):
+        self.close()
+        self._sql, self._params = sql, params
+        self._pending = list(self._shards or all_shards())
+        self.rowcount = 0
+        self._advance()
+
+    def _advance(self):
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+        if self._pending:
+            with database.primary(), database.on_shard(self._pending.pop(0)):
+                cn = database.get_db()
+            self._cur = cn.cursor(**self._kwargs)
+            self._cur.execute(self._sql, self._params)
+            self.rowcount += max(0, self._cur.rowcount)
+
+    def fetchmany(self, size=1):
+        rows = []
+        while self._cur is not None and len(rows) < size:
+            got = self._cur.fetchmany(size - len(rows))
+            if not got:
+                self._advance()
+            rows.extend(got)
+        return rows
+
+    def fetchall(self):
+        rows = []
+        while self._cur is not None:
+            rows.extend(self._cur.fetchall())
+            self._advance()
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def close(self):
+        self._pending = []
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
+
+
+class _AllShards:
+    # stands in for a connection when loading an in-process index
+
+    def __init__(self, shards=None):
+        self._shards = shards
+
+    def cursor(self, **kwargs):
+        return _AllShardsCursor(self._shards, kwargs)
+
+    def holding(self, row_ids):
+        # the same, over just the shards holding these IDs: an index
+        # refreshing a few vehicles reads their shards only
+        return _AllShards(sorted({home(i) for i in row_ids}))
+
+
+_ALL = _AllShards()
+
+
+def all_db():
+    # a connection reading the whole fleet: every shard's, or just the
+    # main database's primary_db() when there is one shard
+    return _ALL if sharded() else database.primary_db()
+
+
+# ---------- SETTING UP A SHARD ----------
+
+def prepare(cn, shard, backend):
+    # turns a database created from db/ into shard `shard`: the sample
+    # fleet, rentals and payments (shard 0's) removed and its IDs moved
+    # into the shard's range; the caller then copies the reference tables
+    # and reconciles its report totals. Leaves a database that already
+    # holds IDs of its range alone; True if it changed anything
+    first, _ = id_range(shard)
+    cur = cn.cursor()
+    try:
+        cur.execute("SELECT MAX(VehicleID) FROM Vehicle")
+        top = cur.fetchone()[0]
+        if top is not None and top >= first:
+            return False
+        for table in _SHARD_LOCAL:
+            cur.execute("DELETE FROM " + table)
+        for table in ID_TABLES:
+            if backend == "sqlite":
+                cur.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s",
+                            (first, table))
+                if cur.rowcount == 0:
+                    cur.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)",
+                                (table, first))
+            else:
+                cur.execute("ALTER TABLE " + table + " AUTO_INCREMENT = %d" % (first + 1))
+        cn.commit()
+        return True
+    except Exception:
+        cn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+def copy_reference(src, dst, batch=5000):
+    # makes the reference tables of `dst` (a shard) match `src` (shard 0):
+    # missing rows inserted, changed ones updated, rows gone from `src`
+    # deleted (a user's rentals in the shard with them); caller reconciles
+    # dst's report totals
+    out = {}
+    for table, key in REFERENCE_TABLES:
+        scur, dcur = src.cursor(dictionary=True), dst.cursor(dictionary=True)
+        try:
+            scur.execute("SELECT * FROM " + table + " ORDER BY " + key)
+            rows = scur.fetchall()
+            dcur.execute("SELECT * FROM " + table)
+            have = {row[key]: row for row in dcur.fetchall()}
+            if not rows:
+                continue
+            columns = list(rows[0])
+            insert = ("INSERT INTO " + table + " (" + ", ".join(columns) + ") VALUES ("
+                      + ", ".join(["%s"] * len(columns)) + ")")
+            others = [c for c in columns if c != key]
+            update = ("UPDATE " + table + " SET " + ", ".join(c + " = %s" for c in others)
+                      + " WHERE " + key + " = %s")
+            new = [[row[c] for c in columns] for row in rows if row[key] not in have]
+            changed = [[row[c] for c in others] + [row[key]] for row in rows
+                       if row[key] in have and have[row[key]] != row]
+            gone = sorted(set(have) - {row[key] for row in rows})
+            for lo in range(0, len(new), batch):
+                dcur.executemany(insert, new[lo:lo + batch])
+            for lo in range(0, len(changed), batch):
+                dcur.executemany(update, changed[lo:lo + batch])
+            for lo in range(0, len(gone), batch):
+                chunk = gone[lo:lo + batch]
+                dcur.execute("DELETE FROM " + table + " WHERE " + key + " IN ("
+                             + ", ".join(["%s"] * len(chunk)) + ")", chunk)
+            dst.commit()
+            out[table] = {"inserted": len(new), "updated": len(changed), "deleted": len(gone)}
+        except Exception:
+            dst.rollback()
+            raise
+        finally:
+            scur.close()
+            dcur.close()
+    return out
+
+
+def init_shard(app, shard):
+    # `flask init-shards` for shard n (1, 2, ...): a missing SQLite file is
+    # created from db/ (a MySQL shard's schema is loaded by hand), then
+    # prepare(), copy_reference() from shard 0 and the shard's report
+    # totals reconciled. Safe to re-run; a summary
+    cfg = app.config
+    if cfg["DB_BACKEND"] == "sqlite":
+        path = database.shard_config(cfg, shard)["SQLITE_PATH"]
+        if not os.path.exists(path):
+            sqlite_compat.create_database(path)
+    main_pool, pool = database.get_pool(app), database.get_shard_pool(shard, app)
+    main, cn = main_pool.acquire(), pool.acquire()
+    try:
+        prepared = prepare(cn, shard, cfg["DB_BACKEND"])
+        copied = copy_reference(main, cn)
+        drift = aggregates.reconcile(cn)
+    finally:
+        pool.release(cn)
+        main_pool.release(main)
+    return {"shard": shard, "prepared": prepared, "reference": copied, "drift": drift}
+
+
+_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+    if len(app.config["DB_SHARDS"]) + 1 > MAX_SHARDS:
+        raise ValueError("at most %d shards (DB_SHARDS lists the %d beyond the main database)"
+                         % (MAX_SHARDS, MAX_SHARDS - 1))
+
+
+def get_fanout(app=None):
+    app = app or current_app._get_current_object()   # the executor keeps the app
+    fanout = app.extensions.get("vrms_fanout")
+    if fanout is None:
+        with _lock:
+            fanout = app.extensions.get("vrms_fanout")
+            if fanout is None:
+                fanout = FanOut(app, workers=app.config["SHARD_WORKERS"])
+                app.extensions["vrms_fanout"] = fanout
+    return fanout
+
+
+def get_branches(app=None):
+    app = app or current_app
+    directory = app.extensions.get("vrms_branches")
+    if directory is None:
+        with _lock:
+            directory = app.extensions.get("vrms_branches")
+            if directory is None:
+                directory = BranchDirectory(ttl=app.config["BRANCH_CACHE_TTL"])
+                app.extensions["vrms_branches"] = directory
+    return directory
+
+
+def fan_out(fn, shards=None):
+    # [fn() on each shard] (every shard by default), concurrently
+    return get_fanout().map(fn, all_shards() if shards is None else shards)
+
+
+def gather(fn, shards=None):
+    # the rows fn() returns on each shard, shard after shard
+    return [row for rows in fan_out(fn, shards) for row in rows]
+
+
+def invalidate_branches():
+    get_branches().invalidate()
+    cachebus.publish("branches")
+
+
+@cachebus.handler("branches")
+def _changed_elsewhere(app, key):
+    directory = app.extensions.get("vrms_branches")
+    if directory is not None:
+        directory.invalidate()
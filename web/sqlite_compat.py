@@ -0,0 +1,152 @@
+import datetime
+import os
+import re
+import sqlite3
+
+# Small stand-in for mysql.connector on top of sqlite3, so the app (and the
+# connection pool) can run and be load-tested without a MySQL server.
+# It understands the handful of MySQL-isms app.py uses: %s placeholders,
+# dictionary cursors, CURDATE(), DATE_ADD(..., INTERVAL n DAY) and
+# TO_DAYS(column).
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "db", "vrms_sqlite.sql")
+
+_DATE_ADD = re.compile(
+    r"DATE_ADD\(\s*CURDATE\(\)\s*,\s*INTERVAL\s+(%s|\d+)\s+DAY\s*\)", re.I)
+_CURDATE = re.compile(r"CURDATE\(\)", re.I)
+_TO_DAYS = re.compile(r"TO_DAYS\(([^()]+)\)", re.I)
+
+sqlite3.register_adapter(datetime.date, lambda d: d.isoformat())
+sqlite3.register_converter("DATE", lambda b: datetime.date.fromisoformat(b.decode()))
+
+
+def translate(sql):
+    sql = _DATE_ADD.sub(r"date('now', 'localtime', '+' || \1 || ' days')", sql)
+    sql = _CURDATE.sub("date('now', 'localtime')", sql)
+    # MySQL day number: TO_DAYS('0001-01-01') = 366
+    sql = _TO_DAYS.sub(r"CAST(julianday(\1) - 1721059.5 AS INTEGER)", sql)
+    return sql.replace("%s", "?")
+
+
+class Cursor:
+    def __init__(self, conn, dictionary=False):
+        self._cur = conn.cursor()
+        self._dictionary = dictionary
+
+    def execute(self, sql, params=()):
+        self._cur.execute(translate(sql), tuple(params or ()))
+        return self
+
+    def executemany(self, sql, seq_params):
+        self._cur.executemany(translate(sql), [tuple(p) for p in seq_params])
+        return self
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return {d[0]: v for d, v in zip(self._cur.description, row)}
+
+    def fetchone(self):
+        return self._row(self._cur.fetchone())
+
+    def fetchmany(self, size=1):
+        return [self._row(r) for r in self._cur.fetchmany(size)]
+
+    def fetchall(self):
+        return [self._row(r) for r in self._cur.fetchall()]
+
+    def __iter__(self):
+        for row in self._cur:
+            yield self._row(row)
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cur.lastrowid
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    def close(self):
+        self._cur.close()
+
+
+class Connection:
+    def __init__(self, raw):
+        self._raw = raw
+
+    def cursor(self, dictionary=False, buffered=None):
+        return Cursor(self._raw, dictionary=dictionary)
+
+    def start_transaction(self):
+        # take the write lock up front (like SELECT ... FOR UPDATE would),
+        # so read-then-write sequences can't interleave with other writers
+        if not self._raw.in_transaction:
+            self._raw.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        self._raw.commit()
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def ping(self, reconnect=False):
+        # raises sqlite3.ProgrammingError once the connection is closed
+        self._raw.execute("SELECT 1").fetchone()
+
+    def is_connected(self):
+        try:
+            self.ping()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        self._raw.close()
+
+
+def connect(path=":memory:", timeout=30.0):
+    raw = sqlite3.connect(
+        path,
+        timeout=timeout,
+        uri=path.startswith("file:"),
+        check_same_thread=False,   # pooled connections move between threads
+        detect_types=sqlite3.PARSE_DECLTYPES,
+    )
+    raw.execute("PRAGMA foreign_keys = ON")
+    return Connection(raw)
+
+
+def analyze(cn, tables):
+    # refreshes the query planner's statistics for `tables` after a bulk
+    # change (InnoDB re-samples on its own), from a sample of each index
+    # so it stays quick on big tables
+    cur = cn.cursor()
+    cur.execute("PRAGMA analysis_limit = 1000")
+    for table in tables:
+        cur.execute("ANALYZE " + table)
+    cur.close()
+    cn.commit()
+
+
+def create_database(path, schema_file=SCHEMA_FILE):
+    # builds the schema + sample data from db/vrms_sqlite.sql
+    raw = sqlite3.connect(path, uri=path.startswith("file:"))
+    with open(schema_file) as f:
+        raw.executescript(f.read())
+    if not path.startswith("file:") and path != ":memory:":
+        raw.execute("PRAGMA journal_mode = WAL")
+    raw.commit()
+    raw.close()
+
+
+if __name__ == "__main__":
+    import sys
+    target = sys.argv[1] if len(sys.argv) > 1 else "vrms.sqlite3"
+    create_database(target)
+    print("created", target)
@@ -0,0 +1,59 @@
+import os
+import threading
+
+from flask import current_app
+
+import search
+from storage.base import (BranchRepository, ConstraintError, JobRepository, PaymentRepository,
+                          PricingRepository, RentalRepository, ReportRepository, Store,
+                          UserRepository, VehicleRepository)
+
+# Data access for the routes: get_store() returns the Store for
+# DB_BACKEND, whose branches / vehicles / users / rentals / payments /
+# pricing / reports / jobs repositories (interfaces in base.py) are the
+# only way app.py reads or writes data.
+#
+#   "mysql"   the production database (sql.py), through the connection pool
+#   "sqlite"  the same SQL on a local file (sql.py + sqlite_compat.py)
+#   "memory"  indexed dicts in this process (memory.py), seeded from the
+#             SQLite file MEMORY_SEED or from the sample data
+
+DEFAULTS = {
+    "MEMORY_SEED": os.environ.get("VRMS_MEMORY_SEED"),
+}
+
+BACKENDS = ("mysql", "sqlite", "memory")
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def create_store(config):
+    backend = config["DB_BACKEND"]
+    if backend == "memory":
+        from storage.memory import MemoryStore
+        return MemoryStore.from_sqlite(config["MEMORY_SEED"], search.options(config))
+    if backend == "sqlite":
+        from storage.sql import SQLiteStore
+        return SQLiteStore()
+    if backend == "mysql":
+        from storage.sql import MySQLStore
+        return MySQLStore()
+    raise ValueError("DB_BACKEND must be one of %s, not %r" % (", ".join(BACKENDS), backend))
+
+
+_store_lock = threading.Lock()
+
+
+def get_store(app=None):
+    app = app or current_app
+    store = app.extensions.get("vrms_storage")
+    if store is None:
+        with _store_lock:
+            store = app.extensions.get("vrms_storage")
+            if store is None:
+                store = create_store(app.config)
+                app.extensions["vrms_storage"] = store
+    return store
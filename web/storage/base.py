@@ -0,0 +1,319 @@
+# The data-access interface, one repository per aggregate. Routes only
+# talk to these; sql.py (MySQL, SQLite) and memory.py implement them.
+#
+# Conventions shared by every implementation:
+#   - rows are plain dicts keyed by the column names of db/vrms_export.sql
+#     (joined columns keep the aliases the templates use, e.g. Customer);
+#   - every write method is its own transaction and is committed (or
+#     rolled back) before it returns;
+#   - unique / foreign-key violations raise ConstraintError, a vehicle that
+#     can't be booked raises booking.BookingConflict;
+#   - listings are keyset pages: page(...) returns a pagination.Page built
+#     from limit + 1 rows, stream(...) a generator over the whole listing;
+#   - `branch` narrows a listing to one Branch's vehicles (None: all).
+
+
+class ConstraintError(Exception):
+    pass
+
+
+class VehicleRepository:
+
+    def get(self, vehicle_id):
+        # every Vehicle column, or None
+        raise NotImplementedError
+
+    def search(self, status=None, vehicle_type="", model="", max_price=None,
+               after=None, limit=None, branch=None):
+        # substring filters on VehicleType / Model (or, for a term that
+        # matches nothing, the values within a few typos), ordered by VehicleID
+        raise NotImplementedError
+
+    def rank(self, status=None, vehicle_type="", model="", max_price=None, branch=None,
+             limit=None):
+        # search() rows ordered best first -- by relevance to the terms,
+        # rental count and price -- each with its "Score"
+        raise NotImplementedError
+
+    def complete(self, field, prefix, limit=8):
+        # VehicleType (field "type") or Model ("model") values completing
+        # `prefix`, most used first
+        raise NotImplementedError
+
+    def iter_search(self, status=None, vehicle_type="", model="", max_price=None, after=None,
+                    branch=None):
+        raise NotImplementedError
+
+    def search_stats(self):
+        raise NotImplementedError
+
+    def status_counts(self, branch=None):
+        # {Status: vehicles}
+        raise NotImplementedError
+
+    def free_between(self, start, end, vehicle_type="", model="", max_price=None, branch=None,
+                     ranked=False):
+        # search() rows (rank() rows if ranked) of the vehicles that can be
+        # had for the days [start, end): no rental or reservation in the
+        # way, not in maintenance, and 'Available' right now if start is today
+        raise NotImplementedError
+
+    def reservation_stats(self):
+        raise NotImplementedError
+
+    def utilization(self):
+        # {VehicleType: (vehicles 'Rented', vehicles not in 'Maintenance')}
+        raise NotImplementedError
+
+    def page(self, after, limit):
+        raise NotImplementedError
+
+    def stream(self, after=None):
+        raise NotImplementedError
+
+    def add(self, vehicle_type, model, regno, price, status="Available", branch_id=1):
+        # new VehicleID
+        raise NotImplementedError
+
+    def update(self, vehicle_id, vehicle_type, model, regno, price, status, branch_id=None):
+        # branch_id None = leave unchanged; a vehicle can't move to a
+        # branch on another shard (ConstraintError)
+        raise NotImplementedError
+
+    def set_status(self, vehicle_id, status):
+        raise NotImplementedError
+
+    def delete(self, vehicle_id):
+        # the vehicle's rentals and payments go with it; False if it didn't exist
+        raise NotImplementedError
+
+    def import_records(self, records, chunk_size, max_errors, branch_id=1):
+        # records from bulk.read_records(), all for one branch; returns a
+        # bulk.ImportReport
+        raise NotImplementedError
+
+
+class UserRepository:
+
+    def get(self, user_id):
+        # UserID, Name, Email, Phone, RoleID, RoleName -- or None
+        raise NotImplementedError
+
+    def by_email(self, email):
+        # UserID, Name, Password, RoleName -- or None
+        raise NotImplementedError
+
+    def roles(self):
+        # [{RoleID, RoleName}]
+        raise NotImplementedError
+
+    def role_id(self, role_name):
+        raise NotImplementedError
+
+    def page(self, after, limit):
+        # UserID, Name, Email, RoleName, RoleID
+        raise NotImplementedError
+
+    def stream(self, after=None):
+        raise NotImplementedError
+
+    def add(self, name, email, phone, password, role_id):
+        # new UserID; `password` is already hashed
+        raise NotImplementedError
+
+    def update(self, user_id, name, email, phone, password=None, role_id=None):
+        # password / role_id None = leave unchanged
+        raise NotImplementedError
+
+    def set_role(self, user_id, role_id):
+        raise NotImplementedError
+
+    def replace_password(self, user_id, old, new):
+        # only if the stored value is still `old`; True if it was replaced
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        # the user's rentals and payments go with it; False if it didn't exist
+        raise NotImplementedError
+
+
+class RentalRepository:
+
+    def book(self, user_id, vehicle_id, days):
+        # (RentalID, TotalAmount); the vehicle becomes 'Rented'
+        raise NotImplementedError
+
+    def reserve(self, user_id, vehicle_id, start, days):
+        # (RentalID, TotalAmount) of a 'Reserved' rental over
+        # [start, start + days); the window is validated by the caller
+        raise NotImplementedError
+
+    def cancel(self, rental_id, user_id=None):
+        # True if a reservation (of this user) was cancelled
+        raise NotImplementedError
+
+    def pick_up(self, rental_id, user_id=None):
+        # a reservation due today becomes Active, the vehicle 'Rented';
+        # False if there is no such reservation, BookingConflict while the
+        # vehicle is still out
+        raise NotImplementedError
+
+    def reservations_for_user(self, user_id):
+        # RentalID, VehicleID, Model, VehicleType, RentalDate, ReturnDate,
+        # TotalAmount -- soonest first
+        raise NotImplementedError
+
+    def return_rentals(self, rental_ids, user_id=None, payment_mode="Cash"):
+        # ({RentalID: booking.RETURNED/NOT_FOUND/NOT_ACTIVE}, returned rows)
+        # as booking.return_rentals(); the vehicles become 'Available'
+        raise NotImplementedError
+
+    def active_for_user(self, user_id):
+        # RentalID, Model, VehicleType, RentalDate, ReturnDate, Status,
+        # TotalAmount, LateFee, OverdueSince
+        raise NotImplementedError
+
+    def mark_overdue(self, today):
+        # sets OverdueSince on the Active rentals due back before `today`
+        # that don't have it yet; how many were marked
+        raise NotImplementedError
+
+    def accrue_late_fees(self, today, rate):
+        # LateFee of every overdue Active rental = days overdue * `rate` *
+        # the vehicle's RentalPrice; (rentals charged, sum of their fees)
+        raise NotImplementedError
+
+    def active_page(self, after, limit, branch=None):
+        # RentalID, Customer, VehicleID, Model, RegistrationNumber,
+        # RentalDate, ReturnDate, TotalAmount -- oldest first
+        raise NotImplementedError
+
+    def recent(self, limit=10):
+        # RentalID, Customer, Model, RentalDate, ReturnDate, Status,
+        # TotalAmount -- newest RentalDate first
+        raise NotImplementedError
+
+    def stream(self, after=None):
+        # every Rental column, archived rentals included
+        raise NotImplementedError
+
+    def archive(self, before, batch_size, max_batches):
+        # moves Completed / Cancelled rentals that ended before `before`,
+        # with their payments, out of the live tables in batches (see
+        # archive.py); a JSON-able summary: rentals, payments, batches, done
+        raise NotImplementedError
+
+    def archive_state(self):
+        # ArchivedBefore, Rentals, Payments (moved so far), LastRun
+        raise NotImplementedError
+
+
+class PaymentRepository:
+
+    def for_user_page(self, user_id, after, limit):
+        # PaymentID, PaymentDate, Amount, PaymentMode, RentalID, Model,
+        # VehicleType -- newest PaymentID first, archived payments included
+        raise NotImplementedError
+
+    def for_user_stream(self, user_id, after=None):
+        raise NotImplementedError
+
+    def recent(self, limit=10):
+        # newest PaymentDate first
+        raise NotImplementedError
+
+    def stream(self, after=None):
+        # every Payment column, archived payments included
+        raise NotImplementedError
+
+
+class BranchRepository:
+
+    def all(self):
+        # [{BranchID, Name, City, Shard}] by BranchID
+        raise NotImplementedError
+
+    def shard_of(self, branch_id):
+        # the database shard holding the branch's fleet (0 if unknown)
+        raise NotImplementedError
+
+    def add(self, name, city, shard=0):
+        # new BranchID; ConstraintError for a taken name or a shard that
+        # isn't configured
+        raise NotImplementedError
+
+    def shard_stats(self):
+        # per shard: its branches, pool and what the fan-outs did
+        raise NotImplementedError
+
+
+class PricingRepository:
+
+    def rules(self):
+        # every PricingRule row, by RuleID
+        raise NotImplementedError
+
+    def add_rule(self, rule):
+        # `rule` as returned by pricing.check_rule(); new RuleID
+        raise NotImplementedError
+
+    def update_rule(self, rule_id, rule):
+        raise NotImplementedError
+
+    def delete_rule(self, rule_id):
+        # False if it didn't exist
+        raise NotImplementedError
+
+
+class ReportRepository:
+
+    def totals(self):
+        # {metric: value} for aggregates.METRICS
+        raise NotImplementedError
+
+    def reconcile(self):
+        # {metric: drift} that was found and corrected
+        raise NotImplementedError
+
+    def analytics_source(self):
+        # what analytics.Analytics reads its columns from
+        raise NotImplementedError
+
+
+class JobRepository:
+    # JobState rows of scheduler.py; `now` is Unix time
+
+    def states(self):
+        # every JobState row, by JobName
+        raise NotImplementedError
+
+    def claim(self, name, owner, lease, interval, now):
+        # takes the job for `lease` seconds if no one holds it and it last
+        # started at least `interval` seconds ago (interval=0: run now);
+        # False if another owner has it or it isn't due
+        raise NotImplementedError
+
+    def finish(self, name, owner, status, duration, result, now):
+        # records the run and releases the lease; False if the lease was
+        # lost to another owner meanwhile
+        raise NotImplementedError
+
+
+class Store:
+    # the eight repositories of one backend
+
+    name = None
+    branches = None
+    vehicles = None
+    users = None
+    rentals = None
+    payments = None
+    pricing = None
+    reports = None
+    jobs = None
+
+    def stats(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
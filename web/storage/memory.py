@@ -0,0 +1,1047 @@
+import bisect
+import datetime
+import threading
+
+import numpy as np
+from flask import current_app
+
+import archive
+import booking
+import bulk
+import eventlog
+import httpcache
+import pagination
+import pricing
+import reservations
+import search
+import sqlite_compat
+from storage.base import (BranchRepository, ConstraintError, JobRepository, PaymentRepository,
+                          PricingRepository, RentalRepository, ReportRepository, Store,
+                          UserRepository, VehicleRepository)
+
+# Pure in-memory store: every table is a dict keyed by its primary key
+# plus a sorted key list for keyset pages, with secondary indexes for the
+# lookups the routes make (email, registration number, rentals per user /
+# vehicle, active rentals, payments per rental, rentals and payments by
+# date) and the same VehicleSearchIndex / ReservationIndex the SQL store
+# uses for the vehicle filters and date ranges, kept current on every
+# write instead of reloaded.
+#
+# It behaves like the SQL schema: unique emails (case-insensitive, like
+# MySQL's collation) and registration numbers, cascading deletes, the
+# rental triggers flipping Vehicle.Status, running report totals. One
+# lock serializes writers and readers; rows handed out are copies.
+#
+# It is seeded from a SQLite database (MEMORY_SEED, e.g. one made by
+# bench/datagen.py) or from the sample data in db/vrms_sqlite.sql, and
+# nothing is persisted: it is the fast reference backend for tests and
+# benchmarks, and for small single-process deployments. Rows a SQL
+# database had archived (archive.py) are loaded back into the one tier it
+# keeps; archiving here is a no-op. It is one database, so every branch
+# is on shard 0 (see shards.py).
+
+
+# a seed made before the Branch table: its whole fleet in one branch
+DEFAULT_BRANCHES = {1: {"BranchID": 1, "Name": "Main", "City": None, "Shard": 0}}
+
+
+class Table:
+    # rows by primary key; `keys` stays sorted (new ids only ever grow)
+
+    def __init__(self, key):
+        self.key = key
+        self.rows = {}
+        self.keys = []
+        self.next_id = 1
+
+    def __len__(self):
+        return len(self.rows)
+
+    def insert(self, row):
+        row_id = row.get(self.key) or self.next_id
+        row[self.key] = row_id
+        self.next_id = max(self.next_id, row_id + 1)
+        self.rows[row_id] = row
+        if not self.keys or row_id > self.keys[-1]:
+            self.keys.append(row_id)
+        else:
+            bisect.insort(self.keys, row_id)
+        return row_id
+
+    def delete(self, row_id):
+        row = self.rows.pop(row_id, None)
+        if row is not None:
+            del self.keys[bisect.bisect_left(self.keys, row_id)]
+        return row
+
+    def ids_after(self, after=None, limit=None):
+        i = 0 if after is None else bisect.bisect_right(self.keys, after)
+        return self.keys[i:] if limit is None else self.keys[i:i + limit]
+
+
+def _add_to(index, key, value):
+    index.setdefault(key, set()).add(value)
+
+
+def _remove_from(index, key, value):
+    values = index.get(key)
+    if values is not None:
+        values.discard(value)
+        if not values:
+            del index[key]
+
+
+class MemoryStore(Store):
+    name = "memory"
+
+    def __init__(self, search_options=None):
+        self.lock = threading.RLock()
+        self.roles = {}                     # RoleID -> RoleName
+        self.branch_rows = dict(DEFAULT_BRANCHES)   # BranchID -> Branch row
+        self.user_table = Table("UserID")
+        self.vehicle_table = Table("VehicleID")
+        self.rental_table = Table("RentalID")
+        self.payment_table = Table("PaymentID")
+        self.rule_table = Table("RuleID")
+        self.job_states = {}                # JobName -> JobState row
+
+        self.emails = {}                    # casefolded Email -> UserID
+        self.regnos = {}                    # casefolded RegistrationNumber -> VehicleID
+        self.user_rentals = {}              # UserID -> {RentalID}
+        self.vehicle_rentals = {}           # VehicleID -> {RentalID}
+        self.active = set()                 # RentalIDs with Status 'Active'
+        self.rental_payments = {}           # RentalID -> {PaymentID}
+        self.rentals_by_date = []           # sorted (RentalDate, RentalID)
+        self.payments_by_date = []          # sorted (PaymentDate, PaymentID)
+        self.revenue = 0.0
+        self._loading = False               # from_sqlite() sorts the date lists once at the end
+        self.index = search.VehicleSearchIndex(ttl=None, **(search_options or {}))
+        self.index.load([])
+        self.holds = reservations.ReservationIndex(ttl=None)   # Active + Reserved rentals
+        self.holds.load([])
+
+        self.branches = MemoryBranches(self)
+        self.vehicles = MemoryVehicles(self)
+        self.users = MemoryUsers(self)
+        self.rentals = MemoryRentals(self)
+        self.payments = MemoryPayments(self)
+        self.pricing = MemoryPricing(self)
+        self.reports = MemoryReports(self)
+        self.jobs = MemoryJobs(self)
+
+    # ---------- loading ----------
+
+    @classmethod
+    def from_sqlite(cls, path=None, search_options=None):
+        # a store holding everything in the SQLite database at `path`
+        # (None = a fresh copy of the sample data); search_options are
+        # search.options()
+        if path:
+            cn = sqlite_compat.connect(path)
+        else:
+            cn = sqlite_compat.connect(":memory:")
+            with open(sqlite_compat.SCHEMA_FILE) as f:
+                cn._raw.executescript(f.read())
+        store = cls(search_options)
+        store._loading = True
+        cur = cn.cursor(dictionary=True)
+        try:
+            cur.execute("SELECT RoleID, RoleName FROM Role")
+            store.roles = {r["RoleID"]: r["RoleName"] for r in cur.fetchall()}
+            cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            tables = {row["name"] for row in cur.fetchall()}
+            if "Branch" in tables:          # else a seed made before branches
+                cur.execute("SELECT BranchID, Name, City, Shard FROM Branch")
+                store.branch_rows = {r["BranchID"]: dict(r, Shard=0) for r in cur.fetchall()}
+            rentals = "SELECT " + ", ".join(archive.RENTAL_COLUMNS) + " FROM "
+            payments = "SELECT " + ", ".join(archive.PAYMENT_COLUMNS) + " FROM "
+            for table, select, insert in (
+                    ("User", "SELECT * FROM ", store._insert_user),
+                    ("Vehicle", "SELECT * FROM ", store._insert_vehicle),
+                    ("Rental", "SELECT * FROM ", store._insert_rental),
+                    ("RentalArchive", rentals, store._insert_rental),
+                    ("Payment", "SELECT * FROM ", store._insert_payment),
+                    ("PaymentArchive", payments, store._insert_payment),
+                    ("PricingRule", "SELECT * FROM ", store.rule_table.insert)):
+                if table not in tables:
+                    continue            # a seed made before the table existed
+                cur.execute(select + table)
+                while True:
+                    rows = cur.fetchmany(10000)
+                    if not rows:
+                        break
+                    for row in rows:
+                        insert(row)
+        finally:
+            cur.close()
+            cn.close()
+        store.rentals_by_date.sort()
+        store.payments_by_date.sort()
+        store._loading = False
+        store.index.load(store.vehicle_table.rows.values(),
+                         {vid: sum(store.rental_table.rows[rid]["Status"] != "Cancelled"
+                                   for rid in rentals)
+                          for vid, rentals in store.vehicle_rentals.items()})
+        store.holds.load((rid, row["VehicleID"], row["RentalDate"], row["ReturnDate"])
+                         for rid, row in store.rental_table.rows.items()
+                         if row["Status"] in reservations.HOLDING)
+        return store
+
+    # ---------- row maintenance (lock held) ----------
+
+    def _insert_user(self, row):
+        user_id = self.user_table.insert(row)
+        self.emails[row["Email"].casefold()] = user_id
+        return user_id
+
+    def _insert_vehicle(self, row):
+        row.setdefault("BranchID", 1)
+        vehicle_id = self.vehicle_table.insert(row)
+        self.regnos[row["RegistrationNumber"].casefold()] = vehicle_id
+        return vehicle_id
+
+    def _insert_rental(self, row):
+        # seeds made before the late-fee columns existed lack them
+        row.setdefault("LateFee", 0)
+        row.setdefault("OverdueSince", None)
+        rental_id = self.rental_table.insert(row)
+        _add_to(self.user_rentals, row["UserID"], rental_id)
+        _add_to(self.vehicle_rentals, row["VehicleID"], rental_id)
+        if row["Status"] == "Active":
+            self.active.add(rental_id)
+        if row["Status"] in reservations.HOLDING and not self._loading:
+            self.holds.put(rental_id, row["VehicleID"], row["RentalDate"], row["ReturnDate"])
+        if row["Status"] != "Cancelled" and not self._loading:
+            self.index.rented(row["VehicleID"])
+        self._list(self.rentals_by_date, (row["RentalDate"], rental_id))
+        return rental_id
+
+    def _insert_payment(self, row):
+        payment_id = self.payment_table.insert(row)
+        _add_to(self.rental_payments, row["RentalID"], payment_id)
+        self._list(self.payments_by_date, (row["PaymentDate"], payment_id))
+        self.revenue += float(row["Amount"])
+        return payment_id
+
+    def _delete_rental(self, rental_id):
+        # with its payments; returns the revenue that went with them
+        row = self.rental_table.delete(rental_id)
+        _remove_from(self.user_rentals, row["UserID"], rental_id)
+        _remove_from(self.vehicle_rentals, row["VehicleID"], rental_id)
+        self.active.discard(rental_id)
+        self.holds.discard(rental_id)
+        if row["Status"] != "Cancelled":
+            self.index.rented(row["VehicleID"], -1)
+        self._unlist(self.rentals_by_date, (row["RentalDate"], rental_id))
+        revenue = 0.0
+        for payment_id in self.rental_payments.pop(rental_id, ()):
+            payment = self.payment_table.delete(payment_id)
+            self._unlist(self.payments_by_date, (payment["PaymentDate"], payment_id))
+            revenue += float(payment["Amount"])
+        self.revenue -= revenue
+        return revenue
+
+    def _list(self, ordered, item):
+        if self._loading or not ordered or item >= ordered[-1]:
+            ordered.append(item)
+        else:
+            bisect.insort(ordered, item)
+
+    @staticmethod
+    def _unlist(ordered, item):
+        i = bisect.bisect_left(ordered, item)
+        if i < len(ordered) and ordered[i] == item:
+            del ordered[i]
+
+    def _set_vehicle_status(self, vehicle_id, status):
+        vehicle = self.vehicle_table.rows.get(vehicle_id)
+        if vehicle is not None:
+            vehicle["Status"] = status
+            self.index.set_status(vehicle_id, status)
+
+    # ---------- reading ----------
+
+    def stream(self, make_rows, key, after=None):
+        # generator over a keyset listing: make_rows(after, n) returns the
+        # next n rows (copies) after key `after`; the lock is only held
+        # while a batch is copied out
+        batch = current_app.config["STREAM_BATCH_SIZE"]
+        while True:
+            with self.lock:
+                rows = make_rows(after, batch)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            if len(rows) < batch:
+                return
+            after = rows[-1][key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": self.name,
+                "users": len(self.user_table),
+                "vehicles": len(self.vehicle_table),
+                "rentals": len(self.rental_table),
+                "active_rentals": len(self.active),
+                "payments": len(self.payment_table),
+            }
+
+
+def _today():
+    return datetime.date.today()
+
+
+def _price(value):
+    try:
+        return round(float(value), 2)
+    except (TypeError, ValueError):
+        raise ConstraintError("invalid price %r" % (value,))
+
+
+class _Repository:
+
+    def __init__(self, store):
+        self.store = store
+
+
+class MemoryBranches(_Repository, BranchRepository):
+
+    def all(self):
+        with self.store.lock:
+            return [dict(row) for _, row in sorted(self.store.branch_rows.items())]
+
+    def shard_of(self, branch_id):
+        return 0
+
+    def add(self, name, city, shard=0):
+        store = self.store
+        with store.lock:
+            if shard != 0:
+                raise ConstraintError("there is no shard %s (see DB_SHARDS)" % shard)
+            if any(row["Name"].casefold() == name.casefold()
+                   for row in store.branch_rows.values()):
+                raise ConstraintError("duplicate branch Name %s" % name)
+            branch_id = max(store.branch_rows, default=0) + 1
+            store.branch_rows[branch_id] = {"BranchID": branch_id, "Name": name, "City": city,
+                                            "Shard": 0}
+        httpcache.bump("vehicles")
+        return branch_id
+
+    def shard_stats(self):
+        return {"shards": [{"shard": 0, "ids": None, "branches": sorted(self.store.branch_rows),
+                            "pool": None}],
+                "fanout": None}
+
+
+class MemoryVehicles(_Repository, VehicleRepository):
+
+    def get(self, vehicle_id):
+        with self.store.lock:
+            row = self.store.vehicle_table.rows.get(vehicle_id)
+            return dict(row) if row is not None else None
+
+    def search(self, status=None, vehicle_type="", model="", max_price=None,
+               after=None, limit=None, branch=None):
+        return self.store.index.search(None, status=status, vehicle_type=vehicle_type,
+                                       model=model, max_price=max_price, after=after, limit=limit,
+                                       branch=branch)
+
+    def iter_search(self, status=None, vehicle_type="", model="", max_price=None, after=None,
+                    branch=None):
+        return self.store.index.iter_search(None, status=status, vehicle_type=vehicle_type,
+                                            model=model, max_price=max_price, after=after,
+                                            branch=branch)
+
+    def rank(self, status=None, vehicle_type="", model="", max_price=None, branch=None,
+             limit=None):
+        return self.store.index.rank(None, status=status, vehicle_type=vehicle_type, model=model,
+                                     max_price=max_price, branch=branch, limit=limit)
+
+    def complete(self, field, prefix, limit=8):
+        return self.store.index.complete(None, field, prefix, limit)
+
+    def search_stats(self):
+        return self.store.index.stats()
+
+    def status_counts(self, branch=None):
+        return self.store.index.counts(None, branch)
+
+    def free_between(self, start, end, vehicle_type="", model="", max_price=None, branch=None,
+                     ranked=False):
+        status = "Available" if start <= _today() else None
+        find = self.rank if ranked else self.search
+        rows = [row for row in find(status=status, vehicle_type=vehicle_type, model=model,
+                                    max_price=max_price, branch=branch)
+                if row["Status"] != "Maintenance"]
+        free = set(self.store.holds.free(None, [row["VehicleID"] for row in rows], start, end))
+        return [row for row in rows if row["VehicleID"] in free]
+
+    def reservation_stats(self):
+        return self.store.holds.stats()
+
+    def utilization(self):
+        counts = {}
+        with self.store.lock:
+            for row in self.store.vehicle_table.rows.values():
+                rented, in_service = counts.get(row["VehicleType"], (0, 0))
+                counts[row["VehicleType"]] = (rented + (row["Status"] == "Rented"),
+                                              in_service + (row["Status"] != "Maintenance"))
+        return counts
+
+    def _rows(self, after, limit):
+        table = self.store.vehicle_table
+        return [dict(table.rows[i]) for i in table.ids_after(after, limit)]
+
+    def page(self, after, limit):
+        with self.store.lock:
+            return pagination.Page(self._rows(after, limit + 1), "VehicleID", after, limit)
+
+    def stream(self, after=None):
+        return self.store.stream(self._rows, "VehicleID", after)
+
+    def _check(self, vehicle_id, regno, status, branch_id=None):
+        if status not in bulk.VEHICLE_STATUSES:
+            raise ConstraintError("invalid Status %r" % status)
+        if branch_id is not None and branch_id not in self.store.branch_rows:
+            raise ConstraintError("no branch %s" % branch_id)
+        taken = self.store.regnos.get(regno.casefold())
+        if taken is not None and taken != vehicle_id:
+            raise ConstraintError("duplicate RegistrationNumber %s" % regno)
+
+    def add(self, vehicle_type, model, regno, price, status="Available", branch_id=1):
+        store = self.store
+        with store.lock:
+            self._check(None, regno, status, branch_id)
+            row = {"VehicleID": None, "VehicleType": vehicle_type, "Model": model,
+                   "RegistrationNumber": regno, "RentalPrice": _price(price), "Status": status,
+                   "BranchID": branch_id}
+            vehicle_id = store._insert_vehicle(row)
+            store.index.put(row)
+        httpcache.bump("vehicles")
+        eventlog.append(eventlog.status_changed(vehicle_id, status))
+        return vehicle_id
+
+    def update(self, vehicle_id, vehicle_type, model, regno, price, status, branch_id=None):
+        store = self.store
+        with store.lock:
+            row = store.vehicle_table.rows.get(vehicle_id)
+            if row is None:
+                return
+            self._check(vehicle_id, regno, status, branch_id)
+            del store.regnos[row["RegistrationNumber"].casefold()]
+            row.update(VehicleType=vehicle_type, Model=model, RegistrationNumber=regno,
+                       RentalPrice=_price(price), Status=status)
+            if branch_id is not None:
+                row["BranchID"] = branch_id
+            store.regnos[regno.casefold()] = vehicle_id
+            store.index.put(row)
+        httpcache.bump("vehicles")
+        eventlog.append(eventlog.status_changed(vehicle_id, status))
+
+    def set_status(self, vehicle_id, status):
+        if status not in bulk.VEHICLE_STATUSES:
+            raise ConstraintError("invalid Status %r" % status)
+        with self.store.lock:
+            self.store._set_vehicle_status(vehicle_id, status)
+        httpcache.bump("vehicles")
+        eventlog.append(eventlog.status_changed(vehicle_id, status))
+
+    def delete(self, vehicle_id):
+        store = self.store
+        with store.lock:
+            row = store.vehicle_table.delete(vehicle_id)
+            if row is None:
+                return False
+            del store.regnos[row["RegistrationNumber"].casefold()]
+            for rental_id in list(store.vehicle_rentals.get(vehicle_id, ())):
+                store._delete_rental(rental_id)
+            store.index.discard(vehicle_id)
+        httpcache.bump("vehicles", "rentals", "payments")
+        eventlog.append(eventlog.status_changed(vehicle_id, "Deleted"))
+        return True
+
+    def import_records(self, records, chunk_size, max_errors, branch_id=1):
+        store = self.store
+        report = bulk.ImportReport(max_errors)
+        for chunk in bulk.valid_chunks(records, report, chunk_size):
+            report.chunks += 1
+            events = []
+            with store.lock:
+                if branch_id not in store.branch_rows:
+                    for line_no, _ in chunk:
+                        report.reject(line_no, "no branch %s" % branch_id)
+                    continue
+                for line_no, (vtype, model, regno, price, status) in chunk:
+                    if regno.casefold() in store.regnos:
+                        report.reject(line_no, "RegistrationNumber %s already exists" % regno)
+                        continue
+                    row = {"VehicleID": None, "VehicleType": vtype, "Model": model,
+                           "RegistrationNumber": regno, "RentalPrice": _price(price),
+                           "Status": status, "BranchID": branch_id}
+                    events.append(eventlog.status_changed(store._insert_vehicle(row), status))
+                    store.index.put(row)
+                    report.inserted += 1
+            eventlog.append(*events)
+        report.errors.sort()
+        if report.inserted:
+            httpcache.bump("vehicles")
+        return report
+
+
+class MemoryUsers(_Repository, UserRepository):
+
+    def _public(self, row):
+        return {"UserID": row["UserID"], "Name": row["Name"], "Email": row["Email"],
+                "Phone": row["Phone"], "RoleID": row["RoleID"],
+                "RoleName": self.store.roles.get(row["RoleID"])}
+
+    def get(self, user_id):
+        with self.store.lock:
+            row = self.store.user_table.rows.get(user_id)
+            return self._public(row) if row is not None else None
+
+    def by_email(self, email):
+        store = self.store
+        with store.lock:
+            user_id = store.emails.get(email.casefold())
+            if user_id is None:
+                return None
+            row = store.user_table.rows[user_id]
+            return {"UserID": user_id, "Name": row["Name"], "Password": row["Password"],
+                    "RoleName": store.roles.get(row["RoleID"])}
+
+    def roles(self):
+        with self.store.lock:
+            return [{"RoleID": k, "RoleName": v} for k, v in sorted(self.store.roles.items())]
+
+    def role_id(self, role_name):
+        with self.store.lock:
+            for role_id, name in self.store.roles.items():
+                if name == role_name:
+                    return role_id
+        return None
+
+    def _rows(self, after, limit):
+        table = self.store.user_table
+        out = []
+        for user_id in table.ids_after(after, limit):
+            row = table.rows[user_id]
+            out.append({"UserID": user_id, "Name": row["Name"], "Email": row["Email"],
+                        "RoleName": self.store.roles.get(row["RoleID"]),
+                        "RoleID": row["RoleID"]})
+        return out
+
+    def page(self, after, limit):
+        with self.store.lock:
+            return pagination.Page(self._rows(after, limit + 1), "UserID", after, limit)
+
+    def stream(self, after=None):
+        return self.store.stream(self._rows, "UserID", after)
+
+    def _check(self, user_id, email, role_id):
+        try:
+            role_id = int(role_id)
+        except (TypeError, ValueError):
+            raise ConstraintError("invalid RoleID %r" % (role_id,))
+        if role_id not in self.store.roles:
+            raise ConstraintError("unknown RoleID %s" % role_id)
+        taken = self.store.emails.get(email.casefold())
+        if taken is not None and taken != user_id:
+            raise ConstraintError("duplicate Email %s" % email)
+        return role_id
+
+    def add(self, name, email, phone, password, role_id):
+        store = self.store
+        with store.lock:
+            role_id = self._check(None, email, role_id)
+            return store._insert_user({"UserID": None, "Name": name, "Email": email,
+                                       "Phone": phone, "Password": password, "RoleID": role_id})
+
+    def update(self, user_id, name, email, phone, password=None, role_id=None):
+        store = self.store
+        with store.lock:
+            row = store.user_table.rows.get(user_id)
+            if row is None:
+                return
+            role_id = self._check(user_id, email, row["RoleID"] if role_id is None else role_id)
+            del store.emails[row["Email"].casefold()]
+            row.update(Name=name, Email=email, Phone=phone, RoleID=role_id)
+            if password is not None:
+                row["Password"] = password
+            store.emails[email.casefold()] = user_id
+
+    def set_role(self, user_id, role_id):
+        store = self.store
+        with store.lock:
+            row = store.user_table.rows.get(user_id)
+            if row is not None:
+                row["RoleID"] = self._check(user_id, row["Email"], role_id)
+
+    def replace_password(self, user_id, old, new):
+        with self.store.lock:
+            row = self.store.user_table.rows.get(user_id)
+            if row is None or row["Password"] != old:
+                return False
+            row["Password"] = new
+            return True
+
+    def delete(self, user_id):
+        store = self.store
+        with store.lock:
+            row = store.user_table.delete(user_id)
+            if row is None:
+                return False
+            del store.emails[row["Email"].casefold()]
+            for rental_id in list(store.user_rentals.get(user_id, ())):
+                store._delete_rental(rental_id)
+        httpcache.bump("rentals", "payments")
+        return True
+
+
+class MemoryRentals(_Repository, RentalRepository):
+
+    def _quote(self, vehicle_id, start, days):
+        # before taking the store lock: the engine may read rules and
+        # utilization through the repositories
+        vehicle = self.store.vehicles.get(vehicle_id)
+        if vehicle is None:
+            return None
+        return pricing.get_engine().quote(self.store, vehicle, start, days)
+
+    def _insert(self, user_id, vehicle_id, start, days, total, status):
+        # lock held; the vehicle is checked by the caller
+        store = self.store
+        if user_id not in store.user_table.rows:
+            raise ConstraintError("unknown UserID %s" % user_id)
+        end = start + datetime.timedelta(days=days)
+        if not store.holds.is_free(None, vehicle_id, start, end):
+            raise booking.BookingConflict(
+                "vehicle %s is not available from %s" % (vehicle_id, start))
+        if total is None:
+            total = round(float(store.vehicle_table.rows[vehicle_id]["RentalPrice"]) * days, 2)
+        rental_id = store._insert_rental({
+            "RentalID": None, "UserID": user_id, "VehicleID": vehicle_id,
+            "RentalDate": start, "ReturnDate": end, "TotalAmount": total,
+            "LateFee": 0, "OverdueSince": None, "Status": status})
+        return rental_id, total
+
+    def book(self, user_id, vehicle_id, days):
+        store = self.store
+        days = max(1, days)
+        total = self._quote(vehicle_id, _today(), days)
+        with store.lock:
+            vehicle = store.vehicle_table.rows.get(vehicle_id)
+            if vehicle is None or vehicle["Status"] != "Available":
+                raise booking.BookingConflict("vehicle %s is not available" % vehicle_id)
+            result = self._insert(user_id, vehicle_id, _today(), days, total, "Active")
+            store._set_vehicle_status(vehicle_id, "Rented")
+        httpcache.bump("rentals", "vehicles")
+        eventlog.append(eventlog.booked(result[0], user_id, vehicle_id, result[1], _today(), days))
+        return result
+
+    def reserve(self, user_id, vehicle_id, start, days):
+        store = self.store
+        days = max(1, days)
+        total = self._quote(vehicle_id, start, days)
+        with store.lock:
+            vehicle = store.vehicle_table.rows.get(vehicle_id)
+            if vehicle is None or vehicle["Status"] == "Maintenance":
+                raise booking.BookingConflict(
+                    "vehicle %s is not available from %s" % (vehicle_id, start))
+            result = self._insert(user_id, vehicle_id, start, days, total, "Reserved")
+        httpcache.bump("rentals")
+        eventlog.append(eventlog.reserved(result[0], user_id, vehicle_id, result[1], start, days))
+        return result
+
+    def _reservation(self, rental_id, user_id):
+        row = self.store.rental_table.rows.get(rental_id)
+        if row is None or row["Status"] != "Reserved":
+            return None
+        if user_id is not None and row["UserID"] != user_id:
+            return None
+        return row
+
+    def cancel(self, rental_id, user_id=None):
+        store = self.store
+        with store.lock:
+            row = self._reservation(rental_id, user_id)
+            if row is None:
+                return False
+            row["Status"] = "Cancelled"
+            store.holds.discard(rental_id)
+            store.index.rented(row["VehicleID"], -1)
+        httpcache.bump("rentals")
+        eventlog.append(eventlog.cancelled(rental_id, row["UserID"], row["VehicleID"]))
+        return True
+
+    def pick_up(self, rental_id, user_id=None):
+        store = self.store
+        with store.lock:
+            row = self._reservation(rental_id, user_id)
+            if row is None or row["RentalDate"] > _today():
+                return False
+            if store.vehicle_table.rows[row["VehicleID"]]["Status"] != "Available":
+                raise booking.BookingConflict("vehicle %s is not back yet" % row["VehicleID"])
+            row["Status"] = "Active"
+            store.active.add(rental_id)
+            # as trg_rental_update_status
+            store._set_vehicle_status(row["VehicleID"], "Rented")
+        httpcache.bump("rentals", "vehicles")
+        eventlog.append(eventlog.picked_up(rental_id, row["UserID"], row["VehicleID"]))
+        return True
+
+    def reservations_for_user(self, user_id):
+        store = self.store
+        with store.lock:
+            out = []
+            for rid in store.user_rentals.get(user_id, ()):
+                row = store.rental_table.rows[rid]
+                if row["Status"] != "Reserved":
+                    continue
+                vehicle = store.vehicle_table.rows[row["VehicleID"]]
+                out.append({"RentalID": rid, "VehicleID": row["VehicleID"],
+                            "Model": vehicle["Model"], "VehicleType": vehicle["VehicleType"],
+                            "RentalDate": row["RentalDate"], "ReturnDate": row["ReturnDate"],
+                            "TotalAmount": row["TotalAmount"]})
+            out.sort(key=lambda r: (r["RentalDate"], r["RentalID"]))
+            return out
+
+    def return_rentals(self, rental_ids, user_id=None, payment_mode="Cash"):
+        ids = list(dict.fromkeys(int(r) for r in rental_ids))
+        results = {}
+        returned = []
+        store = self.store
+        with store.lock:
+            today = _today()
+            for rid in ids:
+                row = store.rental_table.rows.get(rid)
+                if row is None or (user_id is not None and row["UserID"] != user_id):
+                    results[rid] = booking.NOT_FOUND
+                elif row["Status"] != "Active":
+                    results[rid] = booking.NOT_ACTIVE
+                else:
+                    results[rid] = booking.RETURNED
+                    returned.append({k: row[k] for k in ("RentalID", "UserID", "VehicleID",
+                                                         "TotalAmount", "LateFee", "Status")})
+                    row["Status"] = "Completed"
+                    row["ReturnDate"] = today
+                    store.active.discard(rid)
+                    store.holds.discard(rid)
+                    store._insert_payment({"PaymentID": None, "RentalID": rid, "PaymentDate": today,
+                                           "Amount": booking.amount_due(row),
+                                           "PaymentMode": payment_mode})
+                    # as trg_rental_update_status
+                    store._set_vehicle_status(row["VehicleID"], "Available")
+        if returned:
+            httpcache.bump("rentals", "vehicles", "payments")
+            eventlog.append(*(eventlog.returned(row, payment_mode, today) for row in returned))
+        return results, returned
+
+    def active_for_user(self, user_id):
+        store = self.store
+        with store.lock:
+            out = []
+            for rid in sorted(store.user_rentals.get(user_id, ())):
+                row = store.rental_table.rows[rid]
+                if row["Status"] != "Active":
+                    continue
+                vehicle = store.vehicle_table.rows[row["VehicleID"]]
+                out.append({"RentalID": rid, "Model": vehicle["Model"],
+                            "VehicleType": vehicle["VehicleType"],
+                            "RentalDate": row["RentalDate"], "ReturnDate": row["ReturnDate"],
+                            "Status": row["Status"], "TotalAmount": row["TotalAmount"],
+                            "LateFee": row["LateFee"], "OverdueSince": row["OverdueSince"]})
+            return out
+
+    def _overdue(self, today):
+        # lock held; the Active rentals due back before `today` (as in SQL,
+        # an open-ended one -- ReturnDate NULL -- is never overdue)
+        rows = self.store.rental_table.rows
+        return [rows[rid] for rid in self.store.active
+                if rows[rid]["ReturnDate"] is not None and rows[rid]["ReturnDate"] < today]
+
+    def mark_overdue(self, today):
+        with self.store.lock:
+            marked = 0
+            for row in self._overdue(today):
+                if row["OverdueSince"] is None:
+                    row["OverdueSince"] = row["ReturnDate"]
+                    marked += 1
+        if marked:
+            httpcache.bump("rentals")
+        return marked
+
+    def accrue_late_fees(self, today, rate):
+        store = self.store
+        charged = 0
+        total = 0.0
+        with store.lock:
+            overdue = self._overdue(today)
+            for row in overdue:
+                price = float(store.vehicle_table.rows[row["VehicleID"]]["RentalPrice"])
+                fee = round((today - row["ReturnDate"]).days * rate * price, 2)
+                if fee != row["LateFee"]:
+                    row["LateFee"] = fee
+                    charged += 1
+                total += fee
+        if charged:
+            httpcache.bump("rentals")
+        return len(overdue), round(total, 2)
+
+    def active_page(self, after, limit, branch=None):
+        store = self.store
+        with store.lock:
+            ids = sorted(rid for rid in store.active if after is None or rid > after)
+            if branch is not None:
+                rentals, vehicles = store.rental_table.rows, store.vehicle_table.rows
+                ids = [rid for rid in ids
+                       if vehicles[rentals[rid]["VehicleID"]]["BranchID"] == branch]
+            ids = ids[:limit + 1]
+            rows = []
+            for rid in ids:
+                row = store.rental_table.rows[rid]
+                vehicle = store.vehicle_table.rows[row["VehicleID"]]
+                rows.append({"RentalID": rid,
+                             "Customer": store.user_table.rows[row["UserID"]]["Name"],
+                             "VehicleID": row["VehicleID"], "Model": vehicle["Model"],
+                             "RegistrationNumber": vehicle["RegistrationNumber"],
+                             "RentalDate": row["RentalDate"], "ReturnDate": row["ReturnDate"],
+                             "TotalAmount": row["TotalAmount"], "LateFee": row["LateFee"]})
+            return pagination.Page(rows, "RentalID", after, limit)
+
+    def recent(self, limit=10):
+        store = self.store
+        with store.lock:
+            out = []
+            for _, rid in reversed(store.rentals_by_date[-limit:]):
+                row = store.rental_table.rows[rid]
+                out.append({"RentalID": rid,
+                            "Customer": store.user_table.rows[row["UserID"]]["Name"],
+                            "Model": store.vehicle_table.rows[row["VehicleID"]]["Model"],
+                            "RentalDate": row["RentalDate"], "ReturnDate": row["ReturnDate"],
+                            "Status": row["Status"], "TotalAmount": row["TotalAmount"]})
+            return out
+
+    def _rows(self, after, limit):
+        table = self.store.rental_table
+        return [dict(table.rows[i]) for i in table.ids_after(after, limit)]
+
+    def stream(self, after=None):
+        return self.store.stream(self._rows, "RentalID", after)
+
+    def archive(self, before, batch_size, max_batches):
+        # nothing to gain: every row is in memory either way
+        return {"before": before.isoformat(), "rentals": 0, "payments": 0, "batches": 0,
+                "done": True}
+
+    def archive_state(self):
+        return {"ArchivedBefore": None, "Rentals": 0, "Payments": 0, "LastRun": None}
+
+
+class MemoryPayments(_Repository, PaymentRepository):
+
+    def _for_user(self, user_id, after, limit):
+        # newest PaymentID first
+        store = self.store
+        ids = []
+        for rid in store.user_rentals.get(user_id, ()):
+            ids.extend(store.rental_payments.get(rid, ()))
+        ids = sorted((pid for pid in ids if after is None or pid < after), reverse=True)[:limit]
+        out = []
+        for pid in ids:
+            payment = store.payment_table.rows[pid]
+            rental = store.rental_table.rows[payment["RentalID"]]
+            vehicle = store.vehicle_table.rows[rental["VehicleID"]]
+            out.append({"PaymentID": pid, "PaymentDate": payment["PaymentDate"],
+                        "Amount": payment["Amount"], "PaymentMode": payment["PaymentMode"],
+                        "RentalID": payment["RentalID"], "Model": vehicle["Model"],
+                        "VehicleType": vehicle["VehicleType"]})
+        return out
+
+    def for_user_page(self, user_id, after, limit):
+        with self.store.lock:
+            return pagination.Page(self._for_user(user_id, after, limit + 1),
+                                   "PaymentID", after, limit)
+
+    def for_user_stream(self, user_id, after=None):
+        return self.store.stream(lambda a, n: self._for_user(user_id, a, n), "PaymentID", after)
+
+    def recent(self, limit=10):
+        store = self.store
+        with store.lock:
+            return [dict(store.payment_table.rows[pid])
+                    for _, pid in reversed(store.payments_by_date[-limit:])]
+
+    def _rows(self, after, limit):
+        table = self.store.payment_table
+        return [dict(table.rows[i]) for i in table.ids_after(after, limit)]
+
+    def stream(self, after=None):
+        return self.store.stream(self._rows, "PaymentID", after)
+
+
+class MemoryPricing(_Repository, PricingRepository):
+
+    def rules(self):
+        table = self.store.rule_table
+        with self.store.lock:
+            return [dict(table.rows[i]) for i in table.keys]
+
+    def add_rule(self, rule):
+        with self.store.lock:
+            rule_id = self.store.rule_table.insert(dict(rule, RuleID=None))
+        pricing.invalidate()
+        httpcache.bump("pricing")
+        return rule_id
+
+    def update_rule(self, rule_id, rule):
+        with self.store.lock:
+            row = self.store.rule_table.rows.get(rule_id)
+            if row is not None:
+                row.update(rule)
+        pricing.invalidate()
+        httpcache.bump("pricing")
+
+    def delete_rule(self, rule_id):
+        with self.store.lock:
+            deleted = self.store.rule_table.delete(rule_id) is not None
+        pricing.invalidate()
+        httpcache.bump("pricing")
+        return deleted
+
+
+class MemoryJobs(_Repository, JobRepository):
+    # one process, so the lease only keeps the scheduler's own threads apart
+
+    def states(self):
+        with self.store.lock:
+            return [dict(self.store.job_states[name]) for name in sorted(self.store.job_states)]
+
+    def claim(self, name, owner, lease, interval, now):
+        with self.store.lock:
+            row = self.store.job_states.setdefault(name, {
+                "JobName": name, "LockedBy": None, "LockedUntil": None, "LastStarted": None,
+                "LastFinished": None, "LastStatus": None, "LastDuration": None,
+                "LastResult": None, "Runs": 0, "Failures": 0})
+            if row["LockedBy"] is not None and row["LockedUntil"] >= now:
+                return False
+            if row["LastStarted"] is not None and row["LastStarted"] > now - interval:
+                return False
+            row.update(LockedBy=owner, LockedUntil=now + lease, LastStarted=now)
+            return True
+
+    def finish(self, name, owner, status, duration, result, now):
+        with self.store.lock:
+            row = self.store.job_states.get(name)
+            if row is None or row["LockedBy"] != owner:
+                return False
+            row.update(LockedBy=None, LockedUntil=None, LastFinished=now, LastStatus=status,
+                       LastDuration=duration, LastResult=result, Runs=row["Runs"] + 1,
+                       Failures=row["Failures"] + (status != "ok"))
+            return True
+
+
+class MemoryReports(_Repository, ReportRepository):
+
+    def totals(self):
+        store = self.store
+        with store.lock:
+            return {
+                "total_users": len(store.user_table),
+                "total_vehicles": len(store.vehicle_table),
+                "total_rentals": len(store.rental_table),
+                "total_revenue": round(store.revenue, 2),
+            }
+
+    def reconcile(self):
+        # the counts are the tables themselves; only the running revenue
+        # sum can drift (float rounding)
+        store = self.store
+        with store.lock:
+            actual = sum(float(p["Amount"]) for p in store.payment_table.rows.values())
+            drift = actual - store.revenue
+            store.revenue = actual
+        return {"total_revenue": drift} if round(drift, 2) else {}
+
+    def analytics_source(self):
+        return MemorySource(self.store)
+
+
+class MemorySource:
+    # analytics.SQLSource's columns computed from the store; one row per
+    # rental / payment, the engine doesn't need them grouped
+
+    def __init__(self, store):
+        self.store = store
+
+    def payments(self, lo, hi):
+        store = self.store
+        with store.lock:
+            ordered = store.payments_by_date
+            i = bisect.bisect_left(ordered, (lo, 0))
+            j = bisect.bisect_left(ordered, (hi + datetime.timedelta(days=1), 0))
+            days, types, amounts = [], [], []
+            for day, pid in ordered[i:j]:
+                payment = store.payment_table.rows[pid]
+                rental = store.rental_table.rows[payment["RentalID"]]
+                days.append(day.toordinal())
+                types.append(store.vehicle_table.rows[rental["VehicleID"]]["VehicleType"])
+                amounts.append(float(payment["Amount"]))
+        return (np.array(days, dtype=np.int64), np.array(types, dtype=object),
+                np.array(amounts, dtype=np.float64))
+
+    def _overlapping(self, lo, hi):
+        # rentals started by `hi` that are active or ended on/after `lo`
+        store = self.store
+        ordered = store.rentals_by_date
+        j = bisect.bisect_left(ordered, (hi + datetime.timedelta(days=1), 0))
+        for _, rid in ordered[:j]:
+            row = store.rental_table.rows[rid]
+            active = row["Status"] == "Active"
+            if active or (row["Status"] == "Completed" and row["ReturnDate"] is not None
+                          and row["ReturnDate"] >= lo):
+                yield row, active
+
+    def rentals(self, lo, hi):
+        store = self.store
+        with store.lock:
+            starts, ends, actives, types = [], [], [], []
+            for row, active in self._overlapping(lo, hi):
+                start = row["RentalDate"].toordinal()
+                starts.append(start)
+                ends.append(row["ReturnDate"].toordinal() if row["ReturnDate"] else start)
+                actives.append(active)
+                types.append(store.vehicle_table.rows[row["VehicleID"]]["VehicleType"])
+        n = len(starts)
+        return (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+                np.array(actives, dtype=bool), np.array(types, dtype=object),
+                np.ones(n, dtype=np.int64))
+
+    def vehicle_rentals(self, lo, hi):
+        with self.store.lock:
+            ids, starts, ends, actives = [], [], [], []
+            for row, active in self._overlapping(lo, hi):
+                start = row["RentalDate"].toordinal()
+                ids.append(row["VehicleID"])
+                starts.append(start)
+                ends.append(row["ReturnDate"].toordinal() if row["ReturnDate"] else start)
+                actives.append(active)
+        n = len(ids)
+        return (np.array(ids, dtype=np.int64), np.array(starts, dtype=np.int64),
+                np.array(ends, dtype=np.int64), np.array(actives, dtype=bool),
+                np.ones(n, dtype=np.int64))
+
+    def fleet(self):
+        with self.store.lock:
+            fleet = {}
+            for row in self.store.vehicle_table.rows.values():
+                fleet[row["VehicleType"]] = fleet.get(row["VehicleType"], 0) + 1
+            return fleet
+
+    def vehicles(self, ids):
+        with self.store.lock:
+            rows = self.store.vehicle_table.rows
+            return {i: {"VehicleID": i, "VehicleType": rows[i]["VehicleType"],
+                        "Model": rows[i]["Model"]} for i in ids if i in rows}
@@ -0,0 +1,917 @@
+import contextlib
+import datetime
+import functools
+
+from flask import current_app
+
+import aggregates
+import analytics
+import archive
+import booking
+import bulk
+import eventlog
+import httpcache
+import pagination
+import pricing
+import reservations
+import search
+import shards
+import sqlite_compat
+from database import (current_shard, get_db, get_pool, get_shard_pool, on_shard, primary,
+                      primary_db)
+from storage.base import (BranchRepository, ConstraintError, JobRepository, PaymentRepository,
+                          PricingRepository, RentalRepository, ReportRepository, Store,
+                          UserRepository, VehicleRepository)
+
+# MySQL and SQLite repositories. Both speak the same SQL through a pooled
+# connection (sqlite_compat translates the MySQL date functions); the few
+# places where the dialects really differ -- booking through
+# sp_book_vehicle vs. a guarded INSERT ... SELECT, row locks -- are in
+# booking.py and keyed on Store.name. Every method works on the request's
+# connection from get_db(), so it must run inside an app context.
+#
+# The vehicle search index (search.py) sits in front of the Vehicle table
+# and the interval index (reservations.py) in front of the rentals holding
+# a vehicle; the write methods invalidate what they touch after committing.
+# Those indexes load through primary_db(), and writes always go to the
+# primary, even from a view routed to a read replica (database.read_only).
+# Rentals are charged what pricing.py quotes for the vehicle's index row.
+#
+# Old finished rentals and their payments are moved to RentalArchive /
+# PaymentArchive (archive.py); the history listings, recent lists and
+# exports read both tiers in one statement, and deletes take the
+# archived rows along.
+#
+# With DB_SHARDS the branches' vehicles, rentals and payments are spread
+# over several databases (shards.py): a vehicle / rental / payment is read
+# and written on the shard its ID belongs to, listings over all of them
+# are fetched from every shard concurrently and merged, and the reference
+# tables (Role, Branch, User) are written to every shard. With one shard
+# every method behaves as before.
+
+USER_QUERY = """
+    SELECT u.UserID, u.Name, u.Email, u.Phone, u.RoleID, r.RoleName
+    FROM User u
+    LEFT JOIN Role r ON u.RoleID = r.RoleID
+    WHERE u.UserID = %s
+"""
+
+USER_LIST = """
+    SELECT u.UserID, u.Name, u.Email, r.RoleName, u.RoleID
+    FROM User u
+    LEFT JOIN Role r ON u.RoleID = r.RoleID
+    WHERE 1=1
+"""
+
+ACTIVE_RENTALS = """
+    SELECT r.RentalID, u.Name AS Customer, v.VehicleID, v.Model, v.RegistrationNumber,
+           r.RentalDate, r.ReturnDate, r.TotalAmount, r.LateFee
+    FROM Rental r
+    JOIN User u ON r.UserID = u.UserID
+    JOIN Vehicle v ON r.VehicleID = v.VehicleID
+    WHERE r.Status = 'Active'
+"""
+
+USER_RESERVATIONS = """
+    SELECT r.RentalID, r.VehicleID, v.Model, v.VehicleType, r.RentalDate,
+           r.ReturnDate, r.TotalAmount
+    FROM Rental r
+    JOIN Vehicle v ON r.VehicleID = v.VehicleID
+    WHERE r.UserID = %s AND r.Status = 'Reserved'
+    ORDER BY r.RentalDate, r.RentalID
+"""
+
+UTILIZATION = """
+    SELECT VehicleType,
+           SUM(CASE WHEN Status = 'Rented' THEN 1 ELSE 0 END) AS Rented,
+           SUM(CASE WHEN Status <> 'Maintenance' THEN 1 ELSE 0 END) AS InService
+    FROM Vehicle
+    GROUP BY VehicleType
+"""
+
+USER_PAYMENTS = """
+    SELECT p.PaymentID, p.PaymentDate, p.Amount, p.PaymentMode,
+           r.RentalID, v.Model, v.VehicleType
+    FROM Payment p
+    JOIN Rental r ON p.RentalID = r.RentalID
+    JOIN Vehicle v ON r.VehicleID = v.VehicleID
+    WHERE r.UserID = %s
+"""
+
+USER_PAYMENTS_ARCHIVED = """
+    SELECT p.PaymentID, p.PaymentDate, p.Amount, p.PaymentMode,
+           p.RentalID, v.Model, v.VehicleType
+    FROM PaymentArchive p
+    JOIN Vehicle v ON p.VehicleID = v.VehicleID
+    WHERE p.UserID = %s
+"""
+
+RECENT_RENTALS = """
+    SELECT r.RentalID, u.Name AS Customer, v.Model,
+           r.RentalDate, r.ReturnDate, r.Status, r.TotalAmount
+    FROM {table} r
+    JOIN User u ON r.UserID = u.UserID
+    JOIN Vehicle v ON r.VehicleID = v.VehicleID
+    WHERE 1=1
+"""
+
+RENTAL_COLUMNS = ", ".join(archive.RENTAL_COLUMNS)
+PAYMENT_COLUMNS = ", ".join(archive.PAYMENT_COLUMNS)
+
+
+def _is_constraint_error(e):
+    # mysql.connector and sqlite3 both call it IntegrityError
+    return type(e).__name__ == "IntegrityError"
+
+
+def _shards_from(after, descending=False):
+    # the shards a keyset listing on a VehicleID / RentalID / PaymentID
+    # continues on after `after`, in key order
+    count = shards.count()
+    if descending:
+        top = count - 1 if after is None else min(shards.shard_of(after), count - 1)
+        return range(top, -1, -1)
+    return range(0 if after is None else max(shards.shard_of(after), 0), count)
+
+
+def _by_shard(ids):
+    # {shard: [id, ...]}, each list in the order given
+    out = {}
+    for row_id in ids:
+        out.setdefault(shards.home(row_id), []).append(row_id)
+    return out
+
+
+class _Repository:
+
+    def __init__(self, store):
+        self.store = store
+
+    @contextlib.contextmanager
+    def _write(self, shard=None):
+        # a cursor whose work is committed on success, rolled back
+        # otherwise; always on the primary -- of `shard`, by default the
+        # one the caller is on
+        with primary(), on_shard(current_shard() if shard is None else shard):
+            cn = get_db()
+        cur = cn.cursor()
+        try:
+            yield cur
+            cn.commit()
+        except Exception as e:
+            cn.rollback()
+            if _is_constraint_error(e):
+                raise ConstraintError(str(e)) from e
+            raise
+        finally:
+            cur.close()
+
+    def _one(self, sql, params=()):
+        cur = get_db().cursor(dictionary=True)
+        cur.execute(sql, params)
+        row = cur.fetchone()
+        cur.close()
+        return row
+
+    def _all(self, sql, params=()):
+        cur = get_db().cursor(dictionary=True)
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+
+    # ---------- across shards ----------
+
+    def _replicate(self, fn):
+        # repeats a reference-table write, fn(cur), on the other shards
+        # once shard 0 -- the one read -- has committed it
+        def write():
+            with self._write() as cur:
+                fn(cur)
+        if shards.sharded():
+            shards.fan_out(write, range(1, shards.count()))
+
+    def _chained_page(self, fetch, key, after, limit, descending=False):
+        # a keyset page of a listing on a shard-ranged ID: the shards' own
+        # listings one after the other, each read only while the page isn't
+        # full; fetch(after, n) returns up to n rows of the shard it's on
+        rows = []
+        for shard in _shards_from(after, descending):
+            with on_shard(shard):
+                rows.extend(fetch(after, limit + 1 - len(rows)))
+            if len(rows) > limit:
+                break
+        return pagination.Page(rows, key, after, limit)
+
+    def _chained_stream(self, query, after=None, descending=False):
+        # the same for a stream: query(after) is the (sql, params) of the
+        # shard's own listing, each streamed from that shard's connection
+        for shard in _shards_from(after, descending):
+            with on_shard(shard):
+                cn = get_db()
+            yield from pagination.stream_query(cn, *query(after))
+
+    def _latest(self, fetch, key, limit):
+        # the `limit` rows with the highest `key` of a listing not ranged
+        # by shard (the recent lists, on dates): every shard's own first
+        # `limit`, fetched concurrently, merged
+        rows = shards.gather(fetch)
+        rows.sort(key=lambda row: row[key], reverse=True)
+        return rows[:limit]
+
+
+class SQLBranches(_Repository, BranchRepository):
+
+    def _rows(self):
+        with on_shard(0):
+            return shards.get_branches().rows(primary_db())
+
+    def all(self):
+        return list(self._rows().values())
+
+    def shard_of(self, branch_id):
+        return shards.branch_shard(self._rows(), branch_id, shards.count())
+
+    def add(self, name, city, shard=0):
+        if not 0 <= shard < shards.count():
+            raise ConstraintError("there is no shard %s (see DB_SHARDS)" % shard)
+        with self._write(0) as cur:
+            cur.execute("INSERT INTO Branch (Name, City, Shard) VALUES (%s, %s, %s)",
+                        (name, city, shard))
+            branch_id = cur.lastrowid
+        self._replicate(lambda cur: cur.execute(
+            "INSERT INTO Branch (BranchID, Name, City, Shard) VALUES (%s, %s, %s, %s)",
+            (branch_id, name, city, shard)))
+        shards.invalidate_branches()
+        httpcache.bump("vehicles")
+        return branch_id
+
+    def shard_stats(self):
+        branches = self.all()
+        out = []
+        for shard in shards.all_shards():
+            first, end = shards.id_range(shard)
+            out.append({"shard": shard, "ids": [first, end - 1],
+                        "branches": [row["BranchID"] for row in branches
+                                     if row["Shard"] == shard],
+                        "pool": get_shard_pool(shard).stats()})
+        return {"shards": out, "fanout": shards.get_fanout().stats()}
+
+
+class SQLVehicles(_Repository, VehicleRepository):
+
+    def get(self, vehicle_id):
+        with on_shard(shards.home(vehicle_id)):
+            return self._one("SELECT * FROM Vehicle WHERE VehicleID=%s", (vehicle_id,))
+
+    def search(self, status=None, vehicle_type="", model="", max_price=None,
+               after=None, limit=None, branch=None):
+        return search.get_index().search(
+            shards.all_db(), status=status, vehicle_type=vehicle_type, model=model,
+            max_price=max_price, after=after, limit=limit, branch=branch)
+
+    def iter_search(self, status=None, vehicle_type="", model="", max_price=None, after=None,
+                    branch=None):
+        return search.get_index().iter_search(
+            shards.all_db(), status=status, vehicle_type=vehicle_type, model=model,
+            max_price=max_price, after=after, branch=branch)
+
+    def rank(self, status=None, vehicle_type="", model="", max_price=None, branch=None,
+             limit=None):
+        return search.get_index().rank(
+            shards.all_db(), status=status, vehicle_type=vehicle_type, model=model,
+            max_price=max_price, branch=branch, limit=limit)
+
+    def complete(self, field, prefix, limit=8):
+        return search.get_index().complete(shards.all_db(), field, prefix, limit)
+
+    def search_stats(self):
+        return search.get_index().stats()
+
+    def status_counts(self, branch=None):
+        return search.get_index().counts(shards.all_db(), branch)
+
+    def free_between(self, start, end, vehicle_type="", model="", max_price=None, branch=None,
+                     ranked=False):
+        status = "Available" if start <= datetime.date.today() else None
+        find = self.rank if ranked else self.search
+        rows = [row for row in find(status=status, vehicle_type=vehicle_type, model=model,
+                                    max_price=max_price, branch=branch)
+                if row["Status"] != "Maintenance"]
+        free = set(reservations.get_index().free(
+            shards.all_db(), [row["VehicleID"] for row in rows], start, end))
+        return [row for row in rows if row["VehicleID"] in free]
+
+    def reservation_stats(self):
+        return reservations.get_index().stats()
+
+    def utilization(self):
+        out = {}
+        for row in shards.gather(lambda: self._all(UTILIZATION)):
+            rented, in_service = out.get(row["VehicleType"], (0, 0))
+            out[row["VehicleType"]] = (rented + row["Rented"], in_service + row["InService"])
+        return out
+
+    def page(self, after, limit):
+        return self._chained_page(
+            lambda after, n: self._all(*pagination.keyset_query(
+                "SELECT * FROM Vehicle WHERE 1=1", (), "VehicleID", after, n)),
+            "VehicleID", after, limit)
+
+    def stream(self, after=None):
+        return self._chained_stream(lambda after: pagination.keyset_query(
+            "SELECT * FROM Vehicle WHERE 1=1", (), "VehicleID", after), after)
+
+    def _taken_elsewhere(self, shard, regnos):
+        # those of `regnos` (casefolded) the other shards' fleets have:
+        # RegistrationNumber is UNIQUE per database only, so across shards
+        # it is checked here -- best effort, two branches adding the same
+        # number at the same moment both get it
+        others = [s for s in shards.all_shards() if s != shard]
+        if not others or not regnos:
+            return set()
+        sql = ("SELECT RegistrationNumber FROM Vehicle WHERE RegistrationNumber IN ("
+               + ", ".join(["%s"] * len(regnos)) + ")")
+        return {row["RegistrationNumber"].casefold()
+                for row in shards.gather(lambda: self._all(sql, list(regnos)), others)}
+
+    def add(self, vehicle_type, model, regno, price, status="Available", branch_id=1):
+        shard = self.store.branches.shard_of(branch_id)
+        if self._taken_elsewhere(shard, [regno]):
+            raise ConstraintError("RegistrationNumber %s already exists" % regno)
+        with self._write(shard) as cur:
+            cur.execute("""
+                INSERT INTO Vehicle (VehicleType, Model, RegistrationNumber, RentalPrice, Status,
+                                     BranchID)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (vehicle_type, model, regno, price, status, branch_id))
+            vehicle_id = cur.lastrowid
+            aggregates.bump(cur, total_vehicles=1)
+        search.put({"VehicleID": vehicle_id, "VehicleType": vehicle_type, "Model": model,
+                    "RegistrationNumber": regno, "RentalPrice": price, "Status": status,
+                    "BranchID": branch_id})
+        httpcache.bump("vehicles")
+        eventlog.append(eventlog.status_changed(vehicle_id, status))
+        return vehicle_id
+
+    def update(self, vehicle_id, vehicle_type, model, regno, price, status, branch_id=None):
+        shard = shards.home(vehicle_id)
+        if branch_id is not None and self.store.branches.shard_of(branch_id) != shard:
+            raise ConstraintError("vehicle %s can't move to branch %s: that branch's fleet is "
+                                  "in another database" % (vehicle_id, branch_id))
+        if self._taken_elsewhere(shard, [regno]):
+            raise ConstraintError("RegistrationNumber %s already exists" % regno)
+        with self._write(shard) as cur:
+            cur.execute("""
+                UPDATE Vehicle
+                SET VehicleType=%s, Model=%s, RegistrationNumber=%s,
+                    RentalPrice=%s, Status=%s, BranchID=COALESCE(%s, BranchID)
+                WHERE VehicleID=%s
+            """, (vehicle_type, model, regno, price, status, branch_id, vehicle_id))
+            updated = cur.rowcount > 0
+            if updated and branch_id is None:
+                cur.execute("SELECT BranchID FROM Vehicle WHERE VehicleID=%s", (vehicle_id,))
+                branch_id = cur.fetchone()[0]
+        if updated:
+            search.put({"VehicleID": vehicle_id, "VehicleType": vehicle_type, "Model": model,
+                        "RegistrationNumber": regno, "RentalPrice": price, "Status": status,
+                        "BranchID": branch_id})
+        httpcache.bump("vehicles")
+        eventlog.append(eventlog.status_changed(vehicle_id, status))
+
+    def set_status(self, vehicle_id, status):
+        with self._write(shards.home(vehicle_id)) as cur:
+            cur.execute("UPDATE Vehicle SET Status=%s WHERE VehicleID=%s", (status, vehicle_id))
+        search.set_status(vehicle_id, status)
+        httpcache.bump("vehicles")
+        eventlog.append(eventlog.status_changed(vehicle_id, status))
+
+    def delete(self, vehicle_id):
+        with self._write(shards.home(vehicle_id)) as cur:
+            # the vehicle's rentals and payments go with it (ON DELETE CASCADE)
+            rentals, revenue = aggregates.cascade_deltas(cur, "VehicleID", vehicle_id)
+            cur.execute("DELETE FROM Vehicle WHERE VehicleID=%s", (vehicle_id,))
+            deleted = cur.rowcount > 0
+            if deleted:
+                archived, archived_revenue = archive.cascade(cur, "VehicleID", vehicle_id)
+                aggregates.bump(cur, total_vehicles=-1, total_rentals=-(rentals + archived),
+                                total_revenue=-(revenue + archived_revenue))
+        search.discard(vehicle_id)
+        reservations.invalidate(vehicle_id)
+        httpcache.bump("vehicles", "rentals", "payments")
+        if deleted:
+            eventlog.append(eventlog.status_changed(vehicle_id, "Deleted"))
+        return deleted
+
+    def import_records(self, records, chunk_size, max_errors, branch_id=1):
+        shard = self.store.branches.shard_of(branch_id)
+        with on_shard(shard):
+            last = self._one("SELECT MAX(VehicleID) AS last FROM Vehicle")["last"] or 0
+            with primary():
+                cn = get_db()
+        taken_elsewhere = (functools.partial(self._taken_elsewhere, shard)
+                           if shards.sharded() else None)
+        report = bulk.import_vehicles(cn, records, chunk_size, max_errors, branch_id,
+                                      taken_elsewhere)
+        if report.inserted:
+            search.invalidate()
+            httpcache.bump("vehicles")
+            # the imported rows (and any added meanwhile) got higher IDs
+            with on_shard(shard):
+                added = self._all("SELECT VehicleID, Status FROM Vehicle WHERE VehicleID > %s",
+                                  (last,))
+            eventlog.append(*(eventlog.status_changed(row["VehicleID"], row["Status"])
+                              for row in added))
+        return report
+
+
+class SQLUsers(_Repository, UserRepository):
+    # User is a reference table: read on shard 0, written on every shard
+
+    def get(self, user_id):
+        return self._one(USER_QUERY, (user_id,))
+
+    def by_email(self, email):
+        return self._one("""
+            SELECT u.UserID, u.Name, u.Password, r.RoleName
+            FROM User u
+            LEFT JOIN Role r ON u.RoleID = r.RoleID
+            WHERE u.Email = %s
+        """, (email,))
+
+    def roles(self):
+        return self._all("SELECT RoleID, RoleName FROM Role")
+
+    def role_id(self, role_name):
+        row = self._one("SELECT RoleID FROM Role WHERE RoleName = %s", (role_name,))
+        return row["RoleID"] if row else None
+
+    def page(self, after, limit):
+        return pagination.fetch_page(get_db(), USER_LIST, (), "u.UserID", after, limit)
+
+    def stream(self, after=None):
+        return pagination.stream_rows(get_db(), USER_LIST, (), "u.UserID", after)
+
+    def add(self, name, email, phone, password, role_id):
+        with self._write() as cur:
+            cur.execute("""
+                INSERT INTO User (Name, Email, Phone, Password, RoleID)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (name, email, phone, password, role_id))
+            user_id = cur.lastrowid
+            aggregates.bump(cur, total_users=1)
+
+        def copy(cur):
+            cur.execute("""
+                INSERT INTO User (UserID, Name, Email, Phone, Password, RoleID)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (user_id, name, email, phone, password, role_id))
+            aggregates.bump(cur, total_users=1)
+        self._replicate(copy)
+        return user_id
+
+    def update(self, user_id, name, email, phone, password=None, role_id=None):
+        columns = ["Name=%s", "Email=%s", "Phone=%s"]
+        params = [name, email, phone]
+        if password is not None:
+            columns.append("Password=%s")
+            params.append(password)
+        if role_id is not None:
+            columns.append("RoleID=%s")
+            params.append(role_id)
+        sql = "UPDATE User SET " + ", ".join(columns) + " WHERE UserID=%s"
+        with self._write() as cur:
+            cur.execute(sql, params + [user_id])
+        self._replicate(lambda cur: cur.execute(sql, params + [user_id]))
+
+    def set_role(self, user_id, role_id):
+        with self._write() as cur:
+            cur.execute("UPDATE User SET RoleID=%s WHERE UserID=%s", (role_id, user_id))
+        self._replicate(lambda cur: cur.execute(
+            "UPDATE User SET RoleID=%s WHERE UserID=%s", (role_id, user_id)))
+
+    def replace_password(self, user_id, old, new):
+        # the old value in the WHERE keeps a concurrent password change intact
+        with self._write() as cur:
+            cur.execute("UPDATE User SET Password=%s WHERE UserID=%s AND Password=%s",
+                        (new, user_id, old))
+            replaced = cur.rowcount > 0
+        if replaced:
+            self._replicate(lambda cur: cur.execute(
+                "UPDATE User SET Password=%s WHERE UserID=%s", (new, user_id)))
+        return replaced
+
+    def delete(self, user_id):
+        def delete():
+            with self._write() as cur:
+                # the user's rentals and payments go with it (ON DELETE CASCADE)
+                cur.execute("SELECT DISTINCT VehicleID FROM Rental WHERE UserID=%s "
+                            "AND Status IN ('Active', 'Reserved')", (user_id,))
+                held = [row[0] for row in cur.fetchall()]
+                rentals, revenue = aggregates.cascade_deltas(cur, "UserID", user_id)
+                cur.execute("DELETE FROM User WHERE UserID=%s", (user_id,))
+                deleted = cur.rowcount > 0
+                if deleted:
+                    archived, archived_revenue = archive.cascade(cur, "UserID", user_id)
+                    aggregates.bump(cur, total_users=-1, total_rentals=-(rentals + archived),
+                                    total_revenue=-(revenue + archived_revenue))
+            return deleted, held
+
+        # every shard has the user, and their rentals of its branches' vehicles
+        results = shards.fan_out(delete)
+        for _, held in results:
+            for vehicle_id in held:
+                reservations.invalidate(vehicle_id)
+        httpcache.bump("rentals", "payments")
+        return results[0][0]
+
+
+class SQLRentals(_Repository, RentalRepository):
+
+    def _precheck(self, vehicle_id, start, end):
+        # the interval index turns most conflicts away before any write
+        # lock is taken; the index may be behind, so a hit is re-read first
+        index = reservations.get_index()
+        cn = shards.all_db()
+        if not index.is_free(cn, vehicle_id, start, end):
+            index.invalidate(vehicle_id)
+            if not index.is_free(cn, vehicle_id, start, end):
+                raise booking.BookingConflict(
+                    "vehicle %s is not available from %s" % (vehicle_id, start))
+
+    def _commit(self, shard, fn, *args):
+        # fn(cn, ...) in one transaction on the primary of `shard`
+        with primary(), on_shard(shard):
+            cn = get_db()
+        try:
+            result = fn(cn, *args, backend=self.store.name)
+            cn.commit()
+        except Exception:
+            cn.rollback()
+            raise
+        return result
+
+    def _quote(self, vehicle_id, start, days):
+        # the dashboard's quote for this vehicle; None if there is no such
+        # vehicle (the booking statement then finds nothing to book)
+        vehicle = search.get_index().get(shards.all_db(), vehicle_id)
+        if vehicle is None:
+            return None
+        return pricing.get_engine().quote(self.store, vehicle, start, days)
+
+    def book(self, user_id, vehicle_id, days):
+        days = max(1, days)
+        today = datetime.date.today()
+        self._precheck(vehicle_id, today, today + datetime.timedelta(days=days))
+        total = self._quote(vehicle_id, today, days)
+        result = self._commit(shards.home(vehicle_id), booking.book_vehicle, user_id, vehicle_id,
+                              days, total)
+        # trg_rental_insert_status marked it 'Rented'
+        search.set_status(vehicle_id, "Rented")
+        search.rented(vehicle_id)
+        reservations.invalidate(vehicle_id)
+        httpcache.bump("rentals", "vehicles")
+        eventlog.append(eventlog.booked(result[0], user_id, vehicle_id, result[1], today, days))
+        return result
+
+    def reserve(self, user_id, vehicle_id, start, days):
+        self._precheck(vehicle_id, start, start + datetime.timedelta(days=days))
+        total = self._quote(vehicle_id, start, days)
+        result = self._commit(shards.home(vehicle_id), booking.reserve_vehicle, user_id,
+                              vehicle_id, start, days, total)
+        search.rented(vehicle_id)
+        reservations.invalidate(vehicle_id)
+        httpcache.bump("rentals")
+        eventlog.append(eventlog.reserved(result[0], user_id, vehicle_id, result[1], start, days))
+        return result
+
+    def cancel(self, rental_id, user_id=None):
+        vehicle_id = self._commit(shards.home(rental_id), booking.cancel_reservation, rental_id,
+                                  user_id)
+        if vehicle_id is None:
+            return False
+        search.rented(vehicle_id, -1)
+        reservations.invalidate(vehicle_id)
+        httpcache.bump("rentals")
+        eventlog.append(eventlog.cancelled(rental_id, user_id, vehicle_id))
+        return True
+
+    def pick_up(self, rental_id, user_id=None):
+        vehicle_id = self._commit(shards.home(rental_id), booking.pick_up, rental_id, user_id)
+        if vehicle_id is None:
+            return False
+        # trg_rental_update_status marked it 'Rented'
+        search.set_status(vehicle_id, "Rented")
+        httpcache.bump("rentals", "vehicles")
+        eventlog.append(eventlog.picked_up(rental_id, user_id, vehicle_id))
+        return True
+
+    def reservations_for_user(self, user_id):
+        rows = shards.gather(lambda: self._all(USER_RESERVATIONS, (user_id,)))
+        rows.sort(key=lambda row: (row["RentalDate"], row["RentalID"]))
+        return rows
+
+    def return_rentals(self, rental_ids, user_id=None, payment_mode="Cash"):
+        # one transaction per shard the rentals are on (a branch's returns
+        # are all on one)
+        ids = list(dict.fromkeys(int(r) for r in rental_ids))
+        results, returned = {}, []
+        for shard, group in _by_shard(ids).items():
+            got, rows = self._commit(shard, booking.return_rentals, group, user_id, payment_mode)
+            results.update(got)
+            returned.extend(rows)
+        results = {rid: results[rid] for rid in ids}
+        order = {rid: i for i, rid in enumerate(ids)}
+        returned.sort(key=lambda row: order[row["RentalID"]])
+        # trg_rental_update_status freed the vehicles
+        for vehicle_id in {row["VehicleID"] for row in returned}:
+            search.set_status(vehicle_id, "Available")
+            reservations.invalidate(vehicle_id)
+        if returned:
+            httpcache.bump("rentals", "vehicles", "payments")
+            today = datetime.date.today()
+            eventlog.append(*(eventlog.returned(row, payment_mode, today) for row in returned))
+        return results, returned
+
+    def active_for_user(self, user_id):
+        return shards.gather(lambda: self._all("""
+            SELECT r.RentalID, v.Model, v.VehicleType, r.RentalDate,
+                   r.ReturnDate, r.Status, r.TotalAmount, r.LateFee, r.OverdueSince
+            FROM Rental r
+            JOIN Vehicle v ON r.VehicleID = v.VehicleID
+            WHERE r.UserID = %s AND r.Status = 'Active'
+        """, (user_id,)))
+
+    def mark_overdue(self, today):
+        # one statement per shard over idx_rental_status_return (Status, ReturnDate)
+        def mark():
+            with self._write() as cur:
+                cur.execute("""
+                    UPDATE Rental SET OverdueSince = ReturnDate
+                    WHERE Status = 'Active' AND ReturnDate < %s AND OverdueSince IS NULL
+                """, (today,))
+                return cur.rowcount
+
+        marked = sum(shards.fan_out(mark))
+        if marked:
+            httpcache.bump("rentals")
+        return marked
+
+    def accrue_late_fees(self, today, rate):
+        # rows whose fee is already right are left alone, so a re-run on
+        # the same day writes nothing
+        fee = ("ROUND((TO_DAYS(%s) - TO_DAYS(ReturnDate)) * %s * "
+               "(SELECT v.RentalPrice FROM Vehicle v WHERE v.VehicleID = Rental.VehicleID), 2)")
+
+        def accrue():
+            with self._write() as cur:
+                cur.execute("UPDATE Rental SET LateFee = " + fee + """
+                    WHERE Status = 'Active' AND ReturnDate < %s AND LateFee <> """ + fee,
+                            (today, rate, today, today, rate))
+                charged = cur.rowcount
+                cur.execute("""
+                    SELECT COUNT(*), IFNULL(SUM(LateFee), 0) FROM Rental
+                    WHERE Status = 'Active' AND ReturnDate < %s
+                """, (today,))
+                overdue, total = cur.fetchone()
+            return charged, overdue, float(total)
+
+        results = shards.fan_out(accrue)
+        if any(charged for charged, _, _ in results):
+            httpcache.bump("rentals")
+        return (sum(overdue for _, overdue, _ in results),
+                sum(total for _, _, total in results))
+
+    def active_page(self, after, limit, branch=None):
+        if branch is not None:
+            # a branch's rentals are all on its shard
+            with on_shard(self.store.branches.shard_of(branch)):
+                return pagination.fetch_page(get_db(), ACTIVE_RENTALS + " AND v.BranchID = %s",
+                                             (branch,), "r.RentalID", after, limit)
+        return self._chained_page(
+            lambda after, n: self._all(*pagination.keyset_query(
+                ACTIVE_RENTALS, (), "r.RentalID", after, n)),
+            "r.RentalID", after, limit)
+
+    def recent(self, limit=10):
+        # the archive side is an empty range on its date index unless the
+        # live table is nearly empty
+        return self._latest(lambda: self._all(*pagination.union_query(
+            [(RECENT_RENTALS.format(table="Rental"), (), "r.RentalDate"),
+             (RECENT_RENTALS.format(table="RentalArchive"), (), "r.RentalDate")],
+            "RentalDate", limit=limit, descending=True)), "RentalDate", limit)
+
+    def stream(self, after=None):
+        # archived rentals first, shard by shard
+        return self._chained_stream(lambda after: pagination.union_query(
+            [("SELECT " + RENTAL_COLUMNS + " FROM RentalArchive WHERE 1=1", (), "RentalID"),
+             ("SELECT " + RENTAL_COLUMNS + " FROM Rental WHERE 1=1", (), "RentalID")],
+            "RentalID", after, ordered=False), after)
+
+    def archive(self, before, batch_size, max_batches):
+        cfg = current_app.config
+
+        def run():
+            with primary():
+                cn = get_db()
+            result = archive.archive(cn, before, batch_size, max_batches, cfg["ARCHIVE_GRACE"])
+            if result["rentals"] and self.store.name == "sqlite":
+                # statistics taken while the archive was empty would keep
+                # the planner off its indexes
+                sqlite_compat.analyze(cn, ("Rental", "Payment", "RentalArchive",
+                                           "PaymentArchive"))
+            return result
+
+        results = shards.fan_out(run)
+        if len(results) == 1:
+            return results[0]
+        out = {key: sum(result[key] for result in results)
+               for key in ("rentals", "payments", "batches")}
+        out.update(before=results[0]["before"], done=all(r["done"] for r in results),
+                   seconds=max(r["seconds"] for r in results))
+        return out
+
+    def archive_state(self):
+        def state():
+            with primary():
+                return archive.state(get_db())
+
+        states = shards.fan_out(state)
+        if len(states) == 1:
+            return states[0]
+        horizons = [s["ArchivedBefore"] for s in states if s["ArchivedBefore"] is not None]
+        runs = [s["LastRun"] for s in states if s["LastRun"] is not None]
+        return {"ArchivedBefore": min(horizons) if horizons else None,
+                "Rentals": sum(s["Rentals"] for s in states),
+                "Payments": sum(s["Payments"] for s in states),
+                "LastRun": max(runs) if runs else None}
+
+
+class SQLPayments(_Repository, PaymentRepository):
+
+    def _for_user(self, user_id):
+        # live and archived payments, each side a range of its own index
+        return [(USER_PAYMENTS, (user_id,), "p.PaymentID"),
+                (USER_PAYMENTS_ARCHIVED, (user_id,), "p.PaymentID")]
+
+    def for_user_page(self, user_id, after, limit):
+        parts = self._for_user(user_id)
+        return self._chained_page(
+            lambda after, n: self._all(*pagination.union_query(
+                parts, "PaymentID", after, n, descending=True)),
+            "PaymentID", after, limit, descending=True)
+
+    def for_user_stream(self, user_id, after=None):
+        parts = self._for_user(user_id)
+        return self._chained_stream(lambda after: pagination.union_query(
+            parts, "PaymentID", after, descending=True), after, descending=True)
+
+    def recent(self, limit=10):
+        return self._latest(lambda: self._all(*pagination.union_query(
+            [("SELECT " + PAYMENT_COLUMNS + " FROM " + table + " WHERE 1=1", (), "PaymentDate")
+             for table in ("Payment", "PaymentArchive")],
+            "PaymentDate", limit=limit, descending=True)), "PaymentDate", limit)
+
+    def stream(self, after=None):
+        # archived payments first, shard by shard
+        return self._chained_stream(lambda after: pagination.union_query(
+            [("SELECT " + PAYMENT_COLUMNS + " FROM " + table + " WHERE 1=1", (), "PaymentID")
+             for table in ("PaymentArchive", "Payment")],
+            "PaymentID", after, ordered=False), after)
+
+
+class SQLPricing(_Repository, PricingRepository):
+
+    def rules(self):
+        return self._all("SELECT * FROM PricingRule ORDER BY RuleID")
+
+    def add_rule(self, rule):
+        with self._write() as cur:
+            cur.execute("""
+                INSERT INTO PricingRule (Kind, VehicleType, StartDate, EndDate, Threshold, Multiplier)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (rule["Kind"], rule["VehicleType"], rule["StartDate"], rule["EndDate"],
+                  rule["Threshold"], rule["Multiplier"]))
+            rule_id = cur.lastrowid
+        pricing.invalidate()
+        httpcache.bump("pricing")
+        return rule_id
+
+    def update_rule(self, rule_id, rule):
+        with self._write() as cur:
+            cur.execute("""
+                UPDATE PricingRule
+                SET Kind=%s, VehicleType=%s, StartDate=%s, EndDate=%s, Threshold=%s, Multiplier=%s
+                WHERE RuleID=%s
+            """, (rule["Kind"], rule["VehicleType"], rule["StartDate"], rule["EndDate"],
+                  rule["Threshold"], rule["Multiplier"], rule_id))
+        pricing.invalidate()
+        httpcache.bump("pricing")
+
+    def delete_rule(self, rule_id):
+        with self._write() as cur:
+            cur.execute("DELETE FROM PricingRule WHERE RuleID=%s", (rule_id,))
+            deleted = cur.rowcount > 0
+        pricing.invalidate()
+        httpcache.bump("pricing")
+        return deleted
+
+
+class SQLReports(_Repository, ReportRepository):
+
+    def totals(self):
+        # kept up to date by the write paths (see aggregates.py); every
+        # shard counts all the users, and its own vehicles, rentals and
+        # revenue
+        parts = shards.fan_out(lambda: aggregates.read_totals(get_db()))
+        totals = dict(parts[0])
+        for part in parts[1:]:
+            for metric in aggregates.METRICS:
+                if metric != "total_users":
+                    totals[metric] += part[metric]
+        return totals
+
+    def reconcile(self):
+        def run():
+            with primary():
+                return aggregates.reconcile(get_db())
+
+        drift = {}
+        for shard, found in zip(shards.all_shards(), shards.fan_out(run)):
+            for metric, value in found.items():
+                drift[metric if not shard else "%s (shard %d)" % (metric, shard)] = value
+        return drift
+
+    def analytics_source(self):
+        # the closed days it reads are cached
+        size = current_app.config["ANALYTICS_FETCH_SIZE"]
+        if not shards.sharded():
+            return analytics.SQLSource(primary_db(), size)
+        return analytics.ShardedSource(lambda: analytics.SQLSource(primary_db(), size),
+                                       shards.fan_out)
+
+
+class SQLJobs(_Repository, JobRepository):
+
+    def states(self):
+        return self._all("SELECT * FROM JobState ORDER BY JobName")
+
+    def claim(self, name, owner, lease, interval, now):
+        if self._one("SELECT JobName FROM JobState WHERE JobName=%s", (name,)) is None:
+            try:
+                with self._write() as cur:
+                    cur.execute("INSERT INTO JobState (JobName) VALUES (%s)", (name,))
+            except ConstraintError:
+                pass    # another process inserted it first
+        # the conditional UPDATE is the lock: of two processes claiming
+        # at once, only one matches the row
+        with self._write() as cur:
+            cur.execute("""
+                UPDATE JobState SET LockedBy=%s, LockedUntil=%s, LastStarted=%s
+                WHERE JobName=%s
+                  AND (LockedBy IS NULL OR LockedUntil < %s)
+                  AND (LastStarted IS NULL OR LastStarted <= %s)
+            """, (owner, now + lease, now, name, now, now - interval))
+            return cur.rowcount == 1
+
+    def finish(self, name, owner, status, duration, result, now):
+        with self._write() as cur:
+            cur.execute("""
+                UPDATE JobState
+                SET LockedBy=NULL, LockedUntil=NULL, LastFinished=%s, LastStatus=%s,
+                    LastDuration=%s, LastResult=%s, Runs=Runs+1, Failures=Failures+%s
+                WHERE JobName=%s AND LockedBy=%s
+            """, (now, status, duration, result, int(status != "ok"), name, owner))
+            return cur.rowcount == 1
+
+
+class SQLStore(Store):
+
+    def __init__(self):
+        self.branches = SQLBranches(self)
+        self.vehicles = SQLVehicles(self)
+        self.users = SQLUsers(self)
+        self.rentals = SQLRentals(self)
+        self.payments = SQLPayments(self)
+        self.pricing = SQLPricing(self)
+        self.reports = SQLReports(self)
+        self.jobs = SQLJobs(self)
+
+    def stats(self):
+        return get_pool().stats()
+
+    def close(self):
+        get_pool().close()
+        for pool in current_app.extensions.get("vrms_shard_pools", {}).values():
+            pool.close()
+        fanout = current_app.extensions.get("vrms_fanout")
+        if fanout is not None:
+            fanout.close()
+
+
+class MySQLStore(SQLStore):
+    name = "mysql"
+
+
+class SQLiteStore(SQLStore):
+    name = "sqlite"
@@ -0,0 +1,163 @@
+import collections
+import threading
+import time
+
+from flask import current_app
+
+import cachebus
+import database
+import storage
+
+# In-process cache of User rows (with their RoleName) and of the Role table.
+#
+# A before_request hook looks the logged-in user up here on every request
+# and refreshes session["role"] / session["name"], so an admin changing a
+# role (or deleting a user) takes effect on that user's next click instead
+# of at their next login. Most lookups are hits and never touch the
+# database.
+#
+# Every write to a User row calls invalidate(user_id) after committing;
+# other app processes drop the entry too (cachebus). The TTL bounds how
+# stale an entry can get when the row is changed outside the app (the SQL
+# console).
+
+DEFAULTS = {
+    "USER_CACHE_SIZE": 10000,
+    "USER_CACHE_TTL": 60.0,
+}
+
+ROLES = "roles"     # cache key for the Role table
+
+
+class LRUCache:
+    # entries expire after `ttl` seconds; beyond `max_size` the least
+    # recently used one is evicted
+
+    def __init__(self, max_size=10000, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()     # key -> (expires, value)
+        self._generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, load):
+        # cached value, or load(key) on a miss; None results are not cached
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        value = load(key)
+
+        with self._lock:
+            # an invalidate() while we were loading means `value` may
+            # already be stale: hand it out but don't keep it
+            if value is not None and generation == self._generation:
+                self._data[key] = (time.monotonic() + self.ttl, value)
+                self._data.move_to_end(key)
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def prune(self):
+        # drops the expired entries; how many
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (expires, _) in self._data.items() if expires <= now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+# ---------- LOADERS ----------
+
+# from the primary even in a database.read_only view: a replica's copy
+# could be behind a change the cache was just told about
+
+def _load_user(user_id):
+    with database.primary():
+        return storage.get_store().users.get(user_id)
+
+
+def _load_roles(key):
+    with database.primary():
+        return storage.get_store().users.roles()
+
+
+_cache_lock = threading.Lock()
+
+
+def init_app(app):
+    for key, value in DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+
+def get_cache(app=None):
+    app = app or current_app
+    cache = app.extensions.get("vrms_users")
+    if cache is None:
+        with _cache_lock:
+            cache = app.extensions.get("vrms_users")
+            if cache is None:
+                cache = LRUCache(max_size=app.config["USER_CACHE_SIZE"],
+                                 ttl=app.config["USER_CACHE_TTL"])
+                app.extensions["vrms_users"] = cache
+    return cache
+
+
+def get_user(user_id):
+    # UserID, Name, Email, Phone, RoleID, RoleName -- or None; a copy,
+    # so callers may modify it
+    user = get_cache().get(int(user_id), _load_user)
+    return dict(user) if user is not None else None
+
+
+def get_roles():
+    return [dict(r) for r in get_cache().get(ROLES, _load_roles)]
+
+
+def invalidate(user_id=None):
+    # after committing a write to User (None = everything, roles included)
+    get_cache().invalidate(int(user_id) if user_id is not None else None)
+    cachebus.publish("users", user_id)
+
+
+@cachebus.handler("users")
+def _changed_elsewhere(app, user_id):
+    cache = app.extensions.get("vrms_users")
+    if cache is not None:
+        cache.invalidate(user_id)
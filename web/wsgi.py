@@ -0,0 +1,8 @@
+from app import app as application
+
+# Production WSGI entry point, for any WSGI server instead of the
+# development server in app.py, e.g.
+#
+#   gunicorn --workers 4 --threads 16 wsgi:application
+#
+# For the ASGI server (uvicorn) see asgi.py.